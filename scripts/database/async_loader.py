@@ -0,0 +1,195 @@
+"""
+Asyncio post loader overlapping parsing with database round-trips.
+
+A producer decodes byte ranges of `posts.json` in a thread (or a process pool)
+into a bounded queue while the writer sends the previous range. The four
+tables of a range are written in one transaction: with `insert` the statements
+are sent as one libpq pipeline, with `copy` the COPY streams run back to back,
+since COPY cannot be pipelined.
+"""
+from typing import Optional, List, Sequence, Iterable, Any, Callable
+from concurrent.futures import ThreadPoolExecutor
+from pathlib import Path
+import asyncio
+import contextlib
+from psycopg import AsyncConnection, Connection
+from instrument import stage
+from loader import LoadOptions, InsertMethod, OnConflict, ASSOC_TYPES, conflict_clause, stage_table
+from parallel import (POST_COLUMNS, POST_TYPES, VARIANT_COLUMNS, VARIANT_TYPES, FILE_COLUMNS,
+                      FILE_TYPES, TAG_ARRAY_COLUMNS, PostRows, resolve_tags, split_chunks,
+                      transform_ranges)
+from tag_dict import TagDict, UnknownTags
+
+
+async def insert_rows_async(aconn: AsyncConnection,
+                            table_name: str,
+                            columns: Sequence[str],
+                            types: Sequence[str],
+                            rows: List[Sequence[Any]],
+                            conflict: OnConflict = "error") -> int:
+    """
+    Insert rows with a single `INSERT ... SELECT FROM unnest(...)` of one array per column.
+
+    An async `executemany` waits on the event loop for every row, a statement
+    per table keeps the whole range in a handful of pipelined messages. `unnest`
+    flattens nested arrays, so array columns (of numbers) are sent as text.
+    """
+    if not rows:
+        return 0
+    params: List[List[Any]] = []
+    arrays, values = [], []
+    for i, (t, column) in enumerate(zip(types, zip(*rows))):
+        if t.endswith("[]"):
+            params.append(["{" + ",".join(map(str, value)) + "}" for value in column])
+            arrays.append("%s::text[]")
+            values.append(f"c{i}::{t}")
+        else:
+            params.append(list(column))
+            arrays.append(f"%s::{t}[]")
+            values.append(f"c{i}")
+    names = ",".join(f"c{i}" for i in range(len(types)))
+    sql = (f"INSERT INTO {table_name} ({','.join(columns)}) SELECT {','.join(values)} "
+           f"FROM unnest({','.join(arrays)}) AS u({names})" +
+           conflict_clause(table_name, columns, conflict))
+    await aconn.execute(sql, params)    # type: ignore
+    return len(rows)
+
+
+async def copy_rows_async(aconn: AsyncConnection,
+                          table_name: str,
+                          columns: Sequence[str],
+                          types: Sequence[str],
+                          rows: Iterable[Sequence[Any]],
+                          conflict: OnConflict = "error") -> int:
+    """Async `copy_rows`, merging through a staging table unless `conflict` is `error`"""
+    count = 0
+    clause = conflict_clause(table_name, columns, conflict)
+    target = stage_table(table_name) if clause else table_name
+    sql = f"COPY {target} ({','.join(columns)}) FROM STDIN (FORMAT BINARY)"
+    async with aconn.cursor() as c:
+        if clause:
+            await c.execute(f"CREATE TEMP TABLE IF NOT EXISTS {target} "    # type: ignore
+                            f"(LIKE {table_name}) ON COMMIT DROP")
+            await c.execute(f"TRUNCATE {target}")    # type: ignore
+        async with c.copy(sql) as copy:    # type: ignore
+            copy.set_types(types)
+            for row in rows:
+                await copy.write_row(row)
+                count += 1
+        if clause:
+            cols = ",".join(columns)
+            await c.execute(    # type: ignore
+                f"INSERT INTO {table_name} ({cols}) SELECT {cols} FROM {target}" + clause)
+    return count
+
+
+async def write_rows_async(aconn: AsyncConnection,
+                           table_name: str,
+                           columns: Sequence[str],
+                           types: Sequence[str],
+                           rows: List[Sequence[Any]],
+                           method: InsertMethod = "insert",
+                           conflict: OnConflict = "error") -> int:
+    if method == "copy":
+        return await copy_rows_async(aconn, table_name, columns, types, rows, conflict)
+    return await insert_rows_async(aconn, table_name, columns, types, rows, conflict)
+
+
+async def write_post_rows_async(aconn: AsyncConnection,
+                                rows: PostRows,
+                                tag_ids: List[tuple[int, int]],
+                                opts: LoadOptions = LoadOptions()) -> None:
+    """
+    Async `write_post_rows`, the tags being already resolved into `tag_ids`.
+
+    A pipeline only waits for the server when it is closed, so the transaction
+    of a range is timed as a whole, as the `write` stage of `booru.posts`.
+    """
+    method, conflict = opts.method, opts.conflict
+    assoc = ASSOC_TYPES["booru.posts_tags_assoc"]
+    pipeline = aconn.pipeline() if method == "insert" else contextlib.nullcontext()
+    with stage("booru.posts", "write", rows=len(rows.posts)):
+        async with aconn.transaction():
+            async with pipeline:
+                await write_rows_async(aconn, "booru.posts", POST_COLUMNS, POST_TYPES, rows.posts,
+                                       method, conflict)
+                if conflict != "error":
+                    await aconn.execute(
+                        "DELETE FROM booru.posts_media_variants WHERE post_id = ANY(%s)",
+                        ([row[0] for row in rows.posts],))
+                await write_rows_async(aconn, "booru.posts_media_variants", VARIANT_COLUMNS,
+                                       VARIANT_TYPES, rows.variants, method)
+                await write_rows_async(aconn, "booru.posts_file_urls", FILE_COLUMNS, FILE_TYPES,
+                                       rows.files, method, conflict)
+                await write_rows_async(aconn, "booru.posts_tags_assoc",
+                                       [name for name, _ in assoc], [t for _, t in assoc], tag_ids,
+                                       method, conflict)
+                if opts.tag_arrays:
+                    await write_rows_async(aconn, "booru.posts_tag_arrays", TAG_ARRAY_COLUMNS,
+                                           [t for _, t in ASSOC_TYPES["booru.posts_tag_arrays"]],
+                                           rows.tag_arrays, method, conflict)
+
+
+async def load_posts_async(conninfo: str,
+                           conn: Connection,
+                           path: str | Path,
+                           tags: TagDict,
+                           unknown: UnknownTags,
+                           chunk_size: int,
+                           opts: LoadOptions = LoadOptions(),
+                           workers: int = 0,
+                           queue_depth: int = 2,
+                           start: int = 0,
+                           on_written: Callable[[PostRows, int], None] = lambda *_: None) -> int:
+    """
+    Load `posts.json` from `start`, return the number of posts written.
+
+    Up to `queue_depth` decoded ranges wait for the writer. Ranges are parsed in
+    a thread, or by `workers` processes if it is positive. Unknown tags are
+    handled on the synchronous `conn` by the producer, and committed there so
+    tags created by the policy exist before the posts referencing them.
+    `on_written` gets each committed range and the number of ranges queued.
+    """
+    chunks = split_chunks(path, chunk_size, start)
+    source = transform_ranges(path, chunks, workers, opts.validate_rows, str(tags.path))
+    queue: asyncio.Queue[Optional[tuple[PostRows, List[tuple[int, int]]]]] = asyncio.Queue(
+        maxsize=queue_depth)
+
+    def next_range() -> Optional[tuple[PostRows, List[tuple[int, int]]]]:
+        rows = next(source, None)
+        if rows is None:
+            return None
+        rows = resolve_tags(conn, rows, unknown)
+        conn.commit()
+        return rows, rows.tag_ids
+
+    async def produce() -> None:
+        loop = asyncio.get_running_loop()
+        # a single thread, the source generator must not be advanced concurrently
+        with ThreadPoolExecutor(max_workers=1) as executor:
+            try:
+                while True:
+                    item = await loop.run_in_executor(executor, next_range)
+                    await queue.put(item)
+                    if item is None:
+                        return
+            except Exception:
+                # stop the writer, the error is raised when it awaits the producer
+                await queue.put(None)
+                raise
+
+    count = 0
+    async with await AsyncConnection.connect(conninfo) as aconn:
+        producer = asyncio.create_task(produce())
+        try:
+            while (item := await queue.get()) is not None:
+                rows, tag_ids = item
+                await write_post_rows_async(aconn, rows, tag_ids, opts)
+                count += len(rows.posts)
+                on_written(rows, queue.qsize())
+            await producer
+        finally:
+            producer.cancel()
+            with contextlib.suppress(asyncio.CancelledError):
+                await producer
+    return count
@@ -0,0 +1,354 @@
+"""
+End-to-end benchmarks of the loaders and of the `explore.sql` queries, as JSON.
+
+Runs on the raw files of `--input`, generated by `generate.py` at `--scale`
+when the directory does not exist, against the scratch database
+`<dbname>_bench`, which is dropped and created again for every loader mode:
+
+- convert: records/s of `from_raw` with validation and of the compiled row
+  functions of `models.rows`, for every file
+- load: rows/s of every table for each loader mode of `dump_data.py`, `bulk`
+  also reports the time of `finalize`
+- queries: latency of the views and queries of `explore.sql`, on the database
+  of the last mode (`--mode copy-partitioned` alone for the partitioned tables)
+
+The results of another run given as `--baseline` are compared metric by metric.
+
+    python bench.py --scale 0.1 -o bench_results/today.json
+    python bench.py --mode copy --mode bulk --baseline bench_results/today.json
+"""
+from typing import Dict, Optional, List, NamedTuple, Callable, Any
+from datetime import datetime, timezone
+from itertools import islice
+from pathlib import Path
+from loguru import logger
+from pydantic import BaseModel
+import json
+import platform
+import statistics
+import subprocess
+import tempfile
+import time
+import click
+import psycopg
+from psycopg.sql import SQL, Identifier
+import tomli
+from bench_convert import pydantic_path, row_path, timeit
+from dump_data import Config, create_group, postgres_env_password, read_objs, to_kv_str
+from generate import GenerateOptions, generate
+from loader import InsertMethod
+from models.artist_urls import ArtistUrlEntry
+from models.artists import ArtistEntry
+from models.rows import row_fn
+from models.tag_alias import TagAliasEntry
+from models.tags import TagEntry
+from raw_files import open_raw
+from schema import split_statements
+
+
+class LoadMode(NamedTuple):
+    method: InsertMethod
+    # `--engine` of the posts command, with `--workers` parser processes if parallel
+    engine: str = "sync"
+    parallel: bool = False
+    # unlogged tables without keys, then `finalize`
+    bulk: bool = False
+    # `--partitions` of `create-tables`
+    partitions: Optional[str] = None
+
+
+LOAD_MODES: Dict[str, LoadMode] = {
+    "insert": LoadMode("insert"),
+    "copy": LoadMode("copy"),
+    "copy-parallel": LoadMode("copy", parallel=True),
+    "copy-async": LoadMode("copy", "async", parallel=True),
+    "copy-pooled": LoadMode("copy", "pooled", parallel=True),
+    "copy-partitioned": LoadMode("copy", "partitioned", parallel=True, partitions="year"),
+    "bulk": LoadMode("copy", parallel=True, bulk=True),
+}
+
+# command, `[file_names]` entry and table, in load order
+LOAD_ORDER: List[tuple[str, str, str]] = [
+    ("tags", "tags", "booru.tags"),
+    ("tag-alias", "tag_aliases", "booru.tags_aliases"),
+    ("tag-implications", "tag_implications", "booru.tags_implications"),
+    ("artists", "artists", "booru.artists"),
+    ("artist-urls", "artist_urls", "booru.artists_urls"),
+    ("posts", "posts", "booru.posts"),
+]
+
+# `from_raw` with validation and the compiled row function of every file
+CONVERTERS: Dict[str, tuple[Callable[[Any], Any], Callable[[Any], Any]]] = {
+    "tags": (row_fn(TagEntry, True), row_fn(TagEntry)),
+    "tag_aliases": (row_fn(TagAliasEntry, True), row_fn(TagAliasEntry)),
+    "tag_implications": (row_fn(TagAliasEntry, True), row_fn(TagAliasEntry)),
+    "artists": (row_fn(ArtistEntry, True), row_fn(ArtistEntry)),
+    "artist_urls": (row_fn(ArtistUrlEntry, True), row_fn(ArtistUrlEntry)),
+    "posts": (pydantic_path, row_path),
+}
+
+# the three artist tags with the most posts
+TOP_ARTIST_TAGS = ("ARRAY(SELECT c.tag_id FROM booru.tag_post_counts c "
+                   "JOIN booru.tags t ON t.id = c.tag_id WHERE t.category = 1 "
+                   "ORDER BY c.post_count DESC, c.tag_id LIMIT 3)")
+
+QUERIES: Dict[str, str] = {
+    "artist_view": "SELECT * FROM booru.artist_view",
+    "posts_tag_view_top": "SELECT * FROM booru.posts_tag_view ORDER BY score DESC LIMIT 100",
+    "posts_tag_view_post": "SELECT * FROM booru.posts_tag_view WHERE post_id = 1",
+    "aspect_ratio_buckets": "SELECT aspect_ratio_bucket, count(*) "
+                            "FROM booru.view_post_aspect_ratio GROUP BY aspect_ratio_bucket",
+    "illustration_tag_counts": "SELECT t.name, c.post_count FROM booru.illustration_tag_counts c "
+                               "JOIN booru.tags t ON t.id = c.tag_id "
+                               "ORDER BY c.post_count DESC LIMIT 100",
+    "tag_post_counts": "SELECT t.name, c.post_count FROM booru.tag_post_counts c "
+                       "JOIN booru.tags t ON t.id = c.tag_id ORDER BY c.post_count DESC LIMIT 100",
+    # the `&&` filter of `view_posts_tags`, aggregated from the associations as it was
+    # and on the GIN index of the tag arrays
+    "tag_overlap_aggregated": "SELECT count(*) FROM (SELECT post_id, array_agg(tag_id) AS tag_ids "
+                              "FROM booru.posts_tags_assoc GROUP BY post_id) p "
+                              f"WHERE p.tag_ids && {TOP_ARTIST_TAGS}",
+    "tag_overlap_arrays": "SELECT count(*) FROM booru.posts_tag_arrays a "
+                          f"WHERE a.tag_ids && {TOP_ARTIST_TAGS}",
+    # the filter of `view_modern_posts`, which skips the earlier partitions of `copy-partitioned`
+    "modern_posts": "SELECT count(*) FROM booru.posts p WHERE p.created_at > '2015-01-01'",
+    "modern_posts_tags": "SELECT count(*) FROM booru.posts_tags_assoc pta "
+                         "JOIN booru.posts p ON p.id = pta.post_id "
+                         "WHERE p.created_at > '2015-01-01'",
+}
+
+
+class ConvertSpeed(BaseModel):
+    records: int
+    from_raw_per_s: float
+    compiled_per_s: float
+
+
+class TableLoad(BaseModel):
+    # None for the steps that are not a table, e.g. `finalize`
+    rows: Optional[int]
+    seconds: float
+    rows_per_s: Optional[float]
+
+
+class QueryLatency(BaseModel):
+    rows: int
+    median_ms: float
+    min_ms: float
+
+
+class BenchResults(BaseModel):
+    started_at: datetime
+    git_commit: Optional[str]
+    python: str
+    postgres: Optional[str] = None
+    input: str
+    files: Dict[str, int] = {}
+    convert: Dict[str, ConvertSpeed] = {}
+    load: Dict[str, Dict[str, TableLoad]] = {}
+    queries: Dict[str, QueryLatency] = {}
+
+
+def git_commit() -> Optional[str]:
+    try:
+        return subprocess.run(["git", "rev-parse", "HEAD"],
+                              capture_output=True,
+                              text=True,
+                              check=True,
+                              cwd=Path(__file__).parent).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def write_config(config: Config, path: Path) -> None:
+    """The config as TOML, its sections only hold scalars"""
+    lines: List[str] = []
+    for section, values in config.model_dump().items():
+        lines.append(f"[{section}]")
+        lines += [f"{key} = {json.dumps(value if value is not None else '')}"
+                  for key, value in values.items()]
+    path.write_text("\n".join(lines) + "\n")
+
+
+def recreate_database(config: Config, dbname: str) -> None:
+    conn_info = to_kv_str({**config.database.model_dump(), "dbname": "postgres"})
+    with psycopg.connect(conn_info, autocommit=True) as conn:
+        conn.execute(SQL("DROP DATABASE IF EXISTS {}").format(Identifier(dbname)))
+        conn.execute(SQL("CREATE DATABASE {}").format(Identifier(dbname)))
+
+
+def run_dump(config_path: Path, input_dir: Path, *args: str) -> float:
+    """Run a `dump_data.py` command in this process, returns its duration"""
+    start = time.perf_counter()
+    create_group().main(["-c", str(config_path), "-i", str(input_dir), *args],
+                        standalone_mode=False)
+    return time.perf_counter() - start
+
+
+def bench_convert(input_dir: Path, config: Config, count: int,
+                  repeat: int) -> Dict[str, ConvertSpeed]:
+    speeds: Dict[str, ConvertSpeed] = {}
+    for entry, (validated, compiled) in CONVERTERS.items():
+        objs = list(islice(read_objs(input_dir / getattr(config.file_names, entry)), count))
+        if not objs:
+            continue
+        speeds[entry] = ConvertSpeed(records=len(objs),
+                                     from_raw_per_s=1 / timeit(validated, objs, repeat),
+                                     compiled_per_s=1 / timeit(compiled, objs, repeat))
+    return speeds
+
+
+def bench_load(mode: LoadMode, config_path: Path, input_dir: Path, conn_info: str,
+               workers: int) -> Dict[str, TableLoad]:
+    """Load every file into the (empty) scratch database"""
+    loads: Dict[str, TableLoad] = {}
+    run_dump(config_path, input_dir, "create-tables", *(["--bulk"] if mode.bulk else []),
+             *(["--partitions", mode.partitions] if mode.partitions else []))
+    for command, _, table in LOAD_ORDER:
+        args = [command, "--method", mode.method]
+        if command == "posts":
+            args += ["--engine", mode.engine, "--workers", str(workers if mode.parallel else 0)]
+        seconds = run_dump(config_path, input_dir, *args)
+        with psycopg.connect(conn_info) as conn:
+            row = conn.execute(SQL("SELECT count(*) FROM {}").format(
+                Identifier(*table.split(".")))).fetchone()
+        rows = row[0] if row is not None else 0
+        loads[table] = TableLoad(rows=rows, seconds=seconds, rows_per_s=rows / seconds)
+    if mode.bulk:
+        seconds = run_dump(config_path, input_dir, "finalize")
+        loads["finalize"] = TableLoad(rows=None, seconds=seconds, rows_per_s=None)
+    return loads
+
+
+def bench_queries(conn_info: str, repeat: int) -> Dict[str, QueryLatency]:
+    """Create the objects of explore.sql, then time every query after a warm-up run"""
+    # `booru.artist_tags_assoc` is derived by the `artists` command
+    with psycopg.connect(conn_info) as conn:
+        for statement in split_statements((Path(__file__).parent / "explore.sql").read_text()):
+            conn.execute(statement)    # type: ignore
+        conn.commit()
+    with psycopg.connect(conn_info, autocommit=True) as conn:
+        conn.execute("ANALYZE")
+        latencies: Dict[str, QueryLatency] = {}
+        for name, sql in QUERIES.items():
+            times: List[float] = []
+            rows = 0
+            for _ in range(repeat + 1):
+                start = time.perf_counter()
+                rows = len(conn.execute(sql).fetchall())    # type: ignore
+                times.append(time.perf_counter() - start)
+            latencies[name] = QueryLatency(rows=rows,
+                                           median_ms=statistics.median(times[1:]) * 1000,
+                                           min_ms=min(times[1:]) * 1000)
+    return latencies
+
+
+def metrics(results: BenchResults) -> Dict[str, tuple[float, bool]]:
+    """Every number of the results by name, with whether higher is better"""
+    flat: Dict[str, tuple[float, bool]] = {}
+    for entry, speed in results.convert.items():
+        flat[f"convert {entry} from_raw/s"] = (speed.from_raw_per_s, True)
+        flat[f"convert {entry} compiled/s"] = (speed.compiled_per_s, True)
+    for mode, loads in results.load.items():
+        for table, load in loads.items():
+            if load.rows_per_s is not None:
+                flat[f"load {mode} {table} rows/s"] = (load.rows_per_s, True)
+            else:
+                flat[f"load {mode} {table} s"] = (load.seconds, False)
+    for name, latency in results.queries.items():
+        flat[f"query {name} ms"] = (latency.median_ms, False)
+    return flat
+
+
+def compare(results: BenchResults, baseline: BenchResults) -> None:
+    """Print every metric of both runs, with the speedup over the baseline"""
+    old = metrics(baseline)
+    for name, (value, higher_is_better) in metrics(results).items():
+        if name not in old or not old[name][0] or not value:
+            continue
+        speedup = value / old[name][0] if higher_is_better else old[name][0] / value
+        print(f"{name:<56} {old[name][0]:>14.2f} {value:>14.2f} {speedup:8.2f}x")
+
+
+@click.command()
+@click.option("--config",
+              "-c",
+              default="config.toml",
+              help="Path to config file, its database name gets a `_bench` suffix",
+              type=click.Path(exists=True))
+@click.option("--input",
+              "-i",
+              default="bench_raw",
+              help="Directory of the raw files, generated if it does not exist",
+              type=click.Path(file_okay=False))
+@click.option("--scale", "-s", default=0.1, help="Scale of the generated files", type=float)
+@click.option("--seed", default=0, help="Seed of the generated files", type=int)
+@click.option("--mode",
+              "modes",
+              multiple=True,
+              default=list(LOAD_MODES),
+              help="Loader modes to run, all by default",
+              type=click.Choice(list(LOAD_MODES)))
+@click.option("--workers", "-w", default=2, help="Parser processes of the parallel modes", type=int)
+@click.option("--count", "-n", default=10000, help="Records converted per file", type=int)
+@click.option("--repeat", "-r", default=5, help="Runs of each conversion and query", type=int)
+@click.option("--no-queries", is_flag=True, default=False, help="Skip the query latencies")
+@click.option("--output", "-o", default=None, help="JSON file of the results")
+@click.option("--baseline",
+              default=None,
+              help="JSON file of another run to compare with",
+              type=click.Path(exists=True))
+def main(config: str, input: str, scale: float, seed: int, modes: tuple[str, ...], workers: int,
+         count: int, repeat: int, no_queries: bool, output: Optional[str],
+         baseline: Optional[str]):
+    with open(Path(config), "rb") as f:
+        config_obj = Config(**tomli.load(f))
+    if not config_obj.database.password:
+        config_obj.database.password = postgres_env_password()
+    input_dir = Path(input)
+    if not input_dir.exists():
+        counts = generate(input_dir, config_obj.file_names,
+                          GenerateOptions(scale=scale, seed=seed))
+        logger.info("Generated {} posts into {}".format(counts["posts"], input_dir))
+    results = BenchResults(started_at=datetime.now(timezone.utc),
+                           git_commit=git_commit(),
+                           python=platform.python_version(),
+                           input=str(input_dir))
+    for _, entry, _ in LOAD_ORDER:
+        with open_raw(input_dir / getattr(config_obj.file_names, entry)) as f:
+            results.files[entry] = sum(1 for line in f if line.strip())
+    results.convert = bench_convert(input_dir, config_obj, count, repeat)
+
+    with tempfile.TemporaryDirectory(prefix="bench-") as tmp:
+        bench_config = config_obj.model_copy(deep=True)
+        bench_config.database.dbname = config_obj.database.dbname + "_bench"
+        bench_config.insertion.state_file = str(Path(tmp) / "ingest_state.json")
+        bench_config.insertion.tag_cache_dir = str(Path(tmp) / "tag_cache")
+        bench_config.insertion.dead_letter_file = str(Path(tmp) / "unknown_tags.jsonl")
+        config_path = Path(tmp) / "config.toml"
+        write_config(bench_config, config_path)
+        conn_info = to_kv_str(bench_config.database.model_dump())
+        for mode in modes:
+            logger.info("Loading with the {} mode".format(mode))
+            recreate_database(bench_config, bench_config.database.dbname)
+            results.load[mode] = bench_load(LOAD_MODES[mode], config_path, input_dir, conn_info,
+                                            workers)
+        with psycopg.connect(conn_info) as conn:
+            row = conn.execute("SHOW server_version").fetchone()
+            results.postgres = row[0] if row is not None else None
+        if not no_queries:
+            results.queries = bench_queries(conn_info, repeat)
+
+    text = results.model_dump_json(indent=2)
+    if output is not None:
+        Path(output).parent.mkdir(parents=True, exist_ok=True)
+        Path(output).write_text(text)
+        logger.info("Wrote the results to {}".format(output))
+    else:
+        print(text)
+    if baseline is not None:
+        compare(results, BenchResults.model_validate_json(Path(baseline).read_text()))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,58 @@
+"""
+Micro-benchmark of the row conversion paths.
+
+Compares `PostEntry.from_raw(...).model_dump()` against the compiled row
+functions in `models.rows` on the first posts of a dump.
+
+    python bench_convert.py raw/posts.json -n 20000
+"""
+from typing import List, Callable, Any
+from pathlib import Path
+from itertools import islice
+import time
+import click
+from dump_data import read_objs
+from models.posts import PostEntry, PostFileEntry, PostMediaVariantEntry
+from models.rows import post_row, post_file_row, post_media_variant_rows, parse_iso8601
+
+
+def pydantic_path(post: Any) -> Any:
+    return (PostEntry.from_raw(post).model_dump(), PostFileEntry.from_raw(post).model_dump(),
+            [v.model_dump() for v in PostMediaVariantEntry.from_raw(post)])
+
+
+def row_path(post: Any) -> Any:
+    return (post_row(post), post_file_row(post), post_media_variant_rows(post))
+
+
+def timeit(fn: Callable[[Any], Any], posts: List[Any], repeat: int) -> float:
+    """Best per-record time in seconds, each run starts with a cold timestamp cache"""
+    best = float("inf")
+    for _ in range(repeat):
+        parse_iso8601.cache_clear()
+        start = time.perf_counter()
+        for post in posts:
+            fn(post)
+        best = min(best, (time.perf_counter() - start) / len(posts))
+    return best
+
+
+@click.command()
+@click.argument("posts_file", type=click.Path(exists=True))
+@click.option("--count", "-n", default=10000, help="Number of posts to convert", type=int)
+@click.option("--repeat", "-r", default=3, help="Number of runs, the best one is kept", type=int)
+def main(posts_file: str, count: int, repeat: int):
+    posts = list(islice(read_objs(Path(posts_file)), count))
+    if not posts:
+        raise click.ClickException("no posts to convert")
+    slow = timeit(pydantic_path, posts, repeat)
+    fast = timeit(row_path, posts, repeat)
+    print(f"posts:           {len(posts)}")
+    print(f"from_raw + dump: {slow * 1e6:8.2f} us/record")
+    print(f"compiled rows:   {fast * 1e6:8.2f} us/record")
+    print(f"speedup:         {slow / fast:8.2f}x")
+    print(f"timestamp cache: {parse_iso8601.cache_info()}")
+
+
+if __name__ == "__main__":
+    main()
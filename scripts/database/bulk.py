@@ -0,0 +1,179 @@
+"""
+Deferred index and constraint build for initial loads.
+
+`create_tables(..., bulk=True)` creates the tables of `database.sql` unlogged
+and without keys, foreign keys or indexes. Once every entry is loaded,
+`finalize` builds the keys and indexes concurrently, adds the foreign keys as
+`NOT VALID` and validates them concurrently, then switches the tables to logged.
+The tag counts are recounted once, unless the `posts` command derived them,
+and their triggers installed at the end, so the bulk load does not pay for
+them row by row.
+"""
+from typing import Dict, List, Optional
+from concurrent.futures import ThreadPoolExecutor
+from loguru import logger
+from pydantic import BaseModel
+import psycopg
+from psycopg import Connection
+import time
+from schema import (Schema, Table, create_table_sql, key_constraints_sql, foreign_keys_sql,
+                    foreign_key_name, dependency_order)
+from counts import recount_tag_post_counts
+from derived import is_complete
+from partitions import PARTITIONED_TABLES, PARTITIONWISE_SQL, Partition, partitioned_table_sql
+
+
+class FinalizeOptions(BaseModel):
+    """Concurrency and session settings of the connections building indexes"""
+    # statements run at the same time, each on its own connection
+    jobs: int = 4
+    maintenance_work_mem: str = "1GB"
+    # parallel workers of a single index build
+    parallel_workers: int = 2
+
+    def session_sql(self) -> List[str]:
+        return [
+            f"SET maintenance_work_mem = '{self.maintenance_work_mem}'",
+            f"SET work_mem = '{self.maintenance_work_mem}'",
+            f"SET max_parallel_maintenance_workers = {self.parallel_workers}",
+        ]
+
+
+def schema_sql(schema: Schema,
+               bulk: bool = False,
+               partitions: Optional[List[Partition]] = None) -> List[str]:
+    """
+    The statements creating the tables of `schema`.
+
+    In bulk mode the tables are unlogged and without constraints or indexes.
+    With `partitions` the post tables are partitioned (see `partitions.py`).
+    """
+    if bulk and partitions:
+        # a partitioned table cannot be unlogged
+        raise ValueError("partitioned tables cannot be created for a bulk load")
+    statements = ["CREATE SCHEMA IF NOT EXISTS booru"]
+    for table in schema.tables:
+        if partitions and table.name in PARTITIONED_TABLES:
+            statements += partitioned_table_sql(table, partitions)
+        else:
+            statements.append(create_table_sql(table, unlogged=bulk, constraints=not bulk))
+    if not bulk:
+        statements += [index.sql for index in schema.indexes]
+        statements += schema.routines
+    statements += schema.comments
+    if partitions:
+        statements.append(PARTITIONWISE_SQL)
+    return statements
+
+
+def create_tables(conn: Connection,
+                  schema: Schema,
+                  bulk: bool = False,
+                  partitions: Optional[List[Partition]] = None) -> None:
+    """Create the tables of `schema`, see `schema_sql`"""
+    with conn.cursor() as c:
+        for sql in schema_sql(schema, bulk, partitions):
+            c.execute(sql)    # type: ignore
+    conn.commit()
+
+
+def unlogged_tables(conn: Connection, schema: Schema) -> List[Table]:
+    with conn.cursor() as c:
+        c.execute("SELECT n.nspname || '.' || c.relname FROM pg_class c "
+                  "JOIN pg_namespace n ON n.oid = c.relnamespace "
+                  "WHERE c.relkind = 'r' AND c.relpersistence = 'u'")
+        names = {row[0] for row in c.fetchall()}
+    return [t for t in schema.tables if t.name in names]
+
+
+def existing_names(conn: Connection) -> set[str]:
+    """Names of the constraints and indexes already in the `booru` schema"""
+    with conn.cursor() as c:
+        c.execute("SELECT conname FROM pg_constraint WHERE connamespace = 'booru'::regnamespace "
+                  "UNION SELECT indexname FROM pg_indexes WHERE schemaname = 'booru'")
+        return {row[0] for row in c.fetchall()}
+
+
+def table_sizes(conn: Connection) -> Dict[str, int]:
+    with conn.cursor() as c:
+        c.execute("SELECT schemaname || '.' || relname, pg_relation_size(relid) "
+                  "FROM pg_stat_user_tables WHERE schemaname = 'booru'")
+        return dict(c.fetchall())
+
+
+def run_concurrently(conninfo: str, statements: List[str], opts: FinalizeOptions) -> float:
+    """Run statements on `opts.jobs` connections in autocommit, return the wall time"""
+
+    def run(sql: str) -> float:
+        start = time.perf_counter()
+        with psycopg.connect(conninfo, autocommit=True) as conn:
+            for setting in opts.session_sql():
+                conn.execute(setting)    # type: ignore
+            conn.execute(sql)    # type: ignore
+        elapsed = time.perf_counter() - start
+        logger.info("{:.2f}s {}".format(elapsed, sql))
+        return elapsed
+
+    start = time.perf_counter()
+    with ThreadPoolExecutor(max_workers=opts.jobs) as pool:
+        list(pool.map(run, statements))
+    return time.perf_counter() - start
+
+
+def finalize(conn: Connection, conninfo: str, schema: Schema,
+             opts: FinalizeOptions) -> Dict[str, float]:
+    """
+    Build keys, indexes and foreign keys of the unlogged tables and set them logged.
+
+    Statements whose constraint or index already exists are skipped, so an
+    interrupted finalize can simply be run again. Returns the time of each phase.
+    """
+    tables = unlogged_tables(conn, schema)
+    timings: Dict[str, float] = {}
+    if not tables:
+        logger.warning("No unlogged table, nothing to finalize")
+        return timings
+    names = {t.name for t in tables}
+    existing = existing_names(conn)
+    sizes = table_sizes(conn)
+
+    # primary keys first, the foreign keys need them; largest tables start first
+    keys: List[str] = []
+    for table in sorted(tables, key=lambda t: -sizes.get(t.name, 0)):
+        key_names = [f"{table.short_name}_pkey"] if table.primary_key else []
+        key_names += list(table.uniques.keys())
+        keys += [sql for n, sql in zip(key_names, key_constraints_sql(table)) if n not in existing]
+    indexes = [i.sql for i in schema.indexes if i.table in names and i.name not in existing]
+    timings["keys"] = run_concurrently(conninfo, keys, opts)
+    timings["indexes"] = run_concurrently(conninfo, indexes, opts)
+
+    validates: List[str] = []
+    with conn.cursor() as c:
+        for table in tables:
+            for fk, (add, validate) in zip(table.foreign_keys, foreign_keys_sql(table)):
+                if foreign_key_name(table, fk) not in existing:
+                    c.execute(add)    # type: ignore
+                validates.append(validate)
+    conn.commit()
+    timings["foreign keys"] = run_concurrently(conninfo, validates, opts)
+
+    start = time.perf_counter()
+    # derived by the `posts` command otherwise
+    if "booru.posts_tags_assoc" in names and not is_complete(conn, "booru.tag_post_counts"):
+        recount_tag_post_counts(conn)
+    timings["tag counts"] = time.perf_counter() - start
+
+    # a logged table may not reference an unlogged one, so parents go first
+    start = time.perf_counter()
+    with conn.cursor() as c:
+        for table in dependency_order(tables):
+            c.execute(f"ALTER TABLE {table.name} SET LOGGED")    # type: ignore
+            conn.commit()
+    timings["set logged"] = time.perf_counter() - start
+    with conn.cursor() as c:
+        for routine in schema.routines:
+            c.execute(routine)    # type: ignore
+    conn.commit()
+    for phase, elapsed in timings.items():
+        logger.info("{:<14} {:8.2f}s".format(phase, elapsed))
+    return timings
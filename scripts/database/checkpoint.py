@@ -0,0 +1,81 @@
+from typing import Dict, Optional, Any
+from pathlib import Path
+from pydantic import BaseModel
+from psycopg import Connection
+import json
+import os
+from schema import load_schema, create_table_sql
+
+
+class Checkpoint(BaseModel):
+    """Position of the last committed batch of a raw file"""
+    file: str
+    # size of the raw file when the checkpoint was taken, to detect a replaced dump
+    size: int
+    # byte offset right after the last committed line
+    offset: int
+    rows: int = 0
+    last_id: Optional[int] = None
+
+
+class IngestState:
+    """
+    Checkpoints of every entry, kept in a local JSON file.
+
+    The file is rewritten atomically after every committed batch, so it always
+    points at a batch boundary that is in the database.
+    """
+
+    def __init__(self, path: str | Path):
+        self.path = Path(path)
+        self.checkpoints: Dict[str, Checkpoint] = {}
+        if self.path.exists():
+            with open(self.path, "r") as f:
+                raw: Dict[str, Any] = json.load(f)
+            self.checkpoints = {k: Checkpoint(**v) for k, v in raw.items()}
+
+    def get(self, entry: str, file: str | Path) -> Optional[Checkpoint]:
+        """Get the checkpoint of an entry, raise if it was taken on another file"""
+        checkpoint = self.checkpoints.get(entry)
+        if checkpoint is None:
+            return None
+        size = os.path.getsize(file)
+        if checkpoint.file != str(file) or checkpoint.size != size:
+            raise ValueError(f"checkpoint of {entry} was taken on {checkpoint.file} "
+                             f"({checkpoint.size} bytes), not {file} ({size} bytes)")
+        return checkpoint
+
+    def save(self, entry: str, checkpoint: Checkpoint) -> None:
+        self.checkpoints[entry] = checkpoint
+        tmp = self.path.with_suffix(self.path.suffix + ".tmp")
+        with open(tmp, "w") as f:
+            json.dump({k: v.model_dump() for k, v in self.checkpoints.items()}, f, indent=2)
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(tmp, self.path)
+
+
+def bump_generation(conn: Connection) -> int:
+    """
+    Increment the ingest generation of the database and return it.
+
+    Run after every command that writes, it invalidates the query caches of
+    the explore side. Works before `finalize` too, when the table has no key.
+    """
+    with conn.cursor() as c:
+        c.execute("SELECT to_regclass('booru.ingest_generation')")
+        row = c.fetchone()
+        if row is None or row[0] is None:
+            # databases created before the table was added to database.sql
+            table = load_schema().table("booru.ingest_generation")
+            c.execute(create_table_sql(table))    # type: ignore
+        c.execute("UPDATE booru.ingest_generation SET generation = generation + 1, "
+                  "updated_at = now() WHERE id = 1 RETURNING generation")
+        row = c.fetchone()
+        if row is None:
+            c.execute("INSERT INTO booru.ingest_generation (id, generation, updated_at) "
+                      "VALUES (1, 1, now()) RETURNING generation")
+            row = c.fetchone()
+    conn.commit()
+    assert row is not None
+    return row[0]
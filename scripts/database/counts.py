@@ -0,0 +1,419 @@
+"""
+Incremental maintenance of the tag count tables and of the materialized views.
+
+`booru.tag_post_counts` is kept up to date by the statement triggers of
+`database.sql`, every write to `booru.posts_tags_assoc` applies its per-tag
+deltas in its own transaction. The illustration-only counts of `explore.sql`
+depend on the other tags and the date of a post, so their triggers only log
+the changed associations; `refresh_illustration_counts` later recomputes the
+status of the logged posts and applies the differences. Renaming a tag into or
+out of `booru.non_illustration_tag_ids()` is not logged, `verify_counts(fix=True)`
+rebuilds the tables after such a change.
+
+Materialized views are refreshed in dependency order and only when a table
+they read has been written since their last refresh, according to the
+cumulative counters of `pg_stat_user_tables`. `verify_counts` compares the
+incremental tables with a full recount, `verify_tag_arrays` the tag arrays the
+loader writes with the associations.
+"""
+from typing import Dict, Optional, List, Iterator
+from contextlib import contextmanager
+from graphlib import TopologicalSorter
+from loguru import logger
+from psycopg import Connection, IsolationLevel
+from psycopg.types.json import Jsonb
+from pydantic import BaseModel
+
+TAG_POST_COUNTS_SQL = """SELECT t.id AS tag_id, COUNT(pta.post_id) AS post_count
+FROM booru.tags t LEFT JOIN booru.posts_tags_assoc pta ON t.id = pta.tag_id
+GROUP BY t.id"""
+
+# an artist is associated with the artist tag (category 1) of the same name
+ARTIST_TAGS_SQL = """SELECT a.id AS artist_id, t.id AS tag_id
+FROM booru.artists a JOIN booru.tags t ON a.name = t.name AND t.category = 1"""
+
+# column of `booru.posts_tag_arrays` -> tag category
+TAG_ARRAY_CATEGORIES: Dict[str, int] = {
+    "general": 0,
+    "artist": 1,
+    "copyright": 3,
+    "character": 4,
+    "meta": 5,
+}
+
+
+def tag_array_sql(condition: str, name: str) -> str:
+    """The sorted tag ids of a post that satisfy `condition`, `{}` if none does"""
+    return f"COALESCE(array_agg(t.id ORDER BY t.id) FILTER (WHERE {condition}), '{{}}') AS {name}"
+
+
+def tag_arrays_sql(where: str = "TRUE") -> str:
+    """
+    The rows of `booru.posts_tag_arrays` of the posts `p` matching `where`.
+
+    The arrays are split by `booru.tags.category`, as in the loader
+    (`parallel.transform_posts`), the tag strings of the dump are not stored.
+    """
+    return "SELECT p.id AS post_id,\n       " + ",\n       ".join(
+        [tag_array_sql("t.id IS NOT NULL", "tag_ids")] +
+        [tag_array_sql(f"t.category = {c}", name) for name, c in TAG_ARRAY_CATEGORIES.items()]
+    ) + f"""
+FROM booru.posts p LEFT JOIN booru.posts_tags_assoc pta ON pta.post_id = p.id
+     LEFT JOIN booru.tags t ON t.id = pta.tag_id
+WHERE {where}
+GROUP BY p.id"""
+
+
+TAG_ARRAYS_SQL = tag_arrays_sql()
+
+# `p` is the post, `x.ids` the tags of `NON_ILLUSTRATION_TAGS`
+ILLUSTRATION_CONDITION = """p.created_at > '2015-01-01'
+  AND EXISTS (SELECT 1 FROM booru.posts_tags_assoc pta WHERE pta.post_id = p.id)
+  AND NOT EXISTS (SELECT 1 FROM booru.posts_tags_assoc pta
+                  WHERE pta.post_id = p.id AND pta.tag_id = ANY (x.ids))"""
+
+# evaluated once per statement instead of once per post
+NON_ILLUSTRATION_TAGS = "(SELECT booru.non_illustration_tag_ids() AS ids) x"
+
+ILLUSTRATION_POSTS_SQL = (f"SELECT p.id AS post_id FROM booru.posts p, {NON_ILLUSTRATION_TAGS} "
+                          f"WHERE {ILLUSTRATION_CONDITION}")
+
+ILLUSTRATION_TAG_COUNTS_SQL = f"""SELECT pta.tag_id, COUNT(*) AS post_count
+FROM booru.posts_tags_assoc pta JOIN ({ILLUSTRATION_POSTS_SQL}) ip ON ip.post_id = pta.post_id
+GROUP BY pta.tag_id"""
+
+# incremental table -> its full recount
+RECOUNTS: Dict[str, str] = {
+    "booru.tag_post_counts": TAG_POST_COUNTS_SQL,
+    "booru.illustration_tag_counts": ILLUSTRATION_TAG_COUNTS_SQL,
+}
+
+
+@contextmanager
+def snapshot(conn: Connection) -> Iterator[None]:
+    """A REPEATABLE READ transaction, every statement sees the same data"""
+    conn.commit()
+    level = conn.isolation_level
+    conn.isolation_level = IsolationLevel.REPEATABLE_READ
+    try:
+        with conn.transaction():
+            yield
+    finally:
+        conn.isolation_level = level
+
+
+def relation_exists(conn: Connection, name: str) -> bool:
+    row = conn.execute("SELECT to_regclass(%s) IS NOT NULL", (name,)).fetchone()
+    return row is not None and row[0]
+
+
+def recount_tag_post_counts(conn: Connection) -> None:
+    """Rebuild `booru.tag_post_counts` from scratch, e.g. after a bulk load without triggers"""
+    conn.execute("TRUNCATE booru.tag_post_counts")
+    sql = f"INSERT INTO booru.tag_post_counts (tag_id, post_count) {TAG_POST_COUNTS_SQL}"
+    conn.execute(sql)    # type: ignore
+    conn.commit()
+
+
+def rebuild_artist_tags(conn: Connection) -> None:
+    """Rebuild `booru.artist_tags_assoc` from its definition"""
+    conn.execute("TRUNCATE booru.artist_tags_assoc")
+    conn.execute(f"INSERT INTO booru.artist_tags_assoc (artist_id, tag_id) {ARTIST_TAGS_SQL}"
+                )    # type: ignore
+    conn.commit()
+
+
+def rebuild_tag_arrays(conn: Connection) -> None:
+    """Rebuild `booru.posts_tag_arrays` from `booru.posts_tags_assoc`"""
+    conn.execute("TRUNCATE booru.posts_tag_arrays")
+    conn.execute(f"INSERT INTO booru.posts_tag_arrays {TAG_ARRAYS_SQL}")    # type: ignore
+    conn.commit()
+
+
+def replace_tag_arrays(conn: Connection, post_ids: List[int]) -> None:
+    """Recompute the tag arrays of some posts, in the transaction of the caller"""
+    conn.execute("DELETE FROM booru.posts_tag_arrays WHERE post_id = ANY(%s)", (post_ids,))
+    conn.execute(f"INSERT INTO booru.posts_tag_arrays {tag_arrays_sql('p.id = ANY(%s)')}",
+                 (post_ids,))    # type: ignore
+
+
+def rebuild_illustration_counts(conn: Connection) -> None:
+    """Rebuild the illustration-only tables from scratch and drop the pending changes"""
+    with snapshot(conn):
+        conn.execute("TRUNCATE booru.illustration_posts, booru.illustration_tag_counts, "
+                     "booru.posts_tags_changes")
+        sql = f"INSERT INTO booru.illustration_posts (post_id) {ILLUSTRATION_POSTS_SQL}"
+        conn.execute(sql)    # type: ignore
+        conn.execute("INSERT INTO booru.illustration_tag_counts (tag_id, post_count) "
+                     "SELECT pta.tag_id, COUNT(*) FROM booru.posts_tags_assoc pta "
+                     "JOIN booru.illustration_posts ip ON ip.post_id = pta.post_id "
+                     "GROUP BY pta.tag_id")
+
+
+def refresh_illustration_counts(conn: Connection) -> int:
+    """
+    Apply the logged association changes to `booru.illustration_tag_counts`.
+
+    The old tags of a changed post are its current tags without the net added
+    ones and with the net removed ones, so its old contribution is subtracted
+    and the new one added without looking at any other post. Returns the
+    number of posts recomputed.
+    """
+    with snapshot(conn):
+        conn.execute("CREATE TEMP TABLE _changes (post_id INT, tag_id INT, delta INT) "
+                     "ON COMMIT DROP")
+        conn.execute("WITH taken AS (DELETE FROM booru.posts_tags_changes "
+                     "RETURNING post_id, tag_id, delta) "
+                     "INSERT INTO _changes SELECT post_id, tag_id, SUM(delta) FROM taken "
+                     "GROUP BY post_id, tag_id")
+        # a deleted post has no row in `booru.posts` and is no longer counted
+        sql = f"""CREATE TEMP TABLE _dirty ON COMMIT DROP AS
+WITH changed AS (SELECT DISTINCT post_id FROM _changes)
+SELECT c.post_id,
+       EXISTS (SELECT 1 FROM booru.illustration_posts ip WHERE ip.post_id = c.post_id)
+           AS was_counted,
+       COALESCE({ILLUSTRATION_CONDITION}, false) AS is_counted
+FROM changed c LEFT JOIN booru.posts p ON p.id = c.post_id CROSS JOIN {NON_ILLUSTRATION_TAGS}"""
+        conn.execute(sql)    # type: ignore
+        dirty = conn.execute("SELECT COUNT(*) FROM _dirty").fetchone()
+        conn.execute("""WITH old_tags AS (
+    SELECT pta.post_id, pta.tag_id FROM booru.posts_tags_assoc pta
+    JOIN _dirty d ON d.post_id = pta.post_id AND d.was_counted
+    WHERE NOT EXISTS (SELECT 1 FROM _changes c
+                      WHERE c.post_id = pta.post_id AND c.tag_id = pta.tag_id AND c.delta > 0)
+    UNION ALL
+    SELECT c.post_id, c.tag_id FROM _changes c
+    JOIN _dirty d ON d.post_id = c.post_id AND d.was_counted
+    WHERE c.delta < 0),
+new_tags AS (
+    SELECT pta.post_id, pta.tag_id FROM booru.posts_tags_assoc pta
+    JOIN _dirty d ON d.post_id = pta.post_id AND d.is_counted),
+deltas AS (
+    SELECT tag_id, SUM(delta) AS delta
+    FROM (SELECT tag_id, -1 AS delta FROM old_tags UNION ALL SELECT tag_id, 1 FROM new_tags) t
+    GROUP BY tag_id)
+INSERT INTO booru.illustration_tag_counts AS c (tag_id, post_count)
+SELECT tag_id, delta FROM deltas WHERE delta <> 0 ORDER BY tag_id
+ON CONFLICT (tag_id) DO UPDATE SET post_count = c.post_count + excluded.post_count""")
+        conn.execute("DELETE FROM booru.illustration_tag_counts WHERE post_count = 0")
+        conn.execute("DELETE FROM booru.illustration_posts ip USING _dirty d "
+                     "WHERE ip.post_id = d.post_id AND NOT d.is_counted")
+        conn.execute("INSERT INTO booru.illustration_posts (post_id) "
+                     "SELECT post_id FROM _dirty WHERE is_counted AND NOT was_counted")
+    return dirty[0] if dirty is not None else 0
+
+
+class MatView(BaseModel):
+    name: str
+    # plain tables read directly or through views
+    tables: set[str]
+    # materialized views read directly or through views
+    matviews: set[str]
+    populated: bool
+    # a unique index on plain columns allows REFRESH ... CONCURRENTLY
+    concurrent: bool
+
+
+def matview_graph(conn: Connection) -> Dict[str, MatView]:
+    """The materialized views of the `booru` schema with what they read, through views too"""
+    depends: Dict[str, set[str]] = {}
+    for view, relation in conn.execute(
+            "SELECT DISTINCT v.oid::regclass::text, d.refobjid::regclass::text "
+            "FROM pg_depend d JOIN pg_rewrite r ON r.oid = d.objid "
+            "JOIN pg_class v ON v.oid = r.ev_class "
+            "WHERE d.classid = 'pg_rewrite'::regclass AND d.refclassid = 'pg_class'::regclass "
+            "AND d.refobjid <> v.oid AND v.relkind IN ('v', 'm') "
+            "AND v.relnamespace = 'booru'::regnamespace").fetchall():
+        depends.setdefault(view, set()).add(relation)
+    rows = conn.execute(
+        "SELECT c.oid::regclass::text, c.relispopulated, EXISTS (SELECT 1 FROM pg_index i "
+        "WHERE i.indrelid = c.oid AND i.indisunique AND i.indpred IS NULL "
+        "AND i.indexprs IS NULL) FROM pg_class c "
+        "WHERE c.relkind = 'm' AND c.relnamespace = 'booru'::regnamespace").fetchall()
+    names = {row[0] for row in rows}
+    graph: Dict[str, MatView] = {}
+    for name, populated, concurrent in rows:
+        tables: set[str] = set()
+        matviews: set[str] = set()
+        stack = list(depends.get(name, ()))
+        seen: set[str] = set()
+        while stack:
+            relation = stack.pop()
+            if relation in seen:
+                continue
+            seen.add(relation)
+            if relation in names:
+                matviews.add(relation)
+            elif relation in depends:
+                stack += depends[relation]
+            else:
+                tables.add(relation)
+        graph[name] = MatView(name=name,
+                              tables=tables,
+                              matviews=matviews,
+                              populated=populated,
+                              concurrent=concurrent)
+    return graph
+
+
+def table_changes(conn: Connection) -> Dict[str, int]:
+    """Rows inserted, updated and deleted so far in every table"""
+    rows = conn.execute("SELECT relid::regclass::text, n_tup_ins + n_tup_upd + n_tup_del "
+                        "FROM pg_stat_user_tables").fetchall()
+    return {name: changes for name, changes in rows}
+
+
+def refresh_matviews(conn: Connection, force: bool = False) -> List[str]:
+    """
+    Refresh the materialized views whose tables changed since their last refresh.
+
+    Views are visited upstream first, a view reading a refreshed view is
+    refreshed too. The counters of its tables are saved with each refresh in
+    `booru.matview_refreshes`; without that table every view is refreshed.
+    Returns the names of the refreshed views.
+    """
+    conn.commit()
+    graph = matview_graph(conn)
+    tracked = relation_exists(conn, "booru.matview_refreshes")
+    last: Dict[str, Dict[str, int]] = {}
+    if tracked:
+        last = dict(
+            conn.execute("SELECT name, table_changes FROM booru.matview_refreshes").fetchall())
+    refreshed: List[str] = []
+    order = TopologicalSorter({name: view.matviews for name, view in graph.items()})
+    for name in order.static_order():
+        view = graph[name]
+        conn.execute("SELECT pg_stat_clear_snapshot()")
+        changes = table_changes(conn)
+        current = {table: changes.get(table, 0) for table in sorted(view.tables)}
+        stale = (force or not tracked or not view.populated or last.get(name) != current or
+                 bool(view.matviews & set(refreshed)))
+        if not stale:
+            logger.info("{} is up to date".format(name))
+            continue
+        concurrently = " CONCURRENTLY" if view.concurrent and view.populated else ""
+        logger.info("Refreshing{} {}".format(concurrently.lower(), name))
+        conn.execute(f"REFRESH MATERIALIZED VIEW{concurrently} {name}")    # type: ignore
+        if tracked:
+            conn.execute(
+                "INSERT INTO booru.matview_refreshes (name, table_changes, refreshed_at) "
+                "VALUES (%s, %s, now()) ON CONFLICT (name) DO UPDATE "
+                "SET table_changes = excluded.table_changes, refreshed_at = excluded.refreshed_at",
+                (name, Jsonb(current)))
+        conn.commit()
+        refreshed.append(name)
+    return refreshed
+
+
+class CountMismatch(BaseModel):
+    tag_id: int
+    # None when the tag has no row on that side
+    incremental: Optional[int]
+    full: Optional[int]
+
+
+def count_mismatches(conn: Connection,
+                     table: str,
+                     limit: Optional[int] = None) -> List[CountMismatch]:
+    """Tags whose count in `table` differs from the full recount or has no row on one side"""
+    sql = f"""SELECT COALESCE(i.tag_id, f.tag_id), i.post_count, f.post_count
+FROM {table} i FULL JOIN ({RECOUNTS[table]}) f ON f.tag_id = i.tag_id
+WHERE i.post_count IS DISTINCT FROM f.post_count
+ORDER BY 1"""
+    if limit is not None:
+        sql += f" LIMIT {int(limit)}"
+    rows = conn.execute(sql).fetchall()    # type: ignore
+    return [CountMismatch(tag_id=t, incremental=i, full=f) for t, i, f in rows]
+
+
+def verify_counts(conn: Connection, fix: bool = False) -> Dict[str, List[CountMismatch]]:
+    """
+    Compare every incremental count table with a full recount, in one snapshot.
+
+    With `fix`, a table that differs is rebuilt. Pending illustration changes
+    are applied first, they are not a mismatch.
+    """
+    tables = [t for t in RECOUNTS if relation_exists(conn, t)]
+    if "booru.illustration_tag_counts" in tables:
+        refresh_illustration_counts(conn)
+    with snapshot(conn):
+        mismatches = {table: count_mismatches(conn, table) for table in tables}
+    for table, rows in mismatches.items():
+        if not rows:
+            logger.info("{} matches the full recount".format(table))
+            continue
+        logger.warning("{} differs from the full recount for {} tags".format(table, len(rows)))
+        if fix:
+            if table == "booru.tag_post_counts":
+                recount_tag_post_counts(conn)
+            else:
+                rebuild_illustration_counts(conn)
+            logger.info("Rebuilt {}".format(table))
+    return mismatches
+
+
+class ArtistTagMismatch(BaseModel):
+    artist_id: int
+    tag_id: int
+    # in the definition but not in the table, otherwise in the table only
+    missing: bool
+
+
+def artist_tag_mismatches(conn: Connection, limit: Optional[int] = None) -> List[ArtistTagMismatch]:
+    """Pairs of `booru.artist_tags_assoc` and of `ARTIST_TAGS_SQL` that are not in the other"""
+    sql = f"""(SELECT artist_id, tag_id, true FROM ({ARTIST_TAGS_SQL}) d
+ EXCEPT SELECT artist_id, tag_id, true FROM booru.artist_tags_assoc)
+UNION ALL
+(SELECT artist_id, tag_id, false FROM booru.artist_tags_assoc
+ EXCEPT SELECT artist_id, tag_id, false FROM ({ARTIST_TAGS_SQL}) d)
+ORDER BY 1, 2"""
+    if limit is not None:
+        sql += f" LIMIT {int(limit)}"
+    rows = conn.execute(sql).fetchall()    # type: ignore
+    return [ArtistTagMismatch(artist_id=a, tag_id=t, missing=m) for a, t, m in rows]
+
+
+def verify_artist_tags(conn: Connection, fix: bool = False) -> List[ArtistTagMismatch]:
+    """Compare `booru.artist_tags_assoc` with its definition, rebuild it with `fix`"""
+    conn.commit()
+    mismatches = artist_tag_mismatches(conn)
+    conn.commit()
+    if not mismatches:
+        logger.info("booru.artist_tags_assoc matches its definition")
+        return mismatches
+    logger.warning("booru.artist_tags_assoc differs from its definition for {} pairs".format(
+        len(mismatches)))
+    if fix:
+        rebuild_artist_tags(conn)
+        logger.info("Rebuilt booru.artist_tags_assoc")
+    return mismatches
+
+
+def tag_array_mismatches(conn: Connection, limit: Optional[int] = None) -> List[int]:
+    """Posts whose `booru.posts_tag_arrays` row differs from `TAG_ARRAYS_SQL`, or is missing"""
+    columns = ["tag_ids", *TAG_ARRAY_CATEGORIES]
+    loaded = ", ".join("a." + c for c in columns)
+    derived = ", ".join("d." + c for c in columns)
+    sql = f"""SELECT COALESCE(a.post_id, d.post_id)
+FROM booru.posts_tag_arrays a FULL JOIN ({TAG_ARRAYS_SQL}) d ON d.post_id = a.post_id
+WHERE ({loaded}) IS DISTINCT FROM ({derived})
+ORDER BY 1"""
+    if limit is not None:
+        sql += f" LIMIT {int(limit)}"
+    return [row[0] for row in conn.execute(sql).fetchall()]    # type: ignore
+
+
+def verify_tag_arrays(conn: Connection, fix: bool = False) -> List[int]:
+    """Compare `booru.posts_tag_arrays` with the tag associations, rebuild it with `fix`"""
+    conn.commit()
+    mismatches = tag_array_mismatches(conn)
+    conn.commit()
+    if not mismatches:
+        logger.info("booru.posts_tag_arrays matches the tag associations")
+        return mismatches
+    logger.warning("booru.posts_tag_arrays differs from the tag associations for {} posts".format(
+        len(mismatches)))
+    if fix:
+        rebuild_tag_arrays(conn)
+        logger.info("Rebuilt booru.posts_tag_arrays")
+    return mismatches
@@ -68,25 +68,31 @@ CREATE TABLE booru.tags_aliases
 (
     id              INT PRIMARY KEY,
     antecedent_name TEXT NOT NULL,
-    consequent_name TEXT NOT NULL
+    consequent_name TEXT NOT NULL,
+    status          TEXT NOT NULL
 );
 
 COMMENT ON COLUMN booru.tags_aliases.antecedent_name
     IS 'The name of the tag that is a synonym of another tag, which should be in `booru.tags.name`';
 COMMENT ON COLUMN booru.tags_aliases.consequent_name
     IS 'The name of the tag that is the target of a synonym, which should be in `booru.tags.name`';
+COMMENT ON COLUMN booru.tags_aliases.status
+    IS 'Only `active` aliases apply, the others are deleted, retired, rejected... requests';
 
 CREATE TABLE booru.tags_implications
 (
     id              INT PRIMARY KEY,
     antecedent_name TEXT NOT NULL,
-    consequent_name TEXT NOT NULL
+    consequent_name TEXT NOT NULL,
+    status          TEXT NOT NULL
 );
 
 COMMENT ON COLUMN booru.tags_implications.antecedent_name
     IS 'The name of the tag that implies another tag, which should be in `booru.tags.name`';
 COMMENT ON COLUMN booru.tags_implications.consequent_name
     IS 'The name of the tag that is implied by another tag, which should be in `booru.tags.name`';
+COMMENT ON COLUMN booru.tags_implications.status
+    IS 'Only `active` implications apply, the others are deleted, retired, rejected... requests';
 
 CREATE TABLE booru.artists
 (
@@ -121,7 +127,32 @@ CREATE TABLE booru.artists_aliases
 );
 
 
--- TODO: create a view for implications and aliases
+-- alias and implication graph, written by `build-tag-graph` of `explore/cli.py`
+CREATE TABLE booru.tag_canonical
+(
+    name         TEXT PRIMARY KEY,
+    tag_id       INT,
+    canonical_id INT NOT NULL
+);
+
+COMMENT ON TABLE booru.tag_canonical
+    IS 'Every alias of `booru.tags_aliases` with its chain resolved to the id of a tag';
+COMMENT ON COLUMN booru.tag_canonical.tag_id
+    IS 'The id of the alias itself, NULL when the name is not in `booru.tags.name`';
+
+CREATE TABLE booru.tag_implication_closure
+(
+    tag_id         INT,
+    implied_tag_id INT,
+    depth          INT NOT NULL,
+    PRIMARY KEY (tag_id, implied_tag_id)
+);
+
+COMMENT ON TABLE booru.tag_implication_closure
+    IS 'Transitive closure of `booru.tags_implications` over canonical tags';
+COMMENT ON COLUMN booru.tag_implication_closure.depth
+    IS 'The length of the shortest implication chain from the tag to the implied tag';
+
 -- TODO: create a view for tag counts of posts
 
 -- tags <> posts (junction table)
@@ -132,6 +163,19 @@ CREATE TABLE booru.posts_tags_assoc
     PRIMARY KEY (post_id, tag_id)
 );
 
+-- the tag ids of a post as arrays, all of them and per category (of booru.tags), written
+-- by the loader next to `posts_tags_assoc` so the views do not aggregate it back
+CREATE TABLE booru.posts_tag_arrays
+(
+    post_id   INT PRIMARY KEY REFERENCES booru.posts (id),
+    tag_ids   INT[] NOT NULL,
+    general   INT[] NOT NULL,
+    artist    INT[] NOT NULL,
+    copyright INT[] NOT NULL,
+    character INT[] NOT NULL,
+    meta      INT[] NOT NULL
+);
+
 CREATE TABLE booru.tag_post_counts
 (
     tag_id     INT PRIMARY KEY,
@@ -149,6 +193,67 @@ FROM booru.tags t
      booru.posts_tags_assoc pta ON t.id = pta.tag_id
 GROUP BY t.id;
 
+-- from then on every statement writing associations applies its per-tag deltas
+-- to the counts, in the same transaction, so no load path needs a full recount;
+-- the sessions of a load counting the tags itself set `booru.skip_tag_counts`
+CREATE OR REPLACE FUNCTION booru.apply_tag_count_deltas() RETURNS TRIGGER
+    LANGUAGE plpgsql AS
+$$
+BEGIN
+    IF TG_OP = 'INSERT' AND current_setting('booru.skip_tag_counts', true) = 'on' THEN
+        RETURN NULL;
+    ELSIF TG_OP = 'INSERT' THEN
+        INSERT INTO booru.tag_post_counts AS c (tag_id, post_count)
+        SELECT tag_id, COUNT(*)
+        FROM new_rows
+        GROUP BY tag_id
+        ORDER BY tag_id
+        ON CONFLICT (tag_id) DO UPDATE SET post_count = c.post_count + excluded.post_count;
+    ELSE
+        UPDATE booru.tag_post_counts c
+        SET post_count = c.post_count - d.post_count
+        FROM (SELECT tag_id, COUNT(*) AS post_count FROM old_rows GROUP BY tag_id) d
+        WHERE c.tag_id = d.tag_id;
+    END IF;
+    RETURN NULL;
+END;
+$$;
+
+CREATE OR REPLACE TRIGGER tag_post_counts_insert
+    AFTER INSERT
+    ON booru.posts_tags_assoc
+    REFERENCING NEW TABLE AS new_rows
+    FOR EACH STATEMENT
+EXECUTE FUNCTION booru.apply_tag_count_deltas();
+
+CREATE OR REPLACE TRIGGER tag_post_counts_delete
+    AFTER DELETE
+    ON booru.posts_tags_assoc
+    REFERENCING OLD TABLE AS old_rows
+    FOR EACH STATEMENT
+EXECUTE FUNCTION booru.apply_tag_count_deltas();
+
+-- every tag keeps a row, a tag without posts counts 0 like in the definition
+CREATE OR REPLACE FUNCTION booru.add_tag_count_rows() RETURNS TRIGGER
+    LANGUAGE plpgsql AS
+$$
+BEGIN
+    INSERT INTO booru.tag_post_counts (tag_id, post_count)
+    SELECT id, 0
+    FROM new_rows
+    ORDER BY id
+    ON CONFLICT (tag_id) DO NOTHING;
+    RETURN NULL;
+END;
+$$;
+
+CREATE OR REPLACE TRIGGER tag_post_counts_tags
+    AFTER INSERT
+    ON booru.tags
+    REFERENCING NEW TABLE AS new_rows
+    FOR EACH STATEMENT
+EXECUTE FUNCTION booru.add_tag_count_rows();
+
 
 -- associates artists with tags
 CREATE TABLE booru.artist_tags_assoc
@@ -167,9 +272,29 @@ FROM booru.artists a
          JOIN
      booru.tags t ON a.name = t.name AND t.category = 1;
 
+-- a single row bumped by dump_data.py after every command that writes,
+-- caches of query results are keyed on the generation
+CREATE TABLE booru.ingest_generation
+(
+    id         INT PRIMARY KEY,
+    generation BIGINT      NOT NULL,
+    updated_at TIMESTAMPTZ NOT NULL
+);
+
+-- relations dump_data.py derives from the rows it writes (see derived.py), a relation
+-- left incomplete by an interrupted load is rebuilt from its definition
+CREATE TABLE booru.derived_relations
+(
+    name       TEXT PRIMARY KEY,
+    complete   BOOLEAN     NOT NULL,
+    updated_at TIMESTAMPTZ NOT NULL
+);
+
 -- indexes to improve the performance of queries involving those columns
-CREATE INDEX idx_tags_ids ON booru.tags (id);
+-- (ids and (post_id, tag_id) are already indexed by their primary keys)
 CREATE INDEX idx_tags_names ON booru.tags (name, id);
-CREATE INDEX idx_posts_ids ON booru.posts (id);
-CREATE INDEX idx_posts_tags ON booru.posts_tags_assoc (post_id, tag_id);
 CREATE INDEX idx_artists_name ON booru.artists (name);
+CREATE INDEX idx_tag_implication_closure_implied ON booru.tag_implication_closure (implied_tag_id, tag_id);
+-- `&&` and `@>` filters on the tag ids; the built-in array_ops, with the intarray
+-- extension installed `&&` resolves to its operator and needs `tag_ids gin__int_ops`
+CREATE INDEX idx_posts_tag_arrays_tag_ids ON booru.posts_tag_arrays USING GIN (tag_ids);
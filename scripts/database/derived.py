@@ -0,0 +1,344 @@
+"""
+Relations derived from the entries while they are loaded.
+
+`booru.tag_post_counts` and `booru.artist_tags_assoc` are aggregates of the
+loaded tables (`counts.TAG_POST_COUNTS_SQL`, `counts.ARTIST_TAGS_SQL`).
+Instead of a full pass over the tables once the load is over, the `posts`
+and `artists` commands count the rows of every committed batch in memory and
+write each relation with a single COPY at the end.
+
+While the posts are counted, the sessions of the load set
+`booru.skip_tag_counts`, which the statement trigger maintaining the tag counts
+checks, so their writes do not pay for it batch by batch. Only these sessions
+skip it, any other writer (e.g. `sync`) keeps counting, and the setting goes
+away with them, also when the load is killed. The counts of the committed
+batches are applied in one transaction, also when the load fails. A load that
+is killed leaves its relation marked incomplete in `booru.derived_relations`:
+the next load of the entry (or `finalize`, or `verify-counts --fix`) recounts
+it with the SQL definition instead.
+"""
+from typing import Dict, Iterable, List, Optional, Sequence
+from loguru import logger
+from psycopg import Connection
+from psycopg.conninfo import conninfo_to_dict, make_conninfo
+import threading
+import numpy as np
+from counts import ARTIST_TAGS_SQL, TAG_POST_COUNTS_SQL, relation_exists
+from loader import copy_rows
+from models.artists import ArtistRaw
+from parallel import PostRows
+from schema import create_table_sql, load_schema
+
+TAG_COUNT_TRIGGER = "tag_post_counts_insert"
+# session setting of the writers whose inserted associations the trigger does not count
+SKIP_TAG_COUNTS = "booru.skip_tag_counts"
+
+
+class TagCounter:
+    """Posts per tag, the negative ids of created tags (see `UnknownTags`) are kept apart"""
+
+    def __init__(self):
+        self.counts = np.zeros(0, dtype=np.int64)
+        self.negative: Dict[int, int] = {}
+        self.lock = threading.Lock()
+
+    def add(self, tag_ids: Sequence[tuple[int, int]]) -> None:
+        """Count `(post_id, tag_id)` associations"""
+        if not tag_ids:
+            return
+        ids = np.fromiter((tag_id for _, tag_id in tag_ids), dtype=np.int64, count=len(tag_ids))
+        with self.lock:
+            for tag_id in ids[ids < 0].tolist():
+                self.negative[tag_id] = self.negative.get(tag_id, 0) + 1
+            positive = np.bincount(ids[ids >= 0])
+            if len(positive) > len(self.counts):
+                self.counts = np.concatenate(
+                    [self.counts, np.zeros(len(positive) - len(self.counts), dtype=np.int64)])
+            self.counts[:len(positive)] += positive
+
+    def add_rows(self, rows: PostRows) -> None:
+        self.add(rows.tag_ids)
+
+    def rows(self) -> List[tuple[int, int]]:
+        """`(tag_id, post_count)` of the tags seen, by id"""
+        tag_ids = np.flatnonzero(self.counts)
+        rows = sorted(self.negative.items())
+        rows += zip(tag_ids.tolist(), self.counts[tag_ids].tolist())
+        return rows
+
+    def total(self) -> int:
+        return int(self.counts.sum()) + sum(self.negative.values())
+
+
+class ArtistTagMatcher:
+    """`(artist_id, tag_id)` of the artists whose name is an artist tag (category 1)"""
+
+    def __init__(self, conn: Connection):
+        self.tags: Dict[str, int] = dict(
+            conn.execute("SELECT name, id FROM booru.tags WHERE category = 1").fetchall())
+        self.pairs: List[tuple[int, int]] = []
+
+    def add(self, artists: Iterable[ArtistRaw]) -> None:
+        for artist in artists:
+            tag_id = self.tags.get(artist["name"])
+            if tag_id is not None:
+                self.pairs.append((artist["id"], tag_id))
+
+
+def is_complete(conn: Connection, name: str) -> Optional[bool]:
+    """Whether the last load deriving `name` finished, `None` if none did"""
+    if not relation_exists(conn, "booru.derived_relations"):
+        return None
+    row = conn.execute("SELECT complete FROM booru.derived_relations WHERE name = %s",
+                       (name,)).fetchone()
+    return row[0] if row is not None else None
+
+
+def mark(conn: Connection, name: str, complete: bool) -> None:
+    """
+    Record the state of a derived relation, in the transaction of the caller.
+
+    Works before `finalize` too, when the table has no key.
+    """
+    if not relation_exists(conn, "booru.derived_relations"):
+        # databases created before the table was added to database.sql
+        conn.execute(create_table_sql(
+            load_schema().table("booru.derived_relations")))    # type: ignore
+    cur = conn.execute(
+        "UPDATE booru.derived_relations SET complete = %s, updated_at = now() WHERE name = %s",
+        (complete, name))
+    if cur.rowcount == 0:
+        conn.execute(
+            "INSERT INTO booru.derived_relations (name, complete, updated_at) "
+            "VALUES (%s, %s, now())", (name, complete))
+
+
+def tag_count_trigger(conn: Connection) -> Optional[bool]:
+    """Whether the trigger counting tags is enabled, `None` before `finalize` installs it"""
+    row = conn.execute(
+        "SELECT tgenabled <> 'D' FROM pg_trigger "
+        "WHERE tgrelid = 'booru.posts_tags_assoc'::regclass AND tgname = %s",
+        (TAG_COUNT_TRIGGER,)).fetchone()
+    return row[0] if row is not None else None
+
+
+def set_tag_count_trigger(conn: Connection, enabled: bool) -> None:
+    """Enable the trigger again, the loads of older versions disabled it for every session"""
+    action = "ENABLE" if enabled else "DISABLE"
+    conn.execute(f"ALTER TABLE booru.posts_tags_assoc {action} TRIGGER {TAG_COUNT_TRIGGER}"
+                )    # type: ignore
+
+
+def skips_tag_counts(conn: Connection) -> bool:
+    """Whether the installed trigger function knows `SKIP_TAG_COUNTS`"""
+    row = conn.execute("SELECT prosrc LIKE %s FROM pg_proc WHERE oid = to_regprocedure(%s)",
+                       (f"%{SKIP_TAG_COUNTS}%", "booru.apply_tag_count_deltas()")).fetchone()
+    return row is not None and row[0]
+
+
+def skip_tag_counts_conninfo(conninfo: str) -> str:
+    """`conninfo` with `SKIP_TAG_COUNTS` set for the session"""
+    params = conninfo_to_dict(conninfo)
+    options = f"{params.get('options') or ''} -c {SKIP_TAG_COUNTS}=on".strip()
+    return make_conninfo(conninfo, options=options)
+
+
+def is_empty(conn: Connection, table_name: str) -> bool:
+    sql = f"SELECT NOT EXISTS (SELECT 1 FROM {table_name})"
+    row = conn.execute(sql).fetchone()    # type: ignore
+    return row is not None and row[0]
+
+
+def copy_staged(conn: Connection, table_name: str, columns: List[str],
+                rows: List[tuple[int, int]]) -> str:
+    """COPY rows into a temporary table shaped like `table_name`, return its name"""
+    staged = "_derived_" + table_name.replace(".", "_")
+    conn.execute(f"CREATE TEMP TABLE {staged} (LIKE {table_name}) ON COMMIT DROP")    # type: ignore
+    copy_rows(conn, staged, columns, ["int4", "int4"], rows)
+    return staged
+
+
+def write_tag_counts(conn: Connection, counter: TagCounter) -> int:
+    """
+    Add the counts to `booru.tag_post_counts` with one COPY, return the tags written.
+
+    An empty table is copied into directly, otherwise the counts are staged
+    and added to the existing ones, which works without the primary key of a
+    bulk load too. The tags of `booru.tags` without a row get a 0 one, as in
+    the definition of the table.
+    """
+    rows = counter.rows()
+    columns = ["tag_id", "post_count"]
+    if is_empty(conn, "booru.tag_post_counts"):
+        copy_rows(conn, "booru.tag_post_counts", columns, ["int4", "int4"], rows)
+    else:
+        staged = copy_staged(conn, "booru.tag_post_counts", columns, rows)
+        conn.execute(f"UPDATE booru.tag_post_counts c SET post_count = c.post_count + d.post_count "
+                     f"FROM {staged} d WHERE c.tag_id = d.tag_id")    # type: ignore
+        conn.execute(f"INSERT INTO booru.tag_post_counts (tag_id, post_count) "
+                     f"SELECT tag_id, post_count FROM {staged} d WHERE NOT EXISTS "
+                     f"(SELECT 1 FROM booru.tag_post_counts c WHERE c.tag_id = d.tag_id) "
+                     f"ORDER BY tag_id")    # type: ignore
+    cur = conn.execute("INSERT INTO booru.tag_post_counts (tag_id, post_count) "
+                       "SELECT t.id, 0 FROM booru.tags t WHERE NOT EXISTS "
+                       "(SELECT 1 FROM booru.tag_post_counts c WHERE c.tag_id = t.id) "
+                       "ORDER BY t.id")
+    return len(rows) + cur.rowcount
+
+
+def write_artist_tags(conn: Connection, pairs: List[tuple[int, int]]) -> int:
+    """Add the pairs missing from `booru.artist_tags_assoc` with one COPY"""
+    columns = ["artist_id", "tag_id"]
+    pairs = sorted(set(pairs))
+    if is_empty(conn, "booru.artist_tags_assoc"):
+        return copy_rows(conn, "booru.artist_tags_assoc", columns, ["int4", "int4"], pairs)
+    staged = copy_staged(conn, "booru.artist_tags_assoc", columns, pairs)
+    sql = (f"INSERT INTO booru.artist_tags_assoc (artist_id, tag_id) "
+           f"SELECT artist_id, tag_id FROM {staged} d WHERE NOT EXISTS "
+           f"(SELECT 1 FROM booru.artist_tags_assoc a "
+           f"WHERE a.artist_id = d.artist_id AND a.tag_id = d.tag_id)")
+    cur = conn.execute(sql)    # type: ignore
+    return cur.rowcount
+
+
+def rederive_tag_counts(conn: Connection) -> None:
+    """`recount_tag_post_counts` in the transaction of the caller"""
+    conn.execute("TRUNCATE booru.tag_post_counts")
+    conn.execute(f"INSERT INTO booru.tag_post_counts (tag_id, post_count) {TAG_POST_COUNTS_SQL}"
+                )    # type: ignore
+
+
+def rederive_artist_tags(conn: Connection) -> None:
+    """`rebuild_artist_tags` in the transaction of the caller"""
+    conn.execute("TRUNCATE booru.artist_tags_assoc")
+    conn.execute(f"INSERT INTO booru.artist_tags_assoc (artist_id, tag_id) {ARTIST_TAGS_SQL}"
+                )    # type: ignore
+
+
+class DerivedTagCounts:
+    """
+    Counts the tags of the posts committed by a load, written when it exits.
+
+    Without `enabled` (e.g. with `--on-conflict nothing`, the associations
+    that already exist are skipped by the database but would be counted here)
+    the trigger keeps counting, or `finalize` recounts if it is not installed yet.
+    The other connections of the load skip the trigger with `conninfo`.
+    """
+    name = "booru.tag_post_counts"
+
+    def __init__(self, conn: Connection, enabled: bool = True):
+        self.conn = conn
+        self.enabled = enabled
+        self.counter = TagCounter()
+        self.trigger: Optional[bool] = None
+        self.recount = False
+
+    def __enter__(self) -> "DerivedTagCounts":
+        conn = self.conn
+        conn.commit()
+        self.trigger = tag_count_trigger(conn)
+        self.recount = is_complete(conn, self.name) is False
+        if self.recount:
+            logger.warning("An earlier load of the posts was interrupted, {} will be recounted "
+                           "at the end".format(self.name))
+        if self.enabled and self.trigger is not None and not skips_tag_counts(conn):
+            logger.warning("The {} trigger cannot be skipped, it counts the load, install "
+                           "the functions of database.sql again".format(TAG_COUNT_TRIGGER))
+            self.enabled = False
+        if self.enabled or self.trigger is None:
+            mark(conn, self.name, False)
+        if self.skipping:
+            conn.execute(f"SET {SKIP_TAG_COUNTS} = on")    # type: ignore
+        conn.commit()
+        return self
+
+    @property
+    def skipping(self) -> bool:
+        """Whether the connections of the load skip the trigger"""
+        return bool(self.trigger) and self.enabled
+
+    def conninfo(self, conninfo: str) -> str:
+        """`conninfo` of the other connections writing the load"""
+        return skip_tag_counts_conninfo(conninfo) if self.skipping else conninfo
+
+    @property
+    def counting(self) -> bool:
+        """Whether the trigger counts the associations written during the load"""
+        return bool(self.trigger) and not self.enabled
+
+    def add_rows(self, rows: PostRows) -> None:
+        if self.enabled:
+            self.counter.add_rows(rows)
+
+    def __exit__(self, *_exc) -> None:
+        conn = self.conn
+        conn.rollback()
+        if self.recount:
+            rederive_tag_counts(conn)
+            logger.info("Recounted {}".format(self.name))
+        elif self.enabled:
+            written = write_tag_counts(conn, self.counter)
+            logger.info("Counted {} associations of {} tags into {}".format(
+                self.counter.total(), written, self.name))
+        if self.enabled or self.recount:
+            mark(conn, self.name, True)
+        if self.skipping:
+            conn.execute(f"RESET {SKIP_TAG_COUNTS}")    # type: ignore
+        if self.trigger is False:
+            set_tag_count_trigger(conn, True)
+        conn.commit()
+
+
+class DerivedArtistTags:
+    """
+    Matches the artists committed by a load with the artist tags, written when it exits.
+
+    Without `enabled` the relation is rebuilt from its definition instead.
+    """
+    name = "booru.artist_tags_assoc"
+
+    def __init__(self, conn: Connection, enabled: bool = True):
+        self.conn = conn
+        self.matcher = ArtistTagMatcher(conn)
+        self.rederive = not enabled
+
+    def __enter__(self) -> "DerivedArtistTags":
+        if is_complete(self.conn, self.name) is False:
+            logger.warning("An earlier load of the artists was interrupted, {} will be rebuilt "
+                           "at the end".format(self.name))
+            self.rederive = True
+        mark(self.conn, self.name, False)
+        self.conn.commit()
+        return self
+
+    def add(self, artists: Iterable[ArtistRaw]) -> None:
+        self.matcher.add(artists)
+
+    def __exit__(self, *_exc) -> None:
+        conn = self.conn
+        conn.rollback()
+        if self.rederive:
+            rederive_artist_tags(conn)
+            logger.info("Rebuilt {} from its definition".format(self.name))
+        else:
+            written = write_artist_tags(conn, self.matcher.pairs)
+            logger.info("Matched {} artists with their tag into {}".format(written, self.name))
+        mark(conn, self.name, True)
+        conn.commit()
+
+
+def settle(conn: Connection, names: Iterable[str]) -> None:
+    """
+    Mark relations found equal to their definition, or rebuilt, as complete.
+
+    The trigger counting tags is enabled again if a killed load of an older version left it
+    disabled for every session.
+    """
+    for name in names:
+        if is_complete(conn, name) is False:
+            mark(conn, name, True)
+            logger.info("Marked {} complete".format(name))
+    if "booru.tag_post_counts" in names and tag_count_trigger(conn) is False:
+        set_tag_count_trigger(conn, True)
+        logger.info("Enabled the {} trigger again".format(TAG_COUNT_TRIGGER))
+    conn.commit()
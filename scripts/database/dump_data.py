@@ -2,8 +2,9 @@ from loguru import logger
 import psycopg
 from psycopg import Connection
 from psycopg.sql import SQL
+from psycopg_pool import ConnectionPool
 import tomli
-from typing import Dict, Optional, Generator, List, TypedDict, TypeVar, Iterable, Callable, Any, Sequence
+from typing import Dict, Optional, Generator, List, TypedDict, TypeVar, Iterable, Callable, Any, Sequence, Type
 from pydantic import BaseModel
 from pathlib import Path
 from pydantic import ValidationError
@@ -12,17 +13,43 @@ import jsonlines
 import click
 import tqdm
 import toolz
+import time
+import asyncio
+import json
+import functools
+from async_loader import load_posts_async
+from bulk import (FinalizeOptions, create_tables as create_tables_, finalize as finalize_,
+                  schema_sql)
+from checkpoint import Checkpoint, IngestState, bump_generation
+from counts import (refresh_illustration_counts, refresh_matviews, relation_exists,
+                    verify_artist_tags, verify_counts as verify_counts_, verify_tag_arrays)
+from derived import DerivedArtistTags, DerivedTagCounts, settle
+import instrument
+from instrument import record, stage
+from loader import (LoadOptions, InsertMethod, INSERT_METHODS, OnConflict, ON_CONFLICTS,
+                    entry_columns, entry_pg_types, write_rows, write_assoc)
+from parallel import PostRows, process_posts_parallel, transform_posts, write_post_rows
+from partitions import (CreatedAtChecks, constrain_created_at, is_partitioned, plan_partitions,
+                        read_partitions)
+from raw_files import open_raw, resolve_raw_file
 from models.posts import PostEntry, PostRaw, PostMediaVariantEntry, PostFileEntry
 from models.tags import TagEntry
 from models.tag_alias import TagAliasEntry
 from models.artists import ArtistEntry, ArtistRaw
 from models.artist_urls import ArtistUrlEntry
+from models.rows import Row, row_fn
+from schema import load_schema
+from writers import process_posts_pooled
+from tag_dict import TagDict, UnknownTags, UnknownTagPolicy, UNKNOWN_TAG_POLICIES, load_tag_dict
+from sync import (SYNC_TABLES, SyncStats, sync_rows, sync_artist_aliases, sync_artist_tags,
+                  sync_posts, delete_unseen)
+from to_parquet import COMPRESSIONS, Compression, RAW_TYPES, convert_file, read_tags_table
 
 T = TypeVar("T")
 U = TypeVar("U", bound=BaseModel)
 V = TypeVar("V")
 
-__all_tags_table: Optional[dict[str, int]] = None
+__all_tags_table: Optional[TagDict] = None
 
 
 class DatabaseConfig(BaseModel):
@@ -33,6 +60,20 @@ class DatabaseConfig(BaseModel):
 
 class InsertionConfig(BaseModel):
     batch_count: int = 1000
+    # where the checkpoints of `--resume` are kept
+    state_file: str = "ingest_state.json"
+    # where the tag dictionary of the post loader is cached
+    tag_cache_dir: str = ".tag_cache"
+    # what to do with tags of posts that are not in `booru.tags`
+    unknown_tags: UnknownTagPolicy = "skip"
+    dead_letter_file: str = "unknown_tags.jsonl"
+    # commit frequency of the pooled writers
+    rows_per_transaction: int = 50_000
+
+
+class PoolConfig(BaseModel):
+    # connections of the pooled writers, at least one per table written
+    size: int = 5
 
 
 class RawDataFileNameConfig(BaseModel):
@@ -48,6 +89,7 @@ class Config(BaseModel):
     database: DatabaseConfig
     file_names: RawDataFileNameConfig
     insertion: InsertionConfig
+    pool: PoolConfig = PoolConfig()
 
 
 def to_kv_str(d: Dict[str, str]) -> str:
@@ -80,9 +122,8 @@ def split_tags(tags: str) -> Iterable[str]:
 def lookup_tags(conn: Connection, tags: List[str], force_remote: bool = False) -> Dict[str, int]:
     """Lookup multiple tags"""
     if not force_remote and __all_tags_table is not None:
-        return {
-            tag: __all_tags_table[tag] for tag in tags if tag in __all_tags_table    # type: ignore
-        }
+        found = {tag: __all_tags_table.get(tag) for tag in tags}
+        return {tag: tag_id for tag, tag_id in found.items() if tag_id is not None}
 
     placeholders = ", ".join(["%s"] * len(tags))
 
@@ -93,74 +134,88 @@ def lookup_tags(conn: Connection, tags: List[str], force_remote: bool = False) -
         return {row[1]: row[0] for row in rows}
 
 
-def read_all_tags(conn: Connection) -> None:
-    """Read all tags from database"""
+def read_all_tags(conn: Connection, cache_dir: str | Path = ".tag_cache") -> None:
+    """Read all tags from database, through the cached tag dictionary"""
     global __all_tags_table
-    with conn.cursor() as c:
-        c.execute("SELECT id, name FROM booru.tags")
-        rows = c.fetchall()
-        __all_tags_table = {row[1]: row[0] for row in rows}
+    __all_tags_table = load_tag_dict(conn, cache_dir)
 
 
-def read_objs(path: str | Path) -> Generator[Dict[str, Any], None, None]:
-    """Read objects from file"""
-    with jsonlines.open(path) as reader:
-        for obj in reader:
+def read_objs(path: str | Path,
+              pbar: Optional[tqdm.tqdm] = None) -> Generator[Dict[str, Any], None, None]:
+    """Read objects from file, plain or compressed, moving `pbar` to the bytes read"""
+    with open_raw(path) as f:
+        for i, obj in enumerate(jsonlines.Reader(f)):
             yield obj
+            if pbar is not None and i % 1000 == 0:
+                pbar.update(f.position - pbar.n)
+        if pbar is not None:
+            pbar.update(f.position - pbar.n)
 
 
 def batched_read_objs(path: str | Path,
                       batch_size: int = 1000) -> Generator[List[Dict[str, Any]], None, None]:
     """Read objects from file"""
-    with jsonlines.open(path) as reader:
+    for batched, _, _ in batched_read_objs_at(path, batch_size):
+        yield batched
+
+
+def batched_read_objs_at(
+        path: str | Path,
+        batch_size: int = 1000,
+        offset: int = 0) -> Generator[tuple[List[Dict[str, Any]], int, int], None, None]:
+    """
+    Read objects from file starting at a byte offset, with the offset after each batch.
+
+    Offsets are in the decompressed data, the third value of a batch is the
+    position in the file on disk, for the progress bars.
+    """
+    with open_raw(path, offset) as f:
         acc: List[Dict[str, Any]] = []
-        for obj in reader:
+        for line in f:
+            offset += len(line)
+            if not line.strip():
+                continue
+            acc.append(json.loads(line))
             if len(acc) >= batch_size:
-                yield acc
-                acc.clear()
-            acc.append(obj)
+                yield acc, offset, f.position
+                acc = []
         if acc:
-            yield acc
+            yield acc, offset, f.position
 
 
-def get_line_count(path: str | Path) -> int:
-    """Get line count of file"""
-    counter = 0
-    with open(path, "r") as f:
-        for _ in f:
-            counter += 1
-    return counter
+def raw_file(obj: "ContextObject", entry: str) -> Path:
+    """The raw file of an entry, or its compressed version if only that one exists"""
+    return resolve_raw_file(obj["input_dir"] / getattr(obj["config"].file_names, entry))
 
 
-def batched_insert_base(conn: Connection, entries: List[U], table_name: str) -> None:
-    """Insert entries into database in batch"""
-    if not entries:
+def batched_insert_base(conn: Connection,
+                        model: Type[BaseModel],
+                        rows: List[Row],
+                        table_name: str,
+                        opts: LoadOptions = LoadOptions()) -> None:
+    """Insert rows of a model into database in batch"""
+    if not rows:
         return
 
-    entries_dict_list = [entry.model_dump() for entry in entries]
-
-    columns = entries_dict_list[0].keys()
-    placeholders = ",".join(["%s"] * len(columns))
-
-    sql = f"INSERT INTO {table_name} ({','.join(columns)}) VALUES ({placeholders})"
-
-    with conn.cursor() as c:
-        # Prepare the list of values for executemany()
-        values = [list(entry.values()) for entry in entries_dict_list]
-        c.executemany(sql, values)
-
+    write_rows(conn, table_name, entry_columns(model), entry_pg_types(model), rows, opts.method,
+               opts.conflict)
+    with stage(table_name, "commit"):
         conn.commit()
 
 
 def batched_insert_posts(conn: Connection,
                          posts: List[PostRaw],
                          assoc_tags: bool = True,
-                         fetch_all_tags: bool = True) -> None:
+                         fetch_all_tags: bool = True,
+                         opts: LoadOptions = LoadOptions(),
+                         unknown: Optional[UnknownTags] = None,
+                         on_written: Callable[[PostRows], None] = lambda _: None) -> None:
     """
     Insert posts into database in batch.
 
     assoc_tags should only be true if the tags are already in the database,
-    since it depends on the tags table.
+    since it depends on the tags table. Tags missing from it are handled by
+    `unknown`, skipped by default. `on_written` gets the committed rows.
     """
     if not posts:
         return
@@ -170,61 +225,44 @@ def batched_insert_posts(conn: Connection,
             # I assume the tags won't change during the insertion of posts.
             read_all_tags(conn)
 
-    entries = [PostEntry.from_raw(post) for post in posts]
-    media_variants = [PostMediaVariantEntry.from_raw(post) for post in posts]
-    flatten_variants = list(concat(media_variants))
-    file_entries = [PostFileEntry.from_raw(post) for post in posts]
-
-    ids_tags: Optional[list[tuple[int, str]]] = None
-    lookup_table: Optional[dict[str, int]] = None
-
-    if assoc_tags:
-        # the ideal way is using a cache instead of building a lookup table
-        # every time.
-        ids_tags = list(get_id_tag_pairs(posts))
-        only_tags = list(map(lambda x: x[1], ids_tags))
-        if __all_tags_table is None:
-            lookup_table = lookup_tags(conn, only_tags)
-        else:
-            lookup_table = __all_tags_table
-
-    def batch_entries():
-        batched_insert_base(conn, entries, "booru.posts")
-
-    def batch_media_variants():
-        batched_insert_base(conn, flatten_variants, "booru.posts_media_variants")
-
-    def batch_file_entries():
-        batched_insert_base(conn, file_entries, "booru.posts_file_urls")
-
-    def batch_assoc_tags(table: dict[str, int], id_tag_pairs: Iterable[tuple[int, str]]):
-        with conn.cursor() as c:
-            c.executemany("INSERT INTO booru.posts_tags_assoc (post_id, tag_id) VALUES (%s, %s)",
-                          [(post_id, table[tag]) for post_id, tag in id_tag_pairs])
-            conn.commit()
-
-    batch_entries()
-    batch_media_variants()
-    batch_file_entries()
-    if assoc_tags:
-        assert lookup_table is not None
-        assert ids_tags is not None
-        batch_assoc_tags(lookup_table, ids_tags)
-
+    with stage("posts", "transform", rows=len(posts)):
+        rows = transform_posts(posts, validate=opts.validate_rows, tags=__all_tags_table)
+    if not assoc_tags:
+        on_written(write_post_rows(conn, rows, None, opts))
+        return
 
-def batched_insert_tags(conn: Connection, tags: List[TagEntry]) -> None:
+    if __all_tags_table is None and rows.unknown_tags:
+        only_tags = list({tag for _, tag in rows.unknown_tags})
+        lookup_table = lookup_tags(conn, only_tags)
+        rows = rows._replace(
+            tag_ids=[(post_id, lookup_table[tag])
+                     for post_id, tag in rows.unknown_tags
+                     if tag in lookup_table],
+            unknown_tags=[(post_id, tag)
+                          for post_id, tag in rows.unknown_tags
+                          if tag not in lookup_table])
+
+    if unknown is None:
+        unknown = UnknownTags()
+    on_written(write_post_rows(conn, rows, unknown, opts))
+
+
+def batched_insert_tags(conn: Connection,
+                        tags: List[Row],
+                        opts: LoadOptions = LoadOptions()) -> None:
     """Insert tags into database in batch"""
-    batched_insert_base(conn, tags, "booru.tags")
+    batched_insert_base(conn, TagEntry, tags, "booru.tags", opts)
 
 
 def batch_insert_tag_alias(conn: Connection,
-                           tag_aliases: List[TagAliasEntry],
-                           implication: bool = False) -> None:
+                           tag_aliases: List[Row],
+                           implication: bool = False,
+                           opts: LoadOptions = LoadOptions()) -> None:
     """Insert tag aliases into database"""
     if implication:
-        batched_insert_base(conn, tag_aliases, "booru.tag_implications")
+        batched_insert_base(conn, TagAliasEntry, tag_aliases, "booru.tags_implications", opts)
     else:
-        batched_insert_base(conn, tag_aliases, "booru.tag_aliases")
+        batched_insert_base(conn, TagAliasEntry, tag_aliases, "booru.tags_aliases", opts)
 
 
 def other_names_pairs(artists: Sequence[ArtistRaw]) -> Generator[tuple[int, str], None, None]:
@@ -235,47 +273,66 @@ def other_names_pairs(artists: Sequence[ArtistRaw]) -> Generator[tuple[int, str]
             yield from ((artist["id"], name) for name in names)
 
 
-def batched_insert_artists(conn: Connection, artists: List[ArtistRaw]) -> None:
-    """Insert artists and their aliases into database in batch"""
+def batched_insert_artists(conn: Connection,
+                           artists: List[ArtistRaw],
+                           opts: LoadOptions = LoadOptions(),
+                           on_written: Callable[[List[ArtistRaw]], None] = lambda _: None) -> None:
+    """Insert artists and their aliases into database in batch, `on_written` gets them committed"""
     if not artists:
         return
 
-    artists_dict_list = [ArtistEntry.from_raw(artist).model_dump() for artist in artists]
-
-    columns = artists_dict_list[0].keys()
-    placeholders = ",".join(["%s"] * len(columns))
-
-    sql = f"INSERT INTO booru.artists ({','.join(columns)}) VALUES ({placeholders})"
+    artist_row = row_fn(ArtistEntry, opts.validate_rows)
+    rows = [artist_row(artist) for artist in artists]
+    write_rows(conn, "booru.artists", entry_columns(ArtistEntry), entry_pg_types(ArtistEntry),
+               rows, opts.method, opts.conflict)
 
-    with conn.cursor() as c:
-        values = [list(artist.values()) for artist in artists_dict_list]
-        c.executemany(sql, values)
-
-        aliases = list(other_names_pairs(artists))
-
-        if aliases:
-            c.executemany(
-                "INSERT INTO booru.artists_aliases (artist_id, alias) VALUES (%s, %s)",
-                aliases,
-            )
+    aliases = list(other_names_pairs(artists))
+    if aliases:
+        write_assoc(conn, "booru.artists_aliases", aliases, opts.method, opts.conflict)
+    with stage("booru.artists", "commit"):
         conn.commit()
+    on_written(artists)
 
 
-def batched_insert_artist_urls(conn: Connection, artist_urls: List[ArtistUrlEntry]) -> None:
+def batched_insert_artist_urls(conn: Connection,
+                               artist_urls: List[Row],
+                               opts: LoadOptions = LoadOptions()) -> None:
     """Insert artist urls into database in batch"""
-    batched_insert_base(conn, artist_urls, "booru.artists_urls")
+    batched_insert_base(conn, ArtistUrlEntry, artist_urls, "booru.artists_urls", opts)
 
 
 class ContextObject(TypedDict):
     config: Config
     conn: Connection
+    conn_info: str
     input_dir: Path
+    metrics_json: Optional[str]
+    metrics_prom: Optional[str]
+
+
+def write_metrics(obj: ContextObject) -> None:
+    """Log the per-stage timings of the command and write the reports asked for"""
+    instruments = instrument.instruments
+    if instruments.stages:
+        instruments.log()
+    if obj["metrics_json"]:
+        instruments.write_json(obj["metrics_json"])
+        logger.info("Wrote timings to {}".format(obj["metrics_json"]))
+    if obj["metrics_prom"]:
+        instruments.write_prometheus(obj["metrics_prom"])
+        logger.info("Wrote Prometheus metrics to {}".format(obj["metrics_prom"]))
 
 
 class Context(TypedDict):
     obj: ContextObject
 
 
+# commands that only read the raw files and never touch the database
+OFFLINE_COMMANDS = {"to-parquet"}
+# commands that do not bump the ingest generation
+READ_ONLY_COMMANDS = OFFLINE_COMMANDS | {"lookup-tag", "refresh-views", "verify-counts"}
+
+
 def create_group():
 
     @click.group()
@@ -289,8 +346,17 @@ def create_group():
                   default="raw",
                   help="Path to raw data directory",
                   type=click.Path(exists=True))
+    @click.option("--metrics-json",
+                  default=None,
+                  help="Write the per-stage timings of the command to this JSON file",
+                  type=click.Path())
+    @click.option("--metrics-prom",
+                  default=None,
+                  help="Write them in the Prometheus text format to this file too",
+                  type=click.Path())
     @click.pass_context
-    def cli(ctx: click.Context, config: str, input: str):
+    def cli(ctx: click.Context, config: str, input: str, metrics_json: Optional[str],
+            metrics_prom: Optional[str]):
         config_dict = {}
         ctx.ensure_object(dict)
         with open(Path(config), "rb") as f:
@@ -299,13 +365,19 @@ def create_group():
         if not config_obj.database.password:
             config_obj.database.password = postgres_env_password()
         ctx.obj["config"] = config_obj
+        p = Path(input)
+        ctx.obj["input_dir"] = p
+        ctx.obj["metrics_json"] = metrics_json
+        ctx.obj["metrics_prom"] = metrics_prom
+        instrument.reset()
+        if ctx.invoked_subcommand in OFFLINE_COMMANDS:
+            return
         conn_info = to_kv_str(config_obj.database.model_dump())
         # https://www.postgresql.org/docs/current/libpq-connect.html#LIBPQ-CONNSTRING
         logger.info("Connecting to database")
         conn = psycopg.connect(conninfo=conn_info)
         ctx.obj["conn"] = conn
-        p = Path(input)
-        ctx.obj["input_dir"] = p
+        ctx.obj["conn_info"] = conn_info
 
     @cli.command()
     @click.pass_context
@@ -319,65 +391,491 @@ def create_group():
     def process_data(obj: ContextObject,
                      entry: str,
                      insert_fn: Callable[[Connection, List[T]], None],
-                     transform_fn: Optional[Callable[[dict[str, Any]], T]] = None) -> None:
+                     transform_fn: Optional[Callable[[dict[str, Any]], T]] = None,
+                     resume: bool = False) -> None:
         conn = obj["conn"]
-        input_dir = obj["input_dir"]
         config = obj["config"]
-        file = input_dir / getattr(config.file_names, entry)
-        count = get_line_count(file)
-        logger.info("Dumping {} {}".format(count, entry))
-        with tqdm.tqdm(total=count, desc=entry) as pbar:
-            for batched in batched_read_objs(file, config.insertion.batch_count):
+        file = raw_file(obj, entry)
+        state = IngestState(config.insertion.state_file)
+        checkpoint = state.get(entry, file) if resume else None
+        offset = checkpoint.offset if checkpoint is not None else 0
+        done = checkpoint.rows if checkpoint is not None else 0
+        if checkpoint is not None:
+            logger.info("Resuming {} after {} rows (id {})".format(entry, done,
+                                                                  checkpoint.last_id))
+        logger.info("Dumping {} from {}".format(entry, file))
+        start = time.perf_counter()
+        size = file.stat().st_size
+        initial = done
+        # the bar follows the position in the file on disk, compressed or not
+        with tqdm.tqdm(total=size, desc=entry, unit="B", unit_scale=True) as pbar:
+            batches = batched_read_objs_at(file, config.insertion.batch_count, offset)
+            while True:
+                # `decode` covers reading (and decompressing) and parsing the lines of a batch
+                wall, cpu = time.perf_counter(), time.thread_time()
+                last_offset = offset
+                batched, offset, position = next(batches, ([], offset, size))
+                if not batched:
+                    break
+                record(entry, "decode",
+                       time.perf_counter() - wall,
+                       time.thread_time() - cpu, len(batched), offset - last_offset)
                 if transform_fn is None:
                     insert_fn(conn, batched)
                 else:
-                    insert_fn(conn, [transform_fn(item) for item in batched])
-                pbar.update(len(batched))
+                    with stage(entry, "transform", rows=len(batched)):
+                        items = [transform_fn(item) for item in batched]
+                    insert_fn(conn, items)
+                done += len(batched)
+                state.save(entry, Checkpoint(file=str(file), size=size, offset=offset, rows=done,
+                                             last_id=batched[-1].get("id")))
+                pbar.update(position - pbar.n)
+                pbar.set_postfix({"rows": done})
+            elapsed = time.perf_counter() - start
+            dumped = done - initial
+        logger.info("Dumped {} {} in {:.1f}s ({:.0f} rows/s)".format(
+            dumped, entry, elapsed, dumped / elapsed if elapsed > 0 else 0))
+
+    def load_options(fn: Callable[..., Any]) -> Callable[..., Any]:
+        """Add the options shared by every dump command, passed on as `opts` and `resume`"""
+
+        @click.option("--method",
+                      "-m",
+                      default="insert",
+                      help="Insertion method, `copy` streams rows with binary COPY",
+                      type=click.Choice(INSERT_METHODS))
+        @click.option("--validate",
+                      is_flag=True,
+                      default=False,
+                      help="Validate rows with the pydantic models (slower)")
+        @click.option("--on-conflict",
+                      default=None,
+                      help="What to do with rows that already exist, `nothing` with --resume",
+                      type=click.Choice(ON_CONFLICTS))
+        @click.option("--resume",
+                      is_flag=True,
+                      default=False,
+                      help="Continue from the last checkpoint instead of the start of the file")
+        @functools.wraps(fn)
+        def wrapper(*args, method: InsertMethod, validate: bool, on_conflict: Optional[OnConflict],
+                    resume: bool, **kwargs):
+            if on_conflict is None:
+                # the last batch may be committed without its checkpoint
+                on_conflict = "nothing" if resume else "error"
+            opts = LoadOptions(method=method, conflict=on_conflict, validate_rows=validate)
+            return fn(*args, opts=opts, resume=resume, **kwargs)
+
+        return wrapper
+
+    unknown_tags_option = click.option("--unknown-tags",
+                                       default=None,
+                                       help="Policy for tags missing from the tags table "
+                                       "(default from config)",
+                                       type=click.Choice(UNKNOWN_TAG_POLICIES))
+    derive_option = click.option("--derive/--no-derive",
+                                 default=True,
+                                 help="Derive the tag counts or the artist tags from the rows "
+                                 "written, instead of the triggers and the SQL definitions")
 
     @cli.result_callback()
     @click.pass_context
     def close_connection(ctx, *_args, **_kwargs):
+        write_metrics(ctx.obj)
+        conn: Optional[Connection] = ctx.obj.get("conn")
+        if conn is None:
+            return
+        if ctx.invoked_subcommand not in READ_ONLY_COMMANDS:
+            # invalidates the query caches of the explore side
+            conn.rollback()
+            logger.info("Ingest generation {}".format(bump_generation(conn)))
         logger.info("Closing connection")
-        conn: Connection = ctx.obj["conn"]
         conn.close()
 
     @cli.command()
     @click.pass_context
-    def posts(ctx: click.Context):
+    @load_options
+    @click.option("--workers",
+                  "-w",
+                  default=0,
+                  help="Number of parser processes, 0 to parse in the writer process",
+                  type=int)
+    @click.option("--chunk-mb",
+                  default=8,
+                  help="Size of the byte range handed to a parser process",
+                  type=int)
+    @click.option("--engine",
+                  default="sync",
+                  help="`async` decodes the next range while the previous one is written, "
+                  "`pooled` writes each table on its own pooled connection, `partitioned` "
+                  "the partitions of the post tables",
+                  type=click.Choice(["sync", "async", "pooled", "partitioned"]))
+    @click.option("--queue-depth",
+                  default=2,
+                  help="Decoded ranges waiting for the writer of the async engine",
+                  type=int)
+    @unknown_tags_option
+    @derive_option
+    def posts(ctx: click.Context, opts: LoadOptions, resume: bool, workers: int, chunk_mb: int,
+              engine: str, queue_depth: int, unknown_tags: Optional[UnknownTagPolicy],
+              derive: bool):
         """Dump posts"""
-        process_data(ctx.obj, "posts", lambda conn, raw: batched_insert_posts(conn, raw))
+        conn: Connection = ctx.obj["conn"]
+        config: Config = ctx.obj["config"]
+        read_all_tags(conn, config.insertion.tag_cache_dir)
+        unknown = UnknownTags(unknown_tags or config.insertion.unknown_tags,
+                              config.insertion.dead_letter_file)
+        if not relation_exists(conn, "booru.posts_tag_arrays"):
+            logger.warning("No booru.posts_tag_arrays table, the tag arrays are not written")
+            opts = opts.model_copy(update={"tag_arrays": False})
+        if engine == "partitioned" and not is_partitioned(conn):
+            raise click.UsageError("booru.posts is not partitioned, see `create-tables "
+                                   "--partitions`")
+        # the associations that already exist would be counted again
+        with CreatedAtChecks(conn), DerivedTagCounts(
+                conn, enabled=derive and opts.conflict == "error") as tag_counts:
+            if workers <= 0 and engine == "sync":
+                process_data(ctx.obj,
+                             "posts",
+                             lambda conn, raw: batched_insert_posts(
+                                 conn, raw, opts=opts, unknown=unknown,
+                                 on_written=tag_counts.add_rows),
+                             resume=resume)
+                unknown.log()
+                return
+
+            file = raw_file(ctx.obj, "posts")
+            size = file.stat().st_size
+            state = IngestState(config.insertion.state_file)
+            checkpoint = state.get("posts", file) if resume else None
+            offset = checkpoint.offset if checkpoint is not None else 0
+            done = checkpoint.rows if checkpoint is not None else 0
+            assert __all_tags_table is not None
+            logger.info("Dumping posts with the {} engine and {} workers".format(engine, workers))
+            start = time.perf_counter()
+            with tqdm.tqdm(total=size, desc="posts", unit="B", unit_scale=True) as pbar:
+
+                def on_written(rows: PostRows, queued: Optional[int] = None):
+                    nonlocal done
+                    tag_counts.add_rows(rows)
+                    done += len(rows.posts)
+                    last_id = rows.posts[-1][0] if rows.posts else None
+                    state.save(
+                        "posts",
+                        Checkpoint(file=str(file),
+                                   size=size,
+                                   offset=rows.byte_range.end,
+                                   rows=done,
+                                   last_id=last_id))
+                    pbar.update(rows.byte_range.file_end - pbar.n)
+                    elapsed = time.perf_counter() - start
+                    postfix = {"rows/s": "{:.0f}".format((done - initial) / elapsed)}
+                    if queued is not None:
+                        postfix["queued"] = str(queued)
+                    pbar.set_postfix(postfix)
+
+                initial = done
+                if engine == "async":
+                    count = asyncio.run(
+                        load_posts_async(tag_counts.conninfo(ctx.obj["conn_info"]),
+                                         conn,
+                                         file,
+                                         __all_tags_table,
+                                         unknown,
+                                         chunk_mb * 1024 * 1024,
+                                         opts,
+                                         workers,
+                                         queue_depth,
+                                         start=offset,
+                                         on_written=on_written))
+                elif engine in ("pooled", "partitioned"):
+                    partitions = read_partitions(conn) if engine == "partitioned" else None
+                    rows_per_transaction = config.insertion.rows_per_transaction
+                    if partitions is not None and tag_counts.counting:
+                        # the trigger of every writer updates the same counts, a transaction
+                        # of several batches could deadlock with another
+                        rows_per_transaction = 0
+                    with ConnectionPool(tag_counts.conninfo(ctx.obj["conn_info"]),
+                                        min_size=config.pool.size,
+                                        max_size=config.pool.size) as pool:
+                        count = process_posts_pooled(pool,
+                                                     conn,
+                                                     file,
+                                                     __all_tags_table,
+                                                     unknown,
+                                                     chunk_mb * 1024 * 1024,
+                                                     opts,
+                                                     workers,
+                                                     rows_per_transaction,
+                                                     start=offset,
+                                                     on_written=on_written,
+                                                     partitions=partitions)
+                else:
+                    count = process_posts_parallel(conn,
+                                                   file,
+                                                   __all_tags_table,
+                                                   unknown,
+                                                   workers,
+                                                   chunk_mb * 1024 * 1024,
+                                                   opts,
+                                                   start=offset,
+                                                   on_written=on_written)
+            elapsed = time.perf_counter() - start
+            logger.info("Dumped {} posts in {:.1f}s ({:.0f} rows/s)".format(
+                count, elapsed, count / elapsed if elapsed > 0 else 0))
+            unknown.log()
 
     @cli.command()
     @click.pass_context
-    def tags(ctx: click.Context):
+    @load_options
+    def tags(ctx: click.Context, opts: LoadOptions, resume: bool):
         """Dump tags"""
-        process_data(ctx.obj, "tags", batched_insert_tags, TagEntry.from_raw)
+        process_data(ctx.obj, "tags", lambda conn, raw: batched_insert_tags(conn, raw, opts),
+                     row_fn(TagEntry, opts.validate_rows), resume)
 
     @cli.command()
     @click.pass_context
-    def tag_alias(ctx: click.Context):
+    @load_options
+    def tag_alias(ctx: click.Context, opts: LoadOptions, resume: bool):
         """Dump tag aliases"""
-        process_data(ctx.obj, "tag_aliases", batch_insert_tag_alias, TagAliasEntry.from_raw)
+        process_data(ctx.obj, "tag_aliases",
+                     lambda conn, raw: batch_insert_tag_alias(conn, raw, opts=opts),
+                     row_fn(TagAliasEntry, opts.validate_rows), resume)
 
     @cli.command()
     @click.pass_context
-    def tag_implications(ctx: click.Context):
+    @load_options
+    def tag_implications(ctx: click.Context, opts: LoadOptions, resume: bool):
         """Dump tag implications"""
-        process_data(ctx.obj, "tag_implications",
-                     lambda conn, raw: batch_insert_tag_alias(conn, raw, implication=True),
-                     TagAliasEntry.from_raw)
+        process_data(
+            ctx.obj, "tag_implications",
+            lambda conn, raw: batch_insert_tag_alias(conn, raw, implication=True, opts=opts),
+            row_fn(TagAliasEntry, opts.validate_rows), resume)
 
     @cli.command()
     @click.pass_context
-    def artists(ctx: click.Context):
+    @load_options
+    @derive_option
+    def artists(ctx: click.Context, opts: LoadOptions, resume: bool, derive: bool):
         """Dump artists"""
-        process_data(ctx.obj, "artists", batched_insert_artists)
+        conn: Connection = ctx.obj["conn"]
+        if not derive:
+            process_data(ctx.obj,
+                         "artists",
+                         lambda conn, raw: batched_insert_artists(conn, raw, opts),
+                         resume=resume)
+            return
+        # an updated artist may have been renamed, its old pairs are left to the rebuild
+        with DerivedArtistTags(conn, enabled=opts.conflict != "update") as artist_tags:
+            process_data(ctx.obj,
+                         "artists",
+                         lambda conn, raw: batched_insert_artists(
+                             conn, raw, opts, on_written=artist_tags.add),
+                         resume=resume)
 
     @cli.command()
     @click.pass_context
-    def artist_urls(ctx: click.Context):
+    @load_options
+    def artist_urls(ctx: click.Context, opts: LoadOptions, resume: bool):
         """Dump artist urls"""
-        process_data(ctx.obj, "artist_urls", batched_insert_artist_urls, ArtistUrlEntry.from_raw)
+        process_data(ctx.obj, "artist_urls",
+                     lambda conn, raw: batched_insert_artist_urls(conn, raw, opts),
+                     row_fn(ArtistUrlEntry, opts.validate_rows), resume)
+
+    @cli.command()
+    @click.pass_context
+    @click.option("--bulk",
+                  is_flag=True,
+                  default=False,
+                  help="Unlogged tables without keys or indexes, run `finalize` after loading")
+    @click.option("--partitions",
+                  default=None,
+                  help="Partition the post tables by post id, `year` for a partition per "
+                  "created_at year of the posts file or a number of ids per partition",
+                  type=str)
+    @click.option("--print-sql",
+                  is_flag=True,
+                  default=False,
+                  help="Print the statements instead of running them")
+    def create_tables(ctx: click.Context, bulk: bool, partitions: Optional[str], print_sql: bool):
+        """Create the tables of database.sql"""
+        if bulk and partitions:
+            raise click.UsageError("--bulk creates unlogged tables, which cannot be partitioned")
+        planned = plan_partitions(partitions, raw_file(ctx.obj, "posts")) if partitions else None
+        if print_sql:
+            for sql in schema_sql(load_schema(), bulk, planned):
+                click.echo(sql + ";\n")
+            return
+        conn: Connection = ctx.obj["conn"]
+        create_tables_(conn, load_schema(), bulk, planned)
+        logger.info("Created tables{}{}".format(
+            " for a bulk load" if bulk else "",
+            " with {} partitions of the post tables".format(len(planned)) if planned else ""))
+
+    @cli.command()
+    @click.pass_context
+    def constrain_partitions(ctx: click.Context):
+        """Set the created_at checks of the post partitions from their rows"""
+        conn: Connection = ctx.obj["conn"]
+        if not is_partitioned(conn):
+            raise click.UsageError("booru.posts is not partitioned")
+        checked = constrain_created_at(conn)
+        conn.commit()
+        logger.info("Set the created_at checks of {} partitions".format(checked))
+
+    @cli.command()
+    @click.pass_context
+    @click.option("--jobs", "-j", default=4, help="Statements run concurrently", type=int)
+    @click.option("--maintenance-work-mem",
+                  default="1GB",
+                  help="`maintenance_work_mem` of the index builds",
+                  type=str)
+    @click.option("--parallel-workers",
+                  default=2,
+                  help="`max_parallel_maintenance_workers` of each index build",
+                  type=int)
+    def finalize(ctx: click.Context, jobs: int, maintenance_work_mem: str, parallel_workers: int):
+        """Build keys, indexes and foreign keys after a bulk load"""
+        conn: Connection = ctx.obj["conn"]
+        opts = FinalizeOptions(jobs=jobs,
+                               maintenance_work_mem=maintenance_work_mem,
+                               parallel_workers=parallel_workers)
+        finalize_(conn, ctx.obj["conn_info"], load_schema(), opts)
+
+    @cli.command()
+    @click.pass_context
+    @click.option("--force",
+                  is_flag=True,
+                  default=False,
+                  help="Refresh every materialized view, even the up to date ones")
+    def refresh_views(ctx: click.Context, force: bool):
+        """Apply pending changes to the illustration counts and refresh stale materialized views"""
+        conn: Connection = ctx.obj["conn"]
+        posts = 0
+        if relation_exists(conn, "booru.posts_tags_changes"):
+            start = time.perf_counter()
+            posts = refresh_illustration_counts(conn)
+            logger.info("Recounted {} changed posts in {:.2f}s".format(
+                posts,
+                time.perf_counter() - start))
+        refreshed = refresh_matviews(conn, force)
+        logger.info("Refreshed {} materialized views".format(len(refreshed)))
+        if posts or refreshed:
+            logger.info("Ingest generation {}".format(bump_generation(conn)))
+
+    @cli.command()
+    @click.pass_context
+    @click.option("--fix", is_flag=True, default=False, help="Rebuild the tables that differ")
+    @click.option("--show", default=10, help="Mismatched tags shown per table", type=int)
+    def verify_counts(ctx: click.Context, fix: bool, show: int):
+        """Compare the incrementally maintained and derived tables with a full recount"""
+        conn: Connection = ctx.obj["conn"]
+        mismatches = verify_counts_(conn, fix)
+        for table, rows in mismatches.items():
+            for row in rows[:show]:
+                logger.info("{} tag {}: {} incremental, {} recounted".format(
+                    table, row.tag_id, "no row" if row.incremental is None else row.incremental,
+                    "no row" if row.full is None else row.full))
+        artist_tags = verify_artist_tags(conn, fix)
+        for pair in artist_tags[:show]:
+            logger.info("booru.artist_tags_assoc artist {} tag {}: {}".format(
+                pair.artist_id, pair.tag_id,
+                "missing" if pair.missing else "not in the definition"))
+        tag_arrays: List[int] = []
+        if relation_exists(conn, "booru.posts_tag_arrays"):
+            tag_arrays = verify_tag_arrays(conn, fix)
+            for post_id in tag_arrays[:show]:
+                logger.info("booru.posts_tag_arrays post {} differs".format(post_id))
+        consistent = [table for table, rows in mismatches.items() if fix or not rows]
+        if fix or not artist_tags:
+            consistent.append("booru.artist_tags_assoc")
+        settle(conn, consistent)
+        if fix and (any(mismatches.values()) or artist_tags or tag_arrays):
+            logger.info("Ingest generation {}".format(bump_generation(conn)))
+
+    @cli.command()
+    @click.pass_context
+    @click.option("--method",
+                  "-m",
+                  default="insert",
+                  help="Insertion method, `copy` streams rows with binary COPY",
+                  type=click.Choice(INSERT_METHODS))
+    @click.option("--delete/--no-delete",
+                  default=True,
+                  help="Delete rows that are missing from the new dump")
+    @unknown_tags_option
+    @click.argument("entries", type=click.Choice(list(SYNC_TABLES.keys())), nargs=-1)
+    def sync(ctx: click.Context, method: InsertMethod, delete: bool,
+             unknown_tags: Optional[UnknownTagPolicy], entries: tuple[str, ...]):
+        """Sync a newer dump into the database (all entries if none is given)"""
+        conn: Connection = ctx.obj["conn"]
+        config: Config = ctx.obj["config"]
+        stats = SyncStats()
+        unknown = UnknownTags(unknown_tags or config.insertion.unknown_tags,
+                              config.insertion.dead_letter_file)
+        tag_arrays = relation_exists(conn, "booru.posts_tag_arrays")
+        for entry in SYNC_TABLES.keys():
+            if entries and entry not in entries:
+                continue
+            model, table_name = SYNC_TABLES[entry]
+            file = raw_file(ctx.obj, entry)
+            if entry == "posts":
+                # after the tags are synced, so new tags are in the dictionary
+                read_all_tags(conn, config.insertion.tag_cache_dir)
+            logger.info("Syncing {}".format(entry))
+            with CreatedAtChecks(conn, enabled=entry == "posts"):
+                with tqdm.tqdm(total=file.stat().st_size, desc=entry, unit="B",
+                               unit_scale=True) as pbar:
+                    for batched, _, position in batched_read_objs_at(
+                            file, config.insertion.batch_count):
+                        if entry == "posts":
+                            assert __all_tags_table is not None
+                            sync_posts(conn, batched, __all_tags_table, unknown, stats, method,
+                                       tag_arrays)
+                        else:
+                            to_row = row_fn(model)
+                            sync_rows(conn, model, [to_row(obj) for obj in batched], table_name,
+                                      stats, method)
+                            if entry == "artists":
+                                sync_artist_aliases(conn, batched, stats)
+                            conn.commit()
+                        pbar.update(position - pbar.n)
+                if delete:
+                    delete_unseen(conn, table_name, stats)
+        if not entries or {"tags", "artists"} & set(entries):
+            # links new and renamed artists and artist tags, once both are synced
+            sync_artist_tags(conn, stats)
+        stats.log()
+        unknown.log()
+
+    @cli.command()
+    @click.pass_context
+    @click.option("--output",
+                  "-o",
+                  default="parquet",
+                  help="Output directory",
+                  type=click.Path(file_okay=False))
+    @click.option("--row-group-size", default=100_000, help="Rows per row group", type=int)
+    @click.option("--compression",
+                  default="zstd",
+                  help="Parquet compression codec",
+                  type=click.Choice(COMPRESSIONS))
+    @click.argument("entries", type=click.Choice(list(RAW_TYPES.keys())), nargs=-1)
+    def to_parquet(ctx: click.Context, output: str, row_group_size: int,
+                   compression: Compression, entries: tuple[str, ...]):
+        """Convert raw dumps to parquet (all of them if no entry is given)"""
+        output_dir = Path(output)
+        tags_table: Optional[dict[str, int]] = None
+        for entry in entries or RAW_TYPES.keys():
+            file = raw_file(ctx.obj, entry)
+            if entry == "posts" and tags_table is None:
+                logger.info("Reading tags table")
+                tags_table = read_tags_table(raw_file(ctx.obj, "tags"), read_objs)
+            logger.info("Converting {} from {}".format(entry, file))
+            with tqdm.tqdm(total=file.stat().st_size, desc=entry, unit="B",
+                           unit_scale=True) as pbar:
+                rows = convert_file(read_objs(file, pbar), entry, output_dir, row_group_size,
+                                    compression, tags_table)
+            logger.info("Wrote {} {} rows to {}".format(rows, entry, output_dir))
 
     return cli
 
@@ -20,28 +20,22 @@ FROM booru.artist_tags_assoc ata
      booru.tag_post_counts pc ON ata.tag_id = pc.tag_id
 GROUP BY ata.tag_id, a.id, pc.post_count;
 
+-- the names of the tag arrays the loader writes, no aggregation over posts_tags_assoc
 CREATE VIEW booru.posts_tag_view AS
-SELECT p.id                          AS post_id,
+SELECT p.id                                                                           AS post_id,
        p.created_at,
        p.score,
        p.rating,
        p.fav_count,
-       array_agg(DISTINCT t.name)
-       FILTER (WHERE t.category = 0) AS general,
-       array_agg(DISTINCT t.name)
-       FILTER (WHERE t.category = 1) AS artist,
-       array_agg(DISTINCT t.name)
-       FILTER (WHERE t.category = 3) AS copyright,
-       array_agg(DISTINCT t.name)
-       FILTER (WHERE t.category = 4) AS character,
-       array_agg(DISTINCT t.name)
-       FILTER (WHERE t.category = 5) AS meta
+       (SELECT array_agg(t.name ORDER BY t.name) FROM booru.tags t WHERE t.id = ANY (a.general))   AS general,
+       (SELECT array_agg(t.name ORDER BY t.name) FROM booru.tags t WHERE t.id = ANY (a.artist))    AS artist,
+       (SELECT array_agg(t.name ORDER BY t.name) FROM booru.tags t WHERE t.id = ANY (a.copyright)) AS copyright,
+       (SELECT array_agg(t.name ORDER BY t.name) FROM booru.tags t WHERE t.id = ANY (a.character)) AS character,
+       (SELECT array_agg(t.name ORDER BY t.name) FROM booru.tags t WHERE t.id = ANY (a.meta))      AS meta
 FROM booru.posts p
          JOIN
-     booru.posts_tags_assoc pta ON p.id = pta.post_id
-         JOIN
-     booru.tags t ON pta.tag_id = t.id
-GROUP BY p.id, p.created_at, p.score, p.rating, p.fav_count;
+     booru.posts_tag_arrays a ON p.id = a.post_id
+WHERE a.tag_ids <> '{}';
 
 CREATE OR REPLACE VIEW booru.view_post_aspect_ratio AS
 SELECT p.id,
@@ -69,3 +63,105 @@ SELECT aspect_ratio_bucket, count(*)
 FROM booru.view_post_aspect_ratio
 GROUP BY aspect_ratio_bucket;
 
+
+-- incremental illustration-only tag counts, the counterpart of the
+-- `booru.view_posts_count_illustration_only` materialized view of playground.sql.
+-- Association and date changes are logged by triggers, `dump_data.py refresh-views`
+-- applies them to the counts of the affected posts only.
+CREATE OR REPLACE FUNCTION booru.non_illustration_tag_ids() RETURNS INT[]
+    LANGUAGE sql
+    STABLE AS
+$$
+SELECT COALESCE(array_agg(id), '{}')
+FROM booru.tags
+WHERE name IN ('video', 'sound', 'animated')
+   OR (category = 0 AND (name LIKE '%comic' OR name LIKE '%4koma'))
+$$;
+
+-- posts counted in `booru.illustration_tag_counts` as of the last refresh
+CREATE TABLE booru.illustration_posts
+(
+    post_id INT PRIMARY KEY
+);
+
+CREATE TABLE booru.illustration_tag_counts
+(
+    tag_id     INT PRIMARY KEY,
+    post_count INT NOT NULL
+);
+
+-- changes since the last refresh, delta 0 when only the post date changed
+CREATE TABLE booru.posts_tags_changes
+(
+    post_id INT      NOT NULL,
+    tag_id  INT,
+    delta   SMALLINT NOT NULL
+);
+
+-- base table write counters of each materialized view at its last refresh
+CREATE TABLE booru.matview_refreshes
+(
+    name          TEXT PRIMARY KEY,
+    table_changes JSONB       NOT NULL,
+    refreshed_at  TIMESTAMPTZ NOT NULL
+);
+
+INSERT INTO booru.illustration_posts (post_id)
+SELECT p.id
+FROM booru.posts p,
+     (SELECT booru.non_illustration_tag_ids() AS ids) x
+WHERE p.created_at > '2015-01-01'
+  AND EXISTS (SELECT 1 FROM booru.posts_tags_assoc pta WHERE pta.post_id = p.id)
+  AND NOT EXISTS (SELECT 1
+                  FROM booru.posts_tags_assoc pta
+                  WHERE pta.post_id = p.id
+                    AND pta.tag_id = ANY (x.ids));
+
+INSERT INTO booru.illustration_tag_counts (tag_id, post_count)
+SELECT pta.tag_id, COUNT(*)
+FROM booru.posts_tags_assoc pta
+         JOIN
+     booru.illustration_posts ip ON ip.post_id = pta.post_id
+GROUP BY pta.tag_id;
+
+CREATE OR REPLACE FUNCTION booru.log_posts_tags_changes() RETURNS TRIGGER
+    LANGUAGE plpgsql AS
+$$
+BEGIN
+    IF TG_OP = 'INSERT' THEN
+        INSERT INTO booru.posts_tags_changes (post_id, tag_id, delta)
+        SELECT post_id, tag_id, 1 FROM new_rows;
+    ELSIF TG_OP = 'DELETE' THEN
+        INSERT INTO booru.posts_tags_changes (post_id, tag_id, delta)
+        SELECT post_id, tag_id, -1 FROM old_rows;
+    ELSE
+        INSERT INTO booru.posts_tags_changes (post_id, tag_id, delta)
+        SELECT n.id, NULL, 0
+        FROM new_rows n
+                 JOIN old_rows o ON o.id = n.id
+        WHERE n.created_at IS DISTINCT FROM o.created_at;
+    END IF;
+    RETURN NULL;
+END;
+$$;
+
+CREATE OR REPLACE TRIGGER posts_tags_changes_insert
+    AFTER INSERT
+    ON booru.posts_tags_assoc
+    REFERENCING NEW TABLE AS new_rows
+    FOR EACH STATEMENT
+EXECUTE FUNCTION booru.log_posts_tags_changes();
+
+CREATE OR REPLACE TRIGGER posts_tags_changes_delete
+    AFTER DELETE
+    ON booru.posts_tags_assoc
+    REFERENCING OLD TABLE AS old_rows
+    FOR EACH STATEMENT
+EXECUTE FUNCTION booru.log_posts_tags_changes();
+
+CREATE OR REPLACE TRIGGER posts_changes_update
+    AFTER UPDATE
+    ON booru.posts
+    REFERENCING OLD TABLE AS old_rows NEW TABLE AS new_rows
+    FOR EACH STATEMENT
+EXECUTE FUNCTION booru.log_posts_tags_changes();
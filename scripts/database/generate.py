@@ -0,0 +1,439 @@
+"""
+Synthetic Danbooru-shaped dumps, for benchmarks and tests of the loaders.
+
+Writes the files of `[file_names]` in the JSONL shape of `PostRaw`, `TagRaw`,
+`ArtistRaw`, `ArtistUrlsRaw` and `TagAliasRaw`. Tag frequencies follow a Zipf
+law within each category, so a few tags are on most posts and most tags on a
+handful. The tag names the queries of `explore.sql` and `playground.sql` look
+for (`pantyhose`, `cameltoe`, ...) are among the most frequent ones, while the
+tags of the posts the illustration-only views exclude (`video`, `*comic`, ...)
+are put on about as many posts as on Danbooru, whatever the scale.
+`--scale 1` is 100k posts and 31k tags, every count grows linearly with it.
+
+    python generate.py -o bench_raw --scale 0.1 --seed 0
+"""
+from typing import Dict, List, Iterator, Any, Optional
+from datetime import datetime, timedelta, timezone
+from pathlib import Path
+from loguru import logger
+from pydantic import BaseModel
+import json
+import time
+import click
+import numpy as np
+import tomli
+from dump_data import Config, RawDataFileNameConfig
+from models.artist_urls import ArtistUrlsRaw
+from models.artists import ArtistRaw
+from models.posts import PostRaw
+from models.tag_alias import TagAliasRaw
+from models.tags import TagRaw
+from raw_files import RAW_SUFFIXES, write_raw
+
+# number of each at scale 1
+BASE_POSTS = 100_000
+BASE_TAGS: Dict[int, int] = {0: 20_000, 1: 5_000, 3: 1_000, 4: 5_000, 5: 200}
+
+# most frequent first, given the best ranks of their category
+NAMED_TAGS: Dict[int, List[str]] = {
+    0: [
+        "1girl", "solo", "long_hair", "breasts", "looking_at_viewer", "smile", "thighhighs",
+        "pantyhose", "pussy", "cameltoe", "uncensored", "black_pantyhose", "pussy_juice",
+        "white_pantyhose", "1boy", "monochrome", "greyscale"
+    ],
+    5: ["highres", "absurdres", "commentary", "translated"],
+}
+# tags excluded by the illustration-only views -> share of the posts having them, drawn
+# apart from the Zipf law of their category, which is too steep for a few tags
+RARE_TAGS: Dict[int, Dict[str, float]] = {
+    0: {
+        "comic": 0.05,
+        "4koma": 0.01,
+        "translated_comic": 0.005
+    },
+    5: {
+        "animated": 0.02,
+        "video": 0.01,
+        "sound": 0.007
+    },
+}
+
+# share of the posts of an artist, copyright and character tag count
+ARTIST_TAGS = [0.08, 0.87, 0.05]
+COPYRIGHT_TAGS = [0.2, 0.7, 0.1]
+CHARACTER_TAGS = [0.25, 0.45, 0.2, 0.1]
+RATINGS = ["g", "s", "q", "e"]
+SIZES = [(850, 1200), (1200, 1700), (1920, 1080), (2480, 3508), (1000, 1000), (600, 2400)]
+VARIANTS = [("180x180", 180), ("360x360", 360), ("720x720", 720)]
+TZ = timezone(timedelta(hours=-5))
+
+
+class GenerateOptions(BaseModel):
+    scale: float = 1.0
+    seed: int = 0
+    # exponent of the Zipf law of the tag frequencies
+    zipf: float = 1.1
+    # mean number of general tags of a post
+    general_tags: float = 25.0
+    # share of the tags with an alias, and of the general tags implying another one
+    aliases: float = 0.05
+    implications: float = 0.02
+    first_post: datetime = datetime(2005, 5, 24, tzinfo=TZ)
+    last_post: datetime = datetime(2024, 12, 31, tzinfo=TZ)
+
+
+class ZipfSampler:
+    """Draws of ranks 0..n-1 with P(rank) proportional to 1 / (rank + 1) ** s"""
+
+    def __init__(self, n: int, s: float, rng: np.random.Generator):
+        weights = 1 / np.arange(1, n + 1, dtype=np.float64)**s
+        self.cdf = np.cumsum(weights / weights.sum())
+        self.rng = rng
+
+    def draw(self, k: int) -> np.ndarray:
+        """`k` distinct ranks at most, drawn with replacement and deduplicated"""
+        if k <= 0:
+            return np.empty(0, dtype=np.int64)
+        ranks = np.searchsorted(self.cdf, self.rng.random(int(k * 1.3) + 1))
+        ranks = np.minimum(ranks, len(self.cdf) - 1)
+        _, first = np.unique(ranks, return_index=True)
+        return ranks[np.sort(first)][:k]
+
+
+def timestamp(t: datetime) -> str:
+    """ISO 8601 with milliseconds, as in the dumps"""
+    return t.isoformat(timespec="milliseconds")
+
+
+class Vocabulary:
+    """Tags of every category, ids interleaved and ranks assigned at random"""
+
+    def __init__(self, options: GenerateOptions, rng: np.random.Generator):
+        counts = {
+            c: max(int(n * options.scale),
+                   len(NAMED_TAGS.get(c, [])) + len(RARE_TAGS.get(c, {})) + 1)
+            for c, n in BASE_TAGS.items()
+        }
+        categories = np.concatenate([np.full(n, c) for c, n in counts.items()])
+        rng.shuffle(categories)
+        self.categories: List[int] = categories.tolist()
+        # tag ids of each category by rank, ids start at 1
+        self.by_rank: Dict[int, np.ndarray] = {}
+        for category, n in counts.items():
+            ids = np.flatnonzero(categories == category) + 1
+            rng.shuffle(ids)
+            self.by_rank[category] = ids
+        prefix = {0: "tag", 1: "artist", 3: "series", 4: "character", 5: "meta"}
+        self.names: List[str] = [
+            f"{prefix[c]}_{i}" for i, c in enumerate(self.categories, start=1)
+        ]
+        for category, names in NAMED_TAGS.items():
+            for rank, name in enumerate(names):
+                self.names[self.by_rank[category][rank] - 1] = name
+        # (tag id, share of the posts) of the rare tags, after the ranks of the samplers
+        self.rare: Dict[int, List[tuple[int, float]]] = {}
+        for category, shares in RARE_TAGS.items():
+            ids = self.by_rank[category][counts[category] - len(shares):].tolist()
+            self.rare[category] = list(zip(ids, shares.values()))
+            for tag_id, name in zip(ids, shares):
+                self.names[tag_id - 1] = name
+        self.samplers = {
+            c: ZipfSampler(n - len(RARE_TAGS.get(c, {})), options.zipf, rng)
+            for c, n in counts.items()
+        }
+        self.rng = rng
+
+    def name(self, tag_id: int) -> str:
+        return self.names[tag_id - 1]
+
+    def draw(self, category: int, k: int) -> List[int]:
+        return self.by_rank[category][self.samplers[category].draw(k)].tolist()
+
+    def draw_rare(self, category: int) -> List[int]:
+        """The rare tags of a post, each with the probability of its share"""
+        return [
+            tag_id for tag_id, share in self.rare.get(category, []) if self.rng.random() < share
+        ]
+
+
+def generate_posts(vocabulary: Vocabulary, options: GenerateOptions,
+                   rng: np.random.Generator) -> Iterator[PostRaw]:
+    n = max(int(BASE_POSTS * options.scale), 1)
+    span = (options.last_post - options.first_post).total_seconds()
+    general = rng.poisson(options.general_tags, n) + 1
+    artists = rng.choice(len(ARTIST_TAGS), n, p=ARTIST_TAGS)
+    copyrights = rng.choice(len(COPYRIGHT_TAGS), n, p=COPYRIGHT_TAGS)
+    characters = rng.choice(len(CHARACTER_TAGS), n, p=CHARACTER_TAGS)
+    metas = rng.integers(1, 4, n)
+    scores = rng.geometric(0.05, n) - 1
+    sizes = rng.integers(len(SIZES), size=n)
+    for i in range(n):
+        post_id = i + 1
+        tags = {
+            0: vocabulary.draw(0, int(general[i])) + vocabulary.draw_rare(0),
+            1: vocabulary.draw(1, int(artists[i])),
+            3: vocabulary.draw(3, int(copyrights[i])),
+            4: vocabulary.draw(4, int(characters[i])),
+            5: vocabulary.draw(5, int(metas[i])) + vocabulary.draw_rare(5),
+        }
+        names = {c: [vocabulary.name(t) for t in ids] for c, ids in tags.items()}
+        created_at = options.first_post + timedelta(seconds=span * (i + rng.random()) / n)
+        updated_at = timestamp(created_at + timedelta(days=int(rng.integers(0, 400))))
+        is_video = "video" in names[5]
+        file_ext = "mp4" if is_video else ("png" if post_id % 5 == 0 else "jpg")
+        width, height = SIZES[sizes[i]]
+        md5 = f"{post_id:032x}"
+        score = int(scores[i])
+        variants = [{
+            "type": variant,
+            "url": f"https://cdn.donmai.us/{variant}/{md5}.jpg",
+            "width": side,
+            "height": side,
+            "file_ext": "jpg"
+        } for variant, side in VARIANTS]
+        variants.append({
+            "type": "original",
+            "url": f"https://cdn.donmai.us/original/{md5}.{file_ext}",
+            "width": width,
+            "height": height,
+            "file_ext": file_ext
+        })
+        yield {
+            "id": post_id,
+            "created_at": timestamp(created_at),
+            "uploader_id": int(rng.integers(1, 50_000)),
+            "score": score,
+            "source": f"https://www.pixiv.net/artworks/{post_id + 10_000_000}",
+            "md5": md5,
+            "last_comment_bumped_at": None,
+            "rating": RATINGS[post_id % len(RATINGS)],
+            "image_width": width,
+            "image_height": height,
+            "tag_string": " ".join(name for c in sorted(names) for name in names[c]),
+            "fav_count": score + int(rng.integers(0, score + 1)),
+            "file_ext": file_ext,
+            "last_noted_at": None,
+            "parent_id": None,
+            "has_children": False,
+            "approver_id": None,
+            "tag_count_general": len(tags[0]),
+            "tag_count_artist": len(tags[1]),
+            "tag_count_character": len(tags[4]),
+            "tag_count_copyright": len(tags[3]),
+            "file_size": width * height // 4,
+            "up_score": score,
+            "down_score": 0,
+            "is_pending": False,
+            "is_flagged": False,
+            "is_deleted": post_id % 50 == 0,
+            "tag_count": sum(len(ids) for ids in tags.values()),
+            "updated_at": updated_at,
+            "is_banned": False,
+            "pixiv_id": post_id + 10_000_000,
+            "last_commented_at": None,
+            "has_active_children": False,
+            "bit_flags": 0,
+            "tag_count_meta": len(tags[5]),
+            "has_large": True,
+            "has_visible_children": False,
+            "media_asset": {
+                "id": post_id,
+                "created_at": timestamp(created_at),
+                "updated_at": updated_at,
+                "md5": md5,
+                "file_ext": file_ext,
+                "file_size": width * height // 4,
+                "image_width": width,
+                "image_height": height,
+                "duration": 12.0 if is_video else None,
+                "status": "active",
+                "file_key": md5[:9],
+                "is_public": True,
+                "pixel_hash": md5[::-1],
+                "variants": variants,
+            },
+            "tag_string_general": " ".join(names[0]),
+            "tag_string_character": " ".join(names[4]),
+            "tag_string_copyright": " ".join(names[3]),
+            "tag_string_artist": " ".join(names[1]),
+            "tag_string_meta": " ".join(names[5]),
+            "file_url": variants[-1]["url"],
+            "large_file_url": variants[-1]["url"],
+            "preview_file_url": variants[0]["url"],
+        }    # type: ignore
+
+
+def generate_tags(vocabulary: Vocabulary, post_counts: np.ndarray) -> Iterator[TagRaw]:
+    created_at = timestamp(datetime(2013, 2, 28, 4, 48, 10, tzinfo=TZ))
+    for tag_id, (name, category) in enumerate(zip(vocabulary.names, vocabulary.categories),
+                                              start=1):
+        yield {
+            "id": tag_id,
+            "name": name,
+            "post_count": int(post_counts[tag_id]),
+            "category": category,
+            "created_at": created_at,
+            "updated_at": created_at,
+            "is_deprecated": False,
+            "words": name.split("_"),
+        }
+
+
+def generate_artists(vocabulary: Vocabulary,
+                     rng: np.random.Generator) -> tuple[List[ArtistRaw], List[ArtistUrlsRaw]]:
+    """An artist entry for most artist tags, with other names and urls"""
+    artists: List[ArtistRaw] = []
+    urls: List[ArtistUrlsRaw] = []
+    created_at = timestamp(datetime(2013, 2, 28, 4, 48, 10, tzinfo=TZ))
+    for tag_id in np.sort(vocabulary.by_rank[1]).tolist():
+        if rng.random() < 0.1:
+            continue
+        artist_id = len(artists) + 1
+        name = vocabulary.name(tag_id)
+        artists.append({
+            "id": artist_id,
+            "created_at": created_at,
+            "name": name,
+            "updated_at": created_at,
+            "is_deleted": False,
+            "group_name": f"circle_{artist_id % 97}" if artist_id % 7 == 0 else None,
+            "is_banned": artist_id % 101 == 0,
+            "other_names": [f"{name}_{j}" for j in range(int(rng.integers(0, 4)))],
+        })
+        for j in range(int(rng.integers(1, 4))):
+            urls.append({
+                "id": len(urls) + 1,
+                "artist_id": artist_id,
+                "url": f"https://www.pixiv.net/users/{artist_id * 10 + j}",
+                "is_active": j == 0,
+                "created_at": created_at,
+                "updated_at": created_at,
+            })
+    return artists, urls
+
+
+def generate_relations(vocabulary: Vocabulary, options: GenerateOptions,
+                       rng: np.random.Generator) -> tuple[List[TagAliasRaw], List[TagAliasRaw]]:
+    """
+    Aliases from old names to tags, and implications from general tags to more
+    frequent general tags, so the implications never form a cycle
+    """
+    created_at = timestamp(datetime(2014, 1, 1, tzinfo=TZ))
+
+    def relation(i: int, antecedent: str, consequent: str) -> TagAliasRaw:
+        return {
+            "id": i,
+            "antecedent_name": antecedent,
+            "reason": "",
+            "creator_id": 1,
+            "consequent_name": consequent,
+            "status": "active",
+            "forum_topic_id": None,
+            "created_at": created_at,
+            "updated_at": created_at,
+            "approver_id": None,
+            "forum_post_id": None,
+        }
+
+    n_tags = len(vocabulary.names)
+    aliased = np.sort(rng.choice(n_tags, int(n_tags * options.aliases), replace=False)) + 1
+    aliases = [
+        relation(i, f"old_{vocabulary.name(tag_id)}", vocabulary.name(tag_id))
+        for i, tag_id in enumerate(aliased.tolist(), start=1)
+    ]
+    general = vocabulary.by_rank[0]
+    ranks = np.sort(
+        rng.choice(np.arange(1, len(general)), int(len(general) * options.implications),
+                   replace=False))
+    implications = [
+        relation(i, vocabulary.name(general[rank]),
+                 vocabulary.name(general[int(rng.integers(0, rank))]))
+        for i, rank in enumerate(ranks.tolist(), start=1)
+    ]
+    return aliases, implications
+
+
+def write_jsonl(path: Path, objs: Iterator[Any]) -> int:
+    """Write objects as lines, compressed according to the suffix of `path`"""
+    count = 0
+    with write_raw(path) as f:
+        for obj in objs:
+            f.write(json.dumps(obj).encode())
+            f.write(b"\n")
+            count += 1
+    return count
+
+
+def generate(output: str | Path,
+             file_names: RawDataFileNameConfig = RawDataFileNameConfig(),
+             options: GenerateOptions = GenerateOptions(),
+             compress: Optional[str] = None) -> Dict[str, int]:
+    """
+    Write every raw file into `output`, returns the number of objects of each.
+
+    With `compress` (`gz`, `zst`, `xz`) the files get the suffix of the codec,
+    as the dumps are distributed.
+    """
+    if compress is not None:
+        file_names = RawDataFileNameConfig(
+            **{k: f"{v}.{compress}" for k, v in file_names.model_dump().items()})
+    output = Path(output)
+    output.mkdir(parents=True, exist_ok=True)
+    rng = np.random.default_rng(options.seed)
+    vocabulary = Vocabulary(options, rng)
+    post_counts = np.zeros(len(vocabulary.names) + 1, dtype=np.int64)
+
+    def counted(posts: Iterator[PostRaw]) -> Iterator[PostRaw]:
+        for post in posts:
+            for name in post["tag_string"].split(" "):
+                post_counts[index[name]] += 1
+            yield post
+
+    index = {name: i for i, name in enumerate(vocabulary.names, start=1)}
+    counts: Dict[str, int] = {}
+    counts["posts"] = write_jsonl(output / file_names.posts,
+                                  counted(generate_posts(vocabulary, options, rng)))
+    counts["tags"] = write_jsonl(output / file_names.tags, generate_tags(vocabulary, post_counts))
+    artists, urls = generate_artists(vocabulary, rng)
+    counts["artists"] = write_jsonl(output / file_names.artists, iter(artists))
+    counts["artist_urls"] = write_jsonl(output / file_names.artist_urls, iter(urls))
+    aliases, implications = generate_relations(vocabulary, options, rng)
+    counts["tag_aliases"] = write_jsonl(output / file_names.tag_aliases, iter(aliases))
+    counts["tag_implications"] = write_jsonl(output / file_names.tag_implications,
+                                             iter(implications))
+    return counts
+
+
+@click.command()
+@click.option("--config",
+              "-c",
+              default="config.toml",
+              help="Path to config file, for the file names",
+              type=click.Path(exists=True))
+@click.option("--output",
+              "-o",
+              default="bench_raw",
+              help="Directory of the raw files",
+              type=click.Path(file_okay=False))
+@click.option("--scale", "-s", default=1.0, help="1 is 100k posts", type=float)
+@click.option("--seed", default=0, help="Seed of every random choice", type=int)
+@click.option("--zipf", default=1.1, help="Exponent of the tag frequencies", type=float)
+@click.option("--general-tags", default=25.0, help="Mean general tags per post", type=float)
+@click.option("--compress",
+              default=None,
+              help="Compress the files, as the published dumps",
+              type=click.Choice([suffix.lstrip(".") for suffix in RAW_SUFFIXES]))
+def main(config: str, output: str, scale: float, seed: int, zipf: float, general_tags: float,
+         compress: Optional[str]):
+    with open(Path(config), "rb") as f:
+        config_obj = Config(**tomli.load(f))
+    options = GenerateOptions(scale=scale, seed=seed, zipf=zipf, general_tags=general_tags)
+    start = time.perf_counter()
+    counts = generate(output, config_obj.file_names, options, compress)
+    logger.info("Generated {} in {:.1f}s".format(
+        ", ".join(f"{n} {name}" for name, n in counts.items()),
+        time.perf_counter() - start))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,203 @@
+"""
+Per-stage timings of an ingest run.
+
+Every stage of a load (decoding the raw lines, transforming them into rows,
+writing a table, committing) is timed under a `(name, stage)` key, `name`
+being the raw file or the table. A stage keeps its wall and CPU time, the
+rows and bytes it went through and a histogram of the latency of its calls,
+so a slow batch stands out from a slow table.
+
+    with stage("booru.posts", "copy") as timer:
+        timer.rows = write_rows(...)
+
+The report is written as JSON and optionally in the Prometheus text format,
+to be picked up by the node exporter textfile collector.
+"""
+from typing import Dict, Iterator, List, Optional
+from contextlib import contextmanager
+from datetime import datetime, timezone
+from pathlib import Path
+from loguru import logger
+from pydantic import BaseModel
+import json
+import os
+import threading
+import time
+
+# upper bounds of the latency histogram, in seconds
+BUCKETS: tuple[float, ...] = (0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1,
+                              2.5, 5, 10)
+
+METRIC_PREFIX = "danbooru_ingest"
+
+
+class StageStats(BaseModel):
+    """Totals of a stage, `buckets[i]` counts the calls of at most `BUCKETS[i]` seconds"""
+    calls: int = 0
+    wall_seconds: float = 0
+    # CPU time of the calling thread, the work of a worker process is not in it
+    cpu_seconds: float = 0
+    max_seconds: float = 0
+    rows: int = 0
+    bytes: int = 0
+    buckets: List[int] = [0] * (len(BUCKETS) + 1)
+
+    def add(self, wall: float, cpu: float, rows: int, bytes: int) -> None:
+        self.calls += 1
+        self.wall_seconds += wall
+        self.cpu_seconds += cpu
+        self.max_seconds = max(self.max_seconds, wall)
+        self.rows += rows
+        self.bytes += bytes
+        self.buckets[next((i for i, b in enumerate(BUCKETS) if wall <= b), len(BUCKETS))] += 1
+
+    def quantile(self, q: float) -> float:
+        """Upper bound of the bucket the `q` quantile of the latency falls in"""
+        rank = q * self.calls
+        seen = 0
+        for bound, count in zip(BUCKETS, self.buckets):
+            seen += count
+            if seen >= rank:
+                return bound
+        return self.max_seconds
+
+
+class Report(BaseModel):
+    started_at: datetime
+    elapsed_seconds: float
+    # name -> stage -> totals
+    stages: Dict[str, Dict[str, StageStats]]
+
+
+class Timer:
+    """What a stage went through, set `rows` and `bytes` before it exits"""
+
+    def __init__(self, rows: int = 0, bytes: int = 0):
+        self.rows = rows
+        self.bytes = bytes
+
+
+class Instruments:
+    """Stage totals of a run, safe to update from the writer threads"""
+
+    def __init__(self):
+        self.started_at = datetime.now(timezone.utc)
+        self.start = time.perf_counter()
+        self.stages: Dict[tuple[str, str], StageStats] = {}
+        self.lock = threading.Lock()
+
+    def add(self, name: str, stage: str, wall: float, cpu: float, rows: int = 0,
+            bytes: int = 0) -> None:
+        with self.lock:
+            stats = self.stages.get((name, stage))
+            if stats is None:
+                stats = self.stages[(name, stage)] = StageStats()
+            stats.add(wall, cpu, rows, bytes)
+
+    @contextmanager
+    def stage(self, name: str, stage: str, rows: int = 0, bytes: int = 0) -> Iterator[Timer]:
+        """Time the body as one call of `stage` of `name`, failed calls are not recorded"""
+        timer = Timer(rows, bytes)
+        wall, cpu = time.perf_counter(), time.thread_time()
+        yield timer
+        self.add(name, stage,
+                 time.perf_counter() - wall,
+                 time.thread_time() - cpu, timer.rows, timer.bytes)
+
+    def report(self) -> Report:
+        stages: Dict[str, Dict[str, StageStats]] = {}
+        with self.lock:
+            for (name, stage), stats in sorted(self.stages.items()):
+                stages.setdefault(name, {})[stage] = stats.model_copy(deep=True)
+        return Report(started_at=self.started_at,
+                      elapsed_seconds=time.perf_counter() - self.start,
+                      stages=stages)
+
+    def log(self) -> None:
+        """Log the totals of every stage, slowest first"""
+        stages = sorted(self.report().stages.items(),
+                        key=lambda item: -sum(s.wall_seconds for s in item[1].values()))
+        for name, by_stage in stages:
+            for stage, stats in by_stage.items():
+                logger.info("{} {}: {} calls {:.2f}s wall {:.2f}s cpu {} rows, "
+                            "p50 <= {}s p99 <= {}s max {:.3f}s".format(
+                                name, stage, stats.calls, stats.wall_seconds, stats.cpu_seconds,
+                                stats.rows, stats.quantile(0.5), stats.quantile(0.99),
+                                stats.max_seconds))
+
+    def write_json(self, path: str | Path) -> None:
+        write_atomic(path, self.report().model_dump_json(indent=2))
+
+    def write_prometheus(self, path: str | Path) -> None:
+        write_atomic(path, prometheus_text(self.report()))
+
+
+def label_str(name: str, stage: str, **extra: str) -> str:
+    labels = {"name": name, "stage": stage, **extra}
+    return ",".join("{}={}".format(k, json.dumps(v)) for k, v in labels.items())
+
+
+def prometheus_text(report: Report) -> str:
+    """The report in the Prometheus text exposition format"""
+    seconds = f"{METRIC_PREFIX}_stage_seconds"
+    lines = [
+        f"# HELP {seconds} Wall time of the calls of an ingest stage.",
+        f"# TYPE {seconds} histogram",
+    ]
+    counters: Dict[str, List[str]] = {"cpu_seconds": [], "rows": [], "bytes": []}
+    for name, stages in report.stages.items():
+        for stage, stats in stages.items():
+            seen = 0
+            for bound, count in zip(BUCKETS, stats.buckets):
+                seen += count
+                lines.append("{}_bucket{{{}}} {}".format(seconds,
+                                                         label_str(name, stage, le=str(bound)),
+                                                         seen))
+            labels = label_str(name, stage)
+            lines.append("{}_bucket{{{}}} {}".format(seconds, label_str(name, stage, le="+Inf"),
+                                                     stats.calls))
+            lines.append(f"{seconds}_sum{{{labels}}} {stats.wall_seconds}")
+            lines.append(f"{seconds}_count{{{labels}}} {stats.calls}")
+            counters["cpu_seconds"].append(f"{{{labels}}} {stats.cpu_seconds}")
+            counters["rows"].append(f"{{{labels}}} {stats.rows}")
+            counters["bytes"].append(f"{{{labels}}} {stats.bytes}")
+    for counter, samples in counters.items():
+        metric = f"{METRIC_PREFIX}_stage_{counter}_total"
+        lines.append(f"# HELP {metric} Total {counter.replace('_', ' ')} of an ingest stage.")
+        lines.append(f"# TYPE {metric} counter")
+        lines.extend(metric + sample for sample in samples)
+    elapsed = f"{METRIC_PREFIX}_elapsed_seconds"
+    lines.append(f"# HELP {elapsed} Wall time of the ingest run.")
+    lines.append(f"# TYPE {elapsed} gauge")
+    lines.append(f"{elapsed} {report.elapsed_seconds}")
+    return "\n".join(lines) + "\n"
+
+
+def write_atomic(path: str | Path, text: str) -> None:
+    """Write through a temporary file, a scraper never sees half a report"""
+    path = Path(path)
+    tmp = path.with_suffix(path.suffix + ".tmp")
+    with open(tmp, "w") as f:
+        f.write(text)
+    os.replace(tmp, path)
+
+
+# the instruments of the running command
+instruments = Instruments()
+
+
+def stage(name: str, stage: str, rows: int = 0, bytes: int = 0):
+    """`Instruments.stage` of the running command"""
+    return instruments.stage(name, stage, rows, bytes)
+
+
+def record(name: str, stage: str, wall: float, cpu: float, rows: int = 0, bytes: int = 0) -> None:
+    """`Instruments.add` of the running command, for stages that are not a `with` block"""
+    instruments.add(name, stage, wall, cpu, rows, bytes)
+
+
+def reset(new: Optional[Instruments] = None) -> Instruments:
+    """Start over, every command of `dump_data.py` has its own report"""
+    global instruments
+    instruments = new if new is not None else Instruments()
+    return instruments
@@ -0,0 +1,193 @@
+from typing import (Dict, Optional, List, Literal, Iterable, Sequence, Any, Type, Union, get_args,
+                    get_origin)
+from datetime import datetime
+from types import NoneType, UnionType
+from psycopg import Connection
+from pydantic import BaseModel
+from instrument import stage
+
+InsertMethod = Literal["insert", "copy"]
+INSERT_METHODS: tuple[InsertMethod, ...] = ("insert", "copy")
+
+# what to do when a row already exists, `error` is a plain INSERT/COPY
+OnConflict = Literal["error", "nothing", "update"]
+ON_CONFLICTS: tuple[OnConflict, ...] = ("error", "nothing", "update")
+
+
+class LoadOptions(BaseModel):
+    """How a command writes its rows"""
+    method: InsertMethod = "insert"
+    conflict: OnConflict = "error"
+    # go through the pydantic models instead of the compiled row functions
+    validate_rows: bool = False
+    # write `booru.posts_tag_arrays` with the tag associations of the posts
+    tag_arrays: bool = True
+
+# python type -> postgres type name, used by binary COPY to pick the dumper
+PG_TYPES: Dict[type, str] = {
+    bool: "bool",
+    int: "int4",
+    str: "text",
+    datetime: "timestamptz",
+}
+
+# column types of the tables that have no `*Entry` model
+ASSOC_TYPES: Dict[str, List[tuple[str, str]]] = {
+    "booru.posts_tags_assoc": [("post_id", "int4"), ("tag_id", "int4")],
+    "booru.artists_aliases": [("artist_id", "int4"), ("alias", "text")],
+    "booru.posts_tag_arrays": [("post_id", "int4"), ("tag_ids", "int4[]"), ("general", "int4[]"),
+                               ("artist", "int4[]"), ("copyright", "int4[]"),
+                               ("character", "int4[]"), ("meta", "int4[]")],
+}
+
+# conflict target of each table, `booru.posts_media_variants` has only a serial key
+# and is replaced per post instead (see `delete_variants`)
+CONFLICT_KEYS: Dict[str, List[str]] = {
+    "booru.posts": ["id"],
+    "booru.posts_file_urls": ["post_id"],
+    "booru.posts_tags_assoc": ["post_id", "tag_id"],
+    "booru.posts_tag_arrays": ["post_id"],
+    "booru.tags": ["id"],
+    "booru.tags_aliases": ["id"],
+    "booru.tags_implications": ["id"],
+    "booru.artists": ["id"],
+    "booru.artists_urls": ["id"],
+    "booru.artists_aliases": ["artist_id", "alias"],
+}
+
+
+def unwrap_optional(annotation: Any) -> Any:
+    """Strip `Optional[...]` from a type annotation"""
+    if get_origin(annotation) in (Union, UnionType):
+        args = [arg for arg in get_args(annotation) if arg is not NoneType]
+        if len(args) == 1:
+            return args[0]
+    return annotation
+
+
+def entry_columns(model: Type[BaseModel]) -> List[str]:
+    """Get column names of a model, in field order"""
+    return list(model.model_fields.keys())
+
+
+def entry_pg_types(model: Type[BaseModel]) -> List[str]:
+    """Get postgres type names of a model, in field order"""
+    types = []
+    for name, field in model.model_fields.items():
+        t = unwrap_optional(field.annotation)
+        if t not in PG_TYPES:
+            raise TypeError(f"no postgres type for {model.__name__}.{name}: {field.annotation}")
+        types.append(PG_TYPES[t])
+    return types
+
+
+def conflict_clause(table_name: str, columns: Sequence[str], conflict: OnConflict) -> str:
+    """`ON CONFLICT` clause of an INSERT, empty for `error`"""
+    if conflict == "error":
+        return ""
+    keys = CONFLICT_KEYS.get(table_name)
+    if keys is None:
+        return ""
+    updates = [col for col in columns if col not in keys]
+    if conflict == "nothing" or not updates:
+        return f" ON CONFLICT ({','.join(keys)}) DO NOTHING"
+    sets = ",".join(f"{col} = EXCLUDED.{col}" for col in updates)
+    return f" ON CONFLICT ({','.join(keys)}) DO UPDATE SET {sets}"
+
+
+def insert_sql(table_name: str, columns: Sequence[str], conflict: OnConflict = "error") -> str:
+    """Parametrized INSERT of one row"""
+    placeholders = ",".join(["%s"] * len(columns))
+    sql = f"INSERT INTO {table_name} ({','.join(columns)}) VALUES ({placeholders})"
+    return sql + conflict_clause(table_name, columns, conflict)
+
+
+def stage_table(table_name: str) -> str:
+    """Temporary table that COPY fills before the merge into `table_name`"""
+    return "_stage_" + table_name.replace(".", "_")
+
+
+def insert_rows(conn: Connection,
+                table_name: str,
+                columns: Sequence[str],
+                rows: Iterable[Sequence[Any]],
+                conflict: OnConflict = "error") -> int:
+    """Insert rows with `executemany`, return the number of rows written"""
+    values = list(rows)
+    if not values:
+        return 0
+    sql = insert_sql(table_name, columns, conflict)
+    with conn.cursor() as c:
+        c.executemany(sql, values)    # type: ignore
+    return len(values)
+
+
+def copy_rows(conn: Connection,
+              table_name: str,
+              columns: Sequence[str],
+              types: Sequence[str],
+              rows: Iterable[Sequence[Any]],
+              conflict: OnConflict = "error") -> int:
+    """
+    Stream rows with binary `COPY FROM STDIN`, return the number of rows written.
+
+    COPY has no `ON CONFLICT`, so unless `conflict` is `error` the rows are copied
+    into a temporary staging table first and merged with `INSERT ... SELECT`.
+    """
+    count = 0
+    clause = conflict_clause(table_name, columns, conflict)
+    target = table_name
+    if clause:
+        target = stage_table(table_name)
+    sql = f"COPY {target} ({','.join(columns)}) FROM STDIN (FORMAT BINARY)"
+    with conn.cursor() as c:
+        if clause:
+            c.execute(f"CREATE TEMP TABLE IF NOT EXISTS {target} "    # type: ignore
+                      f"(LIKE {table_name}) ON COMMIT DROP")
+            c.execute(f"TRUNCATE {target}")    # type: ignore
+        with c.copy(sql) as copy:    # type: ignore
+            copy.set_types(types)
+            for row in rows:
+                copy.write_row(row)
+                count += 1
+        if clause:
+            cols = ",".join(columns)
+            merge = f"INSERT INTO {table_name} ({cols}) SELECT {cols} FROM {target}" + clause
+            c.execute(merge)    # type: ignore
+    return count
+
+
+def write_rows(conn: Connection,
+               table_name: str,
+               columns: Sequence[str],
+               types: Sequence[str],
+               rows: Iterable[Sequence[Any]],
+               method: InsertMethod = "insert",
+               conflict: OnConflict = "error") -> int:
+    """Write rows with the given method, return the number of rows written"""
+    with stage(table_name, method) as timer:
+        if method == "copy":
+            timer.rows = copy_rows(conn, table_name, columns, types, rows, conflict)
+        else:
+            timer.rows = insert_rows(conn, table_name, columns, rows, conflict)
+    return timer.rows
+
+
+def write_assoc(conn: Connection,
+                table_name: str,
+                rows: Iterable[Sequence[Any]],
+                method: InsertMethod = "insert",
+                conflict: OnConflict = "error",
+                types: Optional[List[tuple[str, str]]] = None) -> int:
+    """Write rows into a table without an `*Entry` model (see `ASSOC_TYPES`)"""
+    spec = types if types is not None else ASSOC_TYPES[table_name]
+    columns = [name for name, _ in spec]
+    pg_types = [t for _, t in spec]
+    return write_rows(conn, table_name, columns, pg_types, rows, method, conflict)
+
+
+def delete_variants(conn: Connection, post_ids: List[int]) -> int:
+    """Delete the media variants of posts, so a replayed batch doesn't duplicate them"""
+    with conn.cursor() as c:
+        c.execute("DELETE FROM booru.posts_media_variants WHERE post_id = ANY(%s)", (post_ids,))
+        return c.rowcount
@@ -20,7 +20,7 @@ class MediaAsset(TypedDict):
     file_size: int
     image_width: int
     image_height: int
-    duration: Optional[str]
+    duration: Optional[float]
     status: str
     file_key: str
     is_public: bool
@@ -0,0 +1,187 @@
+"""
+Fast-path conversion from raw dump objects to positional rows.
+
+Each converter is compiled from a column spec into a single tuple expression,
+in the field order of the matching `*Entry` model, so it can be handed to the
+loader without going through pydantic validation and `model_dump()`.
+"""
+from typing import Dict, Optional, List, Callable, Any, Mapping, Type
+from datetime import datetime, timezone, timedelta
+from functools import lru_cache
+from pydantic import BaseModel
+from pydantic_core import PydanticUndefined
+from .posts import PostEntry, PostRaw, PostMediaVariantEntry, PostFileEntry
+from .tags import TagEntry
+from .tag_alias import TagAliasEntry
+from .artists import ArtistEntry
+from .artist_urls import ArtistUrlEntry
+
+Row = tuple
+RowFn = Callable[[Mapping[str, Any]], Row]
+# column -> raw key, or (raw key, converter)
+ColumnSpec = Dict[str, str | tuple[str, Callable[[Any], Any]]]
+
+
+@lru_cache(maxsize=64)
+def _tz(offset: str) -> timezone:
+    if offset == "Z":
+        return timezone.utc
+    sign = -1 if offset[0] == "-" else 1
+    return timezone(sign * timedelta(hours=int(offset[1:3]), minutes=int(offset[4:6])))
+
+
+@lru_cache(maxsize=1 << 16)
+def parse_iso8601(s: str) -> datetime:
+    """
+    Parse the timestamp format of the dumps, e.g. `2023-11-30T12:34:56.789-05:00`.
+
+    Only milliseconds with a `Z` or `+hh:mm` offset take the fast path, anything
+    else (other fractions, no offset) falls back to `datetime.fromisoformat`.
+    """
+    if len(s) in (24, 29) and s[10] == "T" and s[19] == "." and s[23] in "+-Z":
+        return datetime(int(s[0:4]), int(s[5:7]), int(s[8:10]), int(s[11:13]), int(s[14:16]),
+                        int(s[17:19]),
+                        int(s[20:23]) * 1000, _tz(s[23:]))
+    return datetime.fromisoformat(s)
+
+
+def parse_datetime(s: Optional[str]) -> Optional[datetime]:
+    """Parse an optional timestamp, empty strings are `None`"""
+    return parse_iso8601(s) if s else None
+
+
+def compile_row(model: Type[BaseModel], spec: ColumnSpec) -> RowFn:
+    """Compile a column spec into a function returning a row in the model's field order"""
+    if list(spec.keys()) != list(model.model_fields.keys()):
+        raise ValueError(f"column spec of {model.__name__} does not match its fields")
+    env: Dict[str, Any] = {}
+    exprs: List[str] = []
+    for i, (column, source) in enumerate(spec.items()):
+        key, fn = (source, None) if isinstance(source, str) else source
+        expr = f"get({key!r})"
+        if fn is not None:
+            env[f"_f{i}"] = fn
+            expr = f"_f{i}({expr})"
+        default = model.model_fields[column].default
+        if default is not None and default is not PydanticUndefined:
+            env[f"_d{i}"] = default
+            expr = f"(_d{i} if (v := {expr}) is None else v)"
+        exprs.append(expr)
+    src = f"def {model.__name__}_row(raw):\n    get = raw.get\n    return ({', '.join(exprs)},)\n"
+    exec(compile(src, f"<{model.__name__}_row>", "exec"), env)
+    return env[f"{model.__name__}_row"]
+
+
+post_row = compile_row(
+    PostEntry, {
+        "id": "id",
+        "created_at": ("created_at", parse_datetime),
+        "uploaded_id": "uploader_id",
+        "score": "score",
+        "source": "source",
+        "md5": "md5",
+        "last_commented_at": ("last_comment_bumped_at", parse_datetime),
+        "rating": "rating",
+        "width": "image_width",
+        "height": "image_height",
+        "fav_count": "fav_count",
+        "file_ext": "file_ext",
+        "last_noted_at": ("last_noted_at", parse_datetime),
+        "parent_id": "parent_id",
+        "has_children": "has_children",
+        "approver_id": "approver_id",
+        "file_size": "file_size",
+        "up_score": "up_score",
+        "down_score": "down_score",
+        "is_pending": "is_pending",
+        "is_flagged": "is_flagged",
+        "is_deleted": "is_deleted",
+        "updated_at": ("updated_at", parse_datetime),
+        "is_banned": "is_banned",
+        "pixiv_id": "pixiv_id",
+    })
+
+post_file_row = compile_row(
+    PostFileEntry, {
+        "post_id": "id",
+        "file_url": "file_url",
+        "large_file_url": "large_file_url",
+        "preview_file_url": "preview_file_url",
+    })
+
+tag_row = compile_row(TagEntry, {
+    "id": "id",
+    "name": "name",
+    "category": "category",
+    "is_deprecated": "is_deprecated",
+})
+
+tag_alias_row = compile_row(TagAliasEntry, {
+    "id": "id",
+    "antecedent_name": "antecedent_name",
+    "consequent_name": "consequent_name",
+    "status": "status",
+})
+
+artist_row = compile_row(
+    ArtistEntry, {
+        "id": "id",
+        "created_at": ("created_at", parse_datetime),
+        "name": "name",
+        "updated_at": ("updated_at", parse_datetime),
+        "group_name": "group_name",
+        "is_deleted": "is_deleted",
+        "is_banned": "is_banned",
+    })
+
+artist_url_row = compile_row(
+    ArtistUrlEntry, {
+        "id": "id",
+        "artist_id": "artist_id",
+        "url": "url",
+        "is_active": "is_active",
+        "created_at": ("created_at", parse_datetime),
+        "updated_at": ("updated_at", parse_datetime),
+    })
+
+
+def post_media_variant_rows(raw: PostRaw) -> List[Row]:
+    """Rows of `booru.posts_media_variants`, in `PostMediaVariantEntry` field order"""
+    post_id = raw["id"]
+    variants = (raw.get("media_asset") or {}).get("variants") or []
+    return [(post_id, v.get("type"), v.get("url"), v.get("width"), v.get("height"))
+            for v in variants]
+
+
+ROW_FNS: Dict[Type[BaseModel], RowFn] = {
+    PostEntry: post_row,
+    PostFileEntry: post_file_row,
+    TagEntry: tag_row,
+    TagAliasEntry: tag_alias_row,
+    ArtistEntry: artist_row,
+    ArtistUrlEntry: artist_url_row,
+}
+
+
+def validated_row(model: Type[BaseModel]) -> RowFn:
+    """Row function going through `from_raw` and pydantic validation, for `--validate`"""
+    columns = list(model.model_fields.keys())
+
+    def row(raw: Mapping[str, Any]) -> Row:
+        entry = model.from_raw(raw)    # type: ignore
+        return tuple(getattr(entry, col) for col in columns)
+
+    return row
+
+
+def validated_variant_rows(raw: PostRaw) -> List[Row]:
+    """`post_media_variant_rows` through pydantic validation"""
+    columns = list(PostMediaVariantEntry.model_fields.keys())
+    return [
+        tuple(getattr(e, col) for col in columns) for e in PostMediaVariantEntry.from_raw(raw)
+    ]
+
+
+def row_fn(model: Type[BaseModel], validate: bool = False) -> RowFn:
+    """Get the row function of a model"""
+    return validated_row(model) if validate else ROW_FNS[model]
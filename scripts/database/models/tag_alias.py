@@ -23,9 +23,11 @@ class TagAliasEntry(BaseModel):
     id: int
     antecedent_name: str
     consequent_name: str
+    status: str
 
     @staticmethod
     def from_raw(tag_alias: TagAliasRaw) -> "TagAliasEntry":
         return TagAliasEntry(id=tag_alias["id"],
                              antecedent_name=tag_alias["antecedent_name"],
-                             consequent_name=tag_alias["consequent_name"])
+                             consequent_name=tag_alias["consequent_name"],
+                             status=tag_alias["status"])
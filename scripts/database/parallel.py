@@ -0,0 +1,319 @@
+from typing import (Optional, List, Dict, Generator, NamedTuple, Iterable, Iterator, Callable,
+                    Deque)
+from collections import defaultdict, deque
+from concurrent.futures import ProcessPoolExecutor, Future
+from pathlib import Path
+from psycopg import Connection
+import json
+import os
+import time
+from counts import TAG_ARRAY_CATEGORIES
+from instrument import record, stage
+from raw_files import is_compressed, open_raw
+from loader import (ASSOC_TYPES, LoadOptions, entry_columns, entry_pg_types, write_rows,
+                    write_assoc, delete_variants)
+from models.posts import PostEntry, PostRaw, PostMediaVariantEntry, PostFileEntry
+from models.rows import row_fn, post_media_variant_rows, validated_variant_rows
+from tag_dict import TagDict, UnknownTags, open_tag_dict
+
+POST_COLUMNS = entry_columns(PostEntry)
+POST_TYPES = entry_pg_types(PostEntry)
+VARIANT_COLUMNS = entry_columns(PostMediaVariantEntry)
+VARIANT_TYPES = entry_pg_types(PostMediaVariantEntry)
+FILE_COLUMNS = entry_columns(PostFileEntry)
+FILE_TYPES = entry_pg_types(PostFileEntry)
+TAG_ARRAY_COLUMNS = [name for name, _ in ASSOC_TYPES["booru.posts_tag_arrays"]]
+# tag category -> index of its array, `TAG_ARRAY_CATEGORIES` is in the order of the columns
+CATEGORY_ARRAYS = {category: i for i, category in enumerate(TAG_ARRAY_CATEGORIES.values())}
+
+
+class ByteRange(NamedTuple):
+    """Offsets in the decompressed data of the file"""
+    start: int
+    end: int
+    # position in the compressed file after the range, where it is compressed
+    stored_end: Optional[int] = None
+
+    @property
+    def file_end(self) -> int:
+        """Position in the file on disk after the range, for the progress bars"""
+        return self.end if self.stored_end is None else self.stored_end
+
+
+class Chunk(NamedTuple):
+    """A range handed to a parser"""
+    byte_range: ByteRange
+    # the lines of a compressed file, decompressed by the parent process;
+    # the parsers read the ranges of a plain file themselves
+    data: Optional[bytes] = None
+
+
+class PostRows(NamedTuple):
+    """Ready-to-load rows of one byte range of `posts.json`"""
+    byte_range: ByteRange
+    posts: List[tuple]
+    variants: List[tuple]
+    files: List[tuple]
+    # (post_id, tag_id) of the tags found in the tag dictionary
+    tag_ids: List[tuple[int, int]]
+    # (post_id, tag name) of the other tags, left to the `UnknownTags` policy of the writer
+    unknown_tags: List[tuple[int, str]]
+    # rows of `booru.posts_tag_arrays`, the sorted ids of `tag_ids` per post
+    tag_arrays: List[tuple]
+
+
+def split_ranges(path: str | Path, chunk_size: int, start: int = 0) -> List[ByteRange]:
+    """Split a JSONL file into line-aligned byte ranges of roughly `chunk_size` bytes"""
+    size = os.path.getsize(path)
+    ranges: List[ByteRange] = []
+    with open(path, "rb") as f:
+        while start < size:
+            f.seek(min(start + chunk_size, size))
+            # move the boundary to the end of the current line
+            f.readline()
+            end = min(f.tell(), size)
+            ranges.append(ByteRange(start, end))
+            start = end
+    return ranges
+
+
+def split_chunks(path: str | Path, chunk_size: int, start: int = 0) -> Iterator[Chunk]:
+    """
+    Line-aligned chunks of roughly `chunk_size` decompressed bytes, from `start`.
+
+    A compressed file cannot be read at an offset by the parsers, so its
+    chunks are decompressed here, in order.
+    """
+    if not is_compressed(path):
+        yield from (Chunk(r) for r in split_ranges(path, chunk_size, start))
+        return
+    with open_raw(path, start) as f:
+        while True:
+            data = f.read(chunk_size)
+            if not data:
+                return
+            data += f.readline()
+            end = start + len(data)
+            yield Chunk(ByteRange(start, end, f.position), data)
+            start = end
+
+
+def read_range(path: str | Path, byte_range: ByteRange) -> Generator[bytes, None, None]:
+    """Read the lines in a byte range"""
+    with open(path, "rb") as f:
+        f.seek(byte_range.start)
+        while f.tell() < byte_range.end:
+            line = f.readline()
+            if not line:
+                break
+            if line.strip():
+                yield line
+
+
+def transform_posts(posts: Iterable[PostRaw],
+                    byte_range: ByteRange = ByteRange(0, 0),
+                    validate: bool = False,
+                    tags: Optional[TagDict] = None) -> PostRows:
+    """
+    Transform raw posts into ready-to-load rows.
+
+    Tags are resolved with `tags`, without it they all end up in `unknown_tags`.
+    The tag arrays are split by the category of each tag in `booru.tags`, like
+    `counts.TAG_ARRAYS_SQL`, not by the `tag_string_<category>` fields of the post.
+    """
+    post_row = row_fn(PostEntry, validate)
+    file_row = row_fn(PostFileEntry, validate)
+    variant_rows = validated_variant_rows if validate else post_media_variant_rows
+    rows = PostRows(byte_range, [], [], [], [], [], [])
+    for post in posts:
+        post_id = post["id"]
+        rows.posts.append(post_row(post))
+        rows.variants.extend(variant_rows(post))
+        rows.files.append(file_row(post))
+        ids: List[int] = []
+        arrays: List[List[int]] = [[] for _ in CATEGORY_ARRAYS]
+        for tag in post["tag_string"].split(" "):
+            tag = tag.strip()
+            if not tag:
+                continue
+            entry = tags.entry(tag) if tags is not None else None
+            if entry is None:
+                rows.unknown_tags.append((post_id, tag))
+                continue
+            tag_id, category = entry
+            rows.tag_ids.append((post_id, tag_id))
+            ids.append(tag_id)
+            if category in CATEGORY_ARRAYS:
+                arrays[CATEGORY_ARRAYS[category]].append(tag_id)
+        rows.tag_arrays.append((post_id, sorted(ids), *(sorted(a) for a in arrays)))
+    return rows
+
+
+def transform_range(path: str,
+                    chunk: Chunk,
+                    validate: bool = False,
+                    tags_path: Optional[str] = None) -> PostRows:
+    """Decode and transform a chunk of `posts.json`, run in a worker process"""
+    tags = open_tag_dict(tags_path) if tags_path is not None else None
+    if chunk.data is None:
+        lines: Iterable[bytes] = read_range(path, chunk.byte_range)
+    else:
+        lines = (line for line in chunk.data.splitlines() if line.strip())
+    return transform_posts((json.loads(line) for line in lines), chunk.byte_range, validate, tags)
+
+
+def add_tag_arrays(tag_arrays: List[tuple], pairs: List[tuple[int, int]],
+                   category: str = "general") -> List[tuple]:
+    """`booru.posts_tag_arrays` rows with the (post_id, tag_id) pairs of a category added"""
+    if not pairs:
+        return tag_arrays
+    added: Dict[int, List[int]] = defaultdict(list)
+    for post_id, tag_id in pairs:
+        added[post_id].append(tag_id)
+    column = TAG_ARRAY_COLUMNS.index(category)
+    result = []
+    for row in tag_arrays:
+        ids = added.get(row[0])
+        if ids:
+            row = list(row)
+            row[1] = sorted(row[1] + ids)
+            row[column] = sorted(row[column] + ids)
+            row = tuple(row)
+        result.append(row)
+    return result
+
+
+def resolve_tags(conn: Connection, rows: PostRows, unknown: UnknownTags) -> PostRows:
+    """The rows with their unknown tags resolved by the policy of `unknown`"""
+    if not rows.unknown_tags:
+        return rows
+    created = unknown.resolve(conn, rows.unknown_tags)
+    # `UnknownTags` creates general tags
+    return rows._replace(tag_ids=rows.tag_ids + created,
+                         unknown_tags=[],
+                         tag_arrays=add_tag_arrays(rows.tag_arrays, created))
+
+
+def write_post_tables(conn: Connection, rows: PostRows,
+                      opts: LoadOptions = LoadOptions()) -> None:
+    """
+    Write the rows of a range, their tags resolved, in the transaction of the caller.
+
+    `booru.posts` is written first so the child tables never reference a missing post.
+    """
+    method, conflict = opts.method, opts.conflict
+    write_rows(conn, "booru.posts", POST_COLUMNS, POST_TYPES, rows.posts, method, conflict)
+    if conflict != "error":
+        delete_variants(conn, [row[0] for row in rows.posts])
+    write_rows(conn, "booru.posts_media_variants", VARIANT_COLUMNS, VARIANT_TYPES, rows.variants,
+               method)
+    write_rows(conn, "booru.posts_file_urls", FILE_COLUMNS, FILE_TYPES, rows.files, method,
+               conflict)
+    if rows.tag_ids:
+        write_assoc(conn, "booru.posts_tags_assoc", rows.tag_ids, method, conflict)
+    if rows.tag_arrays and opts.tag_arrays:
+        write_assoc(conn, "booru.posts_tag_arrays", rows.tag_arrays, method, conflict)
+
+
+def write_post_rows(conn: Connection,
+                    rows: PostRows,
+                    unknown: Optional[UnknownTags],
+                    opts: LoadOptions = LoadOptions()) -> PostRows:
+    """
+    Write the rows of a range in one transaction, return the rows written.
+
+    Tag associations are skipped if `unknown` is `None`.
+    """
+    if unknown is not None:
+        rows = resolve_tags(conn, rows, unknown)
+    else:
+        rows = rows._replace(tag_ids=[], unknown_tags=[], tag_arrays=[])
+    write_post_tables(conn, rows, opts)
+    with stage("booru.posts", "commit"):
+        conn.commit()
+    return rows
+
+
+def parallel_transform(path: str | Path,
+                       chunks: Iterable[Chunk],
+                       workers: int,
+                       validate: bool = False,
+                       tags_path: Optional[str] = None,
+                       prefetch: int = 2) -> Generator[PostRows, None, None]:
+    """
+    Transform chunks in a process pool, yielding results in file order.
+
+    At most `workers * prefetch` chunks are in flight, so memory stays bounded.
+    """
+    pending: Deque[Future[PostRows]] = deque()
+    todo = iter(chunks)
+    with ProcessPoolExecutor(max_workers=workers) as pool:
+
+        def submit() -> bool:
+            chunk = next(todo, None)
+            if chunk is None:
+                return False
+            pending.append(pool.submit(transform_range, str(path), chunk, validate, tags_path))
+            return True
+
+        for _ in range(workers * prefetch):
+            if not submit():
+                break
+        while pending:
+            result = pending.popleft().result()
+            submit()
+            yield result
+
+
+def transform_ranges(path: str | Path,
+                     chunks: Iterable[Chunk],
+                     workers: int = 0,
+                     validate: bool = False,
+                     tags_path: Optional[str] = None) -> Iterator[PostRows]:
+    """Transform chunks in file order, in a process pool if `workers` is positive"""
+    if workers > 0:
+        return timed_ranges(parallel_transform(path, chunks, workers, validate, tags_path))
+    return timed_ranges(transform_range(str(path), c, validate, tags_path) for c in chunks)
+
+
+def timed_ranges(source: Iterator[PostRows]) -> Generator[PostRows, None, None]:
+    """
+    Record the `transform` stage of `posts` for every range taken from `source`.
+
+    With a process pool this is the time spent waiting on the workers.
+    """
+    while True:
+        wall, cpu = time.perf_counter(), time.thread_time()
+        rows = next(source, None)
+        if rows is None:
+            return
+        record("posts", "transform",
+               time.perf_counter() - wall,
+               time.thread_time() - cpu, len(rows.posts),
+               rows.byte_range.end - rows.byte_range.start)
+        yield rows
+
+
+def process_posts_parallel(conn: Connection,
+                           path: str | Path,
+                           tags: TagDict,
+                           unknown: UnknownTags,
+                           workers: int,
+                           chunk_size: int,
+                           opts: LoadOptions = LoadOptions(),
+                           start: int = 0,
+                           on_written: Callable[[PostRows], None] = lambda _: None) -> int:
+    """
+    Load `posts.json` with a process pool of parsers and a single writer.
+
+    The parsers resolve tags with the memory-mapped dictionary file of `tags`.
+    `on_written` is called with the rows of a range once they are committed,
+    their unknown tags resolved.
+    """
+    count = 0
+    chunks = split_chunks(path, chunk_size, start)
+    for rows in transform_ranges(path, chunks, workers, opts.validate_rows, str(tags.path)):
+        rows = write_post_rows(conn, rows, unknown, opts)
+        count += len(rows.posts)
+        on_written(rows)
+    return count
@@ -0,0 +1,317 @@
+"""
+Range partitioning of the post tables.
+
+`create-tables --partitions` creates `booru.posts` and the tables keyed on a
+post (`PARTITIONED_TABLES`) partitioned by range of the post id, from the
+definitions of `database.sql`. Every table gets the same bounds, either one
+partition per `created_at` year of `posts.json` (ids grow with the upload
+date) or fixed-size id ranges, so the planner joins them partition by
+partition.
+
+Partitions are bounded by id, a filter on the date only skips partitions with
+the `created_at` range check set on every partition of `booru.posts` from its
+rows (`constraint_exclusion = partition`, the default):
+
+    EXPLAIN SELECT * FROM booru.view_modern_posts;
+    ->  Seq Scan on posts_y2015 p_1 ...
+
+The checks are dropped while posts are written and set again once they are
+(`CreatedAtChecks`). `posts --engine partitioned` routes the rows of every
+range to their partitions and writes the partitions of a pooled connection
+on that connection only, so different partitions load concurrently.
+"""
+from typing import Callable, Deque, Dict, Iterable, Iterator, List, NamedTuple, Optional
+from bisect import bisect_right
+from collections import defaultdict, deque
+from pathlib import Path
+from loguru import logger
+from psycopg import Connection
+import json
+import re
+import time
+from parallel import ByteRange, Chunk, PostRows, read_range
+from raw_files import is_compressed, open_raw
+from schema import Table, create_table_sql
+
+# partitioned table -> its partition key, the post id
+PARTITIONED_TABLES: Dict[str, str] = {
+    "booru.posts": "id",
+    "booru.posts_media_variants": "post_id",
+    "booru.posts_file_urls": "post_id",
+    "booru.posts_tags_assoc": "post_id",
+    "booru.posts_tag_arrays": "post_id",
+}
+
+# a filter pruning the partitions of `booru.posts` prunes the partitions joined with them
+PARTITIONWISE_SQL = """DO $$
+BEGIN
+    EXECUTE format('ALTER DATABASE %I SET enable_partitionwise_join = on', current_database());
+    EXECUTE format('ALTER DATABASE %I SET enable_partitionwise_aggregate = on',
+                   current_database());
+END
+$$"""
+
+BOUND_RE = re.compile(r"FOR VALUES FROM \((\w+)\) TO \((\w+)\)")
+
+
+class Partition(NamedTuple):
+    """Post ids from `start` up to `end` excluded, `None` is unbounded"""
+    suffix: str
+    start: Optional[int]
+    end: Optional[int]
+
+    def name(self, table_name: str) -> str:
+        return f"{table_name}_{self.suffix}"
+
+    def bound_sql(self) -> str:
+        start = "MINVALUE" if self.start is None else str(self.start)
+        end = "MAXVALUE" if self.end is None else str(self.end)
+        return f"FOR VALUES FROM ({start}) TO ({end})"
+
+
+class IdScan(NamedTuple):
+    # created_at year -> lowest post id of the year
+    first_ids: Dict[int, int]
+    last_id: int
+
+
+def scan_post_ids(path: str | Path) -> IdScan:
+    """The first post id of every year and the last id of `posts.json`, in one pass"""
+    first_ids: Dict[int, int] = {}
+    last_id = 0
+    start = time.perf_counter()
+    with open_raw(path) as f:
+        for line in f:
+            if not line.strip():
+                continue
+            post = json.loads(line)
+            post_id = post["id"]
+            last_id = max(last_id, post_id)
+            if post.get("created_at"):
+                year = int(post["created_at"][:4])
+                first_ids[year] = min(first_ids.get(year, post_id), post_id)
+    logger.info("Scanned the post ids of {} in {:.1f}s".format(path, time.perf_counter() - start))
+    return IdScan(first_ids, last_id)
+
+
+def year_partitions(first_ids: Dict[int, int]) -> List[Partition]:
+    """
+    A partition per year, from its first post id to the first id of the next one.
+
+    A year whose first id is below the start of the year before is left in that
+    partition, the bounds only have to grow.
+    """
+    starts: List[tuple[int, int]] = []
+    for year, first_id in sorted(first_ids.items()):
+        if not starts or first_id > starts[-1][1]:
+            starts.append((year, first_id))
+    if not starts:
+        return [Partition("default", None, None)]
+    partitions = []
+    for i, (year, first_id) in enumerate(starts):
+        end = starts[i + 1][1] if i + 1 < len(starts) else None
+        partitions.append(Partition(f"y{year}", None if i == 0 else first_id, end))
+    return partitions
+
+
+def id_partitions(size: int, last_id: int) -> List[Partition]:
+    """Partitions of `size` ids up to `last_id`, the last one unbounded"""
+    count = last_id // size + 1
+    return [
+        Partition(f"p{i:03d}", None if i == 0 else i * size,
+                  None if i == count - 1 else (i + 1) * size) for i in range(count)
+    ]
+
+
+def plan_partitions(spec: str, path: str | Path) -> List[Partition]:
+    """The partitions of `--partitions`, `year` or a number of ids per partition"""
+    scan = scan_post_ids(path)
+    if spec == "year":
+        return year_partitions(scan.first_ids)
+    if not spec.isdigit() or int(spec) <= 0:
+        raise ValueError(f"--partitions is `year` or a number of ids, not {spec!r}")
+    return id_partitions(int(spec), scan.last_id)
+
+
+def partitioned_table_sql(table: Table, partitions: List[Partition]) -> List[str]:
+    """
+    The table partitioned by `PARTITIONED_TABLES` and its partitions.
+
+    The keys of a partitioned table must hold the partition key, the post id is
+    added to those that don't (the serial key of `booru.posts_media_variants`).
+    The foreign key to `booru.posts` is declared between partitions of the same
+    bounds: checked through the partitioned table, every row written costs
+    several times more.
+    """
+    key = PARTITIONED_TABLES[table.name]
+    if table.primary_key and key not in table.primary_key:
+        table = table.model_copy(update={"primary_key": table.primary_key + [key]})
+    by_partition = [
+        fk for fk in table.foreign_keys
+        if fk.ref_table in PARTITIONED_TABLES and fk.columns == [key]
+    ]
+    table = table.model_copy(
+        update={"foreign_keys": [fk for fk in table.foreign_keys if fk not in by_partition]})
+    statements = [f"{create_table_sql(table)} PARTITION BY RANGE ({key})"]
+    for partition in partitions:
+        constraints = ", ".join(f"FOREIGN KEY ({key}) REFERENCES {partition.name(fk.ref_table)} "
+                                f"({', '.join(fk.ref_columns)})" for fk in by_partition)
+        statements.append(f"CREATE TABLE {partition.name(table.name)} PARTITION OF {table.name}" +
+                          (f" ({constraints})" if constraints else "") +
+                          f" {partition.bound_sql()}")
+    return statements
+
+
+def is_partitioned(conn: Connection, table_name: str = "booru.posts") -> bool:
+    row = conn.execute("SELECT relkind = 'p' FROM pg_class WHERE oid = to_regclass(%s)",
+                       (table_name,)).fetchone()
+    return row is not None and row[0]
+
+
+def read_partitions(conn: Connection, table_name: str = "booru.posts") -> List[Partition]:
+    """The partitions of a table, by bound"""
+    prefix = table_name.split(".")[-1] + "_"
+    rows = conn.execute(
+        "SELECT c.relname, pg_get_expr(c.relpartbound, c.oid) FROM pg_inherits i "
+        "JOIN pg_class c ON c.oid = i.inhrelid WHERE i.inhparent = to_regclass(%s)",
+        (table_name,)).fetchall()
+    partitions = []
+    for relname, bound in rows:
+        m = BOUND_RE.match(bound)
+        if m is None:
+            raise ValueError(f"{relname} is not a range partition of post ids: {bound}")
+        start, end = (None if v in ("MINVALUE", "MAXVALUE") else int(v) for v in m.groups())
+        partitions.append(Partition(relname.removeprefix(prefix), start, end))
+    return sorted(partitions, key=lambda p: -1 if p.start is None else p.start)
+
+
+def partition_index(partitions: List[Partition]) -> Callable[[int], int]:
+    """Index of the partition of a post id, `partitions` sorted and contiguous"""
+    starts = [p.start for p in partitions[1:]]
+    return lambda post_id: bisect_right(starts, post_id)    # type: ignore
+
+
+def route_rows(rows: PostRows, partitions: List[Partition]) -> Dict[int, PostRows]:
+    """The rows of a range split by the partition of their post, the post id comes first"""
+    index = partition_index(partitions)
+    routed: Dict[int, PostRows] = {}
+    for field in ("posts", "variants", "files", "tag_ids", "tag_arrays"):
+        for row in getattr(rows, field):
+            i = index(row[0])
+            part = routed.get(i)
+            if part is None:
+                part = routed[i] = PostRows(rows.byte_range, [], [], [], [], [], [])
+            getattr(part, field).append(row)
+    return routed
+
+
+def first_post_id(path: str | Path, byte_range: ByteRange) -> Optional[int]:
+    line = next(read_range(path, byte_range), None)
+    return json.loads(line)["id"] if line is not None else None
+
+
+def interleave_chunks(path: str | Path, chunks: Iterable[Chunk],
+                      partitions: List[Partition]) -> Iterator[Chunk]:
+    """
+    The chunks of a plain file taken from the partitions of their first post in turn.
+
+    The posts of a dump are sorted by id, in file order the ranges would keep a
+    single partition busy at a time. A compressed file is decompressed in order,
+    its chunks are left as they are.
+    """
+    if is_compressed(path):
+        yield from chunks
+        return
+    index = partition_index(partitions)
+    queues: Dict[int, Deque[Chunk]] = defaultdict(deque)
+    for chunk in chunks:
+        post_id = first_post_id(path, chunk.byte_range)
+        queues[index(post_id) if post_id is not None else 0].append(chunk)
+    while queues:
+        for i in sorted(queues):
+            yield queues[i].popleft()
+            if not queues[i]:
+                del queues[i]
+
+
+class CommittedPrefix:
+    """End of the ranges of a file that are all committed, for the checkpoints"""
+
+    def __init__(self, start: int):
+        self.end = start
+        # start -> end of the ranges committed after a gap
+        self.pending: Dict[int, int] = {}
+
+    def add(self, byte_range: ByteRange) -> int:
+        self.pending[byte_range.start] = byte_range.end
+        while self.end in self.pending:
+            self.end = self.pending.pop(self.end)
+        return self.end
+
+
+def check_name(partition_name: str) -> str:
+    return partition_name.split(".")[-1] + "_created_at"
+
+
+def drop_created_at_checks(conn: Connection) -> None:
+    for partition in read_partitions(conn):
+        name = partition.name("booru.posts")
+        conn.execute(f"ALTER TABLE {name} DROP CONSTRAINT IF EXISTS {check_name(name)}"
+                    )    # type: ignore
+
+
+def constrain_created_at(conn: Connection) -> int:
+    """
+    Set the `created_at` range check of every partition of `booru.posts` from its rows.
+
+    Runs in the transaction of the caller, returns the partitions checked.
+    Partitions without a date are left unchecked.
+    """
+    drop_created_at_checks(conn)
+    rows = conn.execute("SELECT tableoid::regclass::text, min(created_at), max(created_at) "
+                        "FROM booru.posts GROUP BY tableoid").fetchall()
+    checked = 0
+    for name, first, last in rows:
+        if first is None:
+            continue
+        conn.execute(f"ALTER TABLE {name} ADD CONSTRAINT {check_name(name)} CHECK "
+                     f"(created_at BETWEEN '{first.isoformat()}' AND '{last.isoformat()}')"
+                    )    # type: ignore
+        checked += 1
+    return checked
+
+
+class CreatedAtChecks:
+    """
+    Drops the `created_at` checks of the post partitions for a load, set again when it exits.
+
+    A written post may fall outside the range of its partition. The checks are
+    set again from the rows also when the load fails, a killed load leaves
+    them dropped until the next one (or `constrain-partitions`). Does nothing
+    if `booru.posts` is not partitioned.
+    """
+
+    def __init__(self, conn: Connection, enabled: bool = True):
+        self.conn = conn
+        self.enabled = enabled
+
+    def __enter__(self) -> "CreatedAtChecks":
+        conn = self.conn
+        conn.commit()
+        self.enabled = self.enabled and is_partitioned(conn)
+        if self.enabled:
+            drop_created_at_checks(conn)
+            conn.commit()
+        return self
+
+    def __exit__(self, *_exc) -> None:
+        if not self.enabled:
+            return
+        conn = self.conn
+        conn.rollback()
+        start = time.perf_counter()
+        checked = constrain_created_at(conn)
+        conn.commit()
+        logger.info("Set the created_at checks of {} partitions in {:.2f}s".format(
+            checked,
+            time.perf_counter() - start))
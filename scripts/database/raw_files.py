@@ -0,0 +1,346 @@
+"""
+Read the raw dumps as they are distributed, plain or compressed.
+
+`posts.json` may as well be `posts.json.gz`, `posts.json.zst` or
+`posts.json.xz`: `open_raw` picks the codec from the suffix and returns a
+binary file of the decompressed lines. Decompression runs in a thread ahead
+of the reader (zlib, lzma and zstandard release the GIL), and the frames of a
+multi-frame zstd file (`pzstd`, the seekable format, `write_raw`) are decoded
+by a pool of threads in parallel. `position` is the number of compressed bytes
+consumed, it drives the progress bars without a first pass over the file.
+
+    with open_raw("raw/posts.json.zst") as f:
+        for line in f:
+            ...
+
+zstd needs the optional `zstandard` package.
+"""
+from typing import Callable, Deque, Dict, Iterator, List, Optional, Protocol
+from collections import deque
+from concurrent.futures import Future, ThreadPoolExecutor
+from pathlib import Path
+import gzip
+import io
+import lzma
+import os
+import queue
+import struct
+import threading
+import zlib
+
+try:
+    import zstandard
+except ImportError:    # pragma: no cover
+    zstandard = None    # type: ignore
+
+RAW_SUFFIXES = (".gz", ".zst", ".xz")
+# compressed bytes fed to a decompressor at once
+READ_SIZE = 1 << 20
+# decompressed chunks waiting for the reader
+QUEUE_DEPTH = 8
+# threads decoding the frames of a multi-frame zstd file
+DECOMPRESS_WORKERS = min(4, os.cpu_count() or 1)
+
+ZSTD_MAGIC = 0xFD2FB528
+# window of `zstd --long=31`, larger than the default limit of the decoder
+ZSTD_MAX_WINDOW = 1 << 31
+
+
+class Decompressor(Protocol):
+    eof: bool
+    unused_data: bytes
+
+    def decompress(self, data: bytes) -> bytes:
+        ...
+
+
+def zstd_decompressor() -> Decompressor:
+    if zstandard is None:
+        raise RuntimeError("reading .zst dumps needs the zstandard package")
+    return zstandard.ZstdDecompressor(max_window_size=ZSTD_MAX_WINDOW).decompressobj()
+
+
+DECOMPRESSORS: Dict[str, Callable[[], Decompressor]] = {
+    # gzip header, `zlib.MAX_WBITS | 16`
+    ".gz": lambda: zlib.decompressobj(31),
+    ".xz": lzma.LZMADecompressor,
+    ".zst": zstd_decompressor,
+}
+
+
+def is_compressed(path: str | Path) -> bool:
+    return Path(path).suffix in DECOMPRESSORS
+
+
+def resolve_raw_file(path: str | Path) -> Path:
+    """`path`, or the compressed file next to it if only that one exists"""
+    path = Path(path)
+    if path.exists():
+        return path
+    for suffix in RAW_SUFFIXES:
+        compressed = path.with_name(path.name + suffix)
+        if compressed.exists():
+            return compressed
+    return path
+
+
+def decompress_stream(f: io.BufferedReader,
+                      new_decompressor: Callable[[], Decompressor],
+                      read_size: int = READ_SIZE) -> Iterator[tuple[bytes, int]]:
+    """
+    Decompressed chunks of a file with the compressed position after each.
+
+    Concatenated members (`pigz`, `bgzip`, multi-frame zstd) are decoded one
+    after another.
+    """
+    d = new_decompressor()
+    while True:
+        data = f.read(read_size)
+        if not data:
+            return
+        while data:
+            out = d.decompress(data)
+            data = b""
+            if d.eof:
+                data = d.unused_data
+                d = new_decompressor()
+            if out:
+                yield out, f.tell() - len(data)
+
+
+def zstd_frames(f: io.BufferedReader) -> Iterator[tuple[int, int]]:
+    """
+    `(offset, length)` of the frames of a zstd file, from their headers alone.
+
+    Skippable frames are left out.
+    """
+    offset = 0
+    header = struct.Struct("<I")
+    while True:
+        f.seek(offset)
+        magic = f.read(4)
+        if len(magic) < 4:
+            return
+        (value,) = header.unpack(magic)
+        if value & 0xFFFFFFF0 == 0x184D2A50:
+            (size,) = header.unpack(f.read(4))
+            offset += 8 + size
+            continue
+        if value != ZSTD_MAGIC:
+            raise ValueError(f"no zstd frame at offset {offset}")
+        descriptor = f.read(1)[0]
+        single_segment = descriptor >> 5 & 1
+        content_size = (1 if single_segment else 0, 2, 4, 8)[descriptor >> 6]
+        dict_id = (0, 1, 2, 4)[descriptor & 3]
+        pos = offset + 5 + (0 if single_segment else 1) + dict_id + content_size
+        while True:
+            f.seek(pos)
+            block = int.from_bytes(f.read(3), "little")
+            block_type, block_size = block >> 1 & 3, block >> 3
+            pos += 3 + (1 if block_type == 1 else block_size)
+            if block & 1:
+                break
+        if descriptor >> 2 & 1:
+            # content checksum
+            pos += 4
+        yield offset, pos - offset
+        offset = pos
+
+
+def decompress_frame(data: bytes) -> bytes:
+    return zstd_decompressor().decompress(data)
+
+
+def decompress_frames(f: io.BufferedReader,
+                      frames: List[tuple[int, int]],
+                      workers: int,
+                      read_size: int = READ_SIZE) -> Iterator[tuple[bytes, int]]:
+    """Decompress zstd frames on `workers` threads, in file order"""
+    # frames are grouped up to `read_size` compressed bytes, small frames would not pay
+    # for the round trip through the pool
+    groups: List[List[tuple[int, int]]] = [[]]
+    for frame in frames:
+        if groups[-1] and sum(length for _, length in groups[-1]) >= read_size:
+            groups.append([])
+        groups[-1].append(frame)
+    pending: Deque[tuple[Future[List[bytes]], int]] = deque()
+    todo = iter(groups)
+    with ThreadPoolExecutor(max_workers=workers) as pool:
+
+        def submit() -> bool:
+            group = next(todo, None)
+            if group is None:
+                return False
+            # skippable frames may sit between the frames of a group
+            start = group[0][0]
+            f.seek(start)
+            data = f.read(group[-1][0] + group[-1][1] - start)
+            chunks = [data[offset - start:offset - start + length] for offset, length in group]
+            pending.append((pool.submit(lambda: [decompress_frame(c) for c in chunks]),
+                            group[-1][0] + group[-1][1]))
+            return True
+
+        for _ in range(workers * 2):
+            if not submit():
+                break
+        while pending:
+            future, position = pending.popleft()
+            out = b"".join(future.result())
+            submit()
+            yield out, position
+
+
+def decompressed_chunks(path: Path, workers: int) -> Iterator[tuple[bytes, int]]:
+    """Decompressed chunks of `path` and the compressed position after each"""
+    with open(path, "rb") as f:
+        if path.suffix == ".zst" and workers > 1:
+            frames = list(zstd_frames(f))
+            if len(frames) > 1:
+                yield from decompress_frames(f, frames, workers)
+                return
+            f.seek(0)
+        yield from decompress_stream(f, DECOMPRESSORS[path.suffix])
+
+
+class ThreadedReader(io.RawIOBase):
+    """Raw stream of the decompressed bytes, produced by a thread into a bounded queue"""
+
+    def __init__(self, path: Path, workers: int = DECOMPRESS_WORKERS, depth: int = QUEUE_DEPTH):
+        self.path = path
+        self.size = os.path.getsize(path)
+        # compressed bytes behind the data handed out so far
+        self.position = 0
+        self.chunks: queue.Queue[Optional[tuple[bytes, int]]] = queue.Queue(maxsize=depth)
+        self.buffer = memoryview(b"")
+        self.next_position = 0
+        self.error: Optional[BaseException] = None
+        self.stopped = threading.Event()
+        self.thread = threading.Thread(target=self.produce,
+                                       args=(workers,),
+                                       name=f"decompress-{path.name}",
+                                       daemon=True)
+        self.thread.start()
+
+    def produce(self, workers: int) -> None:
+        try:
+            for item in decompressed_chunks(self.path, workers):
+                if not self.put(item):
+                    return
+        except BaseException as e:
+            self.error = e
+        self.put(None)
+
+    def put(self, item: Optional[tuple[bytes, int]]) -> bool:
+        """Wait for room in the queue, `False` once the reader is closed"""
+        while not self.stopped.is_set():
+            try:
+                self.chunks.put(item, timeout=0.1)
+                return True
+            except queue.Full:
+                continue
+        return False
+
+    def readable(self) -> bool:
+        return True
+
+    def readinto(self, b) -> int:    # type: ignore[override]
+        while not self.buffer:
+            item = self.chunks.get()
+            if item is None:
+                self.chunks.put(None)
+                if self.error is not None:
+                    raise self.error
+                # the trailer of the last frame or member decompresses to nothing
+                self.position = self.size
+                return 0
+            data, self.next_position = item
+            self.buffer = memoryview(data)
+        n = min(len(b), len(self.buffer))
+        b[:n] = self.buffer[:n]
+        self.buffer = self.buffer[n:]
+        if not self.buffer:
+            self.position = self.next_position
+        return n
+
+    def close(self) -> None:
+        self.stopped.set()
+        super().close()
+
+
+class RawFile(io.BufferedReader):
+    """A buffered raw dump, `position` and `size` are in bytes of the file on disk"""
+
+    def __init__(self, path: Path, workers: int = DECOMPRESS_WORKERS):
+        self.path = path
+        self.compressed = is_compressed(path)
+        raw = ThreadedReader(path, workers) if self.compressed else io.FileIO(path, "rb")
+        super().__init__(raw, buffer_size=READ_SIZE)
+        self.size = os.path.getsize(path)
+
+    @property
+    def position(self) -> int:
+        if isinstance(self.raw, ThreadedReader):
+            return self.raw.position
+        return self.tell()
+
+
+def open_raw(path: str | Path, offset: int = 0, workers: int = DECOMPRESS_WORKERS) -> RawFile:
+    """
+    Open a raw dump for reading at `offset`, a position in the decompressed data.
+
+    A compressed file cannot seek: the data before `offset` is decompressed
+    and skipped. `workers` threads decode the frames of a multi-frame zstd file.
+    """
+    f = RawFile(resolve_raw_file(path), workers)
+    if not f.compressed:
+        f.seek(offset)
+        return f
+    while offset > 0:
+        skipped = len(f.read(min(offset, READ_SIZE)))
+        if not skipped:
+            break
+        offset -= skipped
+    return f
+
+
+class FramedZstdWriter(io.RawIOBase):
+    """Writes a zstd file as independent frames of about `frame_size` input bytes"""
+
+    def __init__(self, path: Path, level: int = 3, frame_size: int = 4 << 20):
+        if zstandard is None:
+            raise RuntimeError("writing .zst dumps needs the zstandard package")
+        self.file = open(path, "wb")
+        self.writer = zstandard.ZstdCompressor(level=level).stream_writer(self.file,
+                                                                           closefd=False)
+        self.frame_size = frame_size
+        self.in_frame = 0
+
+    def writable(self) -> bool:
+        return True
+
+    def write(self, b) -> int:    # type: ignore[override]
+        n = self.writer.write(b)
+        self.in_frame += len(b)
+        if self.in_frame >= self.frame_size:
+            self.writer.flush(zstandard.FLUSH_FRAME)
+            self.in_frame = 0
+        return n
+
+    def close(self) -> None:
+        if not self.closed:
+            self.writer.flush(zstandard.FLUSH_FRAME)
+            self.file.close()
+        super().close()
+
+
+def write_raw(path: str | Path, level: Optional[int] = None) -> io.BufferedIOBase:
+    """Open a dump for writing, compressed according to its suffix"""
+    path = Path(path)
+    if path.suffix == ".gz":
+        return gzip.open(path, "wb", compresslevel=level or 6)    # type: ignore
+    if path.suffix == ".xz":
+        return lzma.open(path, "wb", preset=level or 6)    # type: ignore
+    if path.suffix == ".zst":
+        # lines are never split across frames by the reader, any frame size works
+        return io.BufferedWriter(FramedZstdWriter(path, level or 3), buffer_size=READ_SIZE)
+    return open(path, "wb")
@@ -0,0 +1,200 @@
+"""
+Table definitions parsed from `database.sql`, which stays the single DDL source.
+
+Used to create the tables of a bulk load without any constraint or index, and
+to add them back once the data is in.
+"""
+from typing import Dict, Optional, List, Iterable
+from pathlib import Path
+from pydantic import BaseModel
+import re
+
+SCHEMA_FILE = Path(__file__).parent / "database.sql"
+
+
+class ForeignKey(BaseModel):
+    columns: List[str]
+    ref_table: str
+    ref_columns: List[str]
+
+
+class Table(BaseModel):
+    name: str
+    # (column name, type and column options other than constraints)
+    columns: List[tuple[str, str]]
+    primary_key: List[str] = []
+    foreign_keys: List[ForeignKey] = []
+    # constraint name -> columns
+    uniques: Dict[str, List[str]] = {}
+
+    @property
+    def short_name(self) -> str:
+        return self.name.split(".")[-1]
+
+
+class Index(BaseModel):
+    name: str
+    table: str
+    sql: str
+
+
+class Schema(BaseModel):
+    tables: List[Table]
+    indexes: List[Index]
+    # COMMENT ON and other statements that are replayed as-is
+    comments: List[str]
+    # functions and triggers, created once the tables are loaded
+    routines: List[str] = []
+
+    def table(self, name: str) -> Table:
+        return next(t for t in self.tables if t.name == name)
+
+
+def split_statements(sql: str) -> List[str]:
+    """Split a SQL script into statements, dropping `--` comments and keeping `$$` bodies whole"""
+    sql = re.sub(r"--[^\n]*", "", sql)
+    statements, current = [], ""
+    for i, part in enumerate(re.split(r"(\$\$.*?\$\$)", sql, flags=re.S)):
+        if i % 2:
+            current += part
+            continue
+        first, *rest = part.split(";")
+        current += first
+        for piece in rest:
+            statements.append(current)
+            current = piece
+    statements.append(current)
+    return [s.strip() for s in statements if s.strip()]
+
+
+def split_top_level(body: str) -> List[str]:
+    """Split on commas that are not inside parentheses"""
+    items, depth, current = [], 0, ""
+    for ch in body:
+        if ch == "(":
+            depth += 1
+        elif ch == ")":
+            depth -= 1
+        if ch == "," and depth == 0:
+            items.append(current.strip())
+            current = ""
+        else:
+            current += ch
+    if current.strip():
+        items.append(current.strip())
+    return items
+
+
+def column_list(s: str) -> List[str]:
+    return [c.strip() for c in s.split(",")]
+
+
+def parse_table(statement: str) -> Table:
+    m = re.match(r"CREATE TABLE\s+([\w.]+)\s*\((.*)\)\s*$", statement, re.S | re.I)
+    if m is None:
+        raise ValueError(f"unsupported statement: {statement[:60]}")
+    table = Table(name=m.group(1), columns=[])
+    for item in split_top_level(m.group(2)):
+        item = " ".join(item.split())
+        if m2 := re.match(r"PRIMARY KEY \((.*)\)$", item, re.I):
+            table.primary_key = column_list(m2.group(1))
+        elif m2 := re.match(r"FOREIGN KEY \((.*)\) REFERENCES ([\w.]+) \((.*)\)$", item, re.I):
+            table.foreign_keys.append(
+                ForeignKey(columns=column_list(m2.group(1)),
+                           ref_table=m2.group(2),
+                           ref_columns=column_list(m2.group(3))))
+        elif m2 := re.match(r"CONSTRAINT (\w+) UNIQUE \((.*)\)$", item, re.I):
+            table.uniques[m2.group(1)] = column_list(m2.group(2))
+        else:
+            name, rest = item.split(" ", 1)
+            if m2 := re.search(r"\s*REFERENCES ([\w.]+) \((.*?)\)", rest, re.I):
+                table.foreign_keys.append(
+                    ForeignKey(columns=[name],
+                               ref_table=m2.group(1),
+                               ref_columns=column_list(m2.group(2))))
+                rest = rest.replace(m2.group(0), "")
+            if re.search(r"\s*PRIMARY KEY", rest, re.I):
+                table.primary_key = [name]
+                rest = re.sub(r"\s*PRIMARY KEY", "", rest, flags=re.I)
+            table.columns.append((name, rest.strip()))
+    return table
+
+
+def load_schema(path: str | Path = SCHEMA_FILE) -> Schema:
+    """Parse the tables, indexes, comments and routines of `database.sql`"""
+    with open(path, "r") as f:
+        statements = split_statements(f.read())
+    schema = Schema(tables=[], indexes=[], comments=[])
+    for s in statements:
+        if re.match(r"CREATE TABLE", s, re.I):
+            schema.tables.append(parse_table(s))
+        elif m := re.match(r"CREATE INDEX (\w+) ON ([\w.]+)", s, re.I):
+            schema.indexes.append(Index(name=m.group(1), table=m.group(2), sql=s))
+        elif re.match(r"COMMENT ON", s, re.I):
+            schema.comments.append(s)
+        elif re.match(r"CREATE (OR REPLACE )?(FUNCTION|TRIGGER)", s, re.I):
+            schema.routines.append(s)
+    return schema
+
+
+def create_table_sql(table: Table, unlogged: bool = False, constraints: bool = True) -> str:
+    """CREATE TABLE statement, optionally unlogged and without any constraint"""
+    items = [f"{name} {ddl}" for name, ddl in table.columns]
+    if constraints:
+        if table.primary_key:
+            items.append(f"PRIMARY KEY ({', '.join(table.primary_key)})")
+        for fk in table.foreign_keys:
+            items.append(f"FOREIGN KEY ({', '.join(fk.columns)}) "
+                         f"REFERENCES {fk.ref_table} ({', '.join(fk.ref_columns)})")
+        for name, cols in table.uniques.items():
+            items.append(f"CONSTRAINT {name} UNIQUE ({', '.join(cols)})")
+    body = ",\n    ".join(items)
+    kind = "UNLOGGED TABLE" if unlogged else "TABLE"
+    return f"CREATE {kind} {table.name}\n(\n    {body}\n)"
+
+
+def key_constraints_sql(table: Table) -> List[str]:
+    """Primary key and unique constraints, each one builds an index"""
+    out = []
+    if table.primary_key:
+        out.append(f"ALTER TABLE {table.name} ADD CONSTRAINT {table.short_name}_pkey "
+                   f"PRIMARY KEY ({', '.join(table.primary_key)})")
+    for name, cols in table.uniques.items():
+        out.append(f"ALTER TABLE {table.name} ADD CONSTRAINT {name} UNIQUE ({', '.join(cols)})")
+    return out
+
+
+def foreign_key_name(table: Table, fk: ForeignKey) -> str:
+    return f"{table.short_name}_{'_'.join(fk.columns)}_fkey"
+
+
+def foreign_keys_sql(table: Table) -> List[tuple[str, str]]:
+    """(ADD ... NOT VALID, VALIDATE CONSTRAINT) pairs of the foreign keys of a table"""
+    out = []
+    for fk in table.foreign_keys:
+        name = foreign_key_name(table, fk)
+        add = (f"ALTER TABLE {table.name} ADD CONSTRAINT {name} "
+               f"FOREIGN KEY ({', '.join(fk.columns)}) "
+               f"REFERENCES {fk.ref_table} ({', '.join(fk.ref_columns)}) NOT VALID")
+        out.append((add, f"ALTER TABLE {table.name} VALIDATE CONSTRAINT {name}"))
+    return out
+
+
+def dependency_order(tables: Iterable[Table]) -> List[Table]:
+    """Tables ordered so every table comes after the tables it references"""
+    tables = list(tables)
+    by_name = {t.name: t for t in tables}
+    done: Dict[str, Table] = {}
+
+    def visit(t: Table, stack: tuple[str, ...] = ()):
+        if t.name in done or t.name in stack:
+            return
+        for fk in t.foreign_keys:
+            ref: Optional[Table] = by_name.get(fk.ref_table)
+            if ref is not None:
+                visit(ref, stack + (t.name,))
+        done[t.name] = t
+
+    for t in tables:
+        visit(t)
+    return list(done.values())
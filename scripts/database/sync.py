@@ -0,0 +1,250 @@
+"""
+Incremental sync of a newer dump against what is already loaded.
+
+Rows are compared by id, posts only by `updated_at`. New and changed rows are
+upserted, tag associations of changed posts are rewritten by diffing the old
+and new tag id sets, and rows missing from the new dump are deleted at the end
+together with the rows referencing them. Once the artists and tags are synced,
+`booru.artist_tags_assoc` is brought back to its definition.
+"""
+from typing import Dict, List, Any, Sequence, Type
+from collections import defaultdict
+from loguru import logger
+from psycopg import Connection
+from pydantic import BaseModel
+from counts import ARTIST_TAGS_SQL, relation_exists, replace_tag_arrays
+from loader import (InsertMethod, entry_columns, entry_pg_types, write_rows, write_assoc,
+                    delete_variants)
+from parallel import (POST_COLUMNS, POST_TYPES, VARIANT_COLUMNS, VARIANT_TYPES, FILE_COLUMNS,
+                      FILE_TYPES, resolve_tags, transform_posts)
+from models.posts import PostEntry, PostRaw
+from models.tags import TagEntry
+from models.tag_alias import TagAliasEntry
+from models.artists import ArtistEntry, ArtistRaw
+from models.artist_urls import ArtistUrlEntry
+from tag_dict import TagDict, UnknownTags
+
+# entry in `RawDataFileNameConfig` -> (model, table), in the order they are synced
+SYNC_TABLES: Dict[str, tuple[Type[BaseModel], str]] = {
+    "tags": (TagEntry, "booru.tags"),
+    "tag_aliases": (TagAliasEntry, "booru.tags_aliases"),
+    "tag_implications": (TagAliasEntry, "booru.tags_implications"),
+    "artists": (ArtistEntry, "booru.artists"),
+    "artist_urls": (ArtistUrlEntry, "booru.artists_urls"),
+    "posts": (PostEntry, "booru.posts"),
+}
+
+# table -> (referencing table, referencing column), deleted before the table itself
+DEPENDENTS: Dict[str, List[tuple[str, str]]] = {
+    "booru.posts": [("booru.posts_tags_assoc", "post_id"),
+                    ("booru.posts_tag_arrays", "post_id"),
+                    ("booru.posts_media_variants", "post_id"),
+                    ("booru.posts_file_urls", "post_id")],
+    "booru.tags": [("booru.posts_tags_assoc", "tag_id"), ("booru.tag_post_counts", "tag_id"),
+                   ("booru.artist_tags_assoc", "tag_id")],
+    "booru.artists": [("booru.artists_urls", "artist_id"), ("booru.artists_aliases", "artist_id"),
+                      ("booru.artist_tags_assoc", "artist_id")],
+    "booru.tags_aliases": [],
+    "booru.tags_implications": [],
+    "booru.artists_urls": [],
+}
+
+
+class SyncStats:
+    """Rows inserted, updated and deleted per table"""
+
+    def __init__(self):
+        self.counts: Dict[str, Dict[str, int]] = defaultdict(lambda: {
+            "inserted": 0,
+            "updated": 0,
+            "deleted": 0
+        })
+
+    def add(self, table_name: str, kind: str, n: int) -> None:
+        self.counts[table_name][kind] += n
+
+    def log(self) -> None:
+        for table_name, counts in self.counts.items():
+            logger.info("{:<32} inserted {:>9} updated {:>9} deleted {:>9}".format(
+                table_name, counts["inserted"], counts["updated"], counts["deleted"]))
+
+
+def seen_table(table_name: str) -> str:
+    return "_sync_seen_" + table_name.replace(".", "_")
+
+
+def mark_seen(conn: Connection, table_name: str, ids: Sequence[int]) -> None:
+    """Remember ids present in the new dump, for `delete_unseen`"""
+    seen = seen_table(table_name)
+    with conn.cursor() as c:
+        c.execute(f"CREATE TEMP TABLE IF NOT EXISTS {seen} (id INT PRIMARY KEY)")    # type: ignore
+    write_assoc(conn, seen, [(i,) for i in ids], "copy", types=[("id", "int4")])
+
+
+def delete_unseen(conn: Connection, table_name: str, stats: SyncStats) -> None:
+    """Delete rows whose id is missing from the new dump, and the rows referencing them"""
+    seen = seen_table(table_name)
+    gone = (f"SELECT t.id FROM {table_name} t "
+            f"WHERE NOT EXISTS (SELECT 1 FROM {seen} s WHERE s.id = t.id)")
+    with conn.cursor() as c:
+        c.execute(f"CREATE TEMP TABLE IF NOT EXISTS {seen} (id INT PRIMARY KEY)")    # type: ignore
+        c.execute(f"SELECT EXISTS (SELECT 1 FROM {seen})")    # type: ignore
+        row = c.fetchone()
+        if row is None or not row[0]:
+            logger.warning("Nothing seen in {}, not deleting anything".format(table_name))
+            return
+        arrays: List[int] = []
+        if table_name == "booru.tags" and relation_exists(conn, "booru.posts_tag_arrays"):
+            # posts whose tag arrays hold a deleted tag, recomputed once it is gone
+            c.execute(f"SELECT post_id FROM booru.posts_tag_arrays "
+                      f"WHERE tag_ids && ARRAY({gone})")    # type: ignore
+            arrays = [row[0] for row in c.fetchall()]
+        for child, column in DEPENDENTS[table_name]:
+            if not relation_exists(conn, child):
+                # `booru.posts_tag_arrays` of databases created before it
+                continue
+            c.execute(f"DELETE FROM {child} WHERE {column} IN ({gone})")    # type: ignore
+            stats.add(child, "deleted", c.rowcount)
+        c.execute(f"DELETE FROM {table_name} WHERE id IN ({gone})")    # type: ignore
+        stats.add(table_name, "deleted", c.rowcount)
+        if arrays:
+            replace_tag_arrays(conn, arrays)
+            stats.add("booru.posts_tag_arrays", "updated", len(arrays))
+        c.execute(f"DROP TABLE {seen}")    # type: ignore
+    conn.commit()
+
+
+def fetch_rows(conn: Connection, table_name: str, columns: Sequence[str],
+               ids: List[int]) -> Dict[int, tuple]:
+    """Fetch loaded rows by id, the first column must be `id`"""
+    with conn.cursor() as c:
+        sql = f"SELECT {','.join(columns)} FROM {table_name} WHERE id = ANY(%s)"
+        c.execute(sql, (ids,))    # type: ignore
+        return {row[0]: tuple(row) for row in c.fetchall()}
+
+
+def sync_rows(conn: Connection,
+              model: Type[BaseModel],
+              rows: List[tuple],
+              table_name: str,
+              stats: SyncStats,
+              method: InsertMethod = "insert") -> List[tuple]:
+    """Upsert new and changed rows of a table keyed by `id`, return the rows written"""
+    columns = entry_columns(model)
+    ids = [row[0] for row in rows]
+    loaded = fetch_rows(conn, table_name, columns, ids)
+    changed = [row for row in rows if row[0] in loaded and loaded[row[0]] != row]
+    new = [row for row in rows if row[0] not in loaded]
+    write_rows(conn, table_name, columns, entry_pg_types(model), changed + new, method, "update")
+    mark_seen(conn, table_name, ids)
+    stats.add(table_name, "inserted", len(new))
+    stats.add(table_name, "updated", len(changed))
+    return changed + new
+
+
+def sync_artist_aliases(conn: Connection, artists: List[ArtistRaw], stats: SyncStats) -> None:
+    """Rewrite the aliases of artists by diffing old and new alias sets"""
+    if not artists:
+        return
+    new_pairs = {(a["id"], name) for a in artists for name in (a["other_names"] or [])}
+    with conn.cursor() as c:
+        c.execute("SELECT artist_id, alias FROM booru.artists_aliases WHERE artist_id = ANY(%s)",
+                  ([a["id"] for a in artists],))
+        old_pairs = set(c.fetchall())
+        removed = old_pairs - new_pairs
+        if removed:
+            c.execute(
+                "DELETE FROM booru.artists_aliases WHERE (artist_id, alias) IN "
+                "(SELECT * FROM unnest(%s::int[], %s::text[]))",
+                ([p[0] for p in removed], [p[1] for p in removed]))
+    added = new_pairs - old_pairs
+    write_assoc(conn, "booru.artists_aliases", sorted(added))
+    stats.add("booru.artists_aliases", "inserted", len(added))
+    stats.add("booru.artists_aliases", "deleted", len(removed))
+
+
+def sync_artist_tags(conn: Connection, stats: SyncStats) -> None:
+    """Add the pairs of `ARTIST_TAGS_SQL` that are missing and delete the stale ones"""
+    with conn.cursor() as c:
+        c.execute(f"DELETE FROM booru.artist_tags_assoc a WHERE NOT EXISTS "
+                  f"(SELECT 1 FROM ({ARTIST_TAGS_SQL}) d "
+                  f"WHERE d.artist_id = a.artist_id AND d.tag_id = a.tag_id)")    # type: ignore
+        stats.add("booru.artist_tags_assoc", "deleted", c.rowcount)
+        c.execute(f"INSERT INTO booru.artist_tags_assoc (artist_id, tag_id) "
+                  f"SELECT artist_id, tag_id FROM ({ARTIST_TAGS_SQL}) d WHERE NOT EXISTS "
+                  f"(SELECT 1 FROM booru.artist_tags_assoc a "
+                  f"WHERE a.artist_id = d.artist_id AND a.tag_id = d.tag_id)")    # type: ignore
+        stats.add("booru.artist_tags_assoc", "inserted", c.rowcount)
+    conn.commit()
+
+
+def sync_posts(conn: Connection,
+               posts: List[PostRaw],
+               tags: TagDict,
+               unknown: UnknownTags,
+               stats: SyncStats,
+               method: InsertMethod = "insert",
+               tag_arrays: bool = True) -> None:
+    """
+    Sync a batch of posts and their child tables, in one transaction.
+
+    The `booru.posts_tag_arrays` rows of the changed posts are replaced if `tag_arrays`.
+    """
+    rows = transform_posts(posts, tags=tags)
+    ids = [row[0] for row in rows.posts]
+    updated_at = POST_COLUMNS.index("updated_at")
+    with conn.cursor() as c:
+        c.execute("SELECT id, updated_at FROM booru.posts WHERE id = ANY(%s)", (ids,))
+        loaded: Dict[int, Any] = dict(c.fetchall())
+    changed = {
+        row[0] for row in rows.posts if row[0] in loaded and loaded[row[0]] != row[updated_at]
+    }
+    touched = changed | {i for i in ids if i not in loaded}
+    mark_seen(conn, "booru.posts", ids)
+    stats.add("booru.posts", "inserted", len(touched) - len(changed))
+    stats.add("booru.posts", "updated", len(changed))
+    if not touched:
+        conn.commit()
+        return
+
+    def pick(table_rows: List[tuple]) -> List[tuple]:
+        return [row for row in table_rows if row[0] in touched]
+
+    write_rows(conn, "booru.posts", POST_COLUMNS, POST_TYPES, pick(rows.posts), method, "update")
+
+    stats.add("booru.posts_media_variants", "deleted", delete_variants(conn, list(changed)))
+    variants = pick(rows.variants)
+    write_rows(conn, "booru.posts_media_variants", VARIANT_COLUMNS, VARIANT_TYPES, variants, method)
+    stats.add("booru.posts_media_variants", "inserted", len(variants))
+
+    files = pick(rows.files)
+    write_rows(conn, "booru.posts_file_urls", FILE_COLUMNS, FILE_TYPES, files, method, "update")
+    stats.add("booru.posts_file_urls", "updated", len([f for f in files if f[0] in changed]))
+    stats.add("booru.posts_file_urls", "inserted", len([f for f in files if f[0] not in changed]))
+
+    rows = resolve_tags(
+        conn, rows._replace(unknown_tags=[(post_id, tag)
+                                          for post_id, tag in rows.unknown_tags
+                                          if post_id in touched]), unknown)
+    new_pairs = {pair for pair in rows.tag_ids if pair[0] in touched}
+    with conn.cursor() as c:
+        c.execute("SELECT post_id, tag_id FROM booru.posts_tags_assoc WHERE post_id = ANY(%s)",
+                  (list(changed),))
+        old_pairs = set(c.fetchall())
+        removed = old_pairs - new_pairs
+        if removed:
+            c.execute(
+                "DELETE FROM booru.posts_tags_assoc WHERE (post_id, tag_id) IN "
+                "(SELECT * FROM unnest(%s::int[], %s::int[]))",
+                ([p[0] for p in removed], [p[1] for p in removed]))
+    added = new_pairs - old_pairs
+    write_assoc(conn, "booru.posts_tags_assoc", sorted(added), method)
+    stats.add("booru.posts_tags_assoc", "inserted", len(added))
+    stats.add("booru.posts_tags_assoc", "deleted", len(removed))
+    if tag_arrays:
+        arrays = pick(rows.tag_arrays)
+        write_assoc(conn, "booru.posts_tag_arrays", arrays, method, "update")
+        stats.add("booru.posts_tag_arrays", "updated", len([a for a in arrays if a[0] in changed]))
+        stats.add("booru.posts_tag_arrays", "inserted",
+                  len([a for a in arrays if a[0] not in changed]))
+    conn.commit()
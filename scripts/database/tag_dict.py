@@ -0,0 +1,218 @@
+"""
+Compact tag name -> (tag id, category) dictionary, memory-mapped from a cache file.
+
+The file holds every tag name in one UTF-8 blob, with int32 arrays of ids and
+categories, a uint32 array of name offsets and an open addressing hash table
+of entry indexes keyed by `crc32(name)`. It is named after a fingerprint of
+`booru.tags`, so it is rebuilt whenever the table changes, and worker
+processes open the same file read-only instead of receiving a copy.
+"""
+from typing import Dict, Optional, List, Literal, Iterable
+from array import array
+from functools import lru_cache
+from pathlib import Path
+from loguru import logger
+from psycopg import Connection
+import hashlib
+import json
+import mmap
+import os
+import struct
+import zlib
+
+UnknownTagPolicy = Literal["skip", "create", "dead-letter"]
+UNKNOWN_TAG_POLICIES: tuple[UnknownTagPolicy, ...] = ("skip", "create", "dead-letter")
+
+MAGIC = b"TAGDICT2"
+# magic, entries, hash slots, blob size, padded to 8 bytes
+HEADER = struct.Struct("<8sIIII")
+EMPTY = -1
+# lookups memoized per process, the hot part of a Zipf distribution fits easily
+MEMO_SIZE = 1 << 16
+
+
+def fingerprint(conn: Connection) -> str:
+    """Cheap fingerprint of `booru.tags`, changes when a tag is added, removed, renamed or moved"""
+    with conn.cursor() as c:
+        c.execute("SELECT count(*), coalesce(max(id), 0), coalesce(sum(hashtext("
+                  "id || ':' || name || ':' || category)::bigint), 0) FROM booru.tags")
+        row = c.fetchone()
+    return hashlib.sha1(repr(row).encode()).hexdigest()[:16]
+
+
+def write_tag_dict(path: Path, tags: Iterable[tuple[int, str, int]]) -> None:
+    """Write (id, name, category) rows to a dictionary file, atomically"""
+    ids = array("i")
+    categories = array("i")
+    offsets = array("I", [0])
+    blob = bytearray()
+    for tag_id, name, category in tags:
+        ids.append(tag_id)
+        categories.append(category)
+        blob += name.encode()
+        offsets.append(len(blob))
+    n = len(ids)
+    n_slots = 1
+    while n_slots < 2 * n:
+        n_slots <<= 1
+    slots = array("i", [EMPTY]) * n_slots
+    mask = n_slots - 1
+    for i in range(n):
+        h = zlib.crc32(blob[offsets[i]:offsets[i + 1]]) & mask
+        while slots[h] != EMPTY:
+            h = (h + 1) & mask
+        slots[h] = i
+    for a in (ids, categories, offsets, slots):
+        if a.itemsize != 4:
+            raise RuntimeError("expected 4 byte array items")
+    path.parent.mkdir(parents=True, exist_ok=True)
+    tmp = path.with_suffix(path.suffix + ".tmp")
+    with open(tmp, "wb") as f:
+        f.write(HEADER.pack(MAGIC, n, n_slots, len(blob), 0))
+        ids.tofile(f)
+        categories.tofile(f)
+        offsets.tofile(f)
+        slots.tofile(f)
+        f.write(blob)
+    os.replace(tmp, path)
+
+
+class TagDict:
+    """Read-only tag name -> tag id (and category) lookups over a memory-mapped dictionary file"""
+
+    def __init__(self, path: str | Path):
+        self.path = Path(path)
+        with open(self.path, "rb") as f:
+            self._mm = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        magic, n, n_slots, blob_size, _ = HEADER.unpack_from(self._mm, 0)
+        if magic != MAGIC:
+            raise ValueError(f"{self.path} is not a tag dictionary")
+        view = memoryview(self._mm)
+        start = HEADER.size
+        self._ids = view[start:start + 4 * n].cast("i")
+        start += 4 * n
+        self._categories = view[start:start + 4 * n].cast("i")
+        start += 4 * n
+        self._offsets = view[start:start + 4 * (n + 1)].cast("I")
+        start += 4 * (n + 1)
+        self._slots = view[start:start + 4 * n_slots].cast("i")
+        start += 4 * n_slots
+        self._blob = view[start:start + blob_size]
+        self._mask = n_slots - 1
+        self._len = n
+        # entry index of the name, or EMPTY
+        self._memo: Dict[str, int] = {}
+
+    def __len__(self) -> int:
+        return self._len
+
+    def __contains__(self, name: str) -> bool:
+        return self.get(name) is not None
+
+    def _index(self, name: str) -> int:
+        found = self._memo.get(name)
+        if found is not None:
+            return found
+        key = name.encode()
+        h = zlib.crc32(key) & self._mask
+        while True:
+            found = self._slots[h]
+            if found == EMPTY or self._blob[self._offsets[found]:self._offsets[found + 1]] == key:
+                break
+            h = (h + 1) & self._mask
+        if len(self._memo) < MEMO_SIZE:
+            self._memo[name] = found
+        return found
+
+    def get(self, name: str) -> Optional[int]:
+        i = self._index(name)
+        return self._ids[i] if i != EMPTY else None
+
+    def entry(self, name: str) -> Optional[tuple[int, int]]:
+        """`(tag_id, category)` of a tag name"""
+        i = self._index(name)
+        return (self._ids[i], self._categories[i]) if i != EMPTY else None
+
+
+@lru_cache(maxsize=4)
+def open_tag_dict(path: str) -> TagDict:
+    """Open a dictionary once per process, used by the parser workers"""
+    return TagDict(path)
+
+
+def load_tag_dict(conn: Connection, cache_dir: str | Path) -> TagDict:
+    """Open the cached dictionary of `booru.tags`, building it if the table changed"""
+    cache_dir = Path(cache_dir)
+    path = cache_dir / f"tags-{fingerprint(conn)}.bin"
+    if path.exists():
+        logger.info("Using cached tag dictionary {}".format(path))
+        return TagDict(path)
+    logger.info("Building tag dictionary {}".format(path))
+    with conn.cursor(name="tag_dict") as c:
+        c.itersize = 100_000
+        c.execute("SELECT id, name, category FROM booru.tags")
+        write_tag_dict(path, c)
+    conn.commit()
+    for stale in cache_dir.glob("tags-*.bin"):
+        if stale != path:
+            stale.unlink()
+    return TagDict(path)
+
+
+class UnknownTags:
+    """
+    Applies the policy for tags of posts that are missing from `booru.tags`.
+
+    `skip` drops the association, `create` inserts the tag with a negative id
+    (so it never collides with an id of the dump) and `dead-letter` drops it
+    and appends `{"post_id", "tag"}` to a JSONL file. Every policy counts.
+    """
+
+    def __init__(self, policy: UnknownTagPolicy = "skip", dead_letter_file: str | Path = ""):
+        self.policy = policy
+        self.dead_letter_file = Path(dead_letter_file)
+        self.occurrences = 0
+        self.names: set[str] = set()
+        # tags created during this run, unknown to the dictionary file
+        self.created: Dict[str, int] = {}
+        self._next_id: Optional[int] = None
+
+    def resolve(self, conn: Connection, pairs: List[tuple[int, str]]) -> List[tuple[int, int]]:
+        """Apply the policy to (post_id, tag name) pairs, return the pairs to associate"""
+        pairs = [(post_id, tag) for post_id, tag in pairs if tag]
+        if not pairs:
+            return []
+        self.occurrences += len(pairs)
+        self.names.update(tag for _, tag in pairs)
+        if self.policy == "dead-letter":
+            with open(self.dead_letter_file, "a") as f:
+                for post_id, tag in pairs:
+                    f.write(json.dumps({"post_id": post_id, "tag": tag}) + "\n")
+        if self.policy != "create":
+            return []
+        new = sorted({tag for _, tag in pairs if tag not in self.created})
+        if new:
+            with conn.cursor() as c:
+                if self._next_id is None:
+                    c.execute("SELECT least(coalesce(min(id), 0), 0) - 1 FROM booru.tags")
+                    row = c.fetchone()
+                    assert row is not None
+                    self._next_id = row[0]
+                ids = list(range(self._next_id, self._next_id - len(new), -1))
+                c.executemany(
+                    "INSERT INTO booru.tags (id, name, category, is_deprecated) "
+                    "VALUES (%s, %s, 0, false)", list(zip(ids, new)))
+            self.created.update(zip(new, ids))
+            self._next_id -= len(new)
+        return [(post_id, self.created[tag]) for post_id, tag in pairs]
+
+    def log(self) -> None:
+        if not self.occurrences:
+            return
+        action = {
+            "skip": "skipped",
+            "create": "created",
+            "dead-letter": f"written to {self.dead_letter_file}",
+        }[self.policy]
+        logger.warning("{} unknown tags ({} occurrences) {}".format(len(self.names),
+                                                                    self.occurrences, action))
@@ -0,0 +1,96 @@
+from itertools import combinations
+from math import log
+from pathlib import Path
+import random
+import sys
+import pytest
+
+# the matrix lives with the explore scripts
+sys.path.append(str(Path(__file__).resolve().parent.parent / "explore"))
+from utils.cooccurrence import (Cooccurrence, CooccurrenceOptions, build_cooccurrence,
+                                chunk_tag_lists, count_posts_tags, frequent_tags, posts_tag_lists)
+
+MIN_POSTS = 5
+
+
+def random_posts(n: int, seed: int = 0) -> tuple[list[dict], dict[str, tuple[int, int]]]:
+    rng = random.Random(seed)
+    names = [f"tag_{i}" for i in range(40)]
+    # skewed, the last tags fall under MIN_POSTS
+    weights = [1 / (i + 1) for i in range(len(names))]
+    posts = []
+    for i in range(n):
+        tags = set(rng.choices(names, weights, k=rng.randrange(0, 12)))
+        posts.append({"id": i, "tag_string": " ".join(sorted(tags))})
+    return posts, {name: (1000 - 7 * i, 0) for i, name in enumerate(names)}
+
+
+@pytest.fixture(scope="module", params=[(1_000_000, 1000), (7, 13), (1, 1)])
+def matrix(request: pytest.FixtureRequest,
+           tmp_path_factory: pytest.TempPathFactory) -> tuple[Cooccurrence, list[set[str]]]:
+    # pairs held by the merge and posts per chunk, small values spill many runs and blocks
+    max_pairs, chunk_posts = request.param
+    posts, tags = random_posts(400)
+    counts, n_posts = count_posts_tags(posts, tags)
+    tag_ids, names, tag_counts = frequent_tags(
+        counts, {tag_id: name for name, (tag_id, _) in tags.items()}, MIN_POSTS)
+    index = {name: i for i, name in enumerate(names)}
+    options = CooccurrenceOptions(min_posts=MIN_POSTS, chunk_posts=chunk_posts, workers=2,
+                                  max_pairs=max_pairs, spill_dir=tmp_path_factory.mktemp("spill"))
+    output = tmp_path_factory.mktemp("cooccurrence")
+    build_cooccurrence(chunk_tag_lists(posts_tag_lists(posts, index), chunk_posts), tag_ids,
+                       names, tag_counts, n_posts, output, options)
+    assert not any(options.spill_dir.iterdir())
+    kept = set(names)
+    return Cooccurrence(output), [set(post["tag_string"].split()) & kept for post in posts]
+
+
+def brute_pairs(posts: list[set[str]]) -> dict[tuple[str, str], int]:
+    pairs: dict[tuple[str, str], int] = {}
+    for tags in posts:
+        for a, b in combinations(sorted(tags), 2):
+            pairs[a, b] = pairs.get((a, b), 0) + 1
+            pairs[b, a] = pairs.get((b, a), 0) + 1
+    return pairs
+
+
+def test_counts(matrix: tuple[Cooccurrence, list[set[str]]]):
+    m, posts = matrix
+    pairs = brute_pairs(posts)
+    names = sorted({tag for tags in posts for tag in tags})
+    assert m.names == sorted(names, key=lambda name: m.tag_ids[m.node(name)])
+    assert m.meta["pairs"] == len(pairs) // 2
+    for name in names:
+        assert m.tag_counts[m.node(name)] == sum(name in tags for tags in posts)
+        assert m.node(int(m.tag_ids[m.node(name)])) == m.node(name)
+    for a in names:
+        for b in names:
+            assert m.count(a, b) == pairs.get((a, b), 0)
+    # every row is sorted and holds no empty pair
+    for i in range(len(names)):
+        row = m.indices[m.indptr[i]:m.indptr[i + 1]]
+        assert list(row) == sorted(row) and i not in row
+    assert 0 not in m.values
+
+
+@pytest.mark.parametrize("by", ["count", "pmi", "jaccard"])
+def test_related(matrix: tuple[Cooccurrence, list[set[str]]], by: str):
+    m, posts = matrix
+    pairs = brute_pairs(posts)
+    n = len(posts)
+    posts_of = {name: sum(name in tags for tags in posts) for name in m.names}
+    for a in m.names[:5]:
+        scores = {}
+        for b in m.names:
+            both = pairs.get((a, b), 0)
+            if both < 2:
+                continue
+            scores[b] = (both if by == "count" else log(both * n / (posts_of[a] * posts_of[b]))
+                         if by == "pmi" else both / (posts_of[a] + posts_of[b] - both))
+        related = m.related(a, k=5, by=by, min_count=2)    # type: ignore[arg-type]
+        assert len(related) == min(5, len(scores))
+        best = sorted(scores.values(), reverse=True)[:5]
+        assert [r.score for r in related] == pytest.approx(best)
+        for r in related:
+            assert r.count == pairs[a, r.name]
+            assert r.score == pytest.approx(scores[r.name])
@@ -0,0 +1,105 @@
+from pathlib import Path
+import random
+import struct
+import pytest
+import zstandard
+from raw_files import (READ_SIZE, FramedZstdWriter, decompress_frames, open_raw, write_raw,
+                       zstd_frames)
+
+
+def dump_lines(n: int, seed: int = 0) -> bytes:
+    rng = random.Random(seed)
+    return b"".join(b'{"id": %d, "tag_string": "%s"}\n' %
+                    (i, " ".join(f"tag_{rng.randrange(500)}" for _ in range(rng.randrange(1, 30))
+                                 ).encode()) for i in range(n))
+
+
+def skippable(payload: bytes, nibble: int = 0) -> bytes:
+    return struct.pack("<II", 0x184D2A50 | nibble, len(payload)) + payload
+
+
+def frames_file(path: Path, parts: list[bytes]) -> tuple[bytes, list[tuple[int, int]]]:
+    """
+    A zstd file of one frame per part, with skippable frames in between.
+
+    The frames mix checksums, content sizes, raw, RLE and compressed blocks.
+    Returns the data and the `(offset, length)` of every frame.
+    """
+    out = bytearray(skippable(b"leading"))
+    frames = []
+    for i, part in enumerate(parts):
+        c = zstandard.ZstdCompressor(level=1 + i % 3, write_checksum=i % 2 == 0,
+                                     write_content_size=i % 3 != 0)
+        frame = c.compress(part)
+        frames.append((len(out), len(frame)))
+        out += frame
+        out += skippable(bytes(i), i % 16)
+    path.write_bytes(out)
+    return b"".join(parts), frames
+
+
+@pytest.fixture
+def parts() -> list[bytes]:
+    data = dump_lines(20_000)
+    rng = random.Random(1)
+    return [
+        data[:300_000],
+        # a run of one byte is an RLE block
+        b"a" * 400_000,
+        # random bytes do not compress, raw blocks
+        rng.randbytes(200_000),
+        b"",
+        data[300_000:],
+        b"\n",
+    ]
+
+
+def test_zstd_frames(tmp_path: Path, parts: list[bytes]):
+    path = tmp_path / "posts.json.zst"
+    _, frames = frames_file(path, parts)
+    with open(path, "rb") as f:
+        assert list(zstd_frames(f)) == frames
+
+
+@pytest.mark.parametrize("workers", [1, 4])
+def test_zstd_frames_round_trip(tmp_path: Path, parts: list[bytes], workers: int):
+    path = tmp_path / "posts.json.zst"
+    data, _ = frames_file(path, parts)
+    with open_raw(path, workers=workers) as f:
+        assert f.read() == data
+
+
+@pytest.mark.parametrize("read_size", [1, 100_000, READ_SIZE])
+def test_decompress_frames(tmp_path: Path, parts: list[bytes], read_size: int):
+    path = tmp_path / "posts.json.zst"
+    data, frames = frames_file(path, parts)
+    with open(path, "rb") as f:
+        chunks = list(decompress_frames(f, frames, 3, read_size))
+    assert b"".join(out for out, _ in chunks) == data
+    positions = [position for _, position in chunks]
+    assert positions == sorted(positions)
+    assert positions[-1] == frames[-1][0] + frames[-1][1]
+
+
+@pytest.mark.parametrize("suffix", [".gz", ".xz", ".zst"])
+def test_read_at_offset(tmp_path: Path, suffix: str):
+    data = dump_lines(40_000)
+    path = tmp_path / f"posts.json{suffix}"
+    with write_raw(path, 1) as f:
+        f.write(data)
+    # skipped in one read, and across reads of `READ_SIZE`
+    for offset in (12_345, READ_SIZE + 7, len(data) - 1):
+        with open_raw(path, offset) as f:
+            assert f.read() == data[offset:]
+
+
+def test_framed_writer(tmp_path: Path):
+    data = dump_lines(20_000)
+    path = tmp_path / "posts.json.zst"
+    with FramedZstdWriter(path, frame_size=100_000) as f:
+        for start in range(0, len(data), 30_000):
+            f.write(data[start:start + 30_000])
+    with open(path, "rb") as f:
+        assert len(list(zstd_frames(f))) > 1
+    with open_raw(path, workers=4) as f:
+        assert f.read() == data
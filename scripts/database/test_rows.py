@@ -0,0 +1,18 @@
+from datetime import datetime
+import pytest
+from models.rows import parse_iso8601
+
+
+@pytest.mark.parametrize("s", [
+    "2023-11-30T12:34:56.789-05:00",
+    "2023-11-30T12:34:56.789+00:00",
+    "2023-11-30T12:34:56.789Z",
+    "2023-11-30T12:34:56.789123-05:00",
+    "2023-11-30T12:34:56.789123+00:00",
+    "2023-11-30T12:34:56.78-05:00",
+    "2023-11-30T12:34:56-05:00",
+    "2023-11-30T12:34:56.789",
+])
+def test_parse_iso8601(s: str):
+    assert parse_iso8601(s) == datetime.fromisoformat(s)
+    assert parse_iso8601(s).utcoffset() == datetime.fromisoformat(s).utcoffset()
@@ -0,0 +1,34 @@
+from pathlib import Path
+import random
+import pytest
+from tag_dict import TagDict, write_tag_dict
+
+
+def random_tags(n: int, seed: int = 0) -> dict[str, tuple[int, int]]:
+    rng = random.Random(seed)
+    alphabet = "abcdefghij_()'!:é東方"
+    tags: dict[str, tuple[int, int]] = {}
+    while len(tags) < n:
+        name = "".join(rng.choice(alphabet) for _ in range(rng.randrange(1, 12)))
+        tags[name] = (rng.randrange(1, 10_000_000), rng.choice((0, 1, 3, 4, 5)))
+    return tags
+
+
+@pytest.mark.parametrize("n", [0, 1, 7, 1000])
+def test_tag_dict(tmp_path: Path, n: int):
+    tags = random_tags(n)
+    path = tmp_path / "tags.dict"
+    write_tag_dict(path, ((i, name, category) for name, (i, category) in tags.items()))
+    d = TagDict(path)
+    assert len(d) == n
+    missing = [name + "~" for name in list(tags)[:50]] + ["", "~", "a" * 100]
+    # twice, the second pass is answered by the memo
+    for _ in range(2):
+        for name, (i, category) in tags.items():
+            assert name in d
+            assert d.get(name) == i
+            assert d.entry(name) == (i, category)
+        for name in missing:
+            assert name not in d
+            assert d.get(name) is None
+            assert d.entry(name) is None
@@ -0,0 +1,105 @@
+from fnmatch import fnmatchcase
+from pathlib import Path
+from typing import Callable
+import random
+import sys
+import pytest
+
+# the index lives with the explore scripts
+sys.path.append(str(Path(__file__).resolve().parent.parent / "explore"))
+from utils.tag_index import CATEGORIES, TagIndex, TagInfo, build_from_posts, write_tag_index
+
+NAMES = [
+    "1girl", "solo", "long_hair", "long_sleeves", "short_hair", "smile", "saber_(fate)",
+    "fate_(series)", "hatsune_miku", "vocaloid", "pantyhose", "black_pantyhose", "comic",
+    "translated", "artist_a", "artist_b", "highres", "absurdres"
+]
+CATEGORY = {
+    "saber_(fate)": 4, "hatsune_miku": 4, "fate_(series)": 3, "vocaloid": 3, "artist_a": 1,
+    "artist_b": 1, "comic": 5, "translated": 5, "highres": 5, "absurdres": 5
+}
+TAGS = {name: (100 + i, CATEGORY.get(name, 0)) for i, name in enumerate(NAMES)}
+
+
+def random_posts(n: int, seed: int = 0) -> list[dict]:
+    rng = random.Random(seed)
+    # ids with gaps, and a few tags unknown to the index
+    return [{
+        "id": 3 * i + rng.randrange(3),
+        "tag_string": " ".join(rng.sample(NAMES + ["unknown_tag"], rng.randrange(1, 8))),
+    } for i in range(n)]
+
+
+@pytest.fixture(scope="module")
+def index(tmp_path_factory: pytest.TempPathFactory) -> tuple[TagIndex, list[dict]]:
+    posts = random_posts(300)
+    bitmaps, universe = build_from_posts(posts, TAGS)
+    path = tmp_path_factory.mktemp("index") / "tags.idx"
+    write_tag_index(path, [TagInfo(i, name, category) for name, (i, category) in TAGS.items()],
+                    bitmaps, universe)
+    return TagIndex(path), posts
+
+
+def brute_term(posts: list[dict], pattern: str) -> set[int]:
+    category = None
+    prefix, sep, rest = pattern.partition(":")
+    if sep and prefix in CATEGORIES:
+        category, pattern = CATEGORIES[prefix], rest
+    return {
+        post["id"]
+        for post in posts
+        for tag in post["tag_string"].split(" ")
+        if tag in TAGS and fnmatchcase(tag, pattern) and category in (None, TAGS[tag][1])
+    }
+
+
+Term = Callable[[str], set[int]]
+
+
+@pytest.mark.parametrize("expression,expected", [
+    ("solo", lambda t, u: t("solo")),
+    ("solo smile", lambda t, u: t("solo") & t("smile")),
+    ("solo and smile", lambda t, u: t("solo") & t("smile")),
+    ("solo or smile", lambda t, u: t("solo") | t("smile")),
+    ("solo smile or comic", lambda t, u: t("solo") & t("smile") | t("comic")),
+    ("solo (smile or comic)", lambda t, u: t("solo") & (t("smile") | t("comic"))),
+    ("-solo", lambda t, u: u - t("solo")),
+    ("not solo", lambda t, u: u - t("solo")),
+    ("1girl -solo -smile", lambda t, u: t("1girl") - t("solo") - t("smile")),
+    ("not (solo or smile)", lambda t, u: u - (t("solo") | t("smile"))),
+    ("-(solo smile)", lambda t, u: u - (t("solo") & t("smile"))),
+    ("((-solo) or comic) - smile", lambda t, u: ((u - t("solo")) | t("comic")) - t("smile")),
+    ("saber_(fate) fate_(series)", lambda t, u: t("saber_(fate)") & t("fate_(series)")),
+    ("(saber_(fate) or vocaloid)", lambda t, u: t("saber_(fate)") | t("vocaloid")),
+    ("long_*", lambda t, u: t("long_*")),
+    ("*_hair -long_*", lambda t, u: t("*_hair") - t("long_*")),
+    ("*pantyhose", lambda t, u: t("*pantyhose")),
+    ("?girl", lambda t, u: t("?girl")),
+    ("*", lambda t, u: t("*")),
+    ("character:*", lambda t, u: t("character:*")),
+    ("meta:*res -artist:*", lambda t, u: t("meta:*res") - t("artist:*")),
+    ("general:comic", lambda t, u: set()),
+    ("missing_tag", lambda t, u: set()),
+    ("missing_* or solo", lambda t, u: t("solo")),
+])
+def test_query(index: tuple[TagIndex, list[dict]], expression: str,
+               expected: Callable[[Term, set[int]], set[int]]):
+    tag_index, posts = index
+    universe = {post["id"] for post in posts}
+    result = expected(lambda pattern: brute_term(posts, pattern), universe)
+    assert set(tag_index.query(expression)) == result
+    assert tag_index.post_ids(expression).tolist() == sorted(result)
+
+
+def test_find(index: tuple[TagIndex, list[dict]]):
+    tag_index, _ = index
+    for pattern in ("long_*", "*_(*)", "?o*", "character:*", "comic", "*"):
+        assert sorted(tag_index.tag_ids(pattern)) == sorted(
+            i for name, (i, category) in TAGS.items() if fnmatchcase(name, pattern.split(":")[-1])
+            and (":" not in pattern or category == CATEGORIES[pattern.split(":")[0]]))
+
+
+@pytest.mark.parametrize("expression", ["", "(solo", "solo)", "solo or", "-"])
+def test_invalid(index: tuple[TagIndex, list[dict]], expression: str):
+    with pytest.raises(ValueError):
+        index[0].query(expression)
@@ -0,0 +1,213 @@
+"""
+Streaming conversion of the raw JSONL dumps into Parquet.
+
+The Arrow schema of each file is derived from its `*Raw` TypedDict:
+timestamps (`*_at` fields) become `timestamp[ms, UTC]` and the space-joined
+`tag_string*` fields of posts become `list<int32>` of tag ids.
+"""
+from typing import (Dict, Optional, List, Any, Callable, Literal, Union, get_args, get_origin,
+                    get_type_hints, is_typeddict)
+from types import NoneType, UnionType
+from pathlib import Path
+from loguru import logger
+import pyarrow as pa
+import pyarrow.parquet as pq
+from models.posts import PostRaw
+from models.tags import TagRaw
+from models.tag_alias import TagAliasRaw
+from models.artists import ArtistRaw
+from models.artist_urls import ArtistUrlsRaw
+from models.rows import parse_datetime
+
+Compression = Literal["none", "snappy", "gzip", "brotli", "lz4", "zstd"]
+COMPRESSIONS: tuple[Compression, ...] = ("none", "snappy", "gzip", "brotli", "lz4", "zstd")
+
+# entry in `RawDataFileNameConfig` -> TypedDict of its objects
+RAW_TYPES: Dict[str, type] = {
+    "posts": PostRaw,
+    "tags": TagRaw,
+    "artists": ArtistRaw,
+    "artist_urls": ArtistUrlsRaw,
+    "tag_aliases": TagAliasRaw,
+    "tag_implications": TagAliasRaw,
+}
+
+TIMESTAMP = pa.timestamp("ms", tz="UTC")
+TAG_IDS = pa.list_(pa.int32())
+
+Converter = Callable[[Any], Any]
+
+
+def is_timestamp_field(name: str) -> bool:
+    return name.endswith("_at")
+
+
+def is_tag_string_field(name: str) -> bool:
+    return name.startswith("tag_string")
+
+
+def arrow_type(name: str, annotation: Any) -> pa.DataType:
+    """Map a TypedDict field to an Arrow type"""
+    origin = get_origin(annotation)
+    if origin in (Union, UnionType):
+        args = [arg for arg in get_args(annotation) if arg is not NoneType]
+        return arrow_type(name, args[0])
+    if annotation is str and is_timestamp_field(name):
+        return TIMESTAMP
+    if annotation is str and is_tag_string_field(name):
+        return TAG_IDS
+    if origin in (list, List):
+        return pa.list_(arrow_type(name, get_args(annotation)[0]))
+    if is_typeddict(annotation):
+        return pa.struct(arrow_schema(annotation))
+    if annotation is bool:
+        return pa.bool_()
+    if annotation is int:
+        return pa.int64()
+    if annotation is float:
+        return pa.float64()
+    if annotation is str:
+        return pa.string()
+    raise TypeError(f"no arrow type for {name}: {annotation}")
+
+
+def arrow_schema(raw_type: type) -> pa.Schema:
+    """Derive an Arrow schema from a `*Raw` TypedDict"""
+    hints = get_type_hints(raw_type)
+    return pa.schema([pa.field(name, arrow_type(name, t)) for name, t in hints.items()])
+
+
+def make_converter(schema: pa.Schema | pa.StructType,
+                   tags_table: Optional[Dict[str, int]],
+                   unknown: Dict[str, int]) -> Converter:
+    """
+    Build a function converting a raw object to a dict matching `schema`.
+
+    Only timestamps, tag strings and nested structs are touched, everything
+    else is handed to Arrow as-is. Unknown tags are dropped and counted in `unknown`.
+    """
+    converters: Dict[str, Converter] = {}
+
+    def tag_ids(s: Optional[str]) -> Optional[List[int]]:
+        if s is None:
+            return None
+        assert tags_table is not None
+        ids = []
+        for tag in s.split(" "):
+            if not tag:
+                continue
+            tag_id = tags_table.get(tag)
+            if tag_id is None:
+                unknown[tag] = unknown.get(tag, 0) + 1
+            else:
+                ids.append(tag_id)
+        return ids
+
+    for field in schema:
+        t = field.type
+        if t == TIMESTAMP:
+            converters[field.name] = parse_datetime
+        elif t == TAG_IDS and tags_table is not None:
+            converters[field.name] = tag_ids
+        elif pa.types.is_struct(t):
+            inner = make_converter(t, tags_table, unknown)
+            converters[field.name] = lambda v, f=inner: None if v is None else f(v)
+        elif pa.types.is_list(t) and pa.types.is_struct(t.value_type):
+            inner = make_converter(t.value_type, tags_table, unknown)
+            converters[field.name] = lambda v, f=inner: None if v is None else [f(x) for x in v]
+    names = [field.name for field in schema]
+
+    def convert(obj: Dict[str, Any]) -> Dict[str, Any]:
+        out = {}
+        for name in names:
+            v = obj.get(name)
+            fn = converters.get(name)
+            out[name] = v if fn is None else fn(v)
+        return out
+
+    return convert
+
+
+class BufferedWriter:
+    """Parquet writer flushing one row group every `row_group_size` rows"""
+
+    def __init__(self, path: Path, schema: pa.Schema, row_group_size: int,
+                 compression: Compression):
+        path.parent.mkdir(parents=True, exist_ok=True)
+        self.schema = schema
+        self.row_group_size = row_group_size
+        self.writer = pq.ParquetWriter(path, schema, compression=compression)
+        self.buffer: List[Dict[str, Any]] = []
+        self.rows = 0
+
+    def write(self, row: Dict[str, Any]) -> None:
+        self.buffer.append(row)
+        if len(self.buffer) >= self.row_group_size:
+            self.flush()
+
+    def flush(self) -> None:
+        if not self.buffer:
+            return
+        table = pa.Table.from_pylist(self.buffer, schema=self.schema)
+        self.writer.write_table(table, row_group_size=self.row_group_size)
+        self.rows += len(self.buffer)
+        self.buffer.clear()
+
+    def close(self) -> None:
+        self.flush()
+        self.writer.close()
+
+
+def read_tags_table(tags_file: Path, read_objs: Callable[[Path], Any]) -> Dict[str, int]:
+    """Build the tag name -> tag id table from the raw tags dump"""
+    return {tag["name"]: tag["id"] for tag in read_objs(tags_file)}
+
+
+def convert_file(objs: Any,
+                 entry: str,
+                 output_dir: Path,
+                 row_group_size: int = 100_000,
+                 compression: Compression = "zstd",
+                 tags_table: Optional[Dict[str, int]] = None,
+                 on_row: Callable[[], None] = lambda: None) -> int:
+    """
+    Stream raw objects of `entry` into Parquet, return the number of rows written.
+
+    Posts go to `posts/year=YYYY/part-0.parquet`, partitioned by `created_at`,
+    every other entry to `<entry>.parquet`. At most two row groups worth of rows
+    are buffered across all open files.
+    """
+    schema = arrow_schema(RAW_TYPES[entry])
+    unknown: Dict[str, int] = {}
+    convert = make_converter(schema, tags_table if entry == "posts" else None, unknown)
+    writers: Dict[Optional[int], BufferedWriter] = {}
+
+    def writer_for(row: Dict[str, Any]) -> BufferedWriter:
+        key: Optional[int] = None
+        if entry == "posts":
+            created_at = row.get("created_at")
+            key = created_at.year if created_at is not None else None
+        if key not in writers:
+            if entry == "posts":
+                part = f"year={key if key is not None else '__HIVE_DEFAULT_PARTITION__'}"
+                path = output_dir / "posts" / part / "part-0.parquet"
+            else:
+                path = output_dir / f"{entry}.parquet"
+            writers[key] = BufferedWriter(path, schema, row_group_size, compression)
+        return writers[key]
+
+    try:
+        for obj in objs:
+            row = convert(obj)
+            writer_for(row).write(row)
+            # keep the rows buffered across all partitions bounded
+            if sum(len(w.buffer) for w in writers.values()) > 2 * row_group_size:
+                max(writers.values(), key=lambda w: len(w.buffer)).flush()
+            on_row()
+    finally:
+        for w in writers.values():
+            w.close()
+    if unknown:
+        logger.warning("Dropped {} unknown tags ({} occurrences) from {}".format(
+            len(unknown), sum(unknown.values()), entry))
+    return sum(w.rows for w in writers.values())
@@ -0,0 +1,318 @@
+"""
+Concurrent per-table writers on a connection pool.
+
+Every table gets a thread and a pooled connection of its own, so independent
+tables are written concurrently. A table with a parent only writes the rows of
+a batch once the parent has committed that batch, which keeps foreign keys
+satisfied without one shared transaction. Each writer commits every
+`rows_per_transaction` rows, or earlier when it runs out of input.
+
+Into partitioned post tables (`partitions.py`) the writers are
+`PartitionWriter`s instead, each writes every table of its own partitions.
+"""
+from typing import Dict, Optional, List, Sequence, Callable, Any, Type
+from collections import defaultdict
+from loguru import logger
+from psycopg.pq import TransactionStatus
+from psycopg_pool import ConnectionPool
+from pydantic import BaseModel
+import queue
+import threading
+from pathlib import Path
+from psycopg import Connection
+from instrument import stage
+from loader import LoadOptions, ASSOC_TYPES, write_rows
+from parallel import (POST_COLUMNS, POST_TYPES, VARIANT_COLUMNS, VARIANT_TYPES, FILE_COLUMNS,
+                      FILE_TYPES, ByteRange, PostRows, resolve_tags, split_chunks, transform_ranges,
+                      write_post_tables)
+from partitions import CommittedPrefix, Partition, interleave_chunks, route_rows
+from tag_dict import TagDict, UnknownTags
+
+
+class TableSpec(BaseModel):
+    columns: List[str]
+    types: List[str]
+    # table whose rows must be committed first
+    parent: Optional[str] = None
+    # column of the rows deleted before a batch is written, unless conflicts are errors
+    replace_by: Optional[str] = None
+
+
+class TableWriter(threading.Thread):
+    """Writes the batches of one table on its own pooled connection"""
+
+    def __init__(self, owner: "PooledWriter", table_name: str, spec: TableSpec):
+        super().__init__(name=f"writer-{table_name}", daemon=True)
+        self.owner = owner
+        self.table_name = table_name
+        self.spec = spec
+        self.batches: queue.Queue[Optional[tuple[int, List[Any], List[int]]]] = queue.Queue(
+            maxsize=owner.queue_depth)
+        # last batch whose rows are committed
+        self.committed = -1
+        self.rows = 0
+        # set while a child waits for this writer to commit
+        self.waited_on = False
+        self.error: Optional[BaseException] = None
+
+    def run(self) -> None:
+        try:
+            with self.owner.pool.connection() as conn:
+                self.write_all(conn)
+        except BaseException as e:
+            self.error = e
+            self.owner.fail()
+
+    def write_all(self, conn: Any) -> None:
+        parent = self.owner.writers[self.spec.parent] if self.spec.parent else None
+        pending, last = 0, -1
+        while True:
+            try:
+                idle = conn.info.transaction_status == TransactionStatus.IDLE
+                item = self.batches.get(timeout=None if idle else 0.1)
+            except queue.Empty:
+                # out of input while a child waits for rows that are not committed yet
+                if self.waited_on:
+                    self.commit(conn, last)
+                    pending = 0
+                continue
+            if item is None:
+                self.commit(conn, last)
+                return
+            seq, rows, replace = item
+            if parent is not None:
+                self.owner.wait_committed(parent, seq)
+            written = self.write(conn, rows, replace)
+            pending += written
+            self.rows += written
+            last = seq
+            if conn.info.transaction_status == TransactionStatus.IDLE:
+                # nothing written since the last commit, the batch is as good as committed
+                self.owner.mark_committed(self, seq)
+            elif pending >= self.owner.rows_per_transaction:
+                self.commit(conn, last)
+                pending = 0
+
+    def write(self, conn: Any, rows: List[tuple], replace: List[int]) -> int:
+        """Write the rows of a batch, return the rows written"""
+        opts = self.owner.opts
+        if replace and self.spec.replace_by and opts.conflict != "error":
+            conn.execute(    # type: ignore
+                f"DELETE FROM {self.table_name} WHERE {self.spec.replace_by} = ANY(%s)",
+                (replace,))
+        return write_rows(conn, self.table_name, self.spec.columns, self.spec.types, rows,
+                          opts.method, opts.conflict)
+
+    def commit(self, conn: Any, seq: int) -> None:
+        with stage(self.table_name, "commit"):
+            conn.commit()
+        self.waited_on = False
+        self.owner.mark_committed(self, seq)
+
+
+class PartitionWriter(TableWriter):
+    """Writes the rows of a group of partitions into every post table, posts first"""
+
+    def write(self, conn: Any, rows: List[PostRows],    # type: ignore[override]
+              replace: List[int]) -> int:
+        for part in rows:
+            write_post_tables(conn, part, self.owner.opts)
+        return sum(len(part.posts) for part in rows)
+
+
+class PooledWriter:
+    """
+    Fan batches out to one `TableWriter` per table.
+
+    `on_committed(seq)` is called once every table has committed batch `seq`
+    and all batches before it, e.g. to save a checkpoint.
+    """
+
+    def __init__(self,
+                 pool: ConnectionPool,
+                 tables: Dict[str, TableSpec],
+                 opts: LoadOptions = LoadOptions(),
+                 rows_per_transaction: int = 50_000,
+                 queue_depth: int = 4,
+                 on_committed: Callable[[int], None] = lambda _: None,
+                 writer_class: Type[TableWriter] = TableWriter):
+        self.pool = pool
+        self.opts = opts
+        self.rows_per_transaction = rows_per_transaction
+        self.queue_depth = queue_depth
+        self.on_committed = on_committed
+        if pool.max_size < len(tables):
+            # a writer waiting for a connection would block the others forever
+            raise ValueError(f"pool of {pool.max_size} connections for {len(tables)} tables")
+        self.condition = threading.Condition()
+        self.failed = False
+        self.seq = 0
+        self.durable = -1
+        self.writers = {name: writer_class(self, name, spec) for name, spec in tables.items()}
+        for writer in self.writers.values():
+            writer.start()
+
+    def submit(self,
+               tables: Dict[str, Sequence[Any]],
+               replace: Optional[Dict[str, List[int]]] = None) -> int:
+        """Queue the rows of a batch for each table, return the sequence number of the batch"""
+        seq = self.seq
+        self.seq += 1
+        for name, writer in self.writers.items():
+            item = (seq, list(tables.get(name, [])), (replace or {}).get(name, []))
+            while True:
+                self.raise_error()
+                try:
+                    writer.batches.put(item, timeout=1)
+                    break
+                except queue.Full:
+                    continue
+        return seq
+
+    def close(self) -> Dict[str, int]:
+        """Flush every writer and wait for them, return the rows written per table"""
+        for writer in self.writers.values():
+            while writer.is_alive():
+                try:
+                    writer.batches.put(None, timeout=1)
+                    break
+                except queue.Full:
+                    continue
+        for writer in self.writers.values():
+            writer.join()
+        self.raise_error()
+        return {name: writer.rows for name, writer in self.writers.items()}
+
+    def fail(self) -> None:
+        with self.condition:
+            self.failed = True
+            self.condition.notify_all()
+
+    def raise_error(self) -> None:
+        for writer in self.writers.values():
+            if writer.error is not None:
+                raise RuntimeError(f"{writer.table_name} writer failed") from writer.error
+
+    def wait_committed(self, writer: TableWriter, seq: int) -> None:
+        with self.condition:
+            while writer.committed < seq:
+                if self.failed:
+                    raise RuntimeError(f"{writer.table_name} writer failed")
+                writer.waited_on = True
+                self.condition.wait()
+
+    def mark_committed(self, writer: TableWriter, seq: int) -> None:
+        with self.condition:
+            writer.committed = max(writer.committed, seq)
+            self.condition.notify_all()
+            durable = min(w.committed for w in self.writers.values())
+            if durable > self.durable:
+                self.durable = durable
+                logger.debug("Batches up to {} committed".format(durable))
+                self.on_committed(durable)
+
+
+POST_TABLES: Dict[str, TableSpec] = {
+    "booru.posts":
+        TableSpec(columns=POST_COLUMNS, types=POST_TYPES),
+    "booru.posts_media_variants":
+        TableSpec(columns=VARIANT_COLUMNS,
+                  types=VARIANT_TYPES,
+                  parent="booru.posts",
+                  replace_by="post_id"),
+    "booru.posts_file_urls":
+        TableSpec(columns=FILE_COLUMNS, types=FILE_TYPES, parent="booru.posts"),
+    "booru.posts_tags_assoc":
+        TableSpec(columns=[name for name, _ in ASSOC_TYPES["booru.posts_tags_assoc"]],
+                  types=[t for _, t in ASSOC_TYPES["booru.posts_tags_assoc"]],
+                  parent="booru.posts"),
+    "booru.posts_tag_arrays":
+        TableSpec(columns=[name for name, _ in ASSOC_TYPES["booru.posts_tag_arrays"]],
+                  types=[t for _, t in ASSOC_TYPES["booru.posts_tag_arrays"]],
+                  parent="booru.posts"),
+}
+
+
+def process_posts_pooled(pool: ConnectionPool,
+                         conn: Connection,
+                         path: str | Path,
+                         tags: TagDict,
+                         unknown: UnknownTags,
+                         chunk_size: int,
+                         opts: LoadOptions = LoadOptions(),
+                         workers: int = 0,
+                         rows_per_transaction: int = 50_000,
+                         start: int = 0,
+                         on_written: Callable[[PostRows], None] = lambda _: None,
+                         partitions: Optional[List[Partition]] = None) -> int:
+    """
+    Load `posts.json` from `start` with one pooled writer per post table.
+
+    Unknown tags are handled and committed on `conn` before a range is queued.
+    `on_written` is called in file order once a range is committed in every table.
+
+    With the `partitions` of the post tables, the rows of a range are routed to
+    one `PartitionWriter` per pooled connection instead, partition `i` to writer
+    `i % pool size`, and the ranges are taken from the partitions in turn. The
+    end of the byte range given to `on_written` is then the end of the ranges
+    all committed.
+    """
+    chunks = split_chunks(path, chunk_size, start)
+    queued: Dict[int, PostRows] = {}
+    lock = threading.Lock()
+    prefix = CommittedPrefix(start)
+
+    def on_committed(seq: int) -> None:
+        with lock:
+            done = sorted(s for s in queued if s <= seq)
+            written = [queued.pop(s) for s in done]
+        for rows in written:
+            if partitions is not None:
+                end = prefix.add(rows.byte_range)
+                if end != rows.byte_range.end:
+                    rows = rows._replace(byte_range=ByteRange(rows.byte_range.start, end))
+            on_written(rows)
+
+    if partitions is None:
+        tables = {
+            name: spec
+            for name, spec in POST_TABLES.items()
+            if opts.tag_arrays or name != "booru.posts_tag_arrays"
+        }
+        writer = PooledWriter(pool, tables, opts, rows_per_transaction, on_committed=on_committed)
+    else:
+        groups = [f"partitions[{i}]" for i in range(min(pool.max_size, len(partitions)))]
+        specs = {name: TableSpec(columns=[], types=[]) for name in groups}
+        writer = PooledWriter(pool,
+                              specs,
+                              opts,
+                              rows_per_transaction,
+                              on_committed=on_committed,
+                              writer_class=PartitionWriter)
+        chunks = interleave_chunks(path, chunks, partitions)
+    count = 0
+    try:
+        for rows in transform_ranges(path, chunks, workers, opts.validate_rows, str(tags.path)):
+            rows = resolve_tags(conn, rows, unknown)
+            conn.commit()
+            with lock:
+                queued[writer.seq] = rows
+            if partitions is None:
+                writer.submit(
+                    {
+                        "booru.posts": rows.posts,
+                        "booru.posts_media_variants": rows.variants,
+                        "booru.posts_file_urls": rows.files,
+                        "booru.posts_tags_assoc": rows.tag_ids,
+                        "booru.posts_tag_arrays": rows.tag_arrays,
+                    },
+                    replace={"booru.posts_media_variants": [row[0] for row in rows.posts]})
+            else:
+                routed: Dict[str, List[PostRows]] = defaultdict(list)
+                for i, part in sorted(route_rows(rows, partitions).items()):
+                    routed[groups[i % len(groups)]].append(part)
+                writer.submit(routed)
+            count += len(rows.posts)
+    finally:
+        writer.close()
+    return count
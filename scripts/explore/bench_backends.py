@@ -0,0 +1,100 @@
+"""
+Benchmark of the query backends, the loaded Postgres database against DuckDB over Parquet.
+
+Runs the queries of the core views of `explore.sql` and `playground.sql` on
+both backends of `utils.backends`, `--repeat` times after a warm-up run, and
+compares the best times and the number of rows. The database needs the objects
+of both files, the Parquet directory is the output of `dump_data.py to-parquet`
+of the same dump. Opening the DuckDB backend, which computes the relations the
+database keeps in tables, is timed apart.
+
+    python bench_backends.py --parquet ../database/parquet -r 5
+    python bench_backends.py --threads 4 -q posts_tag_view_top -q artist_post_counts
+"""
+from typing import Dict, Optional, List
+from pathlib import Path
+import asyncio
+import time
+import click
+import tomli
+from utils.backends import DuckDBBackend, PostgresBackend, QueryBackend
+from utils.db import Config, postgres_env_password, to_kv_str
+
+QUERIES: Dict[str, str] = {
+    "artist_view": "SELECT * FROM booru.artist_view",
+    "posts_tag_view_top": "SELECT * FROM booru.posts_tag_view ORDER BY score DESC LIMIT 100",
+    "posts_tag_view_post": "SELECT * FROM booru.posts_tag_view WHERE post_id = 1",
+    "aspect_ratio_buckets": "SELECT aspect_ratio_bucket, count(*) "
+                            "FROM booru.view_post_aspect_ratio GROUP BY aspect_ratio_bucket",
+    "modern_posts": "SELECT count(*) FROM booru.view_modern_posts",
+    "illustration_only": "SELECT count(*), avg(score) FROM booru.view_posts_illustration_only",
+    "modern_illustration_only": "SELECT * FROM booru.view_modern_posts_illustration_only",
+    "illustration_tag_counts": "SELECT t.name, c.post_count "
+                               "FROM booru.view_posts_count_illustration_only c "
+                               "JOIN booru.tags t ON t.id = c.tag_id "
+                               "ORDER BY c.post_count DESC LIMIT 100",
+    "artist_post_counts": "SELECT * FROM booru.view_artist_illustration_only_100",
+    "artists_with_n_posts": "SELECT * FROM booru.artists_with_n_posts",
+}
+
+
+async def measure(backend: QueryBackend, sql: str, repeat: int) -> tuple[float, int]:
+    """Best time of `repeat` runs after a warm-up one, and the rows of the result"""
+    rows = len(await backend.get_df(sql))
+    best = float("inf")
+    for _ in range(repeat):
+        start = time.perf_counter()
+        await backend.get_df(sql)
+        best = min(best, time.perf_counter() - start)
+    return best, rows
+
+
+@click.command()
+@click.option("--config",
+              "-c",
+              default="../database/config.toml",
+              help="Path to config file",
+              type=click.Path(exists=True))
+@click.option("--parquet",
+              default="../database/parquet",
+              help="Output directory of `dump_data.py to-parquet`",
+              type=click.Path(exists=True, file_okay=False))
+@click.option("--threads", default=None, help="Threads of DuckDB, all cores if not given", type=int)
+@click.option("--no-materialize",
+              is_flag=True,
+              default=False,
+              help="Compute the derived relations of DuckDB on every query")
+@click.option("--query",
+              "-q",
+              "queries",
+              multiple=True,
+              help="Run only these queries",
+              type=click.Choice(list(QUERIES)))
+@click.option("--repeat", "-r", default=3, help="Number of runs, the best one is kept", type=int)
+def main(config: str, parquet: str, threads: Optional[int], no_materialize: bool,
+         queries: tuple[str, ...], repeat: int):
+    with open(Path(config), "rb") as f:
+        config_obj = Config(**tomli.load(f))
+    if not config_obj.database.password:
+        config_obj.database.password = postgres_env_password()
+    postgres = PostgresBackend(to_kv_str(config_obj.database.model_dump()))
+    duckdb = DuckDBBackend(parquet, threads, materialize=not no_materialize)
+    print(f"duckdb opened in {duckdb.open_seconds:.3f}s")
+    print(f"{'query':<26} {'postgres':>12} {'duckdb':>12} {'speedup':>8} rows")
+    failed: List[str] = []
+    for name in queries or QUERIES:
+        sql = QUERIES[name]
+        pg_time, pg_rows = asyncio.run(measure(postgres, sql, repeat))
+        duck_time, duck_rows = asyncio.run(measure(duckdb, sql, repeat))
+        rows = str(pg_rows) if pg_rows == duck_rows else f"{pg_rows} != {duck_rows}"
+        if pg_rows != duck_rows:
+            failed.append(name)
+        print(f"{name:<26} {pg_time * 1000:10.2f}ms {duck_time * 1000:10.2f}ms "
+              f"{pg_time / duck_time:7.2f}x {rows}")
+    duckdb.close()
+    if failed:
+        raise click.ClickException("the backends disagree on " + ", ".join(failed))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,88 @@
+"""
+Benchmark of the query -> polars paths.
+
+Compares `get_df_by_sql` (`fetchall()` into Python tuples) against
+`get_df_by_sql_arrow` with COPY decoded by the Arrow CSV reader and with a
+server-side cursor. Without `--sql`, a synthetic result of `--rows` rows is
+generated by the server.
+
+    python bench_df.py -n 2000000
+    python bench_df.py --sql 'SELECT * FROM booru.view_modern_posts_illustration_only' --memory
+"""
+from typing import Optional, Callable, Awaitable
+from pathlib import Path
+import asyncio
+import time
+import tracemalloc
+import click
+import polars as pl
+import tomli
+from utils.db import Config, postgres_env_password, to_kv_str, get_df_by_sql, get_df_by_sql_arrow
+
+SYNTHETIC_SQL = """SELECT i AS id,
+       i % 1000 AS score,
+       random() AS ratio,
+       now() - i * interval '1 second' AS created_at,
+       md5(i::text) AS md5,
+       ARRAY[i, i + 1, i + 2] AS tag_ids
+FROM generate_series(1, {rows}) AS i"""
+
+
+async def measure(load: Callable[[], Awaitable[pl.DataFrame]],
+                  repeat: int,
+                  memory: bool) -> tuple[float, int, Optional[int]]:
+    """Best time, rows and, with `memory`, peak Python heap of a separate traced run"""
+    best, rows = float("inf"), 0
+    for _ in range(repeat):
+        start = time.perf_counter()
+        df = await load()
+        best = min(best, time.perf_counter() - start)
+        rows = len(df)
+        del df
+    peak: Optional[int] = None
+    if memory:
+        tracemalloc.start()
+        df = await load()
+        peak = tracemalloc.get_traced_memory()[1]
+        tracemalloc.stop()
+        del df
+    return best, rows, peak
+
+
+@click.command()
+@click.option("--config",
+              "-c",
+              default="../database/config.toml",
+              help="Path to config file",
+              type=click.Path(exists=True))
+@click.option("--sql", default=None, help="Query to fetch, a synthetic one if not given")
+@click.option("--rows", "-n", default=1_000_000, help="Rows of the synthetic query", type=int)
+@click.option("--batch-size", default=100_000, help="Rows per record batch", type=int)
+@click.option("--repeat", "-r", default=3, help="Number of runs, the best one is kept", type=int)
+@click.option("--memory",
+              is_flag=True,
+              default=False,
+              help="Also trace the peak Python heap, in an extra untimed run")
+def main(config: str, sql: Optional[str], rows: int, batch_size: int, repeat: int, memory: bool):
+    with open(Path(config), "rb") as f:
+        config_obj = Config(**tomli.load(f))
+    if not config_obj.database.password:
+        config_obj.database.password = postgres_env_password()
+    conn_info = to_kv_str(config_obj.database.model_dump())
+    query = sql or SYNTHETIC_SQL.format(rows=rows)
+    paths = {
+        "fetchall": lambda: get_df_by_sql(conn_info, query),
+        "arrow copy": lambda: get_df_by_sql_arrow(conn_info, query, batch_size, method="auto"),
+        "arrow cursor": lambda: get_df_by_sql_arrow(conn_info, query, batch_size, method="cursor"),
+    }
+    baseline: Optional[float] = None
+    for name, load in paths.items():
+        elapsed, count, peak = asyncio.run(measure(load, repeat, memory))
+        baseline = baseline or elapsed
+        heap = f"  {peak / 2**20:8.1f} MiB heap" if peak is not None else ""
+        print(f"{name:<13} {count:>10} rows {elapsed:8.3f}s {count / elapsed:12.0f} rows/s "
+              f"{baseline / elapsed:6.2f}x{heap}")
+
+
+if __name__ == "__main__":
+    main()
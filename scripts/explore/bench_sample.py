@@ -0,0 +1,138 @@
+"""
+Latency of the random-posts query, `ORDER BY random()` against the sampling API.
+
+Runs the random-posts query of `playground.sql` as it is, its rewrite on
+`booru.sample_posts` / `booru.random_artist` (with and without the tag names of
+the posts), and the draws of a `PostSampler`
+on the tag index, each `--repeat` times with a different seed. The SQL runs
+report the shared buffers they touched, from `EXPLAIN (ANALYZE, BUFFERS)`.
+
+    python bench_sample.py --index tag_index.bin -r 20
+"""
+from typing import Optional, List, Callable
+from datetime import date
+from pathlib import Path
+import asyncio
+import statistics
+import time
+import click
+import psycopg
+import tomli
+from utils.db import Config, postgres_env_password, to_kv_str
+from utils.explain import explain, summarize as summarize_plan
+from utils.rank_artists import load_posts_db
+from utils.sampling import PostSampler
+from utils.tag_index import TagIndex
+
+TAG_NAMES = """(SELECT array_agg(name) FROM booru.tags WHERE id = ANY (ap.tag_ids) AND category = 1)
+           AS artist_tags,
+       ap.score,
+       ap.fav_count,
+       (SELECT array_agg(name) FROM booru.tags WHERE id = ANY (ap.tag_ids) AND category = 0)
+           AS general_tags,
+       (SELECT array_agg(name) FROM booru.tags WHERE id = ANY (ap.tag_ids) AND category = 3)
+           AS copyright_tags,
+       (SELECT array_agg(name) FROM booru.tags WHERE id = ANY (ap.tag_ids) AND category = 4)
+           AS characters_tags,
+       ap.created_at,
+       ap.file_url,
+       ap.preview_file_url"""
+
+# `playground.sql`, the query of `data/random_posts_performance.csv`
+ORDER_BY_RANDOM_SQL = f"""WITH artist AS (SELECT * FROM booru.artists_with_n_posts
+                ORDER BY random() LIMIT 1),
+     artist_posts AS (SELECT * FROM booru.view_modern_posts_illustration_only_extra ap
+                      WHERE ap.tag_ids && ARRAY(SELECT tag_id FROM artist))
+SELECT ap.post_id, {TAG_NAMES}
+FROM artist_posts ap
+LIMIT {{n}}"""
+
+SAMPLED_SQL = f"""WITH sampled AS (SELECT *
+                 FROM booru.sample_posts(booru.random_artist(), n => {{n}}))
+SELECT ap.post_id, {TAG_NAMES}
+FROM sampled s
+         INNER JOIN booru.view_modern_posts_illustration_only_extra ap on ap.post_id = s.post_id"""
+
+# the draw alone, without the tag names
+SAMPLED_IDS_SQL = "SELECT * FROM booru.sample_posts(booru.random_artist(), n => {n})"
+
+
+def explain_sql(conn: psycopg.Connection, sql: str) -> tuple[float, int, int]:
+    """Execution time in seconds, rows and shared buffers (hit + read) of a query"""
+    summary = summarize_plan(explain(conn, sql))
+    return summary.execution_ms / 1000, summary.rows, summary.shared_hit + summary.shared_read
+
+
+def summarize(name: str, times: List[float], rows: List[int], buffers: Optional[List[int]],
+              baseline: Optional[float]) -> float:
+    median = statistics.median(times)
+    buffer_text = f" {statistics.median(buffers):10.0f} buffers" if buffers else ""
+    speedup = f" {baseline / median:8.1f}x" if baseline else ""
+    print(f"{name:<16} {median * 1000:10.2f}ms median {min(times) * 1000:10.2f}ms best "
+          f"{statistics.mean(rows):6.1f} rows{buffer_text}{speedup}")
+    return median
+
+
+@click.command()
+@click.option("--config",
+              "-c",
+              default="../database/config.toml",
+              help="Path to config file",
+              type=click.Path(exists=True))
+@click.option("--index",
+              default="tag_index.bin",
+              help="Tag index, the Python sampler is skipped without it",
+              type=click.Path())
+@click.option("--limit", "-n", default=50, help="Posts per draw", type=int)
+@click.option("--repeat", "-r", default=10, help="Draws per path, one seed each", type=int)
+@click.option("--min-posts",
+              default=100,
+              help="A random artist has more posts than this (Python sampler)",
+              type=int)
+def main(config: str, index: str, limit: int, repeat: int, min_posts: int):
+    with open(Path(config), "rb") as f:
+        config_obj = Config(**tomli.load(f))
+    if not config_obj.database.password:
+        config_obj.database.password = postgres_env_password()
+    conn_info = to_kv_str(config_obj.database.model_dump())
+    baseline: Optional[float] = None
+    with psycopg.connect(conn_info, autocommit=True) as conn:
+        paths = {
+            "order by random": ORDER_BY_RANDOM_SQL,
+            "sql sampling": SAMPLED_SQL,
+            "sql ids only": SAMPLED_IDS_SQL,
+        }
+        for name, sql in paths.items():
+            runs = []
+            for seed in range(repeat):
+                conn.execute("SELECT setseed(%s)", (seed / repeat,))
+                runs.append(explain_sql(conn, sql.format(n=limit)))
+            times, rows, buffers = (list(column) for column in zip(*runs))
+            median = summarize(name, times, rows, buffers, baseline)
+            baseline = baseline or median
+    if not Path(index).exists():
+        print(f"no index at {index}, skipping the Python sampler")
+        return
+    start = time.perf_counter()
+    posts = asyncio.run(load_posts_db(conn_info, date(2015, 1, 1)))
+    sampler = PostSampler(TagIndex(index), posts["post_id"].to_numpy())
+    artists = sampler.artists(min_posts)
+    print(f"sampler ready in {time.perf_counter() - start:.2f}s, {len(artists)} artists")
+    if not artists:
+        return
+    draws: List[Callable[[], int]] = [
+        lambda seed=seed: len(
+            sampler.sample_posts(sampler.random_artist(min_posts, seed), n=limit, seed=seed))
+        for seed in range(repeat)
+    ]
+    for name in ("index sampling", "index cached"):
+        times, rows = [], []
+        for draw in draws:
+            start = time.perf_counter()
+            rows.append(draw())
+            times.append(time.perf_counter() - start)
+        summarize(name, times, rows, None, baseline)
+
+
+if __name__ == "__main__":
+    main()
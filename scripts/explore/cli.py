@@ -0,0 +1,532 @@
+"""
+Command line tools of the analysis side, run from `scripts/explore`:
+
+    python cli.py build-tag-index --source posts -i ../database/raw
+    python cli.py query-tags 'pantyhose* -1boy'
+    python cli.py rank-artists --include 'pantyhose*' --any cameltoe --order ratio
+    python cli.py sample-posts --artist some_artist -n 50 --seed 1
+    python cli.py build-tag-graph && python cli.py expand-tag animal_ears
+    python cli.py build-cooccurrence --min-posts 1000 && python cli.py related-tags pantyhose
+    python cli.py query --backend duckdb 'SELECT * FROM booru.view_artist_illustration_only_100'
+"""
+from typing import Any, Dict, Iterator, Optional
+from datetime import date
+from pathlib import Path
+import asyncio
+import json
+import os
+import sys
+import time
+import click
+import psycopg
+import tomli
+import tqdm
+from utils.backends import BACKENDS, Backend, open_backend
+from utils.cache import DEFAULT_CACHE_DIR, QueryCache, db_fingerprint
+from utils.cooccurrence import (RELATED_BY, Cooccurrence, CooccurrenceOptions, RelatedBy,
+                                 chunk_tag_lists, count_posts_tags, db_chunks, db_tag_counts,
+                                 frequent_tags, posts_tag_lists)
+from utils.cooccurrence import build_cooccurrence as build_cooccurrence_
+from utils.db import Config, postgres_env_password, to_kv_str
+from utils.explain import DEFAULT_PLAN_DIR, archive_plan, read_archive
+from utils.rank_artists import (RANK_ORDERS, RankOptions, RankOrder, RankSource,
+                                load_artist_tags_db, load_artist_tags_parquet, load_posts_db,
+                                load_posts_parquet, tag_expression)
+from utils.rank_artists import rank_artists as rank_artists_
+from utils.sampling import PostSampler
+from utils.tag_graph import TagGraph, load_graph_db, write_graph_tables
+from utils.tag_index import (TagIndex, TagInfo, build_from_db, build_from_posts, read_tags,
+                             write_tag_index)
+
+# the raw dumps are read like the loader does, plain or compressed
+sys.path.append(str(Path(__file__).resolve().parent.parent / "database"))
+from raw_files import open_raw, resolve_raw_file    # noqa: E402
+
+
+def read_objs(path: Path, pbar: Optional[tqdm.tqdm] = None) -> Iterator[Dict[str, Any]]:
+    """Objects of a raw dump, plain or compressed, moving `pbar` to the bytes read"""
+    with open_raw(path) as f:
+        for i, line in enumerate(f):
+            if line.strip():
+                yield json.loads(line)
+            if pbar is not None and i % 1000 == 0:
+                pbar.update(f.position - pbar.n)
+        if pbar is not None:
+            pbar.update(f.position - pbar.n)
+
+
+def create_group():
+
+    @click.group()
+    @click.option("--config",
+                  "-c",
+                  default="../database/config.toml",
+                  help="Path to config file",
+                  type=click.Path(exists=True))
+    @click.pass_context
+    def cli(ctx: click.Context, config: str):
+        ctx.ensure_object(dict)
+        with open(Path(config), "rb") as f:
+            config_obj = Config(**tomli.load(f))
+        if not config_obj.database.password:
+            config_obj.database.password = postgres_env_password()
+        ctx.obj["config"] = config_obj
+        ctx.obj["conn_info"] = to_kv_str(config_obj.database.model_dump())
+
+    @cli.command()
+    @click.pass_context
+    @click.option("--source",
+                  default="posts",
+                  help="Build from the raw posts dump or from `booru.posts_tags_assoc`",
+                  type=click.Choice(["posts", "db"]))
+    @click.option("--input",
+                  "-i",
+                  default="../database/raw",
+                  help="Path to raw data directory, for `--source posts`",
+                  type=click.Path(file_okay=False))
+    @click.option("--output", "-o", default="tag_index.bin", help="Index file", type=click.Path())
+    def build_tag_index(ctx: click.Context, source: str, input: str, output: str):
+        """Build the tag -> posts inverted index"""
+        config: Config = ctx.obj["config"]
+        start = time.perf_counter()
+        if source == "posts":
+            input_dir = Path(input)
+            tags = read_tags(read_objs(input_dir / config.file_names.tags))
+            posts_file = resolve_raw_file(input_dir / config.file_names.posts)
+            with tqdm.tqdm(total=posts_file.stat().st_size, unit="B", unit_scale=True,
+                           desc="posts") as pbar:
+                bitmaps, universe = build_from_posts(read_objs(posts_file, pbar), tags)
+            infos = [TagInfo(tag_id, name, category) for name, (tag_id, category) in tags.items()]
+        else:
+            with psycopg.connect(ctx.obj["conn_info"]) as conn:
+                infos, bitmaps, universe = build_from_db(conn)
+        write_tag_index(output, infos, bitmaps, universe)
+        click.echo("Indexed {} tags over {} posts into {} in {:.1f}s".format(
+            len(infos), len(universe), output, time.perf_counter() - start))
+
+    @cli.command()
+    @click.option("--index",
+                  default="tag_index.bin",
+                  help="Index file",
+                  type=click.Path(exists=True))
+    @click.option("--limit", "-n", default=20, help="Number of post ids to print", type=int)
+    @click.argument("expression", type=str)
+    def query_tags(index: str, limit: int, expression: str):
+        """Evaluate a tag expression against the index"""
+        tag_index = TagIndex(index)
+        start = time.perf_counter()
+        try:
+            post_ids = tag_index.post_ids(expression)
+        except ValueError as e:
+            raise click.ClickException(f"invalid expression: {e}")
+        elapsed = time.perf_counter() - start
+        click.echo("{} posts in {:.2f}ms".format(len(post_ids), elapsed * 1000))
+        click.echo(" ".join(str(i) for i in post_ids[:limit]))
+
+    @cli.command()
+    @click.pass_context
+    @click.option("--index",
+                  default="tag_index.bin",
+                  help="Index file",
+                  type=click.Path(exists=True))
+    @click.option("--source",
+                  default="db",
+                  help="Read post scores and artists from the database or from parquet",
+                  type=click.Choice(["db", "parquet"]))
+    @click.option("--parquet",
+                  default="../database/parquet",
+                  help="Output directory of `dump_data.py to-parquet`, for `--source parquet`",
+                  type=click.Path(file_okay=False))
+    @click.option("--include", multiple=True, help="Tag (or pattern) every target post has")
+    @click.option("--any",
+                  "any_of",
+                  multiple=True,
+                  help="Tags (or patterns) a target post has at least one of")
+    @click.option("--exclude", multiple=True, help="Tag (or pattern) no target post has")
+    @click.option("--query",
+                  "-q",
+                  default=None,
+                  help="Tag expression ANDed with the options above")
+    @click.option("--since", default="2015-01-01", help="Count posts created after this date")
+    @click.option("--all-posts",
+                  is_flag=True,
+                  default=False,
+                  help="Also count videos, animations and comics")
+    @click.option("--min-posts", default=100, help="Artists need more posts than this", type=int)
+    @click.option("--min-ratio", default=0.1, help="Target posts / posts above this", type=float)
+    @click.option("--min-target-posts",
+                  default=None,
+                  help="Keep artists with more target posts than this, whatever their ratio",
+                  type=int)
+    @click.option("--min-avg-score",
+                  default=None,
+                  help="Average score of the target posts above this",
+                  type=float)
+    @click.option("--order", default="ratio", help="Sort key", type=click.Choice(RANK_ORDERS))
+    @click.option("--limit", "-n", default=500, help="Number of artists", type=int)
+    @click.option("--ratio-column",
+                  default="ratio",
+                  help="Name of the ratio column, older CSVs use `target_ratio`",
+                  type=click.Choice(["ratio", "target_ratio"]))
+    @click.option("--output", "-o", default=None, help="CSV file, printed if not given")
+    def rank_artists(ctx: click.Context, index: str, source: RankSource, parquet: str,
+                      include: tuple[str, ...], any_of: tuple[str, ...], exclude: tuple[str, ...],
+                      query: Optional[str], since: str, all_posts: bool, min_posts: int,
+                      min_ratio: float, min_target_posts: Optional[int],
+                      min_avg_score: Optional[float], order: RankOrder, limit: int,
+                      ratio_column: str, output: Optional[str]):
+        """Rank artists by their share of posts matching a tag set"""
+        opts = RankOptions(since=since,
+                           illustration_only=not all_posts,
+                           min_posts=min_posts,
+                           min_ratio=min_ratio,
+                           min_target_posts=min_target_posts,
+                           min_avg_score=min_avg_score,
+                           order=order,
+                           limit=limit)
+        try:
+            expression = tag_expression(include, any_of, exclude, query)
+        except ValueError as e:
+            raise click.ClickException(str(e))
+        tag_index = TagIndex(index)
+        start = time.perf_counter()
+        if source == "db":
+
+            async def load():
+                conn_info = ctx.obj["conn_info"]
+                return await asyncio.gather(load_posts_db(conn_info, opts.since),
+                                            load_artist_tags_db(conn_info))
+
+            posts, artist_tags = asyncio.run(load())
+        else:
+            posts = load_posts_parquet(parquet, opts.since)
+            artist_tags = load_artist_tags_parquet(parquet)
+        loaded = time.perf_counter()
+        try:
+            ranked = rank_artists_(tag_index, posts, artist_tags, expression, opts)
+        except ValueError as e:
+            raise click.ClickException(f"invalid expression: {e}")
+        ranked = ranked.rename({"ratio": ratio_column})
+        elapsed = time.perf_counter() - loaded
+        click.echo("{} artists for `{}`, loaded in {:.2f}s, ranked in {:.2f}s".format(
+            len(ranked), expression, loaded - start, elapsed),
+                   err=True)
+        if output is None:
+            click.echo(ranked.write_csv(), nl=False)
+        else:
+            ranked.write_csv(output)
+
+    @cli.command()
+    @click.pass_context
+    @click.option("--index",
+                  default="tag_index.bin",
+                  help="Index file, for `--source index`",
+                  type=click.Path())
+    @click.option("--source",
+                  default="index",
+                  help="Draw from the tag index or with `booru.sample_posts` in the database",
+                  type=click.Choice(["index", "db"]))
+    @click.option("--artist",
+                  "-a",
+                  default=None,
+                  help="Artist tag, a random one if neither it nor --tag is given")
+    @click.option("--tag", "-t", "tags", multiple=True, help="Tag every sampled post has")
+    @click.option("--limit", "-n", default=50, help="Number of posts", type=int)
+    @click.option("--seed", default=None, help="Seed of a reproducible draw", type=int)
+    @click.option("--since",
+                  default="2015-01-01",
+                  help="Sample posts created after this date (index only, the database "
+                  "samples `booru.tag_post_ids`)")
+    @click.option("--all-posts",
+                  is_flag=True,
+                  default=False,
+                  help="Also sample videos, animations and comics (index only)")
+    @click.option("--min-posts",
+                  default=100,
+                  help="A random artist has more posts than this (index only)",
+                  type=int)
+    def sample_posts(ctx: click.Context, index: str, source: str, artist: Optional[str],
+                     tags: tuple[str, ...], limit: int, seed: Optional[int], since: str,
+                     all_posts: bool, min_posts: int):
+        """Draw random posts of an artist and/or tag set"""
+        conn_info = ctx.obj["conn_info"]
+        start = time.perf_counter()
+        if source == "db":
+            with psycopg.connect(conn_info) as conn:
+                if artist is None and not tags:
+                    row = conn.execute("SELECT booru.random_artist(%s)", (seed,)).fetchone()
+                    artist = row[0] if row is not None else None
+                    if artist is None:
+                        raise click.ClickException("no artist in booru.sample_artists")
+                    # the draw continues the seeded sequence
+                    seed = None
+                loaded = time.perf_counter()
+                rows = conn.execute("SELECT post_id FROM booru.sample_posts(%s, %s, %s, %s)",
+                                    (artist, list(tags), limit, seed)).fetchall()
+            post_ids = [row[0] for row in rows]
+        else:
+            if not Path(index).exists():
+                raise click.ClickException(f"no index at {index}, run build-tag-index")
+            posts = asyncio.run(load_posts_db(conn_info, date.fromisoformat(since)))
+            sampler = PostSampler(TagIndex(index),
+                                  posts["post_id"].to_numpy(),
+                                  illustration_only=not all_posts)
+            try:
+                if artist is None and not tags:
+                    artist = sampler.random_artist(min_posts, seed)
+                loaded = time.perf_counter()
+                post_ids = sampler.sample_posts(artist, tags, limit, seed).tolist()
+            except ValueError as e:
+                raise click.ClickException(str(e))
+        elapsed = time.perf_counter() - loaded
+        click.echo("{} posts of {}, loaded in {:.2f}s, drawn in {:.2f}ms".format(
+            len(post_ids), " ".join(([artist] if artist else []) + list(tags)), loaded - start,
+            elapsed * 1000),
+                   err=True)
+        click.echo(" ".join(str(i) for i in post_ids))
+
+    @cli.command()
+    @click.pass_context
+    @click.option("--output",
+                  "-o",
+                  default="tag_graph.npz",
+                  help="Graph file, for expand-tag",
+                  type=click.Path())
+    @click.option("--no-write",
+                  is_flag=True,
+                  default=False,
+                  help="Do not replace `booru.tag_canonical` and `booru.tag_implication_closure`")
+    def build_tag_graph(ctx: click.Context, output: str, no_write: bool):
+        """Resolve the tag aliases and the transitive implications"""
+        start = time.perf_counter()
+        with psycopg.connect(ctx.obj["conn_info"]) as conn:
+            graph = load_graph_db(conn)
+            built = time.perf_counter()
+            if not no_write:
+                write_graph_tables(conn, graph)
+        graph.save(output)
+        for cycle in graph.cycle_names():
+            click.echo("cycle: " + " -> ".join(cycle), err=True)
+        click.echo(", ".join(f"{k} {v}" for k, v in graph.stats.model_dump().items()))
+        click.echo("Built in {:.2f}s, saved to {} in {:.2f}s".format(
+            built - start, output, time.perf_counter() - built))
+
+    @cli.command()
+    @click.option("--graph",
+                  default="tag_graph.npz",
+                  help="Graph file of build-tag-graph",
+                  type=click.Path(exists=True))
+    @click.option("--ids", is_flag=True, default=False, help="Print tag ids instead of names")
+    @click.argument("tag", type=str)
+    def expand_tag(graph: str, ids: bool, tag: str):
+        """Print a tag (aliases resolved) and every tag implying it"""
+        tag_graph = TagGraph.load(graph)
+        start = time.perf_counter()
+        try:
+            tag_ids = tag_graph.expand(tag)
+        except KeyError:
+            raise click.ClickException(f"unknown tag {tag}")
+        elapsed = time.perf_counter() - start
+        click.echo("{} tags in {:.1f}us".format(len(tag_ids), elapsed * 1e6), err=True)
+        if ids:
+            click.echo(" ".join(str(i) for i in tag_ids))
+        else:
+            click.echo(" ".join(tag_graph.name(i) for i in tag_ids))
+
+    @cli.command()
+    @click.pass_context
+    @click.option("--source",
+                  default="posts",
+                  help="Stream the raw posts dump or `booru.posts_tags_assoc`",
+                  type=click.Choice(["posts", "db"]))
+    @click.option("--input",
+                  "-i",
+                  default="../database/raw",
+                  help="Path to raw data directory, for `--source posts`",
+                  type=click.Path(file_okay=False))
+    @click.option("--output",
+                  "-o",
+                  default="cooccurrence",
+                  help="Matrix directory",
+                  type=click.Path(file_okay=False))
+    @click.option("--min-posts", default=100, help="Tags need at least this many posts", type=int)
+    @click.option("--workers", default=os.cpu_count() or 1, help="Worker processes", type=int)
+    @click.option("--chunk-posts", default=20_000, help="Posts per worker task", type=int)
+    @click.option("--max-pairs",
+                  default=20_000_000,
+                  help="Tag pairs held in memory by the merge",
+                  type=int)
+    @click.option("--spill-dir",
+                  default=None,
+                  help="Directory of the partial counts, the temporary directory if not given",
+                  type=click.Path(file_okay=False))
+    def build_cooccurrence(ctx: click.Context, source: str, input: str, output: str,
+                           min_posts: int, workers: int, chunk_posts: int, max_pairs: int,
+                           spill_dir: Optional[str]):
+        """Count the posts of every pair of frequent tags"""
+        config: Config = ctx.obj["config"]
+        options = CooccurrenceOptions(min_posts=min_posts,
+                                      workers=workers,
+                                      chunk_posts=chunk_posts,
+                                      max_pairs=max_pairs,
+                                      spill_dir=spill_dir)
+        start = time.perf_counter()
+        if source == "posts":
+            input_dir = Path(input)
+            tags = read_tags(read_objs(input_dir / config.file_names.tags))
+            posts_file = resolve_raw_file(input_dir / config.file_names.posts)
+            with tqdm.tqdm(total=posts_file.stat().st_size, unit="B", unit_scale=True,
+                           desc="tag counts") as pbar:
+                counts, n_posts = count_posts_tags(read_objs(posts_file, pbar), tags)
+            tag_ids, names, tag_counts = frequent_tags(
+                counts, {tag_id: name for name, (tag_id, _) in tags.items()}, min_posts)
+            index = {name: i for i, name in enumerate(names)}
+            with tqdm.tqdm(total=posts_file.stat().st_size, unit="B", unit_scale=True,
+                           desc="pairs") as pbar:
+                chunks = chunk_tag_lists(posts_tag_lists(read_objs(posts_file, pbar), index),
+                                         chunk_posts)
+                pairs = build_cooccurrence_(chunks, tag_ids, names, tag_counts, n_posts, output,
+                                            options)
+        else:
+            with psycopg.connect(ctx.obj["conn_info"]) as conn:
+                counts, tag_names, n_posts = db_tag_counts(conn)
+                tag_ids, names, tag_counts = frequent_tags(counts, tag_names, min_posts)
+                pairs = build_cooccurrence_(db_chunks(conn, tag_ids, chunk_posts), tag_ids, names,
+                                            tag_counts, n_posts, output, options)
+        click.echo("{} tags, {} pairs over {} posts in {:.1f}s".format(
+            len(tag_ids), pairs, n_posts, time.perf_counter() - start))
+
+    @cli.command()
+    @click.option("--matrix",
+                  default="cooccurrence",
+                  help="Matrix directory of build-cooccurrence",
+                  type=click.Path(exists=True, file_okay=False))
+    @click.option("--by", default="count", help="Score", type=click.Choice(RELATED_BY))
+    @click.option("--limit", "-n", default=20, help="Number of tags", type=int)
+    @click.option("--min-count",
+                  default=1,
+                  help="Related tags are on at least this many posts with the tag",
+                  type=int)
+    @click.argument("tag", type=str)
+    def related_tags(matrix: str, by: RelatedBy, limit: int, min_count: int, tag: str):
+        """Print the tags most related to a tag"""
+        cooccurrence = Cooccurrence(matrix)
+        start = time.perf_counter()
+        try:
+            related = cooccurrence.related(tag, limit, by, min_count)
+        except KeyError:
+            raise click.ClickException(f"{tag} is not in the matrix")
+        elapsed = time.perf_counter() - start
+        click.echo("{} tags in {:.2f}ms".format(len(related), elapsed * 1000), err=True)
+        for r in related:
+            click.echo("{:<40} {:>10} {:>10.4f}".format(r.name, r.count, r.score))
+
+    @cli.command()
+    @click.pass_context
+    @click.option("--cache-dir",
+                  default=str(DEFAULT_CACHE_DIR),
+                  help="Directory of the query cache",
+                  type=click.Path(file_okay=False))
+    @click.option("--stale",
+                  is_flag=True,
+                  default=False,
+                  help="Delete the results of older ingest generations")
+    @click.option("--clear", is_flag=True, default=False, help="Delete every cached result")
+    def query_cache(ctx: click.Context, cache_dir: str, stale: bool, clear: bool):
+        """List (or delete) the cached query results"""
+        cache = QueryCache(cache_dir)
+        if clear:
+            cache.invalidate()
+        elif stale:
+            cache.invalidate(asyncio.run(db_fingerprint(ctx.obj["conn_info"])))
+        for entry in cache.entries():
+            sql = entry.sql if len(entry.sql) <= 60 else entry.sql[:57] + "..."
+            click.echo("{:<20} {:>10} {}".format(entry.fingerprint, entry.bytes, sql))
+        info = cache.info()
+        click.echo("{} results, {:.1f} MiB in {}".format(info.entries, info.bytes / 2**20,
+                                                          cache_dir))
+
+    @cli.command()
+    @click.pass_context
+    @click.option("--backend",
+                  default="postgres",
+                  help="Run on the database or with DuckDB over parquet",
+                  type=click.Choice(BACKENDS))
+    @click.option("--parquet",
+                  default="../database/parquet",
+                  help="Output directory of `dump_data.py to-parquet`, for `--backend duckdb`",
+                  type=click.Path(file_okay=False))
+    @click.option("--threads",
+                  default=None,
+                  help="Threads of DuckDB, all cores if not given",
+                  type=int)
+    @click.option("--file",
+                  "-f",
+                  default=None,
+                  help="Read the query from this file instead of the argument",
+                  type=click.Path(exists=True, dir_okay=False))
+    @click.option("--output", "-o", default=None, help="CSV file, printed if not given")
+    @click.argument("sql", type=str, required=False)
+    def query(ctx: click.Context, backend: Backend, parquet: str, threads: Optional[int],
+              file: Optional[str], output: Optional[str], sql: Optional[str]):
+        """Run a query of the views of explore.sql and playground.sql"""
+        if file is not None:
+            sql = Path(file).read_text()
+        if not sql:
+            raise click.ClickException("give the query as an argument or with --file")
+        options = {"threads": threads} if backend == "duckdb" else {}
+        start = time.perf_counter()
+        try:
+            runner = open_backend(backend, ctx.obj["conn_info"], parquet, **options)
+        except (FileNotFoundError, ImportError) as e:
+            raise click.ClickException(str(e))
+        opened = time.perf_counter()
+        df = asyncio.run(runner.get_df(sql.strip().rstrip(";")))
+        click.echo("{} rows with {}, opened in {:.2f}s, queried in {:.2f}s".format(
+            len(df), backend, opened - start, time.perf_counter() - opened),
+                   err=True)
+        if output is None:
+            click.echo(df.write_csv(), nl=False)
+        else:
+            df.write_csv(output)
+
+    @cli.command()
+    @click.pass_context
+    @click.option("--file",
+                  "-f",
+                  default=None,
+                  help="Read the query from this file instead of the argument",
+                  type=click.Path(exists=True, dir_okay=False))
+    @click.option("--name", "-n", required=True, help="Name the plan is archived under", type=str)
+    @click.option("--archive-dir",
+                  default=str(DEFAULT_PLAN_DIR),
+                  help="Directory of the archived plans",
+                  type=click.Path(file_okay=False))
+    @click.option("--history",
+                  is_flag=True,
+                  default=False,
+                  help="Print the earlier captures of the name too")
+    @click.argument("sql", type=str, required=False)
+    def explain(ctx: click.Context, file: Optional[str], name: str, archive_dir: str,
+                history: bool, sql: Optional[str]):
+        """Run a query under EXPLAIN ANALYZE and archive its plan"""
+        if file is not None:
+            sql = Path(file).read_text()
+        if not sql:
+            raise click.ClickException("give the query as an argument or with --file")
+        sql = sql.strip().rstrip(";")
+        conn_info = ctx.obj["conn_info"]
+        database = asyncio.run(db_fingerprint(conn_info))
+        with psycopg.connect(conn_info, autocommit=True) as conn:
+            summary = archive_plan(conn, sql, name, archive_dir, database=database)
+        click.echo(Path(archive_dir, summary.file).with_suffix(".txt").read_text())
+        captures = read_archive(archive_dir, name) if history else [summary]
+        for c in captures:
+            click.echo("{:%Y-%m-%d %H:%M:%S} {:<20} {:>10.2f}ms {:>10} hit {:>10} read {}".format(
+                c.captured_at, c.database, c.execution_ms, c.shared_hit, c.shared_read, c.file))
+
+    return cli
+
+
+if __name__ == "__main__":
+    create_group()()
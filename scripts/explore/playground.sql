@@ -27,27 +27,26 @@ SELECT *
 FROM booru.posts p
 WHERE p.created_at > '2015-01-01';
 
+-- written by the loader, see booru.posts_tag_arrays in database.sql
 CREATE OR REPLACE VIEW booru.view_posts_tags AS
-SELECT distinct p.id,
-                array_agg(t.id) as tag_ids
-FROM booru.posts p
-         INNER JOIN booru.posts_tags_assoc pta on p.id = pta.post_id
-         INNER JOIN booru.tags t on pta.tag_id = t.id
-group by p.id;
+SELECT a.post_id as id,
+       a.tag_ids as tag_ids
+FROM booru.posts_tag_arrays a
+WHERE a.tag_ids <> '{}';
 
+-- one `&&` against every excluded tag, the same set as booru.non_illustration_tag_ids()
 CREATE OR REPLACE VIEW booru.view_posts_illustration_only AS
-SELECT distinct p.id,
-                p.created_at,
-                p.score,
-                p.fav_count,
-                pt.tag_ids as tag_ids
+SELECT p.id,
+       p.created_at,
+       p.score,
+       p.fav_count,
+       pt.tag_ids as tag_ids
 FROM booru.view_posts_tags pt
          INNER JOIN booru.posts p on pt.id = p.id
-WHERE NOT (tag_ids && ARRAY(SELECT id FROM booru.tags WHERE name = 'video'))
-  AND NOT (tag_ids && ARRAY(SELECT id FROM booru.tags WHERE name = 'sound'))
-  AND NOT (tag_ids && ARRAY(SELECT id FROM booru.tags WHERE name = 'animated'))
-  AND NOT (tag_ids && ARRAY(SELECT id FROM booru.tags WHERE name LIKE '%comic' AND category = 0))
-  AND NOT (tag_ids && ARRAY(SELECT id FROM booru.tags WHERE name LIKE '%4koma' AND category = 0));
+WHERE NOT (tag_ids && ARRAY(SELECT id
+                            FROM booru.tags
+                            WHERE name IN ('video', 'sound', 'animated')
+                               OR (category = 0 AND (name LIKE '%comic' OR name LIKE '%4koma'))));
 
 CREATE MATERIALIZED VIEW booru.view_modern_posts_illustration_only AS
 SELECT distinct p.id      as post_id,
@@ -58,6 +57,9 @@ SELECT distinct p.id      as post_id,
 FROM booru.view_modern_posts vmp
          INNER JOIN booru.view_posts_illustration_only p on p.id = vmp.id;
 
+-- unique indexes let `dump_data.py refresh-views` refresh concurrently
+CREATE UNIQUE INDEX ON booru.view_modern_posts_illustration_only (post_id);
+
 CREATE MATERIALIZED VIEW booru.view_modern_posts_illustration_only_extra AS
 SELECT p.id as post_id,
        p.created_at,
@@ -76,6 +78,8 @@ FROM booru.view_modern_posts_illustration_only vmpi
          INNER JOIN booru.view_post_aspect_ratio vpar on p.id = vpar.id
          INNER JOIN booru.posts_file_urls pfu on p.id = pfu.post_id;
 
+CREATE UNIQUE INDEX ON booru.view_modern_posts_illustration_only_extra (post_id);
+
 CREATE MATERIALIZED VIEW booru.view_posts_count_illustration_only AS
 SELECT t.id               AS tag_id,
        COUNT(pta.post_id) AS post_count
@@ -84,6 +88,8 @@ FROM booru.tags t
          INNER JOIN booru.view_modern_posts_illustration_only p on pta.post_id = p.post_id
 GROUP BY t.id;
 
+CREATE UNIQUE INDEX ON booru.view_posts_count_illustration_only (tag_id);
+
 -- a function return the tag id by artist name
 -- which should be a unique single value
 CREATE OR REPLACE FUNCTION booru.get_tag_id_by_artist_name(artist_name TEXT)
@@ -390,6 +396,141 @@ SELECT *
 FROM artist_posts_with_tags
 LIMIT 50;
 
+-- constant-time sampling instead of `ORDER BY random()`, see utils/sampling.py
+-- and bench_sample.py for the Python side and the latency comparison
+
+-- sorted post ids of every tag, over the modern illustration-only posts
+CREATE MATERIALIZED VIEW booru.tag_post_ids AS
+SELECT pta.tag_id,
+       COUNT(*)                                    AS post_count,
+       array_agg(pta.post_id ORDER BY pta.post_id) AS post_ids
+FROM booru.posts_tags_assoc pta
+         INNER JOIN booru.view_modern_posts_illustration_only p on pta.post_id = p.post_id
+GROUP BY pta.tag_id;
+
+CREATE UNIQUE INDEX ON booru.tag_post_ids (tag_id);
+
+-- artists numbered densely, so a random one is a single index lookup
+CREATE MATERIALIZED VIEW booru.sample_artists AS
+SELECT row_number() OVER (ORDER BY tag_id, artist_id) AS idx,
+       tag_id,
+       artist_id,
+       tag_name
+FROM booru.artists_with_n_posts;
+
+CREATE UNIQUE INDEX ON booru.sample_artists (idx);
+
+-- a seed makes the following random() calls of the session reproducible
+CREATE OR REPLACE FUNCTION booru.random_artist(seed INT DEFAULT NULL)
+    RETURNS TEXT AS
+$$
+DECLARE
+    pick BIGINT;
+BEGIN
+    IF seed IS NOT NULL THEN
+        PERFORM setseed(seed / 2147483648.0);
+    END IF;
+    pick := 1 + floor(random() * (SELECT max(idx) FROM booru.sample_artists));
+    RETURN (SELECT tag_name FROM booru.sample_artists WHERE idx = pick);
+END;
+$$ LANGUAGE plpgsql VOLATILE;
+
+-- n distinct posts of an artist (tag name) having every tag of `tags`. Positions
+-- of the smallest post id array are drawn at random and the other tags checked by
+-- primary key lookups; when few posts have every tag, the rest comes from the
+-- exact intersection. The array is read (and detoasted) whole once per call, so a
+-- call costs O(posts of its rarest tag) plus n lookups, not constant time when
+-- every tag is popular
+CREATE OR REPLACE FUNCTION booru.sample_posts(artist TEXT DEFAULT NULL,
+                                              tags TEXT[] DEFAULT '{}',
+                                              n INT DEFAULT 50,
+                                              seed INT DEFAULT NULL)
+    RETURNS TABLE
+            (
+                post_id INT
+            )
+AS
+$$
+DECLARE
+    tag_ids      INT[];
+    requested    INT;
+    ordered      INT[];
+    others       INT[];
+    pool         INT[];
+    drawn        INT[] := '{}';
+    candidate    INT;
+    attempts     INT   := 0;
+    max_attempts INT   := 20 * n + 100;
+BEGIN
+    IF artist IS NULL AND cardinality(tags) = 0 THEN
+        RAISE EXCEPTION 'sample_posts needs an artist or tags';
+    END IF;
+    IF seed IS NOT NULL THEN
+        PERFORM setseed(seed / 2147483648.0);
+    END IF;
+    SELECT array_agg(t.id)
+    INTO tag_ids
+    FROM booru.tags t
+    WHERE t.name = ANY (tags)
+       OR (t.name = artist AND t.category = 1);
+    -- the artist may be in `tags` too, or a tag twice
+    SELECT count(DISTINCT r.name)
+    INTO requested
+    FROM unnest(tags || artist) AS r(name)
+    WHERE r.name IS NOT NULL;
+    SELECT array_agg(tpi.tag_id ORDER BY tpi.post_count)
+    INTO ordered
+    FROM booru.tag_post_ids tpi
+    WHERE tpi.tag_id = ANY (tag_ids);
+    -- an unknown tag or one without posts, nothing matches
+    IF coalesce(cardinality(ordered), 0) < requested THEN
+        RETURN;
+    END IF;
+    SELECT tpi.post_ids INTO pool FROM booru.tag_post_ids tpi WHERE tpi.tag_id = ordered[1];
+    others := ordered[2:];
+    WHILE cardinality(drawn) < least(n, cardinality(pool)) AND attempts < max_attempts
+        LOOP
+            attempts := attempts + 1;
+            candidate := pool[1 + floor(random() * cardinality(pool))::INT];
+            CONTINUE WHEN candidate = ANY (drawn);
+            CONTINUE WHEN (SELECT count(*)
+                           FROM booru.posts_tags_assoc pta
+                           WHERE pta.post_id = candidate
+                             AND pta.tag_id = ANY (others)) < cardinality(others);
+            drawn := drawn || candidate;
+            post_id := candidate;
+            RETURN NEXT;
+        END LOOP;
+    IF attempts >= max_attempts THEN
+        RETURN QUERY SELECT c.id
+                     FROM unnest(pool) AS c(id)
+                     WHERE c.id <> ALL (drawn)
+                       AND (SELECT count(*)
+                            FROM booru.posts_tags_assoc pta
+                            WHERE pta.post_id = c.id
+                              AND pta.tag_id = ANY (others)) = cardinality(others)
+                     ORDER BY random()
+                     LIMIT n - cardinality(drawn);
+    END IF;
+END;
+$$ LANGUAGE plpgsql VOLATILE;
+
+-- the query above with sampling: about n index lookups and one read of the post ids of
+-- the artist
+WITH sampled AS (SELECT * FROM booru.sample_posts(booru.random_artist(), n => 50))
+SELECT ap.post_id,
+       (SELECT array_agg(name) FROM booru.tags WHERE id = ANY (ap.tag_ids) AND category = 1) as artist_tags,
+       ap.score,
+       ap.fav_count,
+       (SELECT array_agg(name) FROM booru.tags WHERE id = ANY (ap.tag_ids) AND category = 0) as general_tags,
+       (SELECT array_agg(name) FROM booru.tags WHERE id = ANY (ap.tag_ids) AND category = 3) as copyright_tags,
+       (SELECT array_agg(name) FROM booru.tags WHERE id = ANY (ap.tag_ids) AND category = 4) as characters_tags,
+       ap.created_at,
+       ap.file_url,
+       ap.preview_file_url
+FROM sampled s
+         INNER JOIN booru.view_modern_posts_illustration_only_extra ap on ap.post_id = s.post_id;
+
 -- do the stats for all artists
 CREATE MATERIALIZED VIEW booru.artists_stats AS
 WITH spreaded AS (SELECT unnest(tag_ids) as tag_id, * FROM booru.view_modern_posts_illustration_only_extra)
@@ -0,0 +1,361 @@
+"""
+Query backends of the analyses: the loaded Postgres database, or DuckDB over Parquet.
+
+`DuckDBBackend` runs the queries of `explore.sql` and `playground.sql` in
+process, on the files written by `dump_data.py to-parquet`, without a loaded
+database. The tables of `database.sql` are views over the files (`booru.posts`
+over every `posts/year=*` partition, the associations unnested from the tag id
+lists of the posts) and the core views are ported under the same names and
+columns (`RELATIONS`). DuckDB scans the files on every core with vectorized
+operators, and the result is handed to polars as an Arrow table, without a copy.
+
+    backend = DuckDBBackend("../database/parquet")
+    df = await backend.get_df("SELECT * FROM booru.view_artist_illustration_only_100")
+
+Both backends implement `QueryBackend`. The results are those of the database
+but for the tags of the dump missing from `tags.json`, dropped by `to-parquet`
+instead of created, and the tag id arrays, unsorted. The derived tables and materialized views are computed from
+the files when the backend is opened (in memory, `materialize`) or on every
+query. DuckDB needs the optional `duckdb` package.
+"""
+from typing import Dict, Optional, List, Literal, NamedTuple, Protocol, Any
+from pathlib import Path
+import asyncio
+import time
+from loguru import logger
+import polars as pl
+from utils.db import StreamMethod, get_df_by_sql_arrow
+
+try:
+    import duckdb
+except ImportError:    # pragma: no cover
+    duckdb = None    # type: ignore
+
+Backend = Literal["postgres", "duckdb"]
+BACKENDS: tuple[Backend, ...] = ("postgres", "duckdb")
+
+# entry of `dump_data.py to-parquet` -> its files in the output directory
+PARQUET_FILES: Dict[str, str] = {
+    "posts": "posts/*/*.parquet",
+    "tags": "tags.parquet",
+    "artists": "artists.parquet",
+    "artist_urls": "artist_urls.parquet",
+    "tag_aliases": "tag_aliases.parquet",
+    "tag_implications": "tag_implications.parquet",
+}
+
+
+class Relation(NamedTuple):
+    name: str
+    # `{posts}`, `{tags}`... are the scans of the files of `PARQUET_FILES`
+    sql: str
+    # entries the relation is built from, it is left out if one of them was not converted
+    entries: tuple[str, ...]
+    # a table of the database or a materialized view, kept in memory with `materialize`
+    materialized: bool = False
+
+
+# in dependency order
+RELATIONS: List[Relation] = [
+    Relation(
+        "booru.posts", """SELECT id, created_at, uploader_id AS uploaded_id, score, source, md5,
+       last_comment_bumped_at AS last_commented_at, rating, image_width AS width,
+       image_height AS height, fav_count, file_ext, last_noted_at, parent_id, has_children,
+       approver_id, file_size, up_score, down_score, is_pending, is_flagged, is_deleted,
+       updated_at, is_banned, pixiv_id
+FROM {posts}""", ("posts",)),
+    Relation(
+        "booru.posts_media_variants", """SELECT id AS post_id, v.type, v.width, v.height, v.url
+FROM (SELECT id, unnest(media_asset.variants) AS v FROM {posts})""", ("posts",)),
+    Relation(
+        "booru.posts_file_urls",
+        "SELECT id AS post_id, file_url, large_file_url, preview_file_url FROM {posts}",
+        ("posts",)),
+    # split by the category of the tags like the loader, the loader sorts the ids
+    Relation(
+        "booru.posts_tag_arrays", """SELECT p.id                            AS post_id,
+       coalesce(p.tag_string, []::INT[]) AS tag_ids,
+       coalesce(c.general, []::INT[])    AS general,
+       coalesce(c.artist, []::INT[])     AS artist,
+       coalesce(c.copyright, []::INT[])  AS copyright,
+       coalesce(c.character, []::INT[])  AS character,
+       coalesce(c.meta, []::INT[])       AS meta
+FROM {posts} p
+         LEFT JOIN
+     (SELECT pt.post_id,
+             list(t.id) FILTER (WHERE t.category = 0) AS general,
+             list(t.id) FILTER (WHERE t.category = 1) AS artist,
+             list(t.id) FILTER (WHERE t.category = 3) AS copyright,
+             list(t.id) FILTER (WHERE t.category = 4) AS character,
+             list(t.id) FILTER (WHERE t.category = 5) AS meta
+      FROM (SELECT id AS post_id, unnest(tag_string) AS tag_id FROM {posts}) pt
+               JOIN {tags} t ON t.id = pt.tag_id
+      GROUP BY pt.post_id) c ON c.post_id = p.id""", ("posts", "tags"), True),
+    Relation("booru.posts_tags_assoc",
+             "SELECT id AS post_id, unnest(tag_string) AS tag_id FROM {posts}", ("posts",)),
+    Relation("booru.tags", "SELECT id, name, category, is_deprecated FROM {tags}", ("tags",)),
+    Relation("booru.tags_aliases",
+             "SELECT id, antecedent_name, consequent_name, status FROM {tag_aliases}",
+             ("tag_aliases",)),
+    Relation("booru.tags_implications",
+             "SELECT id, antecedent_name, consequent_name, status FROM {tag_implications}",
+             ("tag_implications",)),
+    Relation(
+        "booru.artists",
+        "SELECT id, name, group_name, created_at, updated_at, is_banned, is_deleted FROM {artists}",
+        ("artists",)),
+    Relation(
+        "booru.artists_aliases", """SELECT DISTINCT artist_id, alias
+FROM (SELECT id AS artist_id, unnest(other_names) AS alias FROM {artists})""", ("artists",)),
+    Relation("booru.artists_urls",
+             "SELECT id, artist_id, url, created_at, updated_at, is_active FROM {artist_urls}",
+             ("artist_urls",)),
+    # `counts.TAG_POST_COUNTS_SQL` and `counts.ARTIST_TAGS_SQL` of `scripts/database`
+    Relation(
+        "booru.tag_post_counts", """SELECT t.id AS tag_id, COUNT(pta.post_id) AS post_count
+FROM booru.tags t LEFT JOIN booru.posts_tags_assoc pta ON t.id = pta.tag_id
+GROUP BY t.id""", ("posts", "tags"), True),
+    Relation(
+        "booru.artist_tags_assoc", """SELECT a.id AS artist_id, t.id AS tag_id
+FROM booru.artists a JOIN booru.tags t ON a.name = t.name AND t.category = 1""",
+        ("artists", "tags"), True),
+    # explore.sql
+    Relation(
+        "booru.artist_view", """SELECT ata.tag_id                         AS tag_id,
+       a.id                               AS artist_id,
+       a.name                             AS artist_name,
+       a.group_name                       AS artist_group_name,
+       pc.post_count                      AS post_count,
+       a.is_banned                        AS artist_is_banned,
+       list(DISTINCT al.alias)
+       FILTER (WHERE al.alias IS NOT NULL) AS artist_aliases,
+       list(DISTINCT au.url)
+       FILTER (WHERE au.url IS NOT NULL)   AS artist_urls
+FROM booru.artist_tags_assoc ata
+         JOIN
+     booru.artists a ON ata.artist_id = a.id
+         LEFT JOIN
+     booru.artists_aliases al ON a.id = al.artist_id
+         LEFT JOIN
+     booru.artists_urls au ON a.id = au.artist_id
+         LEFT JOIN
+     booru.tag_post_counts pc ON ata.tag_id = pc.tag_id
+GROUP BY ata.tag_id, a.id, a.name, a.group_name, a.is_banned, pc.post_count""",
+        ("posts", "tags", "artists", "artist_urls")),
+    # the names are joined once for every post instead of a subquery per array
+    Relation(
+        "booru.posts_tag_view",
+        """WITH post_tags AS (SELECT post_id, category, unnest(ids) AS tag_id
+                   FROM (SELECT post_id,
+                                unnest([0, 1, 3, 4, 5])                               AS category,
+                                unnest([general, artist, copyright, character, meta]) AS ids
+                         FROM booru.posts_tag_arrays)),
+     names AS (SELECT pt.post_id,
+                      list(t.name ORDER BY t.name) FILTER (WHERE pt.category = 0) AS general,
+                      list(t.name ORDER BY t.name) FILTER (WHERE pt.category = 1) AS artist,
+                      list(t.name ORDER BY t.name) FILTER (WHERE pt.category = 3) AS copyright,
+                      list(t.name ORDER BY t.name) FILTER (WHERE pt.category = 4) AS character,
+                      list(t.name ORDER BY t.name) FILTER (WHERE pt.category = 5) AS meta
+               FROM post_tags pt
+                        JOIN booru.tags t ON t.id = pt.tag_id
+               GROUP BY pt.post_id)
+SELECT p.id AS post_id,
+       p.created_at,
+       p.score,
+       p.rating,
+       p.fav_count,
+       n.general,
+       n.artist,
+       n.copyright,
+       n.character,
+       n.meta
+FROM booru.posts p
+         JOIN
+     booru.posts_tag_arrays a ON p.id = a.post_id
+         LEFT JOIN
+     names n ON n.post_id = p.id
+WHERE len(a.tag_ids) > 0""", ("posts", "tags")),
+    # `float` is single precision in DuckDB
+    Relation(
+        "booru.view_post_aspect_ratio", """SELECT p.id,
+       p.width,
+       p.height,
+       p.width::double / p.height::double AS aspect_ratio,
+       CASE
+           WHEN width::double / height::double <= (9.0 / 21) THEN '(0, 9/21]'
+           WHEN width::double / height::double <= (9.0 / 16) THEN '(9/21, 9/16]'
+           WHEN width::double / height::double <= (3.0 / 4) THEN '(9/16, 3/4]'
+           WHEN width::double / height::double < 1.0 THEN '(3/4, 1)'
+           WHEN width::double / height::double = 1.0 THEN '1'
+           WHEN width::double / height::double <= (4.0 / 3) THEN '(1, 4/3]'
+           WHEN width::double / height::double <= (16.0 / 9) THEN '(4/3, 16/9]'
+           WHEN width::double / height::double <= (21.0 / 9) THEN '(16/9, 21/9]'
+           ELSE '(21/9, inf)'
+           END                            AS aspect_ratio_bucket
+FROM booru.posts p""", ("posts",)),
+    # playground.sql
+    Relation(
+        "booru.view_modern_posts", """SELECT *
+FROM booru.posts p
+WHERE p.created_at > '2015-01-01'""", ("posts",)),
+    Relation(
+        "booru.view_posts_tags", """SELECT a.post_id as id,
+       a.tag_ids as tag_ids
+FROM booru.posts_tag_arrays a
+WHERE len(a.tag_ids) > 0""", ("posts", "tags")),
+    # an anti-join on the posts of the excluded tags, `list_has_any` against their list is
+    # evaluated as a nested loop join
+    Relation(
+        "booru.view_posts_illustration_only", """SELECT p.id,
+       p.created_at,
+       p.score,
+       p.fav_count,
+       pt.tag_ids as tag_ids
+FROM booru.view_posts_tags pt
+         INNER JOIN booru.posts p on pt.id = p.id
+WHERE pt.id NOT IN (SELECT pta.post_id
+                    FROM booru.posts_tags_assoc pta
+                             JOIN booru.tags t ON t.id = pta.tag_id
+                    WHERE t.name IN ('video', 'sound', 'animated')
+                       OR (t.category = 0 AND (t.name LIKE '%comic' OR t.name LIKE '%4koma')))""",
+        ("posts", "tags")),
+    Relation(
+        "booru.view_modern_posts_illustration_only", """SELECT distinct p.id      as post_id,
+                p.created_at,
+                p.score,
+                p.fav_count,
+                p.tag_ids as tag_ids
+FROM booru.view_modern_posts vmp
+         INNER JOIN booru.view_posts_illustration_only p on p.id = vmp.id""", ("posts", "tags"),
+        True),
+    # the tag ids of a post are its associations, unnested instead of joined back
+    Relation(
+        "booru.view_posts_count_illustration_only", """SELECT t.id               AS tag_id,
+       COUNT(p.post_id)   AS post_count
+FROM booru.tags t
+         INNER JOIN (SELECT post_id, unnest(tag_ids) AS tag_id
+                     FROM booru.view_modern_posts_illustration_only) p on t.id = p.tag_id
+GROUP BY t.id""", ("posts", "tags"), True),
+    # the incremental counts of explore.sql, the same posts
+    Relation("booru.illustration_tag_counts",
+             "SELECT tag_id, post_count FROM booru.view_posts_count_illustration_only",
+             ("posts", "tags")),
+    Relation(
+        "booru.artists_with_n_posts", """SELECT t.id      as tag_id,
+       artist_id as artist_id,
+       t.name    as tag_name,
+       post_count
+FROM booru.artists
+         INNER JOIN booru.artist_tags_assoc ata on artists.id = ata.artist_id
+         INNER JOIN booru.tags t on ata.tag_id = t.id
+         INNER JOIN booru.tag_post_counts tpc on t.id = tpc.tag_id
+WHERE tpc.post_count > 100
+GROUP BY t.id, artist_id, t.name, post_count""", ("posts", "tags", "artists")),
+    Relation(
+        "booru.view_artist_illustration_only_100", """SELECT t.id      as tag_id,
+       artist_id as artist_id,
+       t.name    as tag_name,
+       post_count
+FROM booru.artists
+         INNER JOIN booru.artist_tags_assoc ata on artists.id = ata.artist_id
+         INNER JOIN booru.tags t on ata.tag_id = t.id
+         INNER JOIN booru.view_posts_count_illustration_only pc on t.id = pc.tag_id
+WHERE pc.post_count > 100
+GROUP BY t.id, artist_id, t.name, post_count""", ("posts", "tags", "artists")),
+]
+
+
+class QueryBackend(Protocol):
+    name: str
+
+    async def get_df(self, sql: str) -> pl.DataFrame:
+        ...
+
+
+def require_duckdb() -> None:
+    if duckdb is None:
+        raise ImportError("the DuckDB backend needs duckdb, `pip install duckdb`")
+
+
+class PostgresBackend:
+    """The loaded database, through `get_df_by_sql_arrow`"""
+    name = "postgres"
+
+    def __init__(self, conn_info: str, method: StreamMethod = "auto"):
+        self.conn_info = conn_info
+        self.method = method
+
+    async def get_df(self, sql: str) -> pl.DataFrame:
+        return await get_df_by_sql_arrow(self.conn_info, sql, method=self.method)
+
+
+def parquet_scan(path: Path) -> str:
+    """`read_parquet` of a file or glob, the `year=` directories of the posts are not a column"""
+    quoted = str(path).replace("'", "''")
+    return f"read_parquet('{quoted}', hive_partitioning = false)"
+
+
+class DuckDBBackend:
+    """
+    An in-memory DuckDB database over the output directory of `dump_data.py to-parquet`.
+
+    `threads` caps the threads of a query, all cores by default. With
+    `materialize`, the relations computed by the database at load time are
+    computed once here too, when the backend is opened. The relations of the
+    entries that were not converted are left out (`relations`).
+    """
+    name = "duckdb"
+
+    def __init__(self,
+                 parquet_dir: str | Path,
+                 threads: Optional[int] = None,
+                 materialize: bool = True):
+        require_duckdb()
+        self.parquet_dir = Path(parquet_dir)
+        if not (self.parquet_dir / "posts").is_dir():
+            raise FileNotFoundError(
+                f"no posts in {self.parquet_dir}, run `dump_data.py to-parquet -o {parquet_dir}`")
+        self.conn = duckdb.connect()
+        if threads is not None:
+            self.conn.execute(f"SET threads = {int(threads)}")
+        self.conn.execute("CREATE SCHEMA booru")
+        start = time.perf_counter()
+        self.relations = self.create_relations(materialize)
+        self.open_seconds = time.perf_counter() - start
+        logger.info("Opened {} relations over {} in {:.2f}s".format(
+            len(self.relations), self.parquet_dir, self.open_seconds))
+
+    def create_relations(self, materialize: bool) -> List[str]:
+        scans = {
+            entry: parquet_scan(self.parquet_dir / pattern)
+            for entry, pattern in PARQUET_FILES.items()
+            if any(self.parquet_dir.glob(pattern))
+        }
+        created = []
+        for relation in RELATIONS:
+            if not all(entry in scans for entry in relation.entries):
+                continue
+            kind = "TABLE" if materialize and relation.materialized else "VIEW"
+            self.conn.execute(
+                f"CREATE {kind} {relation.name} AS {relation.sql.format(**scans)}")
+            created.append(relation.name)
+        return created
+
+    def query(self, sql: str) -> pl.DataFrame:
+        """Run `sql` on a cursor of its own, the Arrow result becomes the data frame as is"""
+        with self.conn.cursor() as cur:
+            table = cur.execute(sql).fetch_arrow_table()
+        return pl.from_arrow(table)    # type: ignore
+
+    async def get_df(self, sql: str) -> pl.DataFrame:
+        return await asyncio.to_thread(self.query, sql)
+
+    def close(self) -> None:
+        self.conn.close()
+
+
+def open_backend(backend: Backend, conn_info: str, parquet_dir: str | Path,
+                 **options: Any) -> QueryBackend:
+    if backend == "duckdb":
+        return DuckDBBackend(parquet_dir, **options)
+    return PostgresBackend(conn_info, **options)
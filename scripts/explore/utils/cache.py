@@ -0,0 +1,189 @@
+"""
+Persistent cache of query results, one Parquet file per result.
+
+Entries are keyed by the normalized SQL text (comments and whitespace do not
+matter) and a fingerprint of the database: its name and the ingest generation
+that `dump_data.py` bumps whenever a command that writes finishes. A re-ingest
+therefore misses every entry, and the stale files of the previous generation
+are deleted on the next lookup. The total size of the files is bounded, the
+least recently used ones are evicted first.
+
+    cache = QueryCache()
+    df = await cache.get_df(conn_info, "SELECT ...")
+"""
+from typing import Dict, Optional, List, Any
+from pathlib import Path
+from loguru import logger
+from pydantic import BaseModel
+import hashlib
+import os
+import re
+import psycopg
+import polars as pl
+import pyarrow.parquet as pq
+from utils.db import get_df_by_sql_arrow
+
+DEFAULT_CACHE_DIR = Path(__file__).parent.parent / ".query_cache"
+DEFAULT_MAX_BYTES = 2 << 30
+
+# string literals and quoted identifiers are kept as is
+SQL_TOKENS = re.compile(r"""('(?:[^']|'')*'|"(?:[^"]|"")*")|--[^\n]*|/\*.*?\*/|(\s+)""", re.S)
+
+
+def normalize_sql(sql: str) -> str:
+    """Drop comments and collapse whitespace outside of literals, drop the trailing `;`"""
+
+    def replace(m: re.Match[str]) -> str:
+        if m.group(1) is not None:
+            return m.group(1)
+        return " "
+
+    return SQL_TOKENS.sub(replace, sql).strip().rstrip(";").strip()
+
+
+async def db_fingerprint(conn_info: str) -> str:
+    """
+    `<database>-g<generation>` from `booru.ingest_generation`.
+
+    Databases loaded before the table existed fall back to the write counters
+    of `pg_stat_user_tables`, which also change on every load.
+    """
+    async with await psycopg.AsyncConnection.connect(conninfo=conn_info) as conn:
+        async with conn.cursor() as cur:
+            await cur.execute("SELECT current_database(), to_regclass('booru.ingest_generation')")
+            row = await cur.fetchone()
+            assert row is not None
+            database = re.sub(r"\W", "_", row[0])
+            if row[1] is not None:
+                await cur.execute("SELECT generation FROM booru.ingest_generation WHERE id = 1")
+                generation = await cur.fetchone()
+                if generation is not None:
+                    return f"{database}-g{generation[0]}"
+            await cur.execute("SELECT coalesce(sum(n_tup_ins + n_tup_upd + n_tup_del), 0) "
+                              "FROM pg_stat_user_tables WHERE schemaname = 'booru'")
+            stat = await cur.fetchone()
+            assert stat is not None
+            return f"{database}-s{stat[0]}"
+
+
+class CacheStats(BaseModel):
+    hits: int = 0
+    misses: int = 0
+    evictions: int = 0
+    invalidations: int = 0
+    entries: int = 0
+    bytes: int = 0
+
+    @property
+    def hit_rate(self) -> float:
+        lookups = self.hits + self.misses
+        return self.hits / lookups if lookups else 0.0
+
+
+class CacheEntry(BaseModel):
+    path: Path
+    fingerprint: str
+    sql: str
+    bytes: int
+    last_used: float
+
+
+class QueryCache:
+    """
+    Size-bounded LRU cache of query results on disk.
+
+    A file is named `<fingerprint>-<hash of the SQL and options>.parquet` and
+    holds the normalized SQL in its metadata. A hit refreshes its mtime, which
+    is the LRU order. The statistics count the lookups of this instance.
+    """
+
+    def __init__(self,
+                 cache_dir: str | Path = DEFAULT_CACHE_DIR,
+                 max_bytes: int = DEFAULT_MAX_BYTES):
+        self.cache_dir = Path(cache_dir)
+        self.max_bytes = max_bytes
+        self.stats = CacheStats()
+        self._fingerprint: Optional[str] = None
+
+    def path(self, fingerprint: str, sql: str, options: Dict[str, Any]) -> Path:
+        key = normalize_sql(sql) + "\0" + repr(sorted(options.items()))
+        digest = hashlib.sha1(key.encode()).hexdigest()[:20]
+        return self.cache_dir / f"{fingerprint}-{digest}.parquet"
+
+    async def get_df(self, conn_info: str, sql: str, **options: Any) -> pl.DataFrame:
+        """`get_df_by_sql_arrow(conn_info, sql, **options)`, from the cache if possible"""
+        fingerprint = await db_fingerprint(conn_info)
+        if fingerprint != self._fingerprint:
+            self.invalidate(fingerprint)
+            self._fingerprint = fingerprint
+        path = self.path(fingerprint, sql, options)
+        if path.exists():
+            self.stats.hits += 1
+            os.utime(path)
+            return pl.read_parquet(path)
+        self.stats.misses += 1
+        df = await get_df_by_sql_arrow(conn_info, sql, **options)
+        self.cache_dir.mkdir(parents=True, exist_ok=True)
+        tmp = path.with_suffix(".tmp")
+        table = df.to_arrow()
+        metadata = {**(table.schema.metadata or {}), b"sql": normalize_sql(sql).encode()}
+        table = table.replace_schema_metadata(metadata)
+        pq.write_table(table, tmp, compression="zstd")
+        os.replace(tmp, path)
+        self.evict()
+        return df
+
+    def entries(self) -> List[CacheEntry]:
+        """Every cached result, least recently used first"""
+        entries: List[CacheEntry] = []
+        for path in self.cache_dir.glob("*.parquet"):
+            try:
+                stat = path.stat()
+                metadata = pq.read_schema(path).metadata or {}
+            except (FileNotFoundError, OSError):
+                # evicted by another process in the meantime
+                continue
+            entries.append(
+                CacheEntry(path=path,
+                           fingerprint=path.stem.rsplit("-", 1)[0],
+                           sql=metadata.get(b"sql", b"").decode(),
+                           bytes=stat.st_size,
+                           last_used=stat.st_mtime))
+        return sorted(entries, key=lambda e: e.last_used)
+
+    def evict(self) -> None:
+        """Delete the least recently used results until the cache fits in `max_bytes`"""
+        entries = self.entries()
+        total = sum(e.bytes for e in entries)
+        for entry in entries:
+            if total <= self.max_bytes:
+                break
+            entry.path.unlink(missing_ok=True)
+            total -= entry.bytes
+            self.stats.evictions += 1
+            logger.debug("Evicted {} ({} bytes)".format(entry.path.name, entry.bytes))
+
+    def invalidate(self, fingerprint: Optional[str] = None) -> int:
+        """
+        Delete the results of another generation of the same database, or
+        every result if `fingerprint` is None. Returns the number deleted.
+        """
+        database = fingerprint.rsplit("-", 1)[0] if fingerprint is not None else None
+        count = 0
+        for entry in self.entries():
+            same_database = entry.fingerprint.rsplit("-", 1)[0] == database
+            if database is None or (same_database and entry.fingerprint != fingerprint):
+                entry.path.unlink(missing_ok=True)
+                count += 1
+        self.stats.invalidations += count
+        if count:
+            logger.info("Invalidated {} cached results".format(count))
+        return count
+
+    def info(self) -> CacheStats:
+        """Statistics of this instance with the current entries and size on disk"""
+        entries = self.entries()
+        return self.stats.model_copy(update={
+            "entries": len(entries),
+            "bytes": sum(e.bytes for e in entries),
+        })
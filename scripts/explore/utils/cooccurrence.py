@@ -0,0 +1,388 @@
+"""
+Sparse tag co-occurrence matrix, built by streaming posts in parallel chunks.
+
+Replaces the hand-picked "related" tags of the `best artists for ...` queries:
+the tags on at least `min_posts` posts are numbered by id, and every chunk of
+posts is turned into the sorted (tag pair, posts) counts of its upper triangle
+by a worker process, which spills them to a run file. The runs are merged by
+key range, never more than about `max_pairs` pairs in memory, and the merged
+triangle is mirrored into a symmetric CSR matrix of `.npy` files, which the
+queries memory-map:
+
+    matrix = Cooccurrence("cooccurrence")
+    matrix.related("pantyhose", k=20, by="pmi")
+"""
+from typing import Dict, Optional, List, Literal, Iterable, Iterator, NamedTuple, Any
+from concurrent.futures import Future, ProcessPoolExecutor
+from pathlib import Path
+from loguru import logger
+from pydantic import BaseModel
+from psycopg import Connection
+import json
+import os
+import shutil
+import tempfile
+import numpy as np
+
+RelatedBy = Literal["count", "pmi", "jaccard"]
+RELATED_BY: tuple[RelatedBy, ...] = ("count", "pmi", "jaccard")
+
+# (offsets, tags) of a chunk of posts, the tags of post i are tags[offsets[i]:offsets[i + 1]],
+# as sorted matrix indexes
+Chunk = tuple[np.ndarray, np.ndarray]
+
+
+class CooccurrenceOptions(BaseModel):
+    # tags on fewer posts are left out of the matrix
+    min_posts: int = 100
+    # posts counted by a worker at once
+    chunk_posts: int = 20_000
+    workers: int = os.cpu_count() or 1
+    # pairs held in memory by the merge
+    max_pairs: int = 20_000_000
+    # directory of the run files, the system temporary directory if None
+    spill_dir: Optional[Path] = None
+
+
+class Related(NamedTuple):
+    name: str
+    tag_id: int
+    count: int
+    score: float
+
+
+def count_pairs(offsets: np.ndarray, tags: np.ndarray, n: int) -> tuple[np.ndarray, np.ndarray]:
+    """
+    Sorted keys `i * n + j` (i < j) of the tag pairs of a chunk and their number of posts.
+
+    The posts are grouped by number of tags, so the pairs of a group are one
+    fancy-indexing of its (posts, tags) matrix.
+    """
+    sizes = np.diff(offsets)
+    parts: List[np.ndarray] = []
+    for size in np.unique(sizes[sizes > 1]).tolist():
+        starts = offsets[:-1][sizes == size]
+        rows = tags[starts[:, None] + np.arange(size)].astype(np.int64)
+        first, second = np.triu_indices(size, 1)
+        parts.append((rows[:, first] * n + rows[:, second]).ravel())
+    if not parts:
+        return np.empty(0, dtype=np.int64), np.empty(0, dtype=np.uint32)
+    keys, counts = np.unique(np.concatenate(parts), return_counts=True)
+    return keys, counts.astype(np.uint32)
+
+
+def count_chunk(path: Path, offsets: np.ndarray, tags: np.ndarray, n: int) -> tuple[Path, int]:
+    """Worker: count the pairs of a chunk into the run `path`"""
+    keys, counts = count_pairs(offsets, tags, n)
+    np.save(path.with_suffix(".keys.npy"), keys)
+    np.save(path.with_suffix(".counts.npy"), counts)
+    return path, len(keys)
+
+
+def open_run(path: Path) -> tuple[np.ndarray, np.ndarray]:
+    return (np.load(path.with_suffix(".keys.npy"), mmap_mode="r"),
+            np.load(path.with_suffix(".counts.npy"), mmap_mode="r"))
+
+
+def key_boundaries(runs: List[tuple[np.ndarray, np.ndarray]], total: int,
+                   max_pairs: int) -> List[int]:
+    """Split points of the key space into ranges of about `max_pairs` pairs over every run"""
+    blocks = -(-total // max_pairs)
+    if blocks <= 1:
+        return []
+    # every run sampled at the same rate
+    step = max(total // (blocks * 1000), 1)
+    sample = np.sort(np.concatenate([keys[::step] for keys, _ in runs]))
+    quantiles = sample[(np.arange(1, blocks) * len(sample)) // blocks]
+    return np.unique(quantiles).tolist()
+
+
+def merge_runs(runs: List[tuple[np.ndarray, np.ndarray]], total: int, n: int, max_pairs: int,
+               keys_path: Path, counts_path: Path) -> tuple[np.ndarray, np.ndarray]:
+    """
+    Sum the counts of the same pairs over the runs into two raw files, in key order.
+
+    Returns the number of pairs of every row and of every column of the triangle.
+    """
+    row_pairs = np.zeros(n, dtype=np.int64)
+    col_pairs = np.zeros(n, dtype=np.int64)
+    bounds = [None] + key_boundaries(runs, total, max_pairs) + [None]
+    with open(keys_path, "wb") as keys_file, open(counts_path, "wb") as counts_file:
+        for lo, hi in zip(bounds[:-1], bounds[1:]):
+            parts_keys: List[np.ndarray] = []
+            parts_counts: List[np.ndarray] = []
+            for keys, counts in runs:
+                start = 0 if lo is None else int(np.searchsorted(keys, lo))
+                end = len(keys) if hi is None else int(np.searchsorted(keys, hi))
+                parts_keys.append(keys[start:end])
+                parts_counts.append(counts[start:end])
+            keys = np.concatenate(parts_keys)
+            if not len(keys):
+                continue
+            order = np.argsort(keys, kind="stable")
+            keys, counts = keys[order], np.concatenate(parts_counts)[order]
+            first = np.flatnonzero(np.diff(keys, prepend=-1))
+            keys, counts = keys[first], np.add.reduceat(counts, first, dtype=np.uint32)
+            row_pairs += np.bincount(keys // n, minlength=n)
+            col_pairs += np.bincount(keys % n, minlength=n)
+            keys_file.write(keys.tobytes())
+            counts_file.write(counts.tobytes())
+    return row_pairs, col_pairs
+
+
+def mirror(keys: np.ndarray, counts: np.ndarray, row_pairs: np.ndarray, col_pairs: np.ndarray,
+           n: int, output: Path, max_pairs: int) -> None:
+    """
+    Write the symmetric CSR matrix of the merged triangle, `max_pairs` pairs at a time.
+
+    Row i holds the pairs (j, i) with j < i of the columns of the triangle, in
+    the key order they are read, then its own pairs (i, j) with j > i.
+    """
+    indptr = np.zeros(n + 1, dtype=np.int64)
+    np.cumsum(row_pairs + col_pairs, out=indptr[1:])
+    # start of each row of the triangle in `keys`
+    row_starts = np.zeros(n, dtype=np.int64)
+    np.cumsum(row_pairs[:-1], out=row_starts[1:])
+    cursor = indptr[:-1].copy()
+    np.save(output / "indptr.npy", indptr)
+    shape = (int(indptr[-1]),)
+    indices = np.lib.format.open_memmap(output / "indices.npy", "w+", np.int32, shape)
+    values = np.lib.format.open_memmap(output / "values.npy", "w+", np.uint32, shape)
+    for start in range(0, len(keys), max_pairs):
+        block_keys = np.asarray(keys[start:start + max_pairs])
+        block_counts = np.asarray(counts[start:start + max_pairs])
+        rows, cols = block_keys // n, block_keys % n
+        position = np.arange(start, start + len(block_keys))
+        upper = indptr[rows] + col_pairs[rows] + position - row_starts[rows]
+        indices[upper], values[upper] = cols, block_counts
+        order = np.argsort(cols, kind="stable")
+        sorted_cols = cols[order]
+        group_starts = np.flatnonzero(np.diff(sorted_cols, prepend=-1))
+        rank = np.arange(len(order)) - np.repeat(group_starts, np.diff(
+            np.append(group_starts, len(order))))
+        lower = cursor[sorted_cols] + rank
+        indices[lower], values[lower] = rows[order], block_counts[order]
+        cursor += np.bincount(cols, minlength=n)
+    indices.flush()
+    values.flush()
+
+
+def build_cooccurrence(chunks: Iterable[Chunk],
+                       tag_ids: np.ndarray,
+                       names: List[str],
+                       tag_counts: np.ndarray,
+                       n_posts: int,
+                       output: str | Path,
+                       options: CooccurrenceOptions = CooccurrenceOptions()) -> int:
+    """
+    Count the pairs of the chunks into the matrix directory `output`, returns its number of pairs.
+
+    `tag_ids`, `names` and `tag_counts` (posts of each tag) describe the matrix
+    indexes used by the chunks, in order.
+    """
+    output = Path(output)
+    output.mkdir(parents=True, exist_ok=True)
+    n = len(tag_ids)
+    spill = Path(tempfile.mkdtemp(prefix="cooccurrence-", dir=options.spill_dir))
+    try:
+        paths: List[Path] = []
+        total = 0
+        with ProcessPoolExecutor(options.workers) as pool:
+            pending: List[Future] = []
+            for i, (offsets, tags) in enumerate(chunks):
+                pending.append(pool.submit(count_chunk, spill / f"run{i:06d}", offsets, tags, n))
+                # only a few chunks wait for a worker, the rest are still being read
+                while len(pending) > 2 * options.workers or (pending and pending[0].done()):
+                    path, pairs = pending.pop(0).result()
+                    paths.append(path)
+                    total += pairs
+            for future in pending:
+                path, pairs = future.result()
+                paths.append(path)
+                total += pairs
+        logger.info("Counted {} chunks into {} partial pairs".format(len(paths), total))
+        runs = [open_run(path) for path in paths]
+        keys_path, counts_path = spill / "merged.keys", spill / "merged.counts"
+        row_pairs, col_pairs = merge_runs(runs, total, n, options.max_pairs, keys_path,
+                                          counts_path)
+        del runs
+        pairs = int(row_pairs.sum())
+        keys = np.memmap(keys_path, dtype=np.int64, mode="r") if pairs else np.empty(0, np.int64)
+        counts = (np.memmap(counts_path, dtype=np.uint32, mode="r")
+                  if pairs else np.empty(0, np.uint32))
+        mirror(keys, counts, row_pairs, col_pairs, n, output, options.max_pairs)
+        del keys, counts
+    finally:
+        shutil.rmtree(spill, ignore_errors=True)
+    np.save(output / "tag_ids.npy", np.asarray(tag_ids, dtype=np.int32))
+    np.save(output / "tag_counts.npy", np.asarray(tag_counts, dtype=np.int64))
+    np.save(output / "names.npy", np.frombuffer("\n".join(names).encode(), dtype=np.uint8))
+    with open(output / "meta.json", "w") as f:
+        json.dump({"posts": n_posts, "tags": n, "pairs": pairs, **options.model_dump(mode="json")},
+                  f)
+    logger.info("Wrote {} tags and {} pairs to {}".format(n, pairs, output))
+    return pairs
+
+
+def frequent_tags(counts: Dict[int, int], names: Dict[int, str],
+                  min_posts: int) -> tuple[np.ndarray, List[str], np.ndarray]:
+    """Ids, names and counts of the tags on at least `min_posts` posts, by id"""
+    # the negative ids of the tags created for unknown names are left out
+    kept = sorted(i for i, count in counts.items()
+                  if count >= min_posts and i >= 0 and i in names)
+    tag_ids = np.array(kept, dtype=np.int32)
+    return (tag_ids, [names[i] for i in tag_ids.tolist()],
+            np.array([counts[i] for i in tag_ids.tolist()], dtype=np.int64))
+
+
+def chunk_tag_lists(tag_lists: Iterable[List[int]], chunk_posts: int) -> Iterator[Chunk]:
+    """Chunks of `chunk_posts` posts from the matrix indexes of each post"""
+    sizes: List[int] = []
+    tags: List[int] = []
+    for post_tags in tag_lists:
+        sizes.append(len(post_tags))
+        tags += sorted(post_tags)
+        if len(sizes) == chunk_posts:
+            yield np.cumsum([0] + sizes), np.array(tags, dtype=np.int32)
+            sizes, tags = [], []
+    if sizes:
+        yield np.cumsum([0] + sizes), np.array(tags, dtype=np.int32)
+
+
+def count_posts_tags(posts: Iterable[Dict[str, Any]],
+                     tags: Dict[str, tuple[int, int]]) -> tuple[Dict[int, int], int]:
+    """Posts of every tag id and number of posts of the raw posts dump"""
+    counts: Dict[int, int] = {}
+    n_posts = 0
+    for post in posts:
+        n_posts += 1
+        for tag in post["tag_string"].split(" "):
+            found = tags.get(tag)
+            if found is not None:
+                counts[found[0]] = counts.get(found[0], 0) + 1
+    return counts, n_posts
+
+
+def posts_tag_lists(posts: Iterable[Dict[str, Any]], index: Dict[str, int]) -> Iterator[List[int]]:
+    """Matrix indexes of the tags of each raw post, `index` maps a tag name to its index"""
+    for post in posts:
+        yield [i for i in map(index.get, post["tag_string"].split(" ")) if i is not None]
+
+
+def db_tag_counts(conn: Connection) -> tuple[Dict[int, int], Dict[int, str], int]:
+    """Posts of every tag from `booru.tag_post_counts`, tag names and number of posts"""
+    with conn.cursor() as c:
+        c.execute("SELECT tag_id, post_count FROM booru.tag_post_counts")
+        counts: Dict[int, int] = dict(c.fetchall())    # type: ignore
+        c.execute("SELECT id, name FROM booru.tags")
+        names: Dict[int, str] = dict(c.fetchall())    # type: ignore
+        c.execute("SELECT count(*) FROM booru.posts")
+        row = c.fetchone()
+    conn.commit()
+    return counts, names, row[0] if row is not None else 0
+
+
+def db_chunks(conn: Connection, tag_ids: np.ndarray, chunk_posts: int,
+              batch_size: int = 250_000) -> Iterator[Chunk]:
+    """Chunks of `booru.posts_tags_assoc` in post order, only the tags of `tag_ids`"""
+    # negative ids (tags created for unknown names) would wrap around in `lookup`
+    known = np.flatnonzero(tag_ids >= 0)
+    lookup = np.full(int(tag_ids.max(initial=0)) + 1, -1, dtype=np.int32)
+    lookup[tag_ids[known]] = known.astype(np.int32)
+    post_ids = np.empty(0, dtype=np.int64)
+    tags = np.empty(0, dtype=np.int32)
+    with conn.cursor(name="cooccurrence_assoc") as c:
+        c.itersize = batch_size
+        c.execute("SELECT post_id, tag_id FROM booru.posts_tags_assoc ORDER BY post_id, tag_id")
+        while True:
+            rows = c.fetchmany(batch_size)
+            if rows:
+                batch = np.array(rows, dtype=np.int64)
+                batch = batch[(batch[:, 1] >= 0) & (batch[:, 1] < len(lookup))]
+                index = lookup[batch[:, 1]]
+                kept = index >= 0
+                post_ids = np.concatenate([post_ids, batch[kept, 0]])
+                tags = np.concatenate([tags, index[kept]])
+            starts = np.flatnonzero(np.diff(post_ids, prepend=-1))
+            # the last post may continue in the next batch
+            complete = len(starts) - 1 if rows else len(starts)
+            while complete >= chunk_posts or (not rows and complete > 0):
+                posts = min(complete, chunk_posts)
+                end = starts[posts] if posts < len(starts) else len(post_ids)
+                offsets = np.append(starts[:posts], end) - starts[0]
+                yield offsets, tags[:end]
+                post_ids, tags = post_ids[end:], tags[end:]
+                starts, complete = starts[posts:] - end, complete - posts
+            if not rows:
+                break
+    conn.commit()
+
+
+class Cooccurrence:
+    """Memory-mapped co-occurrence matrix written by `build_cooccurrence`"""
+
+    def __init__(self, path: str | Path):
+        path = Path(path)
+        with open(path / "meta.json") as f:
+            self.meta: Dict[str, Any] = json.load(f)
+        self.n_posts: int = self.meta["posts"]
+        self.tag_ids = np.load(path / "tag_ids.npy")
+        self.tag_counts = np.load(path / "tag_counts.npy")
+        self.names = np.load(path / "names.npy").tobytes().decode().split("\n")
+        self.indptr = np.load(path / "indptr.npy")
+        self.indices = np.load(path / "indices.npy", mmap_mode="r")
+        self.values = np.load(path / "values.npy", mmap_mode="r")
+        self._index = {name: i for i, name in enumerate(self.names)}
+
+    def node(self, tag: str | int) -> int:
+        """Matrix index of a tag name or id"""
+        if isinstance(tag, str):
+            i = self._index.get(tag)
+        else:
+            i = int(np.searchsorted(self.tag_ids, tag))
+            i = i if i < len(self.tag_ids) and self.tag_ids[i] == tag else None
+        if i is None:
+            raise KeyError(tag)
+        return i
+
+    def count(self, a: str | int, b: str | int) -> int:
+        """Posts having both tags"""
+        i, j = self.node(a), self.node(b)
+        start, end = int(self.indptr[i]), int(self.indptr[i + 1])
+        # the indexes of a row are sorted
+        k = start + int(np.searchsorted(self.indices[start:end], j))
+        return int(self.values[k]) if k < end and self.indices[k] == j else 0
+
+    def related(self,
+                tag: str | int,
+                k: int = 20,
+                by: RelatedBy = "count",
+                min_count: int = 1) -> List[Related]:
+        """
+        The `k` tags scoring best with `tag`, among the ones on `min_count` posts with it.
+
+        `pmi` is log(P(a, b) / (P(a) P(b))) and `jaccard` is
+        |a and b| / |a or b|, both over the posts of the matrix.
+        """
+        i = self.node(tag)
+        start, end = self.indptr[i], self.indptr[i + 1]
+        others = np.asarray(self.indices[start:end])
+        counts = np.asarray(self.values[start:end]).astype(np.float64)
+        kept = counts >= min_count
+        others, counts = others[kept], counts[kept]
+        if by == "count":
+            scores = counts
+        elif by == "pmi":
+            scores = np.log(counts * self.n_posts / (self.tag_counts[i] * self.tag_counts[others]))
+        elif by == "jaccard":
+            scores = counts / (self.tag_counts[i] + self.tag_counts[others] - counts)
+        else:
+            raise ValueError(f"unknown score {by}")
+        top = np.arange(len(scores))
+        if len(scores) > k:
+            top = np.argpartition(-scores, k - 1)[:k]
+        top = top[np.lexsort((others[top], -scores[top]))]
+        return [
+            Related(self.names[j], int(self.tag_ids[j]), int(c), float(s))
+            for j, c, s in zip(others[top].tolist(), counts[top].tolist(), scores[top].tolist())
+        ]
@@ -2,10 +2,15 @@ from loguru import logger
 import psycopg
 from psycopg import Connection
 from psycopg.sql import SQL
+from psycopg.types.numeric import FloatLoader
+from psycopg.types.string import TextLoader
 from typing import Dict, Optional, Generator, List, TypedDict, TypeVar, Iterable, Callable, Any, Sequence
+from typing import AsyncIterator, Literal
 from pydantic import BaseModel
 from pathlib import Path
 import pyarrow as pa
+import pyarrow.compute as pc
+import pyarrow.csv as pacsv
 import polars as pl
 import plotly.express as px
 import plotly.graph_objects as go
@@ -57,4 +62,198 @@ async def get_df_by_sql(conn_info: str, sql: str) -> pl.DataFrame:
             rows = await cur.fetchall()
             assert cur.description is not None
             column_names = [desc[0] for desc in cur.description]
-            return pl.DataFrame(rows, schema=column_names)
+            return pl.DataFrame(rows, schema=column_names, orient="row")
+
+
+StreamMethod = Literal["auto", "copy", "cursor"]
+
+# Postgres type name -> Arrow type of the values decoded from CSV
+ARROW_TYPES: Dict[str, pa.DataType] = {
+    "bool": pa.bool_(),
+    "int2": pa.int16(),
+    "int4": pa.int32(),
+    "int8": pa.int64(),
+    "oid": pa.int64(),
+    "float4": pa.float32(),
+    "float8": pa.float64(),
+    "numeric": pa.float64(),
+    "text": pa.string(),
+    "varchar": pa.string(),
+    "bpchar": pa.string(),
+    "name": pa.string(),
+    "uuid": pa.string(),
+    "json": pa.string(),
+    "jsonb": pa.string(),
+    "date": pa.date32(),
+    "timestamp": pa.timestamp("us"),
+    "timestamptz": pa.timestamp("us", tz="UTC"),
+}
+# element types of the arrays `{1,2,3}` that can be split from their text form
+ARRAY_ELEMENT_TYPES = ("int2", "int4", "int8", "float4", "float8")
+# bytes of COPY data parsed at once
+COPY_BLOCK_SIZE = 16 << 20
+
+
+def sample_sql(sql: str, limit: Optional[int] = None, sample: Optional[float] = None) -> str:
+    """Wrap a query to keep a random `sample` fraction of its rows and/or at most `limit` rows"""
+    sql = sql.strip().rstrip(";")
+    if sample is None and limit is None:
+        return sql
+    where = f" WHERE random() < {float(sample)}" if sample is not None else ""
+    limited = f" LIMIT {int(limit)}" if limit is not None else ""
+    return f"SELECT * FROM ({sql}) AS q{where}{limited}"
+
+
+async def query_schema(conn: psycopg.AsyncConnection, sql: str) -> tuple[pa.Schema, bool]:
+    """
+    Arrow schema of the result of `sql`, and whether every column can be decoded from CSV.
+
+    Columns of an unknown type are read as strings, only arrays of anything but
+    numbers need the cursor path. The loaders of `conn` are set to return the
+    same values as the CSV path, strings for every string column (json, uuid...).
+    """
+    conn.adapters.register_loader("numeric", FloatLoader)
+    async with conn.cursor() as cur:
+        await cur.execute(f"SELECT * FROM ({sql}) AS q LIMIT 0")    # type: ignore
+        assert cur.description is not None
+        fields: List[pa.Field] = []
+        csv_ok = True
+        for desc in cur.description:
+            info = conn.adapters.types.get(desc.type_code)
+            name = info.name if info is not None else ""
+            arrow_type = ARROW_TYPES.get(name, pa.string())
+            if arrow_type == pa.string():
+                conn.adapters.register_loader(info.oid if info is not None else desc.type_code,
+                                              TextLoader)
+            if info is not None and info.array_oid == desc.type_code:
+                arrow_type = pa.list_(arrow_type)
+                csv_ok = csv_ok and name in ARRAY_ELEMENT_TYPES
+            fields.append(pa.field(desc.name, arrow_type))
+    return pa.schema(fields), csv_ok
+
+
+def parse_number_array(strings: pa.Array, value_type: pa.DataType) -> pa.Array:
+    """Vectorized parse of one dimensional Postgres number arrays like `{1,2,3}`"""
+    trimmed = pc.utf8_trim(strings, "{}")
+    lists = pc.split_pattern(trimmed, ",")
+    # `{}` would split into a single empty string
+    lists = pc.if_else(pc.equal(trimmed, ""), pa.scalar([], pa.list_(pa.string())), lists)
+    values = lists.values
+    values = pc.if_else(pc.equal(values, "NULL"), pa.scalar(None, pa.string()), values)
+    return pa.ListArray.from_arrays(lists.offsets,
+                                    values.cast(value_type),
+                                    mask=lists.is_null())
+
+
+def parse_csv_block(block: bytes, schema: pa.Schema) -> pa.Table:
+    """Decode a block of whole rows of `COPY ... (FORMAT csv)` with the Arrow CSV reader"""
+    column_types = {
+        f.name: pa.string() if pa.types.is_list(f.type) else f.type for f in schema
+    }
+    table = pacsv.read_csv(
+        pa.py_buffer(block),
+        read_options=pacsv.ReadOptions(column_names=schema.names),
+        parse_options=pacsv.ParseOptions(newlines_in_values=True),
+        # NULL is an unquoted empty field, an empty string is `""`
+        convert_options=pacsv.ConvertOptions(column_types=column_types,
+                                             true_values=["t"],
+                                             false_values=["f"],
+                                             null_values=[""],
+                                             strings_can_be_null=True,
+                                             quoted_strings_can_be_null=False))
+    for i, field in enumerate(schema):
+        if pa.types.is_list(field.type):
+            column = parse_number_array(table.column(i).combine_chunks(), field.type.value_type)
+            table = table.set_column(i, field, column)
+    return table
+
+
+async def _copy_batches(conn: psycopg.AsyncConnection, sql: str, schema: pa.Schema,
+                        batch_size: int) -> AsyncIterator[pa.RecordBatch]:
+    # in CSV format every chunk of COPY TO data is one whole row, so the
+    # blocks can be cut between chunks even with newlines inside values
+    await conn.execute("SET TIME ZONE 'UTC'")
+    await conn.execute("SET DateStyle = 'ISO'")
+    chunks: List[bytes] = []
+    size = 0
+    async with conn.cursor() as cur:
+        async with cur.copy(f"COPY ({sql}) TO STDOUT (FORMAT csv)") as copy:    # type: ignore
+            async for chunk in copy:
+                chunks.append(bytes(chunk))
+                size += len(chunk)
+                if size >= COPY_BLOCK_SIZE:
+                    for batch in parse_csv_block(b"".join(chunks), schema).to_batches(batch_size):
+                        yield batch
+                    chunks.clear()
+                    size = 0
+    if chunks:
+        for batch in parse_csv_block(b"".join(chunks), schema).to_batches(batch_size):
+            yield batch
+
+
+async def _cursor_batches(conn: psycopg.AsyncConnection, sql: str, schema: pa.Schema,
+                          batch_size: int) -> AsyncIterator[pa.RecordBatch]:
+    # only a batch of rows is ever held as Python objects
+    async with conn.cursor(name="arrow_batches") as cur:
+        await cur.execute(sql)    # type: ignore
+        while rows := await cur.fetchmany(batch_size):
+            columns = [pa.array(col, type=field.type) for col, field in zip(zip(*rows), schema)]
+            yield pa.RecordBatch.from_arrays(columns, schema=schema)
+
+
+async def stream_record_batches(conn_info: str,
+                                sql: str,
+                                batch_size: int = 100_000,
+                                limit: Optional[int] = None,
+                                sample: Optional[float] = None,
+                                seed: Optional[float] = None,
+                                method: StreamMethod = "auto") -> AsyncIterator[pa.RecordBatch]:
+    """
+    Stream the result of `sql` as Arrow record batches of at most `batch_size` rows.
+
+    `copy` decodes `COPY (sql) TO STDOUT` in CSV format with the Arrow CSV
+    reader, without creating a Python object per value; `cursor` fetches
+    `batch_size` rows at a time from a server-side cursor. `auto` uses `copy`
+    unless a column is an array of non-numbers. `sample` keeps a random fraction
+    of the rows, repeatable with `seed` (in [-1, 1]) for serial plans, and
+    `limit` caps the number of rows.
+    """
+    async with await psycopg.AsyncConnection.connect(conninfo=conn_info) as conn:
+        _, batches = await open_record_batches(conn, sql, batch_size, limit, sample, seed, method)
+        async for batch in batches:
+            yield batch
+
+
+async def open_record_batches(
+        conn: psycopg.AsyncConnection,
+        sql: str,
+        batch_size: int = 100_000,
+        limit: Optional[int] = None,
+        sample: Optional[float] = None,
+        seed: Optional[float] = None,
+        method: StreamMethod = "auto") -> tuple[pa.Schema, AsyncIterator[pa.RecordBatch]]:
+    """`stream_record_batches` on an open connection, also returns the schema of the batches"""
+    sql = sample_sql(sql, limit, sample)
+    schema, csv_ok = await query_schema(conn, sql)
+    if method == "copy" and not csv_ok:
+        raise ValueError("arrays of non-numbers can not be decoded from COPY, use `cursor`")
+    if seed is not None:
+        await conn.execute("SELECT setseed(%s)", (seed,))
+    if method == "cursor" or not csv_ok:
+        return schema, _cursor_batches(conn, sql, schema, batch_size)
+    return schema, _copy_batches(conn, sql, schema, batch_size)
+
+
+async def get_df_by_sql_arrow(conn_info: str,
+                              sql: str,
+                              batch_size: int = 100_000,
+                              limit: Optional[int] = None,
+                              sample: Optional[float] = None,
+                              seed: Optional[float] = None,
+                              method: StreamMethod = "auto") -> pl.DataFrame:
+    """`get_df_by_sql` through `stream_record_batches`, the batches are handed to polars as is"""
+    async with await psycopg.AsyncConnection.connect(conninfo=conn_info) as conn:
+        schema, batches = await open_record_batches(conn, sql, batch_size, limit, sample, seed,
+                                                    method)
+        table = pa.Table.from_batches([batch async for batch in batches], schema=schema)
+    return pl.from_arrow(table)    # type: ignore
@@ -0,0 +1,185 @@
+"""
+Capture and archive query plans.
+
+Runs a query under `EXPLAIN (ANALYZE, BUFFERS, FORMAT JSON)` and keeps the
+plan next to its text rendering, the way `data/random_posts_performance.csv`
+was captured by hand. Every capture is also appended to `plans.csv` in the
+archive directory, so the timings of a query can be followed across loads
+and schema changes.
+
+    with psycopg.connect(conn_info) as conn:
+        summary = archive_plan(conn, "SELECT ...", "random_posts")
+"""
+from typing import Dict, List, Optional, Any, Sequence
+from datetime import datetime, timezone
+from pathlib import Path
+from pydantic import BaseModel
+import csv
+import hashlib
+import json
+import re
+import psycopg
+from utils.cache import normalize_sql
+
+DEFAULT_PLAN_DIR = Path(__file__).parents[3] / "data" / "plans"
+
+
+class PlanSummary(BaseModel):
+    """The headline numbers of a plan, one row of `plans.csv`"""
+    name: str
+    captured_at: datetime
+    # `db_fingerprint` of the database the plan was taken on, if known
+    database: str = ""
+    sql_hash: str
+    execution_ms: float
+    planning_ms: float
+    rows: int
+    shared_hit: int
+    shared_read: int
+    temp_written: int
+    # the JSON plan, relative to the archive directory
+    file: str = ""
+
+
+def explain(conn: psycopg.Connection,
+            sql: str,
+            params: Optional[Sequence[Any] | Dict[str, Any]] = None) -> Dict[str, Any]:
+    """The JSON plan of a query, which is executed, with its buffer counts"""
+    explain_sql = "EXPLAIN (ANALYZE, BUFFERS, FORMAT JSON) " + sql
+    row = conn.execute(explain_sql, params).fetchone()    # type: ignore
+    assert row is not None
+    return (json.loads(row[0]) if isinstance(row[0], str) else row[0])[0]
+
+
+def summarize(plan: Dict[str, Any],
+              name: str = "",
+              sql: str = "",
+              database: str = "") -> PlanSummary:
+    top = plan["Plan"]
+    return PlanSummary(name=name,
+                       captured_at=datetime.now(timezone.utc),
+                       database=database,
+                       sql_hash=hashlib.sha1(normalize_sql(sql).encode()).hexdigest()[:12],
+                       execution_ms=plan["Execution Time"],
+                       planning_ms=plan["Planning Time"],
+                       rows=top["Actual Rows"],
+                       shared_hit=top.get("Shared Hit Blocks", 0),
+                       shared_read=top.get("Shared Read Blocks", 0),
+                       temp_written=top.get("Temp Written Blocks", 0))
+
+
+def node_line(node: Dict[str, Any]) -> str:
+    label = node["Node Type"]
+    if "Relation Name" in node:
+        label += " on " + node["Relation Name"]
+        if node.get("Alias", node["Relation Name"]) != node["Relation Name"]:
+            label += " " + node["Alias"]
+    elif "CTE Name" in node:
+        label += " on " + node["CTE Name"]
+    if "Index Name" in node:
+        label += " using " + node["Index Name"]
+    line = "{}  (cost={:.2f}..{:.2f} rows={} width={}) ".format(label, node["Startup Cost"],
+                                                               node["Total Cost"],
+                                                               node["Plan Rows"],
+                                                               node["Plan Width"])
+    if not node["Actual Loops"]:
+        # e.g. a partition pruned while executing
+        return line + "(never executed)"
+    return line + "(actual time={:.3f}..{:.3f} rows={} loops={})".format(
+        node["Actual Startup Time"], node["Actual Total Time"], node["Actual Rows"],
+        node["Actual Loops"])
+
+
+def buffers_line(node: Dict[str, Any]) -> Optional[str]:
+    parts = []
+    for kind in ("Shared", "Temp"):
+        counts = [
+            "{}={}".format(what.lower(), node[f"{kind} {what} Blocks"])
+            for what in ("Hit", "Read", "Dirtied", "Written")
+            if node.get(f"{kind} {what} Blocks")
+        ]
+        if counts:
+            parts.append("{} {}".format(kind.lower(), " ".join(counts)))
+    return "Buffers: " + ", ".join(parts) if parts else None
+
+
+# conditions shown under a node, as in the text format
+CONDITIONS = ("Index Cond", "Recheck Cond", "Filter", "Join Filter", "Hash Cond", "Sort Key")
+
+
+def plan_text(plan: Dict[str, Any]) -> str:
+    """A rendering of the JSON plan close to `EXPLAIN (ANALYZE, BUFFERS)`"""
+    lines: List[str] = []
+
+    def walk(node: Dict[str, Any], depth: int) -> None:
+        indent = " " * max(6 * depth - 4, 0)
+        detail = " " * (6 * depth + 2)
+        if node.get("Subplan Name"):
+            lines.append(indent + node["Subplan Name"])
+        lines.append(indent + ("->  " if depth else "") + node_line(node))
+        for key in CONDITIONS:
+            value = node.get(key)
+            if value:
+                lines.append(detail + "{}: {}".format(
+                    key, ", ".join(value) if isinstance(value, list) else value))
+        if node.get("Rows Removed by Filter"):
+            lines.append(detail +
+                         "Rows Removed by Filter: {}".format(node["Rows Removed by Filter"]))
+        # partitions pruned while executing, those pruned by the planner are not in the plan
+        if node.get("Subplans Removed"):
+            lines.append(detail + "Subplans Removed: {}".format(node["Subplans Removed"]))
+        buffers = buffers_line(node)
+        if buffers:
+            lines.append(detail + buffers)
+        for child in node.get("Plans", []):
+            walk(child, depth + 1)
+
+    walk(plan["Plan"], 0)
+    lines.append("Planning Time: {:.3f} ms".format(plan["Planning Time"]))
+    lines.append("Execution Time: {:.3f} ms".format(plan["Execution Time"]))
+    return "\n".join(lines) + "\n"
+
+
+def archive_plan(conn: psycopg.Connection,
+                 sql: str,
+                 name: str,
+                 archive_dir: str | Path = DEFAULT_PLAN_DIR,
+                 params: Optional[Sequence[Any] | Dict[str, Any]] = None,
+                 database: str = "") -> PlanSummary:
+    """
+    Explain a query and archive its plan as `<name>_<timestamp>.json` and `.txt`.
+
+    `database` is recorded with the plan, pass the `db_fingerprint` of the
+    connection to tell the plans of different loads apart.
+    """
+    archive_dir = Path(archive_dir)
+    archive_dir.mkdir(parents=True, exist_ok=True)
+    plan = explain(conn, sql, params)
+    summary = summarize(plan, name, sql, database)
+    stem = "{}_{}".format(re.sub(r"\W", "_", name), summary.captured_at.strftime("%Y%m%dT%H%M%S"))
+    summary.file = stem + ".json"
+    with open(archive_dir / summary.file, "w") as f:
+        json.dump({"summary": summary.model_dump(mode="json"), "sql": sql, "plan": plan},
+                  f,
+                  indent=2)
+    with open(archive_dir / (stem + ".txt"), "w") as f:
+        f.write(plan_text(plan))
+    index = archive_dir / "plans.csv"
+    new = not index.exists()
+    with open(index, "a", newline="") as f:
+        writer = csv.DictWriter(f, fieldnames=list(PlanSummary.model_fields))
+        if new:
+            writer.writeheader()
+        writer.writerow(summary.model_dump(mode="json"))
+    return summary
+
+
+def read_archive(archive_dir: str | Path = DEFAULT_PLAN_DIR,
+                 name: Optional[str] = None) -> List[PlanSummary]:
+    """The captures of `plans.csv`, oldest first, only those of `name` if given"""
+    index = Path(archive_dir) / "plans.csv"
+    if not index.exists():
+        return []
+    with open(index, newline="") as f:
+        rows = [PlanSummary(**row) for row in csv.DictReader(f)]
+    return [row for row in rows if name is None or row.name == name]
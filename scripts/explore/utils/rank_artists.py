@@ -0,0 +1,143 @@
+"""
+"Best artists for a tag set" ranking, in one vectorized pass.
+
+Replaces the hand-copied `best artists for ...` CTEs of `playground.sql`. The
+target posts come from a tag expression evaluated on the `TagIndex`, and the
+posts of every artist tag are read from its bitmaps as flat (tag id, post id)
+arrays. A single polars group-by over those pairs joined with the post scores
+gives the counts and averages of all artists at once.
+
+The semantics are the ones of the materialized views: only posts created
+after `since` that are not videos, animations or comics are counted, and an
+artist needs more than `min_posts` such posts.
+"""
+from typing import Optional, List, Literal, Sequence
+from datetime import date, datetime, time, timezone
+from pathlib import Path
+from pydantic import BaseModel
+import numpy as np
+import polars as pl
+from utils.db import get_df_by_sql
+from utils.tag_index import TagIndex
+
+# `booru.view_posts_illustration_only`
+ILLUSTRATION_ONLY = "not (video or sound or animated or general:*comic or general:*4koma)"
+
+RankOrder = Literal["ratio", "avg_score", "avg_fav_count", "target_post_count", "total_post_count"]
+RANK_ORDERS: tuple[RankOrder, ...] = ("ratio", "avg_score", "avg_fav_count", "target_post_count",
+                                      "total_post_count")
+RankSource = Literal["db", "parquet"]
+
+# column order of `data/best_artists_*.csv`
+COLUMNS: List[str] = [
+    "artist_id", "tag_id", "tag_name", "target_post_count", "total_post_count", "avg_score",
+    "avg_fav_count", "ratio"
+]
+
+
+class RankOptions(BaseModel):
+    # posts created after this date only, `booru.view_modern_posts`
+    since: date = date(2015, 1, 1)
+    illustration_only: bool = True
+    # an artist needs more posts than this, `booru.view_artist_illustration_only_100`
+    min_posts: int = 100
+    min_ratio: float = 0.1
+    # artists with more target posts than this are kept whatever their ratio
+    min_target_posts: Optional[int] = None
+    min_avg_score: Optional[float] = None
+    order: RankOrder = "ratio"
+    limit: int = 500
+
+
+def tag_expression(include: Sequence[str] = (),
+                   any_of: Sequence[str] = (),
+                   exclude: Sequence[str] = (),
+                   query: Optional[str] = None) -> str:
+    """
+    Expression of posts having every `include` tag, at least one `any_of` tag
+    and none of the `exclude` tags, ANDed with a free-form `query`
+    """
+    terms = list(include)
+    if any_of:
+        terms.append("( " + " or ".join(any_of) + " )")
+    terms += [f"-{tag}" for tag in exclude]
+    if query:
+        terms.append(f"( {query} )")
+    if not terms:
+        raise ValueError("no tag given")
+    return " ".join(terms)
+
+
+async def load_posts_db(conn_info: str, since: date) -> pl.DataFrame:
+    """post_id, score and fav_count of the posts created after `since`"""
+    return await get_df_by_sql(
+        conn_info, "SELECT id AS post_id, score, fav_count FROM booru.posts "
+        f"WHERE created_at > '{since.isoformat()}'")
+
+
+async def load_artist_tags_db(conn_info: str) -> pl.DataFrame:
+    """artist_id, tag_id and tag_name of `booru.artist_tags_assoc`"""
+    return await get_df_by_sql(
+        conn_info, "SELECT ata.artist_id, ata.tag_id, t.name AS tag_name "
+        "FROM booru.artist_tags_assoc ata JOIN booru.tags t ON t.id = ata.tag_id")
+
+
+def load_posts_parquet(parquet_dir: str | Path, since: date) -> pl.DataFrame:
+    """`load_posts_db` from the `posts/year=*` files written by `dump_data.py to-parquet`"""
+    return (pl.scan_parquet(Path(parquet_dir) / "posts" / "**" / "*.parquet").filter(
+        pl.col("created_at") > datetime.combine(since, time(), timezone.utc)).select(
+            pl.col("id").alias("post_id"), "score", "fav_count").collect())
+
+
+def load_artist_tags_parquet(parquet_dir: str | Path) -> pl.DataFrame:
+    """`load_artist_tags_db` from `artists.parquet` and `tags.parquet`, joined by name"""
+    parquet_dir = Path(parquet_dir)
+    artists = pl.scan_parquet(parquet_dir / "artists.parquet").select(
+        pl.col("id").alias("artist_id"), "name")
+    tags = pl.scan_parquet(parquet_dir / "tags.parquet").filter(pl.col("category") == 1).select(
+        pl.col("id").alias("tag_id"), "name")
+    return (artists.join(tags, on="name").select("artist_id", "tag_id",
+                                                  pl.col("name").alias("tag_name")).collect())
+
+
+def rank_artists(index: TagIndex,
+                 posts: pl.DataFrame,
+                 artist_tags: pl.DataFrame,
+                 expression: str,
+                 opts: RankOptions = RankOptions()) -> pl.DataFrame:
+    """
+    Rank the artists of `artist_tags` by their posts matching `expression`.
+
+    `posts` holds post_id, score and fav_count of the candidate posts (see
+    `load_posts_db`). Returns the columns of `COLUMNS`, best first.
+    """
+    target = index.post_ids(expression)
+    if opts.illustration_only:
+        keep = index.post_ids(ILLUSTRATION_ONLY)
+        posts = posts.filter(pl.col("post_id").is_in(pl.Series(keep, dtype=pl.Int64)))
+    posts = posts.with_columns(
+        pl.col("post_id").cast(pl.Int64),
+        pl.col("post_id").is_in(pl.Series(target, dtype=pl.Int64)).alias("target"))
+    tag_ids, post_ids = index.tag_posts(artist_tags["tag_id"].unique().to_numpy())
+    pairs = pl.DataFrame({
+        "tag_id": tag_ids.astype(np.int64),
+        "post_id": post_ids.astype(np.int64),
+    })
+    is_target = pl.col("target")
+    counts = (pairs.join(posts, on="post_id").group_by("tag_id").agg(
+        pl.len().alias("total_post_count"),
+        is_target.sum().alias("target_post_count"),
+        pl.col("score").filter(is_target).mean().alias("avg_score"),
+        pl.col("fav_count").filter(is_target).mean().alias("avg_fav_count"),
+    ).filter((pl.col("total_post_count") > opts.min_posts) & (pl.col("target_post_count") > 0)))
+    ranked = counts.with_columns(
+        (pl.col("target_post_count") / pl.col("total_post_count")).alias("ratio"))
+    kept = pl.col("ratio") > opts.min_ratio
+    if opts.min_target_posts is not None:
+        kept = kept | (pl.col("target_post_count") > opts.min_target_posts)
+    if opts.min_avg_score is not None:
+        kept = kept & (pl.col("avg_score") > opts.min_avg_score)
+    artists = artist_tags.with_columns(pl.col("tag_id").cast(pl.Int64))
+    ranked = ranked.filter(kept).join(artists, on="tag_id")
+    ranked = ranked.sort([opts.order, "tag_id"], descending=[True, False])
+    return ranked.head(opts.limit).select(COLUMNS)
@@ -0,0 +1,354 @@
+"""
+Tag alias and implication graph: canonical tags and transitive implications.
+
+Both edge lists of `booru.tags_aliases` and `booru.tags_implications` are
+turned into integer arrays over the tags sorted by id (names only known as
+aliases get indexes after the tags). Alias chains are resolved by pointer
+jumping, implications are rewritten onto canonical tags, and the closure of
+every tag is computed in one pass over the strongly connected components in
+reverse topological order, each component merging the closures of the ones
+it points to. Cycles, of aliases or of implications, are reported; the tags
+of an implication cycle imply each other, a cycle counting as one step of
+the depth of an implication.
+
+The closure is kept as CSR arrays in both directions, so the tags implied by
+a tag and the tags implying it (its descendants, e.g. `cat_ears` for
+`animal_ears`) are array slices:
+
+    graph = TagGraph.load("tag_graph.npz")
+    tag_ids = graph.expand("animal_ears")
+"""
+from typing import Dict, Optional, List, Iterable, Iterator, Sequence, Any
+from pathlib import Path
+from loguru import logger
+from pydantic import BaseModel
+from psycopg import Connection
+import numpy as np
+
+
+class GraphStats(BaseModel):
+    tags: int = 0
+    aliases: int = 0
+    # aliases whose chain does not end at a tag of `booru.tags`
+    dangling_aliases: int = 0
+    implications: int = 0
+    # implications with an unknown side, between aliases of the same tag or repeated
+    dropped_implications: int = 0
+    closure_pairs: int = 0
+
+
+def to_csr(src: np.ndarray, dst: np.ndarray, n: int,
+           *values: np.ndarray) -> tuple[np.ndarray, np.ndarray, List[np.ndarray]]:
+    """`indptr`, `indices` (sorted within a row) and the values, reordered alike"""
+    order = np.lexsort((dst, src))
+    indptr = np.zeros(n + 1, dtype=np.int64)
+    np.cumsum(np.bincount(src, minlength=n), out=indptr[1:])
+    return indptr, dst[order].astype(np.int32), [v[order] for v in values]
+
+
+def resolve_aliases(parent: np.ndarray) -> tuple[np.ndarray, List[List[int]]]:
+    """
+    Follow every alias chain to its end by pointer jumping, `parent[i] == i` ends a chain.
+
+    Returns the end of each chain and the alias cycles. The nodes of a cycle, and
+    of the chains leading into one, are left unresolved.
+    """
+    original = parent
+    for _ in range(max(len(parent), 1).bit_length() + 1):
+        jumped = parent[parent]
+        if np.array_equal(jumped, parent):
+            break
+        parent = jumped
+    # a chain ending in a cycle never reaches the end of a chain
+    unstable = np.flatnonzero(original[parent] != parent)
+    cycles: List[List[int]] = []
+    done: set[int] = set()
+    for start in unstable.tolist():
+        path: Dict[int, int] = {}
+        node = start
+        while node not in path and node not in done:
+            path[node] = len(path)
+            node = int(original[node])
+        if node in path:
+            cycles.append(list(path)[path[node]:])
+        done.update(path)
+    parent[unstable] = unstable
+    return parent, cycles
+
+
+def strongly_connected(indptr: np.ndarray, indices: np.ndarray,
+                       nodes: Iterable[int]) -> List[List[int]]:
+    """Tarjan's components reachable from `nodes`, a component after every one it points to"""
+    n = len(indptr) - 1
+    index = np.full(n, -1, dtype=np.int64)
+    low = np.zeros(n, dtype=np.int64)
+    on_stack = np.zeros(n, dtype=bool)
+    stack: List[int] = []
+    components: List[List[int]] = []
+    counter = 0
+    for root in nodes:
+        if index[root] >= 0:
+            continue
+        work = [(root, int(indptr[root]))]
+        index[root] = low[root] = counter
+        counter += 1
+        stack.append(root)
+        on_stack[root] = True
+        while work:
+            node, edge = work[-1]
+            if edge < indptr[node + 1]:
+                work[-1] = (node, edge + 1)
+                child = int(indices[edge])
+                if index[child] < 0:
+                    index[child] = low[child] = counter
+                    counter += 1
+                    stack.append(child)
+                    on_stack[child] = True
+                    work.append((child, int(indptr[child])))
+                elif on_stack[child]:
+                    low[node] = min(low[node], index[child])
+                continue
+            work.pop()
+            if work:
+                parent = work[-1][0]
+                low[parent] = min(low[parent], low[node])
+            if low[node] == index[node]:
+                component = []
+                while True:
+                    member = stack.pop()
+                    on_stack[member] = False
+                    component.append(member)
+                    if member == node:
+                        break
+                components.append(component)
+    return components
+
+
+def merge_closures(parts_ids: List[np.ndarray],
+                   parts_depths: List[np.ndarray]) -> tuple[np.ndarray, np.ndarray]:
+    """Union of (tag, depth) sets keeping the smallest depth, sorted by tag"""
+    ids = np.concatenate(parts_ids)
+    depths = np.concatenate(parts_depths)
+    order = np.lexsort((depths, ids))
+    ids, depths = ids[order], depths[order]
+    first = np.ones(len(ids), dtype=bool)
+    first[1:] = ids[1:] != ids[:-1]
+    return ids[first], depths[first]
+
+
+class TagGraph:
+    """Canonical tags and implication closure over the tags sorted by id"""
+
+    def __init__(self, ids: np.ndarray, names: List[str], canonical: np.ndarray,
+                 indptr: np.ndarray, indices: np.ndarray, depths: np.ndarray,
+                 cycles: List[List[int]], alias_cycles: List[List[int]],
+                 stats: Optional[GraphStats] = None):
+        # tag ids, then -1 for the names only known as aliases
+        self.ids = ids
+        self.names = names
+        self.canonical = canonical
+        self.indptr = indptr
+        self.indices = indices
+        self.depths = depths
+        self.cycles = cycles
+        self.alias_cycles = alias_cycles
+        self.stats = stats or GraphStats()
+        self.n_tags = int(np.count_nonzero(ids >= 0))
+        src = np.repeat(np.arange(self.n_tags, dtype=np.int32), np.diff(indptr))
+        self.rev_indptr, self.rev_indices, _ = to_csr(indices, src, self.n_tags)
+        self._index = {name: i for i, name in enumerate(names)}
+
+    @classmethod
+    def build(cls, tags: Sequence[tuple[int, str]], aliases: Sequence[tuple[str, str]],
+              implications: Sequence[tuple[str, str]]) -> "TagGraph":
+        """From (id, name) tags and (antecedent, consequent) names of aliases and implications"""
+        stats = GraphStats(tags=len(tags), aliases=len(aliases), implications=len(implications))
+        tags = sorted(tags)
+        names = [name for _, name in tags]
+        index = {name: i for i, name in enumerate(names)}
+        n_tags = len(names)
+        for antecedent, consequent in aliases:
+            for name in (antecedent, consequent):
+                if name not in index:
+                    index[name] = len(names)
+                    names.append(name)
+        ids = np.full(len(names), -1, dtype=np.int32)
+        ids[:n_tags] = [tag_id for tag_id, _ in tags]
+
+        parent = np.arange(len(names), dtype=np.int64)
+        if aliases:
+            parent[[index[a] for a, _ in aliases]] = [index[c] for _, c in aliases]
+        canonical, alias_cycles = resolve_aliases(parent)
+        dangling = canonical >= n_tags
+        moved = canonical != np.arange(len(names))
+        stats.dangling_aliases = int(np.count_nonzero(dangling & moved))
+        canonical[dangling] = np.flatnonzero(dangling)
+
+        pairs = [(index.get(a, -1), index.get(c, -1)) for a, c in implications]
+        edges = np.array(pairs, dtype=np.int64).reshape(-1, 2)
+        known = (edges >= 0).all(axis=1)
+        src, dst = canonical[edges[known, 0]], canonical[edges[known, 1]]
+        kept = (src < n_tags) & (dst < n_tags) & (src != dst)
+        src, dst = src[kept], dst[kept]
+        unique = np.unique(src * len(names) + dst)
+        src, dst = unique // len(names), unique % len(names)
+        stats.dropped_implications = len(implications) - len(src)
+        indptr, indices, _ = to_csr(src, dst, n_tags)
+
+        closure_ids: Dict[int, np.ndarray] = {}
+        closure_depths: Dict[int, np.ndarray] = {}
+        cycles: List[List[int]] = []
+        for component in strongly_connected(indptr, indices, np.unique(src).tolist()):
+            members = set(component)
+            parts_ids: List[np.ndarray] = []
+            parts_depths: List[np.ndarray] = []
+            if len(component) > 1:
+                cycles.append(sorted(component))
+                parts_ids.append(np.array(component, dtype=np.int32))
+                parts_depths.append(np.ones(len(component), dtype=np.int32))
+            for node in component:
+                for child in indices[indptr[node]:indptr[node + 1]].tolist():
+                    if child in members:
+                        continue
+                    parts_ids += [np.array([child], dtype=np.int32), closure_ids.get(
+                        child, np.empty(0, dtype=np.int32))]
+                    parts_depths += [np.ones(1, dtype=np.int32), closure_depths.get(
+                        child, np.empty(0, dtype=np.int32)) + 1]
+            if not parts_ids:
+                continue
+            merged_ids, merged_depths = merge_closures(parts_ids, parts_depths)
+            for node in component:
+                own = merged_ids != node
+                closure_ids[node], closure_depths[node] = merged_ids[own], merged_depths[own]
+
+        nodes = sorted(closure_ids)
+        lengths = [len(closure_ids[node]) for node in nodes]
+        closure_src = np.repeat(np.array(nodes, dtype=np.int64), lengths)
+        closure_dst = (np.concatenate([closure_ids[node] for node in nodes])
+                       if nodes else np.empty(0, dtype=np.int32))
+        closure_depth = (np.concatenate([closure_depths[node] for node in nodes])
+                         if nodes else np.empty(0, dtype=np.int32))
+        indptr, indices, (depths,) = to_csr(closure_src, closure_dst, n_tags,
+                                           closure_depth.astype(np.int16))
+        stats.closure_pairs = len(indices)
+        alias_cycles = [[int(i) for i in cycle] for cycle in alias_cycles]
+        return cls(ids, names, canonical.astype(np.int32), indptr, indices, depths, cycles,
+                   alias_cycles, stats)
+
+    def save(self, path: str | Path) -> None:
+        """Write the arrays to an `.npz` file"""
+        arrays: Dict[str, np.ndarray] = {}
+        for key, cycles in (("cycles", self.cycles), ("alias_cycles", self.alias_cycles)):
+            arrays[f"{key}_lengths"] = np.array([len(c) for c in cycles], dtype=np.int64)
+            arrays[f"{key}_members"] = np.array([i for c in cycles for i in c], dtype=np.int64)
+        np.savez(path,
+                 ids=self.ids,
+                 names=np.frombuffer("\n".join(self.names).encode(), dtype=np.uint8),
+                 canonical=self.canonical,
+                 indptr=self.indptr,
+                 indices=self.indices,
+                 depths=self.depths,
+                 stats=np.frombuffer(self.stats.model_dump_json().encode(), dtype=np.uint8),
+                 **arrays)
+
+    @classmethod
+    def load(cls, path: str | Path) -> "TagGraph":
+        with np.load(path) as data:
+            cycles: Dict[str, List[List[int]]] = {}
+            for key in ("cycles", "alias_cycles"):
+                ends = np.cumsum(data[f"{key}_lengths"]).tolist()
+                members = data[f"{key}_members"].tolist()
+                cycles[key] = [members[end - length:end]
+                               for end, length in zip(ends, data[f"{key}_lengths"].tolist())]
+            return cls(data["ids"], data["names"].tobytes().decode().split("\n"),
+                       data["canonical"], data["indptr"], data["indices"], data["depths"],
+                       cycles["cycles"], cycles["alias_cycles"],
+                       GraphStats.model_validate_json(data["stats"].tobytes()))
+
+    def _position(self, tag_id: int) -> int:
+        i = int(np.searchsorted(self.ids[:self.n_tags], tag_id))
+        if i >= self.n_tags or self.ids[i] != tag_id:
+            raise KeyError(tag_id)
+        return i
+
+    def node(self, tag: str | int) -> int:
+        """Canonical index of a tag name or id, aliases resolved"""
+        if isinstance(tag, str):
+            i = self._index.get(tag)
+            if i is None:
+                raise KeyError(tag)
+        else:
+            i = self._position(tag)
+        node = int(self.canonical[i])
+        if node >= self.n_tags:
+            # an alias that does not lead to a tag
+            raise KeyError(tag)
+        return node
+
+    def name(self, tag_id: int) -> str:
+        return self.names[self._position(tag_id)]
+
+    def canonical_id(self, tag: str | int) -> int:
+        """Id of the tag an alias resolves to"""
+        return int(self.ids[self.node(tag)])
+
+    def implied(self, tag: str | int) -> np.ndarray:
+        """Ids of the tags a tag implies, transitively"""
+        i = self.node(tag)
+        return self.ids[self.indices[self.indptr[i]:self.indptr[i + 1]]]
+
+    def expand(self, tag: str | int) -> np.ndarray:
+        """Id of the canonical tag followed by the ids of every tag implying it"""
+        i = self.node(tag)
+        descendants = self.rev_indices[self.rev_indptr[i]:self.rev_indptr[i + 1]]
+        return np.concatenate(([self.ids[i]], self.ids[descendants]))
+
+    def canonical_rows(self) -> Iterator[tuple[str, Optional[int], int]]:
+        """(name, tag id or None, canonical id) of every alias"""
+        for i in np.flatnonzero(self.canonical != np.arange(len(self.canonical))).tolist():
+            tag_id = int(self.ids[i])
+            yield self.names[i], tag_id if tag_id >= 0 else None, int(self.ids[self.canonical[i]])
+
+    def closure_rows(self) -> Iterator[tuple[int, int, int]]:
+        """(tag id, implied tag id, depth) of the closure"""
+        src = np.repeat(self.ids[:self.n_tags], np.diff(self.indptr))
+        yield from zip(src.tolist(), self.ids[self.indices].tolist(), self.depths.tolist())
+
+    def cycle_names(self) -> List[List[str]]:
+        return [[self.names[i] for i in cycle] for cycle in self.alias_cycles + self.cycles]
+
+
+def load_graph_db(conn: Connection) -> TagGraph:
+    """
+    Build the graph from `booru.tags`, `booru.tags_aliases` and `booru.tags_implications`.
+
+    Only the active aliases and implications are edges, the deleted, retired or
+    rejected ones of the dump would add false canonical tags and cycles.
+    """
+    with conn.cursor() as c:
+        c.execute("SELECT id, name FROM booru.tags")
+        tags: List[Any] = c.fetchall()
+        c.execute("SELECT antecedent_name, consequent_name FROM booru.tags_aliases "
+                  "WHERE status = 'active' ORDER BY id")
+        aliases: List[Any] = c.fetchall()
+        c.execute("SELECT antecedent_name, consequent_name FROM booru.tags_implications "
+                  "WHERE status = 'active' ORDER BY id")
+        implications: List[Any] = c.fetchall()
+    conn.commit()
+    return TagGraph.build(tags, aliases, implications)
+
+
+def write_graph_tables(conn: Connection, graph: TagGraph) -> None:
+    """Replace `booru.tag_canonical` and `booru.tag_implication_closure`, in one transaction"""
+    with conn.cursor() as c:
+        c.execute("TRUNCATE booru.tag_canonical, booru.tag_implication_closure")
+        with c.copy("COPY booru.tag_canonical (name, tag_id, canonical_id) FROM STDIN") as copy:
+            for row in graph.canonical_rows():
+                copy.write_row(row)
+        with c.copy("COPY booru.tag_implication_closure (tag_id, implied_tag_id, depth) "
+                    "FROM STDIN") as copy:
+            for row in graph.closure_rows():
+                copy.write_row(row)
+    conn.commit()
+    logger.info("Wrote {} aliases and {} implication pairs".format(
+        sum(1 for _ in graph.canonical_rows()), len(graph.indices)))
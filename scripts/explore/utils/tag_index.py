@@ -0,0 +1,358 @@
+"""
+Inverted index of tag id -> roaring bitmap of post ids, memory-mapped from disk.
+
+The file holds the tags sorted by name (one `\\n` terminated blob, with their
+ids and categories) and one serialized roaring bitmap per tag, plus the bitmap
+of every post id so `NOT` can be evaluated. Only the bitmaps of the tags in a
+query are deserialized.
+
+Query expressions follow the danbooru search syntax with explicit operators:
+
+    pantyhose* -1boy (cameltoe or general:*pussy*)
+
+Terms next to each other are ANDed, `or` has the lowest precedence, `-term`
+and `not term` negate. `*` and `?` are wildcards on tag names, and a category
+prefix (`general:`, `artist:`, `copyright:`, `character:`, `meta:`) restricts a
+term to the tags of that category.
+"""
+from typing import Dict, Optional, List, Iterable, Iterator, NamedTuple, Any, Callable
+from bisect import bisect_left, bisect_right
+from pathlib import Path
+import mmap
+import os
+import re
+import struct
+import numpy as np
+from psycopg import Connection
+
+try:
+    from pyroaring import BitMap, FrozenBitMap
+except ImportError:    # pragma: no cover
+    BitMap = FrozenBitMap = None    # type: ignore
+
+MAGIC = b"TAGIDX01"
+# magic, tags, padding
+HEADER = struct.Struct("<8sII")
+
+CATEGORIES: Dict[str, int] = {
+    "general": 0,
+    "artist": 1,
+    "copyright": 3,
+    "character": 4,
+    "meta": 5,
+}
+
+
+def require_pyroaring() -> None:
+    if BitMap is None:
+        raise ImportError("the tag index needs pyroaring, `pip install pyroaring`")
+
+
+class TagInfo(NamedTuple):
+    id: int
+    name: str
+    category: int
+
+
+def write_tag_index(path: str | Path, tags: Iterable[TagInfo], bitmaps: Dict[int, Any],
+                    universe: Any) -> None:
+    """Write tags and their post bitmaps to an index file, atomically"""
+    require_pyroaring()
+    entries = sorted(tags, key=lambda t: t.name.encode())
+    n = len(entries)
+    names = bytearray()
+    name_offsets = np.zeros(n + 1, dtype="<u4")
+    for i, tag in enumerate(entries):
+        name_offsets[i] = len(names)
+        names += tag.name.encode() + b"\n"
+    name_offsets[n] = len(names)
+    blobs = [BitMap(bitmaps.get(tag.id, ())).serialize() for tag in entries]
+    blobs.append(BitMap(universe).serialize())
+    bitmap_offsets = np.zeros(n + 2, dtype="<u8")
+    np.cumsum([len(b) for b in blobs], out=bitmap_offsets[1:])
+    path = Path(path)
+    path.parent.mkdir(parents=True, exist_ok=True)
+    tmp = path.with_suffix(path.suffix + ".tmp")
+    with open(tmp, "wb") as f:
+        f.write(HEADER.pack(MAGIC, n, 0))
+        f.write(bitmap_offsets.tobytes())
+        f.write(np.array([t.id for t in entries], dtype="<i4").tobytes())
+        f.write(np.array([t.category for t in entries], dtype="<i4").tobytes())
+        f.write(name_offsets.tobytes())
+        f.write(names)
+        for blob in blobs:
+            f.write(blob)
+    os.replace(tmp, path)
+
+
+def build_from_posts(posts: Iterable[Dict[str, Any]], tags: Dict[str, tuple[int, int]],
+                     on_post: Callable[[], None] = lambda: None) -> tuple[Dict[int, Any], Any]:
+    """
+    Bitmaps of every tag from raw posts, `tags` maps a name to (id, category).
+
+    Returns the bitmaps by tag id and the bitmap of every post id.
+    """
+    require_pyroaring()
+    bitmaps: Dict[int, Any] = {}
+    universe = BitMap()
+    for post in posts:
+        post_id = post["id"]
+        universe.add(post_id)
+        for tag in post["tag_string"].split(" "):
+            found = tags.get(tag)
+            if found is None:
+                continue
+            bitmap = bitmaps.get(found[0])
+            if bitmap is None:
+                bitmap = bitmaps[found[0]] = BitMap()
+            bitmap.add(post_id)
+        on_post()
+    return bitmaps, universe
+
+
+def build_from_db(conn: Connection) -> tuple[List[TagInfo], Dict[int, Any], Any]:
+    """Tags, bitmaps by tag id and the bitmap of every post id from `booru.posts_tags_assoc`"""
+    require_pyroaring()
+    with conn.cursor() as c:
+        c.execute("SELECT id, name, coalesce(category, -1) FROM booru.tags")
+        tags = [TagInfo(*row) for row in c.fetchall()]
+    bitmaps: Dict[int, Any] = {}
+    with conn.cursor(name="tag_index_assoc") as c:
+        c.itersize = 1000
+        c.execute("SELECT tag_id, array_agg(post_id) FROM booru.posts_tags_assoc GROUP BY tag_id")
+        for tag_id, post_ids in c:
+            bitmaps[tag_id] = BitMap(post_ids)
+    universe = BitMap()
+    with conn.cursor(name="tag_index_posts") as c:
+        c.execute("SELECT id FROM booru.posts")
+        while rows := c.fetchmany(100_000):
+            universe.update(row[0] for row in rows)
+    conn.commit()
+    return tags, bitmaps, universe
+
+
+def glob_regex(pattern: str) -> re.Pattern[bytes]:
+    """Regex matching whole lines of the names blob against a `*`/`?` pattern"""
+    parts = [b"[^\n]*" if ch == "*" else b"[^\n]" if ch == "?" else re.escape(ch.encode())
+             for ch in pattern]
+    # every name ends with `\n`, so `*` does not match the empty end of the blob
+    return re.compile(b"^" + b"".join(parts) + b"\n", re.M)
+
+
+class TagIndex:
+    """Read-only, memory-mapped tag index"""
+
+    def __init__(self, path: str | Path):
+        require_pyroaring()
+        self.path = Path(path)
+        with open(self.path, "rb") as f:
+            self._mm = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        magic, n, _ = HEADER.unpack_from(self._mm, 0)
+        if magic != MAGIC:
+            raise ValueError(f"{self.path} is not a tag index")
+        start = HEADER.size
+        self._bitmap_offsets = np.frombuffer(self._mm, dtype="<u8", count=n + 2, offset=start)
+        start += 8 * (n + 2)
+        self.ids = np.frombuffer(self._mm, dtype="<i4", count=n, offset=start)
+        start += 4 * n
+        self.categories = np.frombuffer(self._mm, dtype="<i4", count=n, offset=start)
+        start += 4 * n
+        self._name_offsets = np.frombuffer(self._mm, dtype="<u4", count=n + 1, offset=start)
+        start += 4 * (n + 1)
+        self._names_start = start
+        self._bitmaps_start = start + int(self._name_offsets[n])
+        self._len = n
+        self._cache: Dict[int, Any] = {}
+        self._universe: Optional[Any] = None
+
+    def __len__(self) -> int:
+        return self._len
+
+    def name(self, i: int) -> str:
+        """Name of the i-th tag, in name order"""
+        return self._name_bytes(i).decode()
+
+    def _name_bytes(self, i: int) -> bytes:
+        start = self._names_start + int(self._name_offsets[i])
+        end = self._names_start + int(self._name_offsets[i + 1]) - 1
+        return self._mm[start:end]
+
+    def _bitmap(self, i: int) -> Any:
+        bitmap = self._cache.get(i)
+        if bitmap is None:
+            bitmap = self._cache[i] = self._read_bitmap(i)
+        return bitmap
+
+    def _read_bitmap(self, i: int) -> Any:
+        start = self._bitmaps_start + int(self._bitmap_offsets[i])
+        end = self._bitmaps_start + int(self._bitmap_offsets[i + 1])
+        return FrozenBitMap.deserialize(self._mm[start:end])
+
+    @property
+    def universe(self) -> Any:
+        """Bitmap of every post id"""
+        if self._universe is None:
+            self._universe = self._bitmap(self._len)
+        return self._universe
+
+    def find(self, pattern: str) -> List[int]:
+        """Entry indexes of the tags matching a name, a wildcard pattern and/or a category"""
+        category: Optional[int] = None
+        prefix, sep, rest = pattern.partition(":")
+        if sep and prefix in CATEGORIES:
+            category, pattern = CATEGORIES[prefix], rest
+        if "*" not in pattern and "?" not in pattern:
+            key = pattern.encode()
+            i = bisect_left(range(self._len), key, key=self._name_bytes)
+            found = [i] if i < self._len and self._name_bytes(i) == key else []
+        else:
+            literal = re.split(r"[*?]", pattern, maxsplit=1)[0].encode()
+            if literal:
+                # a literal prefix narrows the scan to a range of the sorted names
+                lo = bisect_left(range(self._len), literal, key=self._name_bytes)
+                hi = bisect_right(range(self._len), literal + b"\xff", key=self._name_bytes)
+            else:
+                lo, hi = 0, self._len
+            start = self._names_start + int(self._name_offsets[lo])
+            end = self._names_start + int(self._name_offsets[hi])
+            blob = self._mm[start:end]
+            offsets = self._name_offsets[lo:hi + 1] - self._name_offsets[lo]
+            found = [
+                lo + int(np.searchsorted(offsets, m.start(), side="right")) - 1
+                for m in glob_regex(pattern).finditer(blob)
+            ]
+        if category is not None:
+            found = [i for i in found if self.categories[i] == category]
+        return found
+
+    def tag_ids(self, pattern: str) -> List[int]:
+        """Tag ids matching a pattern, see `find`"""
+        return [int(self.ids[i]) for i in self.find(pattern)]
+
+    def term(self, pattern: str) -> Any:
+        """Posts having any tag matching `pattern`"""
+        return BitMap.union(BitMap(), *(self._bitmap(i) for i in self.find(pattern)))
+
+    def query(self, expression: str) -> Any:
+        """Evaluate a tag expression into a bitmap of post ids"""
+        return Parser(self, expression).parse()
+
+    def post_ids(self, expression: str) -> np.ndarray:
+        """Post ids matching a tag expression, sorted, as a numpy array"""
+        bitmap = self.query(expression)
+        return np.frombuffer(bitmap.to_array(), dtype=np.uint32)
+
+    def counts(self, entries: Iterable[int], within: Optional[Any] = None) -> np.ndarray:
+        """
+        Number of posts of each entry, only the posts in the bitmap `within` if given.
+
+        The bitmaps are read without being cached.
+        """
+        if within is None:
+            return np.array([len(self._read_bitmap(i)) for i in entries], dtype=np.int64)
+        return np.array([within.intersection_cardinality(self._read_bitmap(i)) for i in entries],
+                        dtype=np.int64)
+
+    def tag_posts(self, tag_ids: Iterable[int]) -> tuple[np.ndarray, np.ndarray]:
+        """
+        (tag id, post id) pairs of the given tags as two flat arrays, ready for a group-by.
+
+        Unknown ids are ignored. The bitmaps are read without being cached.
+        """
+        wanted = np.fromiter(tag_ids, dtype=np.int32)
+        order = np.argsort(self.ids, kind="stable")
+        pos = np.searchsorted(self.ids, wanted, sorter=order).clip(0, max(self._len - 1, 0))
+        entries = order[pos][self.ids[order[pos]] == wanted] if self._len else order
+        arrays = [np.frombuffer(self._read_bitmap(i).to_array(), dtype=np.uint32) for i in entries]
+        tag_ids = np.repeat(self.ids[entries], [len(a) for a in arrays])
+        post_ids = np.concatenate(arrays) if arrays else np.empty(0, dtype=np.uint32)
+        return tag_ids, post_ids
+
+
+def tokenize(expression: str) -> Iterator[str]:
+    """Split an expression, keeping parentheses that belong to tag names like `saber_(fate)`"""
+    for word in expression.split():
+        while word.startswith(("(", "-(")):
+            # a negated group, `-(a or b)`
+            if word[0] == "-":
+                yield "-"
+                word = word[1:]
+            yield "("
+            word = word[1:]
+        closing = 0
+        while word.endswith(")") and word.count(")") > word.count("("):
+            closing += 1
+            word = word[:-1]
+        if word:
+            yield word
+        yield from ")" * closing
+
+
+class Parser:
+    """
+    Recursive descent parser of tag expressions.
+
+        expr := and ("or" and)*
+        and  := not ("and"? not)*
+        not  := ("not" | "-") not | "(" expr ")" | term
+    """
+
+    def __init__(self, index: TagIndex, expression: str):
+        self.index = index
+        self.tokens = list(tokenize(expression))
+        self.pos = 0
+
+    def peek(self) -> Optional[str]:
+        return self.tokens[self.pos] if self.pos < len(self.tokens) else None
+
+    def take(self) -> str:
+        token = self.peek()
+        if token is None:
+            raise ValueError("unexpected end of expression")
+        self.pos += 1
+        return token
+
+    def parse(self) -> Any:
+        if not self.tokens:
+            raise ValueError("empty expression")
+        result = self.expr()
+        if self.peek() is not None:
+            raise ValueError(f"unexpected {self.peek()!r}")
+        return result
+
+    def expr(self) -> Any:
+        result = self.and_()
+        while self.peek() == "or":
+            self.take()
+            result = result | self.and_()
+        return result
+
+    def and_(self) -> Any:
+        result = self.not_()
+        while self.peek() not in (None, "or", ")"):
+            if self.peek() == "and":
+                self.take()
+            result = result & self.not_()
+        return result
+
+    def not_(self) -> Any:
+        token = self.take()
+        if token in ("not", "-"):
+            return self.index.universe - self.not_()
+        if token.startswith("-") and len(token) > 1:
+            self.tokens[self.pos - 1] = token[1:]
+            self.pos -= 1
+            return self.index.universe - self.not_()
+        if token == "(":
+            result = self.expr()
+            if self.take() != ")":
+                raise ValueError("missing )")
+            return result
+        if token == ")":
+            raise ValueError("unexpected )")
+        return self.index.term(token)
+
+
+def read_tags(tags: Iterable[Dict[str, Any]]) -> Dict[str, tuple[int, int]]:
+    """Tag name -> (id, category) from the objects of the raw tags dump"""
+    return {tag["name"]: (tag["id"], tag["category"]) for tag in tags}